@@ -5,11 +5,10 @@ import re
 from dateutil.parser import parse
 from .. import util
 from .. import geocoding_util
-import rtree
+from .. import record_store
 import json
 import os
 import argparse
-import sys
 from ..record import Record
 
 
@@ -86,14 +85,7 @@ def find_address_from_filename(filename, cached):
     return None, None, None, None, 'F'
 
 
-def snap_inter_and_non_inter(summary):
-    inter = util.read_geojson(
-        os.path.join(PROCESSED_DATA_FP, 'maps/inters_segments.geojson'))
-
-    # Create spatial index for quick lookup
-    segments_index = rtree.index.Index()
-    for idx, element in enumerate(inter):
-        segments_index.insert(idx, element.geometry.bounds)
+def snap_inter_and_non_inter(summary, processed_fp=PROCESSED_DATA_FP):
     print("Snapping tmcs to intersections")
 
     # Turn the summary into the format that works for reprojection
@@ -105,7 +97,11 @@ def snap_inter_and_non_inter(summary):
         }
         address_records.append(Record(properties))
 
-    util.find_nearest(address_records, inter, segments_index, 30, type_record=True)
+    util.find_nearest(
+        address_records,
+        util.read_segments_snapper(
+            os.path.join(processed_fp, 'maps'), get_non_inter=False),
+        30, type_record=True)
 
     # Find_nearest got the nearest intersection id, but we want to compare
     # against all segments too.  They don't always match, which may be
@@ -115,24 +111,26 @@ def snap_inter_and_non_inter(summary):
             str(address.properties['near_id'])
         address.properties['near_id'] = ''
 
-    combined_seg, segments_index = util.read_segments(os.path.join(PROCESSED_DATA_FP, 'maps'))
-    util.find_nearest(address_records, combined_seg, segments_index, 30, type_record=True)
+    util.find_nearest(
+        address_records,
+        util.read_segments_snapper(os.path.join(processed_fp, 'maps')),
+        30, type_record=True)
 
     return address_records
 
 
-def get_normalization_factor():
+def get_normalization_factor(standardized_fp=STANDARDIZED_DATA_FP):
     """
     TMC counts are only over 11 or 12 hours, always starting at 7
     Normalize using average rates of the 24 hour ATRs,
     since they're pretty consistent
     Args:
-        None
+        standardized_fp - the standardized data directory
     Returns:
         Tuple of 11 hour normalization, 12 hour normalization
     """
     counts = util.get_hourly_rates(os.path.join(
-        STANDARDIZED_DATA_FP, 'volume.json'))
+        standardized_fp, 'volume.json'))
 
     return sum(counts[7:18]), sum(counts[7:19])
 
@@ -387,21 +385,23 @@ def parse_15_min_format(workbook, sheet_name, format, sheet_name2=None):
     return [total_count, left_count, right_count, conflicts, quarter_hours]
 
 
-def parse_conflicts():
+def parse_conflicts(processed_fp=PROCESSED_DATA_FP,
+                    standardized_fp=STANDARDIZED_DATA_FP,
+                    tmc_fp=TMC_FP):
     count = 0
 
     print('getting normalization factors')
-    n_11, n_12 = get_normalization_factor()
+    n_11, n_12 = get_normalization_factor(standardized_fp)
 
     # Read geocoded cache
-    geocoded_file = os.path.join(PROCESSED_DATA_FP, 'geocoded_addresses.csv')
+    geocoded_file = os.path.join(processed_fp, 'geocoded_addresses.csv')
     cached = {}
     if path_exists(geocoded_file):
         print('reading geocoded cache file')
         cached = geocoding_util.read_geocode_cache(filename=geocoded_file)
 
     summary = []
-    for filename in listdir(TMC_FP):
+    for filename in listdir(tmc_fp):
         if filename.endswith('.XLS'):
 
             # Pull out what we can from the filename itself
@@ -416,7 +416,7 @@ def parse_conflicts():
                         address, latitude, longitude, status]
                 date = str(find_date(filename))
                 hours = num_hours(filename)
-                file_path = path.join(TMC_FP, filename)
+                file_path = path.join(tmc_fp, filename)
                 workbook = xlrd.open_workbook(file_path)
                 sheet_names = workbook.sheet_names()
 
@@ -489,7 +489,8 @@ def parse_conflicts():
     print("parsed " + str(count) + " TMC files")
     return summary
 
-if __name__ == '__main__':
+
+def main(argv=None):
 
     parser = argparse.ArgumentParser()
 
@@ -500,37 +501,38 @@ if __name__ == '__main__':
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether force update the maps')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    processed_fp = PROCESSED_DATA_FP
+    standardized_fp = STANDARDIZED_DATA_FP
+    tmc_fp = TMC_FP
     if args.datadir:
-        RAW_DATA_FP = os.path.join(args.datadir, 'raw')
-        PROCESSED_DATA_FP = os.path.join(args.datadir, 'processed')
-        STANDARDIZED_DATA_FP = os.path.join(args.datadir, 'standardized')
-        ATR_FP = os.path.join(RAW_DATA_FP, 'volume', 'ATRs')
-        TMC_FP = os.path.join(RAW_DATA_FP, 'volume', 'TMCs')
+        processed_fp = os.path.join(args.datadir, 'processed')
+        standardized_fp = os.path.join(args.datadir, 'standardized')
+        tmc_fp = os.path.join(args.datadir, 'raw', 'volume', 'TMCs')
 
-    if not os.path.exists(TMC_FP):
+    if not os.path.exists(tmc_fp):
         print("No TMC directory, skipping...")
-        sys.exit()
-    if not os.path.exists(os.path.join(STANDARDIZED_DATA_FP, 'volume.json')):
+        return
+    if not record_store.exists(os.path.join(standardized_fp, 'volume.json')):
         # At the moment this is true, but it probably can be skipped if
         # not available
         print("TMC parsing needs volume data for normalization, skipping...")
-        sys.exit
+        return
 
     address_records = []
 
     print('Parsing turning movement counts...')
-    summary_file = os.path.join(PROCESSED_DATA_FP, 'tmc_summary.json')
+    summary_file = os.path.join(processed_fp, 'tmc_summary.json')
     if not path_exists(summary_file) or args.forceupdate:
         print('Parsing tmc files...')
 
-        summary = parse_conflicts()
-        address_records = snap_inter_and_non_inter(summary)
+        summary = parse_conflicts(processed_fp, standardized_fp, tmc_fp)
+        address_records = snap_inter_and_non_inter(summary, processed_fp)
 
-        items = json.load(
-            open(os.path.join(PROCESSED_DATA_FP, 'crash_joined.json')))
+        items = record_store.read_records(
+            os.path.join(processed_fp, 'crash_joined.json'))
 
-        all_crashes, crashes_by_location = util.group_json_by_location(items)
+        _, crashes_by_location = util.group_json_by_location(items)
 
         for record in address_records:
             if record.properties['near_id'] \
@@ -547,7 +549,5 @@ if __name__ == '__main__':
         print("Read in " + str(len(address_records)) + " records")
 
 
-
-
-
-
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,12 @@
 import argparse
 from . import util
-from shapely.ops import unary_union
-from shapely.geometry import Point
+from . import profiling
+from shapely.prepared import prep
+import numpy as np
 import rtree
 import os
-from .segment import Segment
+from . import conflate
+from . import segment
 
 BASE_DIR = os.path.dirname(
     os.path.dirname(
@@ -14,6 +16,9 @@ BASE_DIR = os.path.dirname(
 PROCESSED_DATA_FP = None
 MAP_FP = None
 
+# Buffer sizes lines are matched at, smallest first
+BUFFER_SIZES = [5, 10, 20]
+
 
 def add_match_features(line, features):
     """
@@ -36,7 +41,43 @@ def add_match_features(line, features):
             line['properties'][feat] = 0
 
 
-def get_mapping(lines, features):
+def candidate_distances(lines, processes=1, flat_lines=None):
+    """
+    The furthest vertex distances both ways between each line and each
+    of its candidates, see conflate.pair_distances
+    Args:
+        lines - list of dicts with the line and its candidates,
+            see get_candidates
+        processes - number of processes to compute distances with
+        flat_lines - optional conflate.FlatLines of the lines, if they've
+            already been flattened
+    Returns:
+        the positions in the two distance arrays where each line's
+        candidates start (with the end of the last line's at the end),
+        and the two arrays
+    """
+    candidates = {}
+    line_idx = []
+    candidate_idx = []
+    for i, line in enumerate(lines):
+        for candidate in line['candidates']:
+            # Candidates are shared between lines, so flatten each once
+            key = id(candidate[0])
+            if key not in candidates:
+                candidates[key] = (len(candidates), candidate[0])
+            line_idx.append(i)
+            candidate_idx.append(candidates[key][0])
+    starts = segment.offsets([len(x['candidates']) for x in lines])
+
+    if flat_lines is None:
+        flat_lines = conflate.FlatLines([x['line'] for x in lines])
+    flat_candidates = conflate.FlatLines(
+        [x[1] for x in sorted(candidates.values(), key=lambda x: x[0])])
+    return (starts,) + conflate.pair_distances(
+        flat_lines, flat_candidates, line_idx, candidate_idx, processes)
+
+
+def get_mapping(lines, features, processes=1, flat_lines=None):
     """
     Attempts to map one or more segments of the second map to the first map
     Args:
@@ -44,98 +85,50 @@ def get_mapping(lines, features):
             the properties, the candidate overlapping lines from the new map,
             and nearby segments on the original map because we may want to
             combine two for the purposes of mapping
+        features - the features to add to the lines
+        processes - number of processes to compare lines with
+        flat_lines - optional conflate.FlatLines of the lines from the
+            first map, to share between maps mapped to it
     """
     print(len(lines))
     result_counts = [0, 0]
-    buff = 5
+
+    add_candidate_ids(lines)
+
+    # A candidate matches at a buffer size if all of its vertices are
+    # within that distance of the line
+    starts, within, contains = candidate_distances(
+        lines, processes, flat_lines)
 
     # keep track of which new segments matched at which size buffer
     buff_match = {}
 
-    new_id = 0
-    while buff <= 20:
+    for buff in BUFFER_SIZES:
         print("Looking at buffer " + str(buff))
-        for i in range(len(lines)):
-            util.track(i, 1000, len(lines))
-            if 'matches' in list(lines[i].keys()):
-                continue
-
-            matched_candidates = []
-
-            for j, candidate in enumerate(lines[i]['candidates']):
-                if 'id' not in list(lines[i]['candidates'][j][1].keys()):
-                    lines[i]['candidates'][j][1]['id'] = new_id
-                    new_id += 1
-                match = True
-
-                for coord in candidate[0].coords:
-                    if not Point(coord).within(lines[i]['line'].buffer(buff)):
-                        match = False
-                if match:
-                    matched_candidates.append((candidate, buff))
-
-                    if lines[i]['candidates'][j][1]['id'] \
-                       not in list(buff_match.keys()):
-                        buff_match[lines[i]['candidates'][j][1]['id']] = buff
-
-            if matched_candidates:
-                lines[i]['matches'] = matched_candidates
-
-        buff *= 2
-    
+        for i, line in enumerate(lines):
+            if 'matches' not in line:
+                match_candidates(line, within[starts[i]:starts[i + 1]],
+                                 buff, buff_match)
+
     # Now go through the lines that still aren't matched
     # this time, see if they are a subset of any of their candidates
-    for i in range(len(lines)):
-        matched_candidates = []
-        if 'matches' in list(lines[i].keys()):
-            continue
-        for j, candidate in enumerate(lines[i]['candidates']):
-            if 'id' not in list(lines[i]['candidates'][j][1].keys()):
-                lines[i]['candidates'][j][1]['id'] = new_id
-                new_id += 1
+    # Candidates first matched here are recorded past the largest
+    # buffer, so they don't count as a better match for other lines
+    for i, line in enumerate(lines):
+        if 'matches' not in line:
+            match_candidates(line, contains[starts[i]:starts[i + 1]],
+                             BUFFER_SIZES[-1], buff_match,
+                             BUFFER_SIZES[-1] * 2)
 
-            match = True
-            for coord in lines[i]['line'].coords:
-                if not Point(coord).within(candidate[0].buffer(20)):
-                    match = False
-            if match:
-                matched_candidates.append((candidate, 20))
-                if lines[i]['candidates'][j][1]['id'] not in list(buff_match.keys()):
-                    buff_match[lines[i]['candidates'][j][1]['id']] = buff
-        if matched_candidates:
-            lines[i]['matches'] = matched_candidates
-
-    # Remove matches that matched better on a different segment
-    # But only if there's a match for that segment already
-    for i in range(len(lines)):
-        if 'matches' in list(lines[i].keys()):
-            matches = lines[i]['matches']
-            new_matches = []
-            for (m, buff) in matches:
-                if buff_match[m[1]['id']] == buff:
-                    new_matches.append(m)
-            if new_matches:
-                lines[i]['matches'] = new_matches
-            else:
-                # Remove buffer info
-                lines[i]['matches'] = [m[0] for m in lines[i]['matches']]
+    remove_worse_matches(lines, buff_match)
 
-    orig = []
-    matched = []
-    for i, line in enumerate(lines):
-        if 'matches' in list(line.keys()) and line['matches']:
+    for line in lines:
+        if 'matches' in line and line['matches']:
             result_counts[0] += 1
-            
-            orig.append((line['line'], line['properties']))
 
             # Every single match for this line
             add_match_features(line, features)
 
-            # Add each matching line
-            # Only used for debugging purposes, take out eventually
-            for m in line['matches']:
-                matched.append((m[0], m[1]))
-
         else:
             for f in features:
                 line['properties'][f] = 0
@@ -146,33 +139,108 @@ def get_mapping(lines, features):
     print('Found matches for ' + str(percent_matched) + '% of segments')
 
 
-def get_int_mapping(lines, buffered, buffered_index):
+def add_candidate_ids(lines):
+    """
+    Number the candidates that don't have an id, in the order they're
+    first seen
+    """
+    new_id = 0
+    for line in lines:
+        for candidate in line['candidates']:
+            if 'id' not in candidate[1]:
+                candidate[1]['id'] = new_id
+                new_id += 1
+
+
+def remove_worse_matches(lines, buff_match):
+    """
+    Remove matches that matched better on a different segment
+    But only if there's a match for that segment already
+    Args:
+        lines - dicts of the lines and their matches, with the buffer
+            size each matched at
+        buff_match - dict of the buffer size each candidate first
+            matched at
+    """
+    for line in lines:
+        if 'matches' in line:
+            new_matches = [m for (m, buff) in line['matches']
+                           if buff_match[m[1]['id']] == buff]
+            if new_matches:
+                line['matches'] = new_matches
+            else:
+                # Remove buffer info
+                line['matches'] = [m[0] for m in line['matches']]
+
+
+def match_candidates(line, distances, buff, buff_match, recorded=None):
+    """
+    Match a line to its candidates within a buffer size
+    Args:
+        line - dict of the line and its candidates, see get_candidates
+        distances - the furthest vertex distance for each candidate
+        buff - buffer size
+        buff_match - dict of the buffer size each candidate first
+            matched at, updated with the candidates matched here
+        recorded - buffer size to record in buff_match, if not buff
+    """
+    matched_candidates = [
+        (candidate, buff) for candidate, distance
+        in zip(line['candidates'], distances) if distance < buff]
+    for candidate, _ in matched_candidates:
+        buff_match.setdefault(candidate[1]['id'], recorded or buff)
+    if matched_candidates:
+        line['matches'] = matched_candidates
+
+
+def get_int_mapping(lines, buffered, buffered_index, processes=1,
+                    line_buffers=None):
     """
     Gets the mappings between intersections
     Args:
         lines - the set of lines in an intersection
         buffered - the buffered lines for the intersections in the other map
         buffered_index - the rtree index
+        processes - number of processes to buffer lines with
+        line_buffers - optional dict of the lines' buffers by position,
+            filled in with the ones buffered here, to share between
+            maps mapped to the same lines
+    Returns:
+        a list of the geometry, properties, and the properties of the
+        best matching intersection in the other map (or an empty dict)
+        for each line
     """
     print("Getting intersection mappings")
 
+    # Each buffer is compared against many lines, so find its area once,
+    # when it first comes up
+    areas = {}
+
+    # Find the buffers each line intersects first, so that only lines
+    # with some get buffered themselves
+    line_candidates = int_candidates(lines, buffered, buffered_index, areas)
+
+    if line_buffers is None:
+        line_buffers = {}
+    missing = [i for i, x in enumerate(line_candidates)
+               if x and i not in line_buffers]
+    line_buffers.update(zip(missing, conflate.buffers(
+        [lines[i].geometry for i in missing], 10, processes)))
+
     line_results = []
     # Go through each line from the osm map
     for i, line in enumerate(lines):
-        util.track(i, 1000, len(lines))
-        line_buffer = line.geometry.buffer(10)
-
+        # If the new buffered intersection intersects the old one
+        # figure out how much overlap, and take the best one
         best_match = {}
         best_overlap = 0
-        for idx in buffered_index.intersection(line_buffer.bounds):
-            buffer = buffered[idx][0]
-            # If the new buffered intersection intersects the old one
-            # figure out how much overlap, and take the best one
-            if buffer.intersects(line.geometry):
-                total_area = unary_union([line_buffer, buffer]).area
-                overlap = max(
-                    line_buffer.area/total_area, buffer.area/total_area)
-                
+        candidates = line_candidates[i]
+        if candidates:
+            scores = overlap_scores(
+                line_buffers[i], line_buffers[i].area,
+                [buffered[idx][0] for idx in candidates],
+                [areas[idx] for idx in candidates])
+            for idx, overlap in zip(candidates, scores):
                 if overlap > best_overlap and overlap > .20:
                     best_overlap = overlap
                     best_match = buffered[idx][2]
@@ -186,6 +254,62 @@ def get_int_mapping(lines, buffered, buffered_index):
     return line_results
 
 
+def int_candidates(lines, buffered, buffered_index, areas):
+    """
+    Find the buffers that each line intersects
+    Args:
+        lines, buffered, buffered_index - as for get_int_mapping
+        areas - dict of the buffers' areas by position, filled in
+            with the area of each buffer that comes up
+    Returns:
+        list of the positions in buffered of each line's candidates
+    """
+    # Each buffer is compared against many lines, so prepare it once
+    prepared = {}
+    line_candidates = []
+    for i, line in enumerate(lines):
+        util.track(i, 1000, len(lines))
+        candidates = []
+        line_candidates.append(candidates)
+        # An empty line has no candidates, and its bounds can't be
+        # looked up
+        if line.geometry.is_empty:
+            continue
+        minx, miny, maxx, maxy = line.geometry.bounds
+        for idx in buffered_index.intersection(
+                (minx - 10, miny - 10, maxx + 10, maxy + 10)):
+            if idx not in prepared:
+                prepared[idx] = prep(buffered[idx][0])
+                areas[idx] = buffered[idx][0].area
+            if prepared[idx].intersects(line.geometry):
+                candidates.append(idx)
+    return line_candidates
+
+
+def overlap_scores(buffer, area, others, other_areas):
+    """
+    How much a buffer overlaps each of a list of other buffers: the
+    larger of the two buffers' areas as a fraction of their union's
+    The union's area is found from the intersection's, as the sum of
+    the areas less the intersection, which is much cheaper than
+    building the union
+    Args:
+        buffer - shapely polygon
+        area - the buffer's area
+        others - list of shapely polygons
+        other_areas - list of their areas
+    Returns:
+        array of scores, between 0 and 1
+    """
+    other_areas = np.asarray(other_areas, dtype=float)
+    intersections = np.array(
+        [buffer.intersection(other).area for other in others], dtype=float)
+    unions = area + other_areas - intersections
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.maximum(area, other_areas) / unions
+    return np.where(unions > 0, scores, 0)
+
+
 def get_candidates(buffered, buffered_index, lines):
     """
     Gets candidate matches: lines that overlap the buffer of
@@ -210,8 +334,11 @@ def get_candidates(buffered, buffered_index, lines):
         util.track(i, 1000, len(lines))
 
         # First, get candidates from new map that overlap the buffer
-        # from the original map
-        for idx in buffered_index.intersection(line.geometry.bounds):
+        # from the original map; an empty line has none, and its
+        # bounds can't be looked up
+        matches = [] if line.geometry.is_empty else \
+            buffered_index.intersection(line.geometry.bounds)
+        for idx in matches:
             buffer = buffered[idx][0]
 
             # If the new line overlaps the old line
@@ -261,7 +388,89 @@ def add_int_features(inters, int_lines, featlist):
     return indexed_inters.values()
 
 
-if __name__ == '__main__':
+class OsmMap(object):
+    """
+    The osm segments that supplemental maps are mapped to, along with
+    what's worked out from them for mapping, so that it's done once
+    however many maps there are
+    Args:
+        map_fp - the maps directory
+    """
+    def __init__(self, map_fp):
+        non_inters_file = os.path.join(map_fp, 'non_inters_segments.geojson')
+        print("Reading original map from " + non_inters_file)
+        self.non_inters = util.read_geojson(non_inters_file)
+        self.inters = util.read_geojson(
+            os.path.join(map_fp, 'inters_segments.geojson'))
+
+        self.flat_non_inters = conflate.FlatLines(
+            [x.geometry for x in self.non_inters])
+        # Intersection buffers, computed as they're needed
+        self.inter_buffers = {}
+
+    def add_features(self, new_map_fp, features, processes=1):
+        """
+        Map a supplemental map's segments to the osm segments, and add
+        its features to their properties
+        Args:
+            new_map_fp - directory of the supplemental map's segments
+            features - the features to add
+            processes - number of processes to use
+        """
+        non_inters_new_file = os.path.join(
+            new_map_fp, 'non_inters_segments.geojson')
+        print("Reading new map from " + non_inters_new_file)
+        new_buffered, new_index = buffer_segments(
+            util.read_geojson(non_inters_new_file), 20, processes)
+
+        non_ints_with_candidates = get_candidates(
+            new_buffered, new_index, self.non_inters)
+
+        print("Adding features: " + ','.join(features))
+        with profiling.step('get_mapping',
+                            rows_in=len(non_ints_with_candidates)):
+            get_mapping(non_ints_with_candidates, features, processes,
+                        self.flat_non_inters)
+
+        # Now do intersections
+        new_buffered_inter, new_index_inter = buffer_segments(
+            util.read_geojson(os.path.join(
+                new_map_fp, 'inters_segments.geojson')), 10, processes)
+
+        with profiling.step('get_int_mapping', rows_in=len(self.inters)):
+            int_results = get_int_mapping(
+                self.inters, new_buffered_inter, new_index_inter,
+                processes, self.inter_buffers)
+
+        self.inters = list(add_int_features(
+            self.inters, int_results, features))
+
+
+def buffer_segments(segments, distance, processes=1):
+    """
+    Buffer a map's segments and index the buffers
+    Args:
+        segments - list of Segments
+        distance - buffer size
+        processes - number of processes to buffer with
+    Returns:
+        a list of tuples containing the buffer, the geometry, and the
+        properties for each segment, and an rtree index of the buffers
+    """
+    buffered = [
+        (b, line.geometry, line.properties)
+        for line, b in zip(segments, conflate.buffers(
+            [x.geometry for x in segments], distance, processes))]
+    # Segments with empty geometries are kept in buffered, so positions
+    # still line up with segments, but left out of the index, which
+    # can't be given their bounds
+    bounds = [(idx, x[0].bounds, None) for idx, x in enumerate(buffered)
+              if not x[0].is_empty]
+    index = rtree.index.Index(bounds) if bounds else rtree.index.Index()
+    return buffered, index
+
+
+def main(argv=None):
     # Read osm map file
     parser = argparse.ArgumentParser()
 
@@ -270,76 +479,41 @@ if __name__ == '__main__':
         "datadir", help="base data directory containing maps generated from"
         + "open street map")
     parser.add_argument(
-        "map2dir", help="directory containing maps generated from"
+        "map2dir", nargs='?', help="directory containing maps generated from"
         + "city specific data")
     parser.add_argument("-features", "--features", nargs="+", default=[
         'AADT', 'SPEEDLIMIT', 'Struct_Cnd', 'Surface_Tp', 'F_F_Class'],
         help="List of segment features to include")
-
-    args = parser.parse_args()
-    
-    feats = args.features
+    parser.add_argument(
+        "-m", "--map", nargs="+", action="append", default=[],
+        metavar=("MAPDIR", "FEATURE"),
+        help="Another directory of maps generated from city specific "
+        + "data, and the features to include from it (by default, "
+        + "--features); can be given any number of times")
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='Number of processes to match and buffer ' +
+                        'lines with')
+
+    args = parser.parse_args(argv)
+
+    maps = [(x[0], x[1:] or args.features) for x in args.map]
+    if args.map2dir:
+        maps.insert(0, (args.map2dir, args.features))
+    if not maps:
+        parser.error("a map directory is required")
 
     PROCESSED_DATA_FP = os.path.join(args.datadir, 'processed')
     MAP_FP = os.path.join(PROCESSED_DATA_FP, 'maps')
 
-    non_inters_osm_file = os.path.join(
-        MAP_FP, 'non_inters_segments.geojson')
-    print("Reading original map from " + non_inters_osm_file)
-    osm_map_non_inter = util.read_geojson(non_inters_osm_file)
-
-    non_inters_new_file = os.path.join(
-        MAP_FP, args.map2dir, 'non_inters_segments.geojson')
-    print("Reading new map from " + non_inters_new_file)
-
-    new_map_non_inter = util.read_geojson(non_inters_new_file)
-
-    # Index for the new map
-    new_buffered = []
-    new_index = rtree.index.Index()
-
-    # Buffer all the new lines
-    for idx, new_line in enumerate(new_map_non_inter):
-        b = new_line.geometry.buffer(20)
-        new_buffered.append((b, new_line.geometry, new_line.properties))
-        new_index.insert(idx, b.bounds)
+    # All the maps are mapped to the osm segments, which are written
+    # once with every map's features
+    osm_map = OsmMap(MAP_FP)
+    for map2dir, feats in maps:
+        osm_map.add_features(
+            os.path.join(MAP_FP, map2dir), feats, args.processes)
 
-    non_ints_with_candidates = get_candidates(
-        new_buffered, new_index, osm_map_non_inter)
-
-    print("Adding features: " + ','.join(feats))
-    get_mapping(non_ints_with_candidates, feats)
-
-    non_inters = [Segment(x['line'], x['properties'])
-                  for x in non_ints_with_candidates]
-
-    # Now do intersections
-    osm_map_inter = util.read_geojson(
-        os.path.join(MAP_FP, 'inters_segments.geojson'))
-    new_map_inter = util.read_geojson(os.path.join(
-        MAP_FP, args.map2dir, 'inters_segments.geojson'))
-
-    orig_buffered_inter = []
-    orig_index_inter = rtree.index.Index()
-
-    new_buffered_inter = []
-    new_index_inter = rtree.index.Index()
-    for idx, new_line in enumerate(new_map_inter):
-        b = new_line.geometry.buffer(10)
-        new_buffered_inter.append((b, new_line.geometry, new_line.properties))
-        new_index_inter.insert(idx, b.bounds)
-
-    int_results = get_int_mapping(
-        osm_map_inter, new_buffered_inter, new_index_inter)
-
-    inters = add_int_features(
-        osm_map_inter,
-        int_results,
-        feats
-    )
-    util.write_segments(non_inters, inters, MAP_FP)
-
-
-    
+    util.write_segments(osm_map.non_inters, osm_map.inters, MAP_FP)
 
 
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,10 @@
 import argparse
 from . import util
+from . import map_store
+from . import record_store
+from . import jam_matcher
+from . import waze_store
 import os
-import json
 import geojson
 from collections import defaultdict
 from .record import Record
@@ -29,121 +32,99 @@ def get_linestring(value):
     )
 
 
-def get_features(waze_info, properties, num_snapshots):
+def match_alerts(items, road_segments):
     """
-    Given a dict with keys of segment id, and val a list of waze jams
-    (for now, just jams), the properties of a road segment, and the
-    total number of snapshots we're looking at, update the road segment's
-    properties to include features
+    Find the segment nearest each alert
     Args:
-        waze_info - dict
-        properties - dict
-        num_snapshots
-    Returns
-        properties
+        items - list of waze alerts
+        road_segments - list of Segments
+    Returns:
+        list of tuples of the nearest segment's id (or '' if none is
+        close) and the alert's type
     """
-    # Waze feature list
-    # jam_percent - percentage of snapshots that have a jam on this segment
-    if properties['segment_id'] in waze_info:
-
-        # only count one jam per snapshot on a road
-        num_jams = len(set([x['properties']['snapshotId']
-                            for x in waze_info[properties['segment_id']]]))
-        # The average jam level across all jam instances
-        avg_level_when_jammed = round(sum(
-            [x['properties']['level']
-             for x in waze_info[properties['segment_id']]]
-        )/len(waze_info[properties['segment_id']]))
-        avg_speed = round(sum(
-            [x['properties']['speed']
-             for x in waze_info[properties['segment_id']]]
-        )/len(waze_info[properties['segment_id']]))
-    else:
-        num_jams = 0
-        avg_speed = 0
-        avg_level_when_jammed = 0
-
-    # Turn into number between 0 and 100
-    properties.update(jam_percent=100*num_jams/num_snapshots)
-    properties.update(jam=1 if num_jams else 0)
-    properties.update(avg_jam_speed=avg_speed)
-    properties.update(avg_jam_level=avg_level_when_jammed)
-    
-    return properties
-
-
-def add_alerts(items, road_segments):
-
-    roads, roads_index = util.index_segments(
-        road_segments, geojson=True, segment=True)
-
     # We'll want to consider making these point-based features at some point
     items = [Record(x) for x in items
              if x['eventType'] == 'alert']
 
-    util.find_nearest(
-        items, roads, roads_index, 30, type_record=True)
+    util.find_nearest(items, road_segments, 30, type_record=True)
 
-    # Turn records into a dict
-    items_dict = defaultdict(dict)
-    for item in items:
-        if item.properties['type'] not in items_dict[item.near_id]:
-            items_dict[item.near_id][item.properties['type']] = 0
-        items_dict[item.near_id][item.properties['type']] += 1
-
-    for road in road_segments:
-        properties = road.properties
-        if properties['id'] in items_dict:
-            for key in items_dict[properties['id']].keys():
-                properties['alert_' + key] = items_dict[properties['id']][key]
+    return [(item.near_id, item.properties['type']) for item in items]
 
-        road.properties = properties
 
-    return road_segments
-
-
-def map_segments(datadir, filename, forceupdate=False):
+def read_new_records(filenames, aggregates):
     """
-    Map a set of waze segment info (jams) onto segments drawn from
-    openstreetmap: the osm_elements.geojson file
+    Read waze data a record at a time, keeping the jams and alerts from
+    snapshots that haven't been added to the totals yet
     Args:
-        datadir - directory where the city's data is found
-        filename - the filename of the json aggregated waze file
+        filenames - list of waze files, in any of the formats in
+            record_store.py
+        aggregates - WazeAggregates
     Returns:
-        nothing - just updates osm_elements.geojson and writes
-            a jams.geojson with the segments that have jams
+        the jams, the alerts, and the set of new snapshots, see
+        waze_store.snapshot_key
     """
-    items = json.load(open(filename))
-
-    # Get the total number of snapshots in the waze data
-    num_snapshots = max([x['snapshotId'] for x in items])
-
-    osm_file = os.path.join(
-        datadir,
-        'processed',
-        'maps',
-        'osm_elements.geojson'
-    )
-    road_segments, inters = util.get_roads_and_inters(osm_file)
-    if 'jam' in road_segments[0].properties and not forceupdate:
-        print("Already processed waze data")
-        return
+    jams = []
+    alerts = []
+    snapshots = set()
+    for filename in filenames:
+        # Only the records after those read last time, if the file
+        # still starts with them
+        reader = record_store.RecordReader(
+            filename, aggregates.files.get(filename))
+        for item in reader:
+            if not aggregates.is_new(item):
+                continue
+            snapshots.add(waze_store.snapshot_key(item))
+            if item['eventType'] == 'jam':
+                jams.append(item)
+            elif item['eventType'] == 'alert':
+                alerts.append(item)
+        if reader.resumed:
+            print("Read {} from where it was read to before".format(
+                filename))
+        aggregates.files[filename] = reader.watermark
+    return jams, alerts, snapshots
+
+
+def update_features(road_segments, aggregates):
+    """
+    Refresh the road segments' waze features from the totals
+    Returns:
+        whether any segment's features changed
+    """
+    changed = False
+    for road in road_segments:
+        before = dict(road.properties)
+        aggregates.features(road.properties)
+        changed = changed or road.properties != before
+    return changed
 
-    # Add jam and alert information
-    road_segments, roads_with_jams = add_jams(
-        items, road_segments, inters, num_snapshots)
-    road_segments = add_alerts(items, road_segments)
 
+def write_maps(road_segments, inters, osm_file, jams_file):
+    """
+    Write osm_elements.geojson with the road segments' new features,
+    and the segments with jams to jams.geojson
+    Args:
+        road_segments - list of Segments
+        inters - list of intersection records, with shapely points
+        osm_file - osm_elements.geojson
+        jams_file - jams.geojson
+    """
     # Convert into format that util.prepare_geojson is expecting
     geojson_roads = []
-    for road in road_segments:
-        geojson_roads.append({
+    jam_indices = []
+    for i, road in enumerate(road_segments):
+        geojson_road = {
             'geometry': {
                 'coordinates': [x for x in road.geometry.coords],
                 'type': 'LineString'
             },
             'properties': road.properties
-        })
+        }
+        geojson_roads.append(geojson_road)
+        if road.properties['jam']:
+            jam_indices.append(i)
+
     # Convert this back to geojson from shapely point
     inters = [{
         'geometry': {
@@ -153,91 +134,117 @@ def map_segments(datadir, filename, forceupdate=False):
         'properties': x['properties']
     } for x in inters]
 
-    results = util.prepare_geojson(geojson_roads + inters)
+    # Serialized once, for both files
+    features = util.dump_features(
+        util.prepare_geojson(geojson_roads + inters)['features'])
+    util.write_features(features, osm_file)
+    map_store.write_records(geojson_roads + inters, osm_file)
 
-    with open(osm_file, 'w') as outfile:
-        geojson.dump(results, outfile)
+    util.write_features([features[i] for i in jam_indices], jams_file)
 
-    jam_results = util.prepare_geojson(roads_with_jams)
 
-    with open(os.path.join(
-            datadir,
-            'processed',
-            'maps',
-            'jams.geojson'), 'w') as outfile:
-        geojson.dump(jam_results, outfile)
-
-
-def add_jams(items, road_segments, inters, num_snapshots):
+def map_segments(datadir, filenames, forceupdate=False, processes=1):
+    """
+    Map a set of waze segment info (jams) onto segments drawn from
+    openstreetmap: the osm_elements.geojson file
+    Only snapshots that haven't been added before are mapped, and added
+    to the running totals in processed/waze_aggregates.json, which the
+    segments' features are then refreshed from; the maps are only
+    written again if some segment's features changed
+    Args:
+        datadir - directory where the city's data is found
+        filenames - list of json aggregated waze files (or a single
+            one), in any of the formats in record_store.py
+        forceupdate - whether to start the totals over, adding all
+            of the waze data again
+        processes - number of processes to match jams with
+    Returns:
+        nothing - just updates osm_elements.geojson and writes
+            a jams.geojson with the segments that have jams
+    """
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    osm_file = os.path.join(
+        datadir,
+        'processed',
+        'maps',
+        'osm_elements.geojson'
+    )
+    road_segments, inters = util.get_roads_and_inters(osm_file)
 
-    # Only look at jams for now
-    items = [get_linestring(x) for x in items
-             if x['eventType'] == 'jam']
-    items = util.reproject_records(items)
+    store_file = os.path.join(datadir, 'processed', waze_store.FILENAME)
+    roads = waze_store.roads_key(road_segments)
+    if forceupdate:
+        aggregates = waze_store.WazeAggregates(roads)
+    else:
+        aggregates = waze_store.WazeAggregates.load(store_file, roads)
+
+    jams, alerts, snapshots = read_new_records(filenames, aggregates)
+    jams_file = os.path.join(datadir, 'processed', 'maps', 'jams.geojson')
+    written = road_segments and 'jam' in road_segments[0].properties \
+        and os.path.exists(jams_file)
+    if not snapshots and written:
+        print("No new waze data")
+        # Still save how far the files have been read
+        aggregates.save(store_file)
+        return
+    print("Adding {} new snapshots to {} already added".format(
+        len(snapshots), len(aggregates.snapshots)))
 
-    # Get roads_and_inters returns elements that have shapely geometry
-    # In order to output the unchanged points back out at the end,
-    # Need to convert to geojson
-    # This is something that should be addressed
-    inters = [{'properties': x['properties'], 'geometry': {
-        'type': 'Point',
-        'coordinates': [x['geometry'].x, x['geometry'].y]
-    }} for x in inters]
-    
-    roads, roads_index = util.index_segments(
-        road_segments, geojson=True, segment=True)
+    # Add jam and alert information
+    aggregates.add_snapshots(snapshots)
+    aggregates.add_jams(match_jams(jams, road_segments, processes))
+    aggregates.add_alerts(match_alerts(alerts, road_segments))
 
-    road_buffers = []
+    if update_features(road_segments, aggregates) or not written:
+        write_maps(road_segments, inters, osm_file, jams_file)
+    else:
+        print("No segment's waze features changed")
 
-    for road in roads:
-        road_buffers.append(road.geometry.buffer(3))
+    # Saved last, so that if anything above fails,
+    # the new snapshots are added again next time
+    aggregates.save(store_file)
 
-    print("read in {} road segments".format(len(roads)))
 
-    waze_info = defaultdict(list)
-    count = 0
+def match_jams(items, road_segments, processes=1):
+    """
+    Find the segments each jam is on
+    Args:
+        items - list of waze jams
+        road_segments - list of Segments
+        processes - number of processes to match jams with
+    Returns:
+        dict of segment_id to the list of jams on the segment
+    """
+    # Only look at jams for now
+    items = [x for x in items if x['eventType'] == 'jam']
 
+    # The same jam is usually in many snapshots, so each distinct line
+    # (on a distinct street) is only reprojected and matched once
+    keys = {}
+    item_keys = []
     for item in items:
-        count += 1
-
-        if item['properties']['eventType'] == 'jam':
-            for idx in roads_index.intersection(item['geometry'].bounds):
-                segment = roads[idx]
-                buff = road_buffers[idx]
-
-                # But if the roads share a name,
-                # increase buffer size, in case of a median segment
-                # Waze does not appear to specify which direction
-                if 'street' in item['properties'] and segment.properties['name'] and \
-                   item['properties']['street'].split()[0] == segment.properties['name'].split()[0]:
-                    buff = segment.geometry.buffer(10)
-                overlap = buff.intersection(item['geometry'])
-
-                if not overlap.length or \
-                   (overlap.length < 20 and segment.geometry.length > 20):
-                    # Skip segments with no overlap
-                    # or very short overlaps
-                    continue
-                waze_info[segment.properties['segment_id']].append(item)
-    # Add waze features
-    roads_with_jams = []
+        key = (tuple((x['x'], x['y']) for x in item['line']),
+               jam_matcher.first_word(item.get('street')))
+        item_keys.append(keys.setdefault(key, len(keys)))
+    lines = util.reproject_records([{
+        'geometry': {'type': 'LineString', 'coordinates': list(key[0])},
+        'properties': {},
+    } for key in keys])
+    print("read in {} jams, {} distinct".format(len(items), len(keys)))
+
+    matcher = jam_matcher.JamMatcher(road_segments, processes)
+    print("read in {} road segments".format(len(road_segments)))
+    matches = matcher.match_all([
+        (line['geometry'], key[1]) for line, key in zip(lines, keys)
+    ], processes)
 
-    for road in road_segments:
-        properties = get_features(
-            waze_info,
-            road.properties,
-            num_snapshots
-        )
-        road.properties = properties
-        if properties['segment_id'] in waze_info:
-            roads_with_jams.append({
-                    'geometry': {
-                        'coordinates': [x for x in road.geometry.coords],
-                        'type': 'LineString'
-                    },
-                    'properties': properties
-            })
-    return road_segments, roads_with_jams
+    waze_info = defaultdict(list)
+    for item, key in zip(items, item_keys):
+        for idx in matches[key]:
+            waze_info[road_segments[idx].properties['segment_id']].append(
+                item)
+    return waze_info
 
 
 def make_map(filename, datadir):
@@ -251,25 +258,36 @@ def make_map(filename, datadir):
         filename - input json file
         datadir - directory to write the waze.geojson file out
     """
-    items = json.load(open(filename))
     geojson_items = []
-    for item in items:
+    for item in record_store.iter_records(filename):
         if item['eventType'] == 'jam':
             geojson_items.append(get_linestring(item))
     with open(os.path.join(datadir, 'waze.geojson'), 'w') as outfile:
         geojson.dump(geojson.FeatureCollection(geojson_items), outfile)
 
 
-if __name__ == '__main__':
+def main(argv=None):
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-d", "--datadir", type=str,
                         help="data directory")
+    parser.add_argument("-f", "--filenames", nargs="+",
+                        help="waze files to add, by default the " +
+                        "standardized waze.json")
     parser.add_argument('--forceupdate', action='store_true',
-                        help='Whether to force update of the waze data')
+                        help='Whether to add all of the waze data again, ' +
+                        'instead of only the snapshots not added before')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='Number of processes to match jams with')
+
+    args = parser.parse_args(argv)
 
-    args = parser.parse_args()
+    infiles = args.filenames or [
+        os.path.join(args.datadir, 'standardized', 'waze.json')]
+#    make_map(infiles[0], os.path.join(args.datadir, 'processed', 'maps'))
+    map_segments(args.datadir, infiles, forceupdate=args.forceupdate,
+                 processes=args.processes)
 
-    infile = os.path.join(args.datadir, 'standardized', 'waze.json')
-#    make_map(infile, os.path.join(args.datadir, 'processed', 'maps'))
-    map_segments(args.datadir, infile, forceupdate=args.forceupdate)
+
+if __name__ == '__main__':
+    main()
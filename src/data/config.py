@@ -45,6 +45,20 @@ class Configuration(object):
                or config['map_geography'] != 'shapefile':
                 sys.exit('If boundary_shapefile is set, map_geography must be shapefile')
 
+        # Optional local OpenStreetMap extract (.osm.pbf or .osm) to build
+        # the map from, instead of downloading it; relative paths are
+        # relative to the city's raw/maps directory
+        self.osm_extract = config['osm_extract'] \
+            if 'osm_extract' in config and config['osm_extract'] else None
+
+        # Format of the standardized records and crash_joined: json (a
+        # single list), jsonl (a record per line) or jsonl.gz
+        self.record_format = config['record_format'] \
+            if 'record_format' in config and config['record_format'] \
+            else 'json'
+        if self.record_format not in ['json', 'jsonl', 'jsonl.gz']:
+            sys.exit('record_format must be one of json, jsonl or jsonl.gz')
+
         self.default_features, self.categorical_features, \
             self.continuous_features = self.get_feature_list(config)
 
@@ -61,6 +75,7 @@ class Configuration(object):
         self.additional_map_features = config['additional_map_features'] \
             if 'additional_map_features' in config \
                else None
+        self.extra_maps = self.get_extra_maps(config)
         if 'atr' in config and config['atr'] and 'atr_cols' in config and config['atr_cols']:
             self.atr = config['atr']
             self.atr_cols = ['speed_coalesced', 'volume_coalesced']
@@ -82,6 +97,39 @@ class Configuration(object):
                 self.split_columns += crash_value['optional']['split_columns'].keys()
 
         
+    def get_extra_maps(self, config):
+        """
+        The supplemental maps whose features are added to the segments,
+        see add_map
+        Args:
+            Config - the city's config file
+        Returns:
+            list of dicts with the map's name (the directory its
+            segments are written to), filename, and the features to take
+            from it (None for add_map's defaults)
+        """
+        additional = self.additional_map_features or {}
+        extra_maps = []
+        # A single extra map is named after the city
+        if additional.get('extra_map'):
+            extra_maps.append({
+                'name': self.city.split(',')[0],
+                'filename': additional['extra_map'],
+                'features': None,
+            })
+        for extra_map in additional.get('extra_maps') or []:
+            if not extra_map.get('name') or not extra_map.get('filename'):
+                sys.exit('Each of extra_maps needs a name and a filename')
+            extra_maps.append({
+                'name': str(extra_map['name']),
+                'filename': extra_map['filename'],
+                'features': extra_map.get('features'),
+            })
+        names = [x['name'] for x in extra_maps]
+        if len(set(names)) != len(names):
+            sys.exit('The names of extra maps must be different')
+        return extra_maps
+
     def get_feature_list(self, config):
         """
         Make the list of features, and write it to the city's data folder
@@ -0,0 +1,223 @@
+"""
+Vectorized distances between the lines of two maps, for conflating them
+
+Matching a line from one map to a line from another comes down to how
+far the vertices of one are from the other: a line lies within a buffer
+of another exactly when its furthest vertex is closer than the buffer
+size. Rather than buffering lines and testing vertices one at a time,
+the lines are flattened once into arrays of vertices and straight line
+pieces, and the furthest vertex distance is computed for a whole list of
+line pairs with numpy, so that any number of buffer sizes can then be
+compared against the same distances.
+"""
+import multiprocessing
+import numpy as np
+from .segment import offsets, ranges
+from .snap import geometry_coords, point_piece_distance
+
+
+# Max number of vertex to piece distances computed at a time,
+# to bound memory use
+CHUNK_SIZE = 1 << 22
+
+
+class FlatLines(object):
+    """
+    The vertices and straight line pieces of a list of geometries
+    The vertices of geometry i are vertices[vertex_offsets[i]:
+    vertex_offsets[i + 1]], and its pieces likewise with piece_offsets
+    Args:
+        geometries - list of shapely geometries
+    """
+    def __init__(self, geometries):
+        vertices = []
+        starts = []
+        ends = []
+        vertex_counts = np.zeros(len(geometries), dtype=np.int64)
+        piece_counts = np.zeros(len(geometries), dtype=np.int64)
+        for i, geometry in enumerate(geometries):
+            for coords in geometry_coords(geometry):
+                vertices.append(coords)
+                vertex_counts[i] += len(coords)
+                if len(coords) == 1:
+                    # A single point, treated as a zero length piece
+                    coords = np.vstack([coords, coords])
+                starts.append(coords[:-1])
+                ends.append(coords[1:])
+                piece_counts[i] += len(coords) - 1
+
+        self.vertices = np.vstack(vertices) if vertices else np.zeros((0, 2))
+        self.starts = np.vstack(starts) if starts else np.zeros((0, 2))
+        self.ends = np.vstack(ends) if ends else np.zeros((0, 2))
+        self.vertex_offsets = offsets(vertex_counts)
+        self.piece_offsets = offsets(piece_counts)
+
+    def __len__(self):
+        return len(self.vertex_offsets) - 1
+
+    def vertex_counts(self, idx):
+        return np.diff(self.vertex_offsets)[idx]
+
+    def piece_counts(self, idx):
+        return np.diff(self.piece_offsets)[idx]
+
+
+def max_distances(sources, targets, source_idx, target_idx):
+    """
+    For each pair of lines, the furthest any vertex of the source line
+    is from the target line
+    Args:
+        sources, targets - FlatLines
+        source_idx, target_idx - arrays of positions in sources and
+            targets, one pair of lines per position
+    Returns:
+        array of distances; 0 for a source line without vertices, and
+        inf for a target line without any (unless the source has none)
+    """
+    source_idx = np.asarray(source_idx, dtype=np.int64)
+    target_idx = np.asarray(target_idx, dtype=np.int64)
+    distances = np.zeros(len(source_idx))
+    for start, end in chunk_bounds(sources, targets, source_idx, target_idx):
+        distances[start:end] = _max_distances_chunk(
+            sources, targets, source_idx[start:end], target_idx[start:end])
+    return distances
+
+
+def chunk_bounds(sources, targets, source_idx, target_idx):
+    """
+    Split a list of pairs into consecutive chunks of about CHUNK_SIZE
+    vertex to piece distances each
+    Returns:
+        list of start and end positions
+    """
+    sizes = sources.vertex_counts(source_idx) \
+        * targets.piece_counts(target_idx)
+    totals = np.cumsum(sizes)
+    bounds = []
+    start = 0
+    while start < len(sizes):
+        done = totals[start - 1] if start else 0
+        # At least one pair, however big
+        end = max(start + 1, int(np.searchsorted(
+            totals, done + CHUNK_SIZE, side='right')))
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def _max_distances_chunk(sources, targets, source_idx, target_idx):
+    vertex_counts = sources.vertex_counts(source_idx)
+    piece_counts = targets.piece_counts(target_idx)
+    distances = np.where(vertex_counts > 0, np.inf, 0.0)
+    valid = (vertex_counts > 0) & (piece_counts > 0)
+    if not valid.any():
+        return distances
+    vertex_counts = vertex_counts[valid]
+    piece_counts = piece_counts[valid]
+
+    # A row for each vertex of each pair's source line
+    row_pairs = np.repeat(np.arange(len(vertex_counts)), vertex_counts)
+    row_vertices = ranges(
+        sources.vertex_offsets[source_idx[valid]], vertex_counts)
+    # And in each row, an element for each piece of the pair's target line
+    row_pieces = piece_counts[row_pairs]
+    element_rows = np.repeat(np.arange(len(row_pairs)), row_pieces)
+    element_pieces = ranges(
+        targets.piece_offsets[target_idx[valid]][row_pairs], row_pieces)
+
+    vertices = sources.vertices[row_vertices][element_rows]
+    vertex_distances = np.minimum.reduceat(
+        point_piece_distance(
+            vertices[:, 0], vertices[:, 1],
+            targets.starts[element_pieces], targets.ends[element_pieces]),
+        offsets(row_pieces)[:-1])
+    distances[valid] = np.maximum.reduceat(
+        vertex_distances, offsets(vertex_counts)[:-1])
+    return distances
+
+
+# The lines and pairs a worker process computes distances for,
+# see pair_distances
+_worker_args = None
+
+
+def _init_worker(*args):
+    global _worker_args
+    _worker_args = args
+
+
+def _pair_distances_chunk(bounds):
+    lines, candidates, line_idx, candidate_idx = _worker_args
+    start, end = bounds
+    return start, (
+        max_distances(candidates, lines, candidate_idx[start:end],
+                      line_idx[start:end]),
+        max_distances(lines, candidates, line_idx[start:end],
+                      candidate_idx[start:end]))
+
+
+def pair_distances(lines, candidates, line_idx, candidate_idx,
+                   processes=1):
+    """
+    The furthest vertex distances both ways between pairs of lines
+    Args:
+        lines, candidates - FlatLines of the two maps
+        line_idx, candidate_idx - arrays of positions in lines and
+            candidates, one pair of lines per position
+        processes - number of processes to use; if more than one, the
+            pairs are split into chunks and run in a process pool
+    Returns:
+        two arrays: for each pair, the furthest any vertex of the
+        candidate is from the line, and the furthest any vertex of
+        the line is from the candidate
+    """
+    line_idx = np.asarray(line_idx, dtype=np.int64)
+    candidate_idx = np.asarray(candidate_idx, dtype=np.int64)
+    if processes <= 1 or len(line_idx) < 2:
+        return (max_distances(candidates, lines, candidate_idx, line_idx),
+                max_distances(lines, candidates, line_idx, candidate_idx))
+
+    # A few chunks per process, to even out the work
+    num_chunks = min(processes * 4, len(line_idx))
+    bounds = np.linspace(0, len(line_idx), num_chunks + 1).astype(int)
+    candidate_distances = np.zeros(len(line_idx))
+    line_distances = np.zeros(len(line_idx))
+    with multiprocessing.Pool(
+            processes, initializer=_init_worker,
+            initargs=(lines, candidates, line_idx, candidate_idx)) as pool:
+        for start, (from_candidates, from_lines) in pool.imap_unordered(
+                _pair_distances_chunk, list(zip(bounds[:-1], bounds[1:]))):
+            candidate_distances[start:start + len(from_candidates)] = \
+                from_candidates
+            line_distances[start:start + len(from_lines)] = from_lines
+    return candidate_distances, line_distances
+
+
+def _buffer_chunk(args):
+    geometries, distance = args
+    return [x.buffer(distance) for x in geometries]
+
+
+def buffers(geometries, distance, processes=1):
+    """
+    Buffer a list of geometries, which for lines with several parts
+    takes far longer than anything else done with them
+    Args:
+        geometries - list of shapely geometries
+        distance - buffer size
+        processes - number of processes to use; if more than one, the
+            geometries are split into chunks and buffered in a
+            process pool
+    Returns:
+        list of the buffers, in the same order
+    """
+    if processes <= 1 or len(geometries) < 2:
+        return [x.buffer(distance) for x in geometries]
+
+    num_chunks = min(processes * 4, len(geometries))
+    bounds = np.linspace(0, len(geometries), num_chunks + 1).astype(int)
+    with multiprocessing.Pool(processes) as pool:
+        chunks = pool.map(_buffer_chunk, [
+            (geometries[start:end], distance)
+            for start, end in zip(bounds[:-1], bounds[1:])])
+    return [x for chunk in chunks for x in chunk]
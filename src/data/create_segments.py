@@ -8,9 +8,14 @@
 import rtree
 import json
 import copy
+import itertools
+import math
+import multiprocessing
 from shapely.ops import unary_union
 from collections import defaultdict
 from . import util
+from . import profiling
+from . import record_store
 import argparse
 import os
 import re
@@ -34,6 +39,9 @@ def get_intersection_buffers(intersections, intersection_buffer_units,
                              debug=False):
     """
     Buffers intersection according to proj units
+    Intersections whose buffers overlap are clustered first, using a
+    spatial hash with cells twice the buffer size and union-find, and
+    only the buffers in each cluster are unioned
     Args:
         intersections
         intersection_buffer_units - in meters
@@ -41,104 +49,340 @@ def get_intersection_buffers(intersections, intersection_buffer_units,
     Returns:
         a list of polygons, buffering the intersections
         these are circles, or groups of overlapping circles
+        in order of the first intersection in each, which is the order
+        intersection ids are given in
     """
+    buffers = [intersection['geometry'].buffer(intersection_buffer_units)
+               for intersection in intersections]
+
+    # Buffers can only overlap when their intersections are closer
+    # than twice the buffer size, so are in neighbouring cells
+    cell_size = 2 * intersection_buffer_units
+    parents = list(range(len(intersections)))
+    cells = defaultdict(list)
+    for i, intersection in enumerate(intersections):
+        x, y = intersection['geometry'].x, intersection['geometry'].y
+        cell_x = int(math.floor(x / cell_size))
+        cell_y = int(math.floor(y / cell_size))
+        for cell in itertools.product(range(cell_x - 1, cell_x + 2),
+                                      range(cell_y - 1, cell_y + 2)):
+            for j in cells[cell]:
+                other = intersections[j]['geometry']
+                if math.hypot(x - other.x, y - other.y) < cell_size \
+                   and buffers[i].intersects(buffers[j]):
+                    join_roots(parents, i, j)
+        cells[(cell_x, cell_y)].append(i)
+
+    clusters = defaultdict(list)
+    for i in range(len(intersections)):
+        clusters[find_root(parents, i)].append(i)
 
-    buffered_intersections = [intersection['geometry'].buffer(
-        intersection_buffer_units) for intersection in intersections]
+    results = []
+    for root in sorted(clusters.keys()):
+        members = clusters[root]
+        if len(members) == 1:
+            buff = buffers[root]
+        else:
+            buff = unary_union([buffers[i] for i in members])
+        results.append(IntersectionBuffer(buff, [
+            Record(intersections[i]['properties'],
+                   point=intersections[i]['geometry'])
+            for i in members
+        ]))
 
-    buffered_intersections = unary_union(buffered_intersections)
     if debug:
         util.output_from_shapes(
-            [(x, {}) for x in buffered_intersections],
+            [(x.buffer, {}) for x in results],
             os.path.join(MAP_FP, 'int_buffers.geojson')
         )
 
-    results = []
+    return results
 
-    # Index the intersection points for fast lookup
-    inter_index = rtree.index.Index()
-    for idx, inter_point in enumerate(intersections):
-        inter_index.insert(idx, inter_point['geometry'].bounds)
 
-    # Get the points that overlap with the buffers
-    for buff in buffered_intersections:
-        matches = []
-        for idx in inter_index.intersection(buff.bounds):
-            if intersections[idx]['geometry'].within(buff):
-                matches.append(Record(
-                    intersections[idx]['properties'],
-                    point=intersections[idx]['geometry']
-                    
-                ))
+def find_root(parents, i):
+    """
+    Find the root of an item in a union-find forest, halving the
+    path to it along the way
+    Args:
+        parents - list of each item's parent position
+        i - the item's position
+    Returns:
+        the position of the root
+    """
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
 
-        results.append(IntersectionBuffer(buff, matches))
 
-    return results
+def join_roots(parents, i, j):
+    """
+    Merge the sets of two items in a union-find forest. The lower
+    root becomes the root of the merged set, so roots don't depend
+    on the order items are joined in
+    """
+    i = find_root(parents, i)
+    j = find_root(parents, j)
+    if i < j:
+        parents[j] = i
+    elif j < i:
+        parents[i] = j
 
 
-def get_connections(points, segments):
+def end_points(geometry):
+    """
+    Get the end points of each part of a geometry
+    Args:
+        geometry - a shapely geometry
+    Returns:
+        a list of x, y tuples
+    """
+    if geometry.is_empty:
+        return []
+    if geometry.type == 'Point':
+        return [(geometry.x, geometry.y)]
+    if geometry.type in ('LineString', 'LinearRing'):
+        return [geometry.coords[0], geometry.coords[-1]]
+    if hasattr(geometry, 'geoms'):
+        return [x for part in geometry.geoms for x in end_points(part)]
+    return []
+
+
+def get_connections(points, segments, tolerance=.0001):
     """
     Gets intersections by looking at the connections between points
     and segments that fall within an intersection buffer
+    Points and segments are joined into connected components: a segment
+    is connected to the points it passes within tolerance of, and to the
+    segments it passes within tolerance of, whether they share an end
+    point, one ends on the other, or they cross
     Args:
         points - a list of points
         segments - a list of segment objects
+        tolerance - distance within which things are connected
     Returns:
-        A list of tuples for each intersection.
+        A list of tuples for each intersection, i.e. each component
+        with a point in it, in order of the first point in each.
         Each tuple contains a set of segment objects
         and the buffer of the unary_union of the segment objects
         with a little bit of padding, because of a slight precision error
         in shapely operations
     """
-    # Create a dict with each intersection point's coords as key
-    # The values are the point itself and an empty list that will
-    # store all the linestrings with a connection to the point
-    inters = []
-
-    for p in points:
-        inters.append([p.point, []])
-
-    # Get a starting list of all lines that touch any of the
-    # intersection points
-    for line in segments:
-        for i, (curr_shape, _) in enumerate(inters):
-            if line.geometry.distance(curr_shape) < .0001:
-                inters[i][1].append(line)
-                inters[i][0] = unary_union([inters[i][0], line.geometry])
-
-    # Merge connected components
-    resulting_inters = []
-    connected_lines = []
-    while inters:
-        curr = inters.pop(0)
-        if inters:
-            connected = [x[1] for x in inters if x[0].intersects(
-                    curr[0]
-            )]
-
-            if connected:
-                connected_lines = set(
-                    curr[1] + [x for y in connected for x in y]
-                )
-            else:
-                connected_lines = set(curr[1])
-        else:
-            connected_lines = set(curr[1])
-        inters = [x for x in inters if not x[0].intersects(curr[0])]
-        
-        resulting_inters.append((connected_lines, unary_union(
-            [x.geometry for x in connected_lines]).buffer(.001)
-        ))
+    # Positions in the forest are the points, then the segments
+    parents = list(range(len(points) + len(segments)))
+
+    # Shared end points are by far the most common connection, and
+    # are found without comparing geometries
+    ends = [(i, p.point.x, p.point.y) for i, p in enumerate(points)]
+    for i, segment in enumerate(segments):
+        ends.extend((len(points) + i, x[0], x[1])
+                    for x in end_points(segment.geometry))
+    join_ends(parents, ends, tolerance)
+
+    # Then anything else within tolerance of a segment: points and end
+    # points in the middle of it, and segments crossing it
+    join_touching(parents, points, segments, tolerance)
+
+    components = {}
+    for i in range(len(points)):
+        components.setdefault(find_root(parents, i), set())
+    for j, segment in enumerate(segments):
+        root = find_root(parents, len(points) + j)
+        if root in components:
+            components[root].add(segment)
+
+    return [
+        (connected_lines, unary_union(
+            [x.geometry for x in connected_lines]).buffer(.001))
+        for _, connected_lines in sorted(components.items())
+    ]
+
+
+def join_ends(parents, ends, tolerance):
+    """
+    Join points that are within tolerance of each other
+    Each point is hashed by the grid cell it falls in, with cells the
+    size of the tolerance, and only compared with the points in its
+    cell and the neighbouring cells
+    Args:
+        parents - union-find forest, see find_root
+        ends - list of (position in the forest, x, y) tuples
+        tolerance - distance within which points are joined
+    """
+    cells = defaultdict(list)
+    for i, x, y in ends:
+        cell_x = int(math.floor(x / tolerance))
+        cell_y = int(math.floor(y / tolerance))
+        for cell in itertools.product(range(cell_x - 1, cell_x + 2),
+                                      range(cell_y - 1, cell_y + 2)):
+            for j, other_x, other_y in cells[cell]:
+                if math.hypot(x - other_x, y - other_y) < tolerance:
+                    join_roots(parents, i, j)
+        cells[(cell_x, cell_y)].append((i, x, y))
+
+
+def join_touching(parents, points, segments, tolerance):
+    """
+    Join segments to the points and segments within tolerance of them,
+    checking bounds before distances, and skipping segments that are
+    already joined
+    Args:
+        parents - union-find forest of the points, then the segments
+        points - a list of points
+        segments - a list of segment objects
+        tolerance - distance within which things are joined
+    """
+    bounds = [None if x.geometry.is_empty else padded_bounds(
+        x.geometry.bounds, tolerance) for x in segments]
+    others = [(i, p.point) for i, p in enumerate(points)] + [
+        (len(points) + j, x.geometry) for j, x in enumerate(segments)]
+    for j, segment in enumerate(segments):
+        if bounds[j] is None:
+            continue
+        # Each pair of segments is only compared once
+        for i, other in others[:len(points) + j]:
+            if find_root(parents, i) == find_root(parents, len(points) + j) \
+               or other.is_empty \
+               or not bounds_overlap(bounds[j], other.bounds):
+                continue
+            if segment.geometry.distance(other) < tolerance:
+                join_roots(parents, i, len(points) + j)
+
+
+def padded_bounds(bounds, padding):
+    minx, miny, maxx, maxy = bounds
+    return (minx - padding, miny - padding, maxx + padding, maxy + padding)
+
+
+def bounds_overlap(bounds, other):
+    return bounds[0] <= other[2] and other[0] <= bounds[2] \
+        and bounds[1] <= other[3] and other[1] <= bounds[3]
+
+
+def road_candidates(roads, int_buffers):
+    """
+    Find the roads that might overlap each intersection buffer, using
+    the bounds of the roads padded by 20 meters
+    Args:
+        roads - a list of segment objects
+        int_buffers - a list of IntersectionBuffer objects
+    Returns:
+        a list, for each intersection buffer, of the sorted positions
+        of the roads whose padded bounds overlap the buffer's bounds
+    """
+    print("creating rindex")
+    bounds = []
+    for idx, road in enumerate(roads):
+        if not road.geometry.is_empty:
+            minx, miny, maxx, maxy = road.geometry.bounds
+            bounds.append(
+                (idx, (minx - 20, miny - 20, maxx + 20, maxy + 20), None))
+    if not bounds:
+        return [[] for _ in int_buffers]
+    road_lines_index = rtree.index.Index(bounds)
+
+    return [sorted(road_lines_index.intersection(x.buffer.bounds))
+            for x in int_buffers]
+
+
+def buffer_connections(roads, tasks):
+    """
+    Get the connections for each of a set of intersection buffers
+    Args:
+        roads - dict of road position to road geometry, for every
+            road the tasks refer to
+        tasks - list of (buffer position, IntersectionBuffer object,
+            candidate road positions) tuples
+    Returns:
+        list of (buffer position, matched road positions, connections)
+        tuples, where connections is a list of tuples of
+        the sorted (road position, geometry) pieces of the roads
+        in the intersection, and the padded union of the pieces
+    """
+    results = []
+    for buffer_idx, int_buffer, candidates in tasks:
+        match_segments = []
+        matched_roads = []
+
+        # Add the portion of each road that intersects intersection buffer
+        # to match_segments. These are possible connections
+        # If the road intersects, add that to matched_roads
+        for idx in candidates:
+            if roads[idx].intersects(int_buffer.buffer):
+                match_segments.append(Segment(roads[idx].intersection(
+                    int_buffer.buffer), {'position': idx}))
+                matched_roads.append(idx)
+
+        # Get the connections that touch a point in the intersection buffer
+        connections = []
+        for lines, buffered in get_connections(
+                int_buffer.points, match_segments):
+            connections.append((
+                sorted((x.properties['position'], x.geometry) for x in lines),
+                buffered
+            ))
+        results.append((buffer_idx, matched_roads, connections))
+    return results
+
+
+def road_differences(tasks):
+    """
+    Cut the intersections out of a set of roads
+    Args:
+        tasks - list of (road position, road geometry, list of padded
+            intersection geometries) tuples
+    Returns:
+        list of (road position, remaining geometry) tuples
+    """
+    results = []
+    for idx, diff, buffered_ints in tasks:
+        for buffered_int in buffered_ints:
+            diff = diff.difference(buffered_int)
+        results.append((idx, diff))
+    return results
+
+
+def _buffer_connections_tile(args):
+    return buffer_connections(*args)
 
-    return resulting_inters
 
+def _road_differences_tile(tasks):
+    return road_differences(tasks)
 
-def find_non_ints(roads, int_buffers):
+
+def run_tiles(func, tasks, processes):
+    """
+    Run a function over a list of tile tasks, in a process pool
+    if there's more than one process
+    Returns:
+        a list of all the tasks' results, in no particular order
+    """
+    results = []
+    if processes > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(processes) as pool:
+            for i, tile_results in enumerate(
+                    pool.imap_unordered(func, tasks)):
+                util.track(i, 10, len(tasks))
+                results.extend(tile_results)
+    else:
+        for task in tasks:
+            results.extend(func(task))
+    return results
+
+
+def find_non_ints(roads, int_buffers, processes=1):
     """
     Find the segments that aren't intersections
     Args:
         roads - a list of tuples of shapely shape and dict of segment info
         int_buffers - a list of IntersectionBuffer objects
+        processes - number of processes to use; if more than one, the
+            city is split into spatial tiles that are run in a process
+            pool. Each tile gets the intersection buffers centered in it,
+            along with every road overlapping them, so roads crossing
+            tile edges go to each tile they reach. Results are merged
+            in the order of the buffers and roads, so ids come out
+            the same however many processes are used
     Returns:
         tuple consisting of:
             non_int_lines - list in same format as input roads, just a subset
@@ -150,41 +394,36 @@ def find_non_ints(roads, int_buffers):
                 each element in the data list is a dict of properties
                 corresponding to the lines
     """
+    candidates = road_candidates(roads, int_buffers)
+    # A few tiles per process, to even out the work
+    num_tiles = processes * 4 if processes > 1 else 1
+
+    tasks = []
+    for group in util.tile_groups(
+            [x.buffer.bounds for x in int_buffers], num_tiles):
+        needed = set(idx for i in group for idx in candidates[i])
+        tasks.append((
+            {idx: roads[idx].geometry for idx in needed},
+            [(i, int_buffers[i], candidates[i]) for i in group]
+        ))
 
-    # Create index for quick lookup
-    print("creating rindex")
-
-    road_lines_index = rtree.index.Index()
-    buffered_lines = []
-    for idx, road in enumerate(roads):
-        b = road.geometry.buffer(20)
-        buffered_lines.append((b, road))
-        road_lines_index.insert(idx, b.bounds)
+    print("Generating intersection segments")
+    buffer_results = run_tiles(_buffer_connections_tile, tasks, processes)
+    buffer_results.sort(key=lambda x: x[0])
 
     inter_segments = []
     roads_with_int_segments = {}
     count = 0
-    print("Generating intersection segments")
     connected_segment_ids = defaultdict(list)
 
     # Go through each intersection buffer object
-    for i, int_buffer in enumerate(int_buffers):
-        util.track(i, 1000, len(int_buffers))
-        match_segments = []
-        matched_roads = []
-
-        # Add the portion of each road that intersects intersection buffer
-        # to match_segments. These are possible connections
-        # If the road intersects, add that to matched_roads
-        for idx in road_lines_index.intersection(int_buffer.buffer.bounds):
-            road = roads[idx]
-            if road.geometry.intersects(int_buffer.buffer):
-                match_segments.append(Segment(road.geometry.intersection(
-                    int_buffer.buffer), road.properties))
-                matched_roads.append(road)
-
-        # Get the connections that touch a point in the intersection buffer
-        int_segments = get_connections(int_buffer.points, match_segments)
+    for buffer_idx, matched_roads, connections in buffer_results:
+        int_buffer = int_buffers[buffer_idx]
+        int_segments = [
+            ([Segment(geometry, roads[idx].properties)
+              for idx, geometry in lines], buffered)
+            for lines, buffered in connections
+        ]
 
         # Each road_with_int is a road segment and a list of lists of segments
         # representing the intersections associated with that road
@@ -192,7 +431,8 @@ def find_non_ints(roads, int_buffers):
         # associated with them don't need to be split into separate
         # intersection and non intersection segments
         # to-do: turn these into intersection objects
-        for r in matched_roads:
+        for idx in matched_roads:
+            r = roads[idx]
             if r.properties['id'] not in roads_with_int_segments:
                 roads_with_int_segments[r.properties['id']] = []
             roads_with_int_segments[r.properties['id']] += int_segments
@@ -215,12 +455,27 @@ def find_non_ints(roads, int_buffers):
                 connected_segment_ids[idx].append(count)
 
             count += 1
-    
+
+    # Cut the intersections out of the roads that have any, grouping
+    # the roads into tiles the same way
+    print("Generating non-intersection segments")
+    int_roads = [i for i, road in enumerate(roads)
+                 if road.properties['id'] in roads_with_int_segments]
+    tasks = []
+    for group in util.tile_groups(
+            [roads[i].geometry.bounds for i in int_roads], num_tiles):
+        tasks.append([(
+            int_roads[i],
+            roads[int_roads[i]].geometry,
+            [inter[1] for inter in roads_with_int_segments[
+                roads[int_roads[i]].properties['id']]]
+        ) for i in group])
+    diffs = dict(run_tiles(_road_differences_tile, tasks, processes))
+
     non_int_lines = []
     # Store the mappings of non intersection orig_id to id
     # We'll need this to give intersections the appropriate mapping
     orig_to_id = defaultdict()
-    print("Generating non-intersection segments")
 
     non_int_count = 0
 
@@ -228,20 +483,13 @@ def find_non_ints(roads, int_buffers):
         util.track(i, 1000, len(roads))
 
         # If there's no overlap between the road segment and any intersections
-        if road.properties['id'] not in roads_with_int_segments:
+        if i not in diffs:
             non_int_lines.append(road)
             road.properties['id'] = '00' + str(non_int_count)
             orig_to_id[road.properties['orig_id']] = road.properties['id']
         else:
 
-            # Check against each separate intersection
-            road_info = roads_with_int_segments[road.properties['id']]
-
-            diff = road.geometry
-            for inter in road_info:
-                buffered_int = inter[1]
-                diff = diff.difference(buffered_int)
-
+            diff = diffs[i]
             if diff.type in ('LineString', 'MultiLineString'):
                 if 'LineString' == diff.type:
                     coords = [x for x in diff.coords]
@@ -303,11 +551,8 @@ def add_point_based_features(non_inters, inters, jsonfile,
             features += util.read_records(
                 additional_feats_filename, 'record')
         print('Snapping {} point-based features'.format(len(features)))
-        seg, segments_index = util.index_segments(
-            inters + non_inters, geojson=False, segment=True
-        )
-
-        util.find_nearest(features, seg, segments_index, 20, type_record=True)
+        util.find_nearest(
+            features, inters + non_inters, 20, type_record=True)
 
         # Dump to file
         print("output {} point-based features to {}".format(
@@ -464,7 +709,7 @@ def get_non_intersection_name(non_inter_segment, inters_by_id):
     return segment_street
 
 
-def create_segments_from_json(roads_shp_path, mapfp):
+def create_segments_from_json(roads_shp_path, mapfp, processes=1):
     print(roads_shp_path)
     roads, inter_nodes = util.get_roads_and_inters(roads_shp_path)
     print("read in {} road segments".format(len(roads)))
@@ -474,10 +719,15 @@ def create_segments_from_json(roads_shp_path, mapfp):
         road.properties['orig_id'] = int(str(99) + str(i))
 
     # Initial buffer = 20 meters
-    int_buffers = get_intersection_buffers(inter_nodes, 20)
+    with profiling.step('get_intersection_buffers',
+                        rows_in=len(inter_nodes)) as step:
+        int_buffers = get_intersection_buffers(inter_nodes, 20)
+        step.rows_out = len(int_buffers)
     print("Found {} intersection buffers".format(len(int_buffers)))
-    non_int_lines, inter_segments = find_non_ints(
-        roads, int_buffers)
+    with profiling.step('find_non_ints', rows_in=len(roads)) as step:
+        non_int_lines, inter_segments = find_non_ints(
+            roads, int_buffers, processes)
+        step.rows_out = len(non_int_lines) + len(inter_segments)
 
     non_int_w_ids = []
 
@@ -499,12 +749,15 @@ def create_segments_from_json(roads_shp_path, mapfp):
             segment, inters_by_id)
         non_int_w_ids.append(segment)
 
+        # Segments whose geometry isn't a line don't have a center
         x, y = util.get_center_point(segment)
-        x, y = util.reproject(
-            [[x, y]], transformer_3857_to_4326)[0]['coordinates']
+        if x is not None:
+            x, y = util.reproject(
+                [[x, y]], transformer_3857_to_4326)[0]['coordinates']
+            x, y = round(x, 4), round(y, 4)
 
-        segment.properties['center_y'] = round(y, 4)
-        segment.properties['center_x'] = round(x, 4)
+        segment.properties['center_y'] = y
+        segment.properties['center_x'] = x
 
     print("extracted {} non-intersection segments".format(len(non_int_w_ids)))
 
@@ -539,8 +792,9 @@ def create_segments_from_json(roads_shp_path, mapfp):
             segment_data.append(segment)
 
         x, y = util.get_center_point(intersection)
-        x, y = util.reproject(
-            [[x, y]], transformer_3857_to_4326)[0]['coordinates']
+        if x is not None:
+            x, y = util.reproject(
+                [[x, y]], transformer_3857_to_4326)[0]['coordinates']
         intersection.properties['center_x'] = x
         intersection.properties['center_y'] = y
         intersection.data = segment_data
@@ -574,7 +828,7 @@ def update_intersection_properties(inters, config):
     return inters
 
 
-if __name__ == '__main__':
+def main(argv=None):
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--datadir", type=str,
@@ -589,8 +843,11 @@ if __name__ == '__main__':
                         "within the maps directory")
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether to force update the points-based data')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='Number of processes to create segments ' +
+                        'with, defaults to 1')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     DATA_FP = args.datadir
     PROCESSED_DATA_FP = os.path.join(args.datadir, 'processed')
     MAP_FP = os.path.join(args.datadir, 'processed/maps')
@@ -606,28 +863,33 @@ if __name__ == '__main__':
     if args.altroad:
         elements = args.altroad
 
-    non_inters, inters = create_segments_from_json(elements, MAP_FP)
+    non_inters, inters = create_segments_from_json(
+        elements, MAP_FP, args.processes)
 
     feats_file = os.path.join(MAP_FP, 'features.geojson')
     additional_feats_file = os.path.join(
         DATA_FP, 'standardized', 'points.json')
     if not os.path.exists(feats_file):
         feats_file = None
-    if not os.path.exists(additional_feats_file):
+    if not record_store.exists(additional_feats_file):
         additional_feats_file = None
 
     if feats_file or additional_feats_file:
         jsonfile = os.path.join(DATA_FP, 'processed', 'points_joined.json')
-        non_inters, inters = add_point_based_features(
-            non_inters,
-            inters,
-            jsonfile,
-            feats_filename=feats_file,
-            additional_feats_filename=additional_feats_file,
-            forceupdate=args.forceupdate
-        )
+        with profiling.step('add_point_based_features'):
+            non_inters, inters = add_point_based_features(
+                non_inters,
+                inters,
+                jsonfile,
+                feats_filename=feats_file,
+                additional_feats_filename=additional_feats_file,
+                forceupdate=args.forceupdate
+            )
     config = data.config.Configuration(args.config)
     
     inters = update_intersection_properties(inters, config)
     util.write_segments(non_inters, inters, MAP_FP)
 
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,14 @@
 import fiona
 import math
+import multiprocessing
 from shapely.geometry import Point, shape
-import itertools
 import pickle
+import rtree
 import os
 import argparse
-from .util import track, prepare_geojson
+from .util import track, prepare_geojson, tile_groups
+from . import map_store
+from . import profiling
 import geojson
 
 MAP_DATA_FP = os.path.dirname(
@@ -13,6 +16,10 @@ MAP_DATA_FP = os.path.dirname(
         os.path.dirname(
             os.path.abspath(__file__)))) + '/data/processed/maps/'
 
+# Intersection points closer than this (in map units, i.e. metres)
+# are treated as the same point
+DEDUP_TOLERANCE = 0.01
+
 
 def extract_intersections(inter, prop):
     """
@@ -50,64 +57,183 @@ def extract_intersections(inter, prop):
                 yield i
 
 
-def generate_intersections(lines):
+def candidate_pairs(lines):
     """
-    Runs extract_intersections on all combinations of lines
-    Writes the resulting intersections to file as well as returning
+    Find the pairs of lines whose bounding boxes intersect, using a
+    spatial index instead of looking at every combination of lines
 
     Args:
-        lines: the lines from the shapefile
+        lines: list of id, shapely geometry tuples
 
     Returns:
-        inters: intersections - a list of point, dict tuples
-            the dict contains the newly created ids of the
-            intersecting segments
+        list of (i, j) tuples of positions in lines, with i < j,
+        in the same order as itertools.combinations
     """
-    inters = []
-    i = 0
-
-    # Total combinations of two road segments
-    def nCr(n, r):
-        f = math.factorial
-        return f(n) // f(r) // f(n-r)
-    tot = nCr(len(lines), 2)
-    # Look at all pairs of segments to extract intersections
-    for segment1, segment2 in itertools.combinations(lines, 2):
-        track(i, 10000, tot)
+    bounds = [(i, line[1].bounds, None) for i, line in enumerate(lines)
+              if not line[1].is_empty]
+    if not bounds:
+        return []
+    index = rtree.index.Index(bounds)
+
+    pairs = []
+    for i, line in enumerate(lines):
+        if line[1].is_empty:
+            continue
+        pairs.extend(
+            (i, j) for j in sorted(index.intersection(line[1].bounds))
+            if j > i)
+    return pairs
+
+
+def intersect_pairs(lines, pairs):
+    """
+    Extract the intersections for the given pairs of lines
+
+    Args:
+        lines: dict or list of id, shapely geometry tuples, keyed by position
+        pairs: list of (i, j) positions
+
+    Returns:
+        list of ((i, j), intersections) tuples, only including the pairs
+        that intersect
+    """
+    results = []
+    for i, j in pairs:
+        segment1 = lines[i]
+        segment2 = lines[j]
         if segment1[1].intersects(segment2[1]):
             inter = segment1[1].intersection(segment2[1])
-            inters.extend(extract_intersections(
+            results.append(((i, j), list(extract_intersections(
                 inter,
                 {'id_1': segment1[0], 'id_2': segment2[0]}
-            ))
-        i += 1
+            ))))
+    return results
+
+
+def _intersect_tile(args):
+    return intersect_pairs(*args)
+
+
+def tile_tasks(lines, pairs, num_tiles):
+    """
+    Split the candidate pairs into spatial tiles, by the center of the
+    first line in each pair, so each task only needs the lines near it
+
+    Args:
+        lines: list of id, shapely geometry tuples
+        pairs: list of (i, j) positions
+        num_tiles: the approximate number of tiles
+
+    Returns:
+        list of (lines, pairs) tasks, where lines is a dict of just
+        the lines the task's pairs use
+    """
+    groups = tile_groups([lines[i][1].bounds for i, _ in pairs], num_tiles)
+
+    tasks = []
+    for group in groups:
+        tile_pairs = [pairs[x] for x in group]
+        needed = set(x for pair in tile_pairs for x in pair)
+        tasks.append(({x: lines[x] for x in needed}, tile_pairs))
+    return tasks
+
+
+def generate_intersections(lines, processes=1):
+    """
+    Runs extract_intersections on all pairs of lines whose bounding
+    boxes intersect
+
+    Args:
+        lines: the lines from the shapefile
+        processes: number of processes to use; if more than one, the
+            pairs are split into spatial tiles and run in a process pool
+
+    Returns:
+        inters: intersections - a list of point, dict tuples
+            the dict contains the newly created ids of the
+            intersecting segments
+            These are in the same order as if every combination of
+            lines had been checked
+    """
+    pairs = candidate_pairs(lines)
+    print("Checking {} candidate pairs out of {} lines".format(
+        len(pairs), len(lines)))
+
+    if processes > 1 and len(pairs) > 1:
+        # A few tiles per process, to even out the work
+        tasks = tile_tasks(lines, pairs, processes * 4)
+        with multiprocessing.Pool(processes) as pool:
+            results = []
+            for i, tile_results in enumerate(
+                    pool.imap_unordered(_intersect_tile, tasks)):
+                track(i, 1, len(tasks))
+                results.extend(tile_results)
+        results.sort(key=lambda x: x[0])
+    else:
+        results = []
+        for i in range(0, len(pairs), 10000):
+            track(i, 10000, len(pairs))
+            results.extend(intersect_pairs(lines, pairs[i:i + 10000]))
 
+    inters = []
+    for _, pair_inters in results:
+        inters.extend(pair_inters)
     return inters
 
 
-def write_intersections(inters, roads):
+class PointGrid(object):
+    """
+    Hash grid of points, for finding duplicates within a tolerance
+    Cells are the size of the tolerance, so any point within tolerance
+    of a new point is in the same cell or one of its neighbours
+    """
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.cells = {}
+
+    def add(self, x, y):
+        """
+        Add a point, unless there's already one within tolerance
+        Returns:
+            True if the point was added, False if it's a duplicate
+        """
+        cell_x = int(math.floor(x / self.tolerance))
+        cell_y = int(math.floor(y / self.tolerance))
+        for i in range(cell_x - 1, cell_x + 2):
+            for j in range(cell_y - 1, cell_y + 2):
+                for other_x, other_y in self.cells.get((i, j), []):
+                    if math.hypot(x - other_x, y - other_y) \
+                       <= self.tolerance:
+                        return False
+        self.cells.setdefault((cell_x, cell_y), []).append((x, y))
+        return True
+
+
+def write_intersections(inters, roads, mapfp=MAP_DATA_FP):
     """
     Given a list of shapely intersections,
     de-dupe and write shape files
 
     Args:
         inters: list of points indicating intersections
+        roads: the road segments from the shapefile
+        mapfp: the maps directory to write elements.geojson to
     """
     output_inters = []
 
     # De-dupe and add intersection as a property
-    seen_points = {}
+    seen_points = PointGrid(DEDUP_TOLERANCE)
     for x in inters:
         properties = x[1]
 
-        if str(x[0].x) + str(x[0].y) not in list(seen_points.keys()):
+        if seen_points.add(x[0].x, x[0].y):
             properties.update({'intersection': 1})
             output_inters.append(geojson.Feature(
                 geometry=geojson.Point([x[0].x, x[0].y]),
                 properties=properties
             ))
-        seen_points[str(x[0].x) + str(x[0].y)] = True
 
+    store_records = list(output_inters)
     output_inters = prepare_geojson(output_inters)
 
     roads_with_ids = []
@@ -116,17 +242,19 @@ def write_intersections(inters, roads):
     for road in roads:
         road['properties']['id'] = road['id']
         roads_with_ids.append(road)
+    store_records += roads_with_ids
     roads = prepare_geojson(roads_with_ids)
 
     elements = geojson.FeatureCollection(
         output_inters['features'] + roads['features'])
 
-    outfp = os.path.join(MAP_DATA_FP, 'elements.geojson')
+    outfp = os.path.join(mapfp, 'elements.geojson')
     with open(outfp, 'w') as outfile:
         geojson.dump(elements, outfile)
+    map_store.write_records(store_records, outfp)
 
 
-if __name__ == '__main__':
+def main(argv=None):
 
     parser = argparse.ArgumentParser()
     parser.add_argument("shp", help="Segments shape file")
@@ -140,19 +268,23 @@ if __name__ == '__main__':
     # Can force update
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether to force update the maps')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='Number of processes to find intersections ' +
+                        'with, defaults to 1')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # Import shapefile specified at commandline
     shp = args.shp
 
     # Can override the hardcoded maps directory
+    map_fp = MAP_DATA_FP
     if args.dir:
-        MAP_DATA_FP = os.path.join(args.dir, 'processed/maps')
+        map_fp = os.path.join(args.dir, 'processed/maps')
     if args.newmap:
-        MAP_DATA_FP = os.path.join(MAP_DATA_FP, args.newmap)
-        if not os.path.exists(MAP_DATA_FP):
-            os.mkdir(MAP_DATA_FP)
+        map_fp = os.path.join(map_fp, args.newmap)
+        if not os.path.exists(map_fp):
+            os.mkdir(map_fp)
 
     roads = fiona.open(shp)
     # Get all lines, dummy id
@@ -163,13 +295,16 @@ if __name__ == '__main__':
         ) for i, line in enumerate(roads)
     ]
 
-    print('Extracting intersections and writing into ' + MAP_DATA_FP)
+    print('Extracting intersections and writing into ' + map_fp)
     inters = []
-    pkl_file = os.path.join(MAP_DATA_FP, 'inters.pkl')
+    pkl_file = os.path.join(map_fp, 'inters.pkl')
 
     if not os.path.exists(pkl_file) or args.forceupdate:
         print('Generating intersections...')
-        inters = generate_intersections(lines)
+        with profiling.step('generate_intersections',
+                            rows_in=len(lines)) as step:
+            inters = generate_intersections(lines, args.processes)
+            step.rows_out = len(inters)
 
         # Save to pickle in case script breaks
         with open(pkl_file, 'wb') as f:
@@ -180,4 +315,8 @@ if __name__ == '__main__':
             inters = pickle.load(f)
 
     print("writing intersections and road segments to geojson")
-    write_intersections(inters, roads)
+    write_intersections(inters, roads, map_fp)
+
+
+if __name__ == '__main__':
+    main()
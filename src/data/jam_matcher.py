@@ -0,0 +1,145 @@
+"""
+Matching waze jams to the road segments they run along
+
+A jam matches a segment when enough of the jam's line lies within a small
+buffer of the segment, or within a larger one when the jam is on a street
+with the same name, since waze doesn't say which side of a divided road a
+jam is on. Both buffers are made once per segment, and prepared when
+they're first needed, so that most candidate segments that don't match
+are ruled out without computing an intersection.
+
+The same jam is usually reported in many snapshots, so callers match each
+distinct jam line once; the distinct lines can be matched in a process
+pool.
+"""
+import multiprocessing
+import numpy as np
+import rtree
+from shapely.prepared import prep
+from . import conflate
+
+
+# Buffer sizes around segments, for jams on any street
+# and for jams on a street with the segment's name
+NEAR_BUFFER = 3
+SAME_NAME_BUFFER = 10
+# Overlaps shorter than this only count on segments that are shorter too
+MIN_OVERLAP = 20
+
+
+def first_word(name):
+    """
+    The first word of a street name, which is what jams and segments
+    are compared on, or None if there isn't one
+    """
+    words = name.split() if name else []
+    return words[0] if words else None
+
+
+class JamMatcher(object):
+    """
+    Finds the road segments each of a list of jams matches
+    Args:
+        roads - list of Segments, in 3857 projection, with a name property
+        processes - number of processes to buffer the segments with
+    """
+    def __init__(self, roads, processes=1):
+        self.geometries = [x.geometry for x in roads]
+        self.names = [first_word(x.properties.get('name')) for x in roads]
+        self.lengths = [x.geometry.length for x in roads]
+        # Buffers by whether the names match
+        self.buffers = {
+            False: conflate.buffers(self.geometries, NEAR_BUFFER, processes),
+            True: conflate.buffers(
+                self.geometries, SAME_NAME_BUFFER, processes),
+        }
+        self.index = None
+        self.prepared = {}
+
+    def __getstate__(self):
+        # The index and prepared geometries can't be pickled,
+        # so they're made again in each process
+        state = self.__dict__.copy()
+        state['index'] = None
+        state['prepared'] = {}
+        return state
+
+    def candidates(self, geometry):
+        if self.index is None:
+            bounds = [(i, x.bounds, None)
+                      for i, x in enumerate(self.geometries)
+                      if not x.is_empty]
+            self.index = rtree.index.Index(bounds) if bounds \
+                else rtree.index.Index()
+        return self.index.intersection(geometry.bounds)
+
+    def overlap(self, idx, same_name, geometry):
+        """
+        Length of a jam's line within a segment's buffer
+        """
+        key = (idx, same_name)
+        if key not in self.prepared:
+            self.prepared[key] = prep(self.buffers[same_name][idx])
+        if not self.prepared[key].intersects(geometry):
+            return 0
+        return self.buffers[same_name][idx].intersection(geometry).length
+
+    def match(self, geometry, street=None):
+        """
+        Find the segments a jam matches
+        Args:
+            geometry - the jam's shapely line, in 3857 projection
+            street - the first word of the jam's street, see first_word
+        Returns:
+            list of positions in roads
+        """
+        if geometry.is_empty:
+            return []
+        matches = []
+        for idx in self.candidates(geometry):
+            same_name = street is not None and street == self.names[idx]
+            overlap = self.overlap(idx, same_name, geometry)
+            # Skip segments with no overlap or very short overlaps
+            if not overlap or (overlap < MIN_OVERLAP
+                               and self.lengths[idx] > MIN_OVERLAP):
+                continue
+            matches.append(idx)
+        return matches
+
+    def match_all(self, jams, processes=1):
+        """
+        Find the segments each of a list of jams matches
+        Args:
+            jams - list of tuples of a jam's geometry and street,
+                as for match
+            processes - number of processes to use; if more than one,
+                the jams are split into chunks and matched in a
+                process pool
+        Returns:
+            list of the matches for each jam
+        """
+        if processes <= 1 or len(jams) < 2:
+            return [self.match(*x) for x in jams]
+
+        num_chunks = min(processes * 4, len(jams))
+        bounds = np.linspace(0, len(jams), num_chunks + 1).astype(int)
+        with multiprocessing.Pool(
+                processes, initializer=_init_worker,
+                initargs=(self,)) as pool:
+            chunks = pool.map(_match_chunk, [
+                jams[start:end]
+                for start, end in zip(bounds[:-1], bounds[1:])])
+        return [x for chunk in chunks for x in chunk]
+
+
+# The matcher a worker process matches jams with, see match_all
+_worker_matcher = None
+
+
+def _init_worker(matcher):
+    global _worker_matcher
+    _worker_matcher = matcher
+
+
+def _match_chunk(jams):
+    return [_worker_matcher.match(*x) for x in jams]
@@ -6,8 +6,9 @@
 # Draws on: http://bit.ly/2m7469y
 # Developed by: bpben
 
-import json
 from . import util
+from . import profiling
+from . import record_store
 import os
 import argparse
 from shapely.geometry import Point
@@ -28,28 +29,27 @@ PROCESSED_DATA_FP = os.path.join(BASE_DIR, 'data/processed')
 
 
 def snap_records(
-        combined_seg, segments_index, infile,
-        startyear=None, endyear=None):
+        segments, infile,
+        startyear=None, endyear=None, processed_fp=PROCESSED_DATA_FP,
+        record_format='json'):
 
     print("reading crash data...")
-    records = util.read_records(infile, 'crash', startyear, endyear)
+    records = util.read_record_batch(infile, 'crash', startyear, endyear)
 
     # Find nearest crashes - 30 tolerance
     print("snapping crash records to segments")
-    util.find_nearest(
-        records, combined_seg, segments_index, 30, type_record=True)
+    util.find_nearest(records, segments, 30)
     record_num = len(records)
-    records = [x for x in records if x.near_id]
+    records = records.select([bool(x) for x in records.near_ids])
     dropped_records = record_num - len(records)
     if dropped_records:
         print("Dropped {} crashes that don't map to a segment".format(dropped_records))
         print("{} crashes remain".format(len(records)))
-    jsonfile = os.path.join(
-        PROCESSED_DATA_FP, 'crash_joined.json')
+    jsonfile = record_store.format_filename(os.path.join(
+        processed_fp, 'crash_joined.json'), record_format)
 
     print("output crash data to " + jsonfile)
-    with open(jsonfile, 'w') as f:
-        json.dump([r.properties for r in records], f)
+    record_store.write_records(jsonfile, records.properties())
 
 
 def make_crash_rollup(crashes_json, split_columns=[]):
@@ -114,7 +114,8 @@ def make_crash_rollup(crashes_json, split_columns=[]):
 
     return crashes_agg
 
-if __name__ == '__main__':
+
+def main(argv=None):
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str,
@@ -126,24 +127,36 @@ if __name__ == '__main__':
     parser.add_argument("-end", "--endyear", type=str,
                         help="Can limit data to crashes this year or earlier")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     config = data.config.Configuration(args.config)
     
     # Can override the hardcoded data directory
+    raw_data_fp = RAW_DATA_FP
+    processed_fp = PROCESSED_DATA_FP
+    map_fp = MAP_FP
     if args.datadir:
-        RAW_DATA_FP = os.path.join(args.datadir, 'standardized')
-        PROCESSED_DATA_FP = os.path.join(args.datadir, 'processed')
-        MAP_FP = os.path.join(args.datadir, 'processed/maps')
-
-    combined_seg, segments_index = util.read_segments(dirname=MAP_FP)
-    snap_records(
-        combined_seg, segments_index,
-        os.path.join(RAW_DATA_FP, 'crashes.json'),
-        startyear=args.startyear, endyear=args.endyear)
-
-    with open(os.path.join(PROCESSED_DATA_FP, 'crash_joined.json')) as crash_file:
-        data = json.load(crash_file)
-    crashes_agg_list = make_crash_rollup(data, config.split_columns)
+        raw_data_fp = os.path.join(args.datadir, 'standardized')
+        processed_fp = os.path.join(args.datadir, 'processed')
+        map_fp = os.path.join(args.datadir, 'processed/maps')
+
+    snapper = util.read_segments_snapper(dirname=map_fp)
+    with profiling.step(
+            'snap_records',
+            inputs=[record_store.find_file(
+                os.path.join(raw_data_fp, 'crashes.json'))],
+            outputs=[record_store.format_filename(
+                os.path.join(processed_fp, 'crash_joined.json'),
+                config.record_format)]):
+        snap_records(
+            snapper,
+            os.path.join(raw_data_fp, 'crashes.json'),
+            startyear=args.startyear, endyear=args.endyear,
+            processed_fp=processed_fp, record_format=config.record_format)
+
+    crashes = record_store.read_records(
+        os.path.join(processed_fp, 'crash_joined.json'))
+    with profiling.step('make_crash_rollup', rows_in=len(crashes)):
+        crashes_agg_list = make_crash_rollup(crashes, config.split_columns)
 
     crashes_agg_path = os.path.join(
         args.datadir, "processed", "crashes_rollup.geojson")
@@ -167,3 +180,7 @@ if __name__ == '__main__':
             filename,
             driver="GeoJSON"
         )
+
+
+if __name__ == '__main__':
+    main()
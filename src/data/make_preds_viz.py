@@ -133,7 +133,7 @@ def write_all_preds(DATA_FP, config):
             DATA_FP, "processed", output_file))
 
 
-if __name__ == "__main__":
+def main(argv=None):
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--datadir", type=str,
@@ -142,6 +142,10 @@ if __name__ == "__main__":
                         help="yml file for model config"
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     config = data.config.Configuration(args.config)
     write_all_preds(args.datadir, config)
+
+
+if __name__ == '__main__':
+    main()
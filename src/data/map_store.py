@@ -0,0 +1,354 @@
+"""
+Columnar storage for map intermediates
+
+Each map geojson written by the data stages (osm_elements, elements,
+inters_segments, non_inters_segments) gets a companion .npz file with the
+same records, holding WKB geometries in 3857 projection and one typed
+column per property. Stages read the companion instead of parsing the
+geojson and reprojecting every coordinate. The geojson files are still
+written, for the showcase, feature generation and anything outside the
+data stages.
+
+A companion is only used while its geojson file has the same size and
+modification time as when the companion was written, so geojson files
+replaced by other means are read directly.
+
+inter_and_non_int.geojson is the two segment files put together, so its
+store holds no records of its own, just the names of the segment files,
+and reads their stores while none of the three files has changed.
+"""
+import json
+import numbers
+import os
+import struct
+import numpy as np
+from shapely import wkb
+from shapely.geometry import shape
+
+
+STORE_VERSION = 1
+# WKB type codes of the geometries that can be written empty,
+# see dump_geometry
+EMPTY_WKB_TYPES = {
+    'LineString': 2, 'Polygon': 3, 'MultiPoint': 4, 'MultiLineString': 5,
+    'MultiPolygon': 6,
+}
+# Property states
+ABSENT, NULL, PRESENT = 0, 1, 2
+# Placeholder for absent properties when reading
+_MISSING = object()
+
+
+def store_filename(geojson_filename):
+    return os.path.splitext(geojson_filename)[0] + '.npz'
+
+
+def source_stamp(geojson_filename):
+    stat = os.stat(geojson_filename)
+    return [STORE_VERSION, stat.st_size, stat.st_mtime_ns]
+
+
+def dump_geometry(geometry):
+    """
+    WKB for a geometry
+    Shapely writes every empty geometry as an empty geometry collection,
+    which has no coordinates when turned back into geojson, so empty
+    geometries are written with their own type instead
+    """
+    # An empty geometry's geom_type is always GeometryCollection,
+    # but its class still says what it is
+    geom_type = type(geometry).__name__
+    if geometry.is_empty and geom_type in EMPTY_WKB_TYPES:
+        # Little endian, the type, and no points or parts
+        return struct.pack('<BII', 1, EMPTY_WKB_TYPES[geom_type], 0)
+    return wkb.dumps(geometry)
+
+
+def column_kind(values):
+    """
+    Pick the storage type for a property's non null values
+    Returns:
+        one of bool, int, float, str or json
+    """
+    if all(isinstance(x, (bool, np.bool_)) for x in values):
+        return 'bool'
+    if all(isinstance(x, numbers.Integral)
+           and not isinstance(x, (bool, np.bool_))
+           and -2**63 <= x < 2**63 for x in values):
+        return 'int'
+    if all(isinstance(x, (float, np.floating)) for x in values):
+        return 'float'
+    if all(isinstance(x, str) for x in values):
+        return 'str'
+    return 'json'
+
+
+def encode_column(values, states):
+    """
+    Turn a property's values into a numpy array
+    Args:
+        values - list of values, one per record
+        states - array of ABSENT, NULL or PRESENT per record
+    Returns:
+        kind string, numpy array
+    """
+    present = [x for x, state in zip(values, states) if state == PRESENT]
+    kind = column_kind(present)
+    fill = {'bool': False, 'int': 0, 'float': 0.0, 'str': '', 'json': ''}[kind]
+    filled = [
+        x if state == PRESENT else fill for x, state in zip(values, states)]
+    if kind == 'json':
+        filled = [json.dumps(x) if state == PRESENT else ''
+                  for x, state in zip(filled, states)]
+    dtype = {'bool': bool, 'int': np.int64, 'float': np.float64,
+             'str': str, 'json': str}[kind]
+    if not filled:
+        return kind, np.zeros(0, dtype=dtype)
+    return kind, np.array(filled, dtype=dtype)
+
+
+def property_order(properties):
+    """
+    All the keys of a list of dicts, in order of first appearance
+    """
+    order = {}
+    for row in properties:
+        for key in row:
+            order.setdefault(key, len(order))
+    return list(order)
+
+
+def encode_columns(properties):
+    """
+    Turn a list of property dicts into typed columns
+    Args:
+        properties - list of dicts
+    Returns:
+        list of [name, kind] for each column, in order of first
+        appearance, and a list of (values, states) arrays for each
+    """
+    columns = []
+    encoded = []
+    for name in property_order(properties):
+        values = []
+        states = np.zeros(len(properties), dtype=np.uint8)
+        for j, row in enumerate(properties):
+            if name not in row:
+                values.append(None)
+            elif row[name] is None:
+                states[j] = NULL
+                values.append(None)
+            else:
+                states[j] = PRESENT
+                values.append(row[name])
+        kind, values = encode_column(values, states)
+        columns.append([name, kind])
+        encoded.append((values, states))
+    return columns, encoded
+
+
+def write_records(records, geojson_filename):
+    """
+    Write the companion store for a geojson file that has just been
+    written with the same records
+    Args:
+        records - list of dicts with geometry (a shapely geometry,
+            or a geojson style dict) in 3857 projection, and properties
+        geojson_filename - the geojson file
+    """
+    geometries = []
+    for record in records:
+        geometry = record['geometry']
+        if isinstance(geometry, dict):
+            geometry = shape(geometry)
+        geometries.append(dump_geometry(geometry))
+    lengths = np.array([len(x) for x in geometries], dtype=np.int64)
+
+    columns, encoded = encode_columns([x['properties'] for x in records])
+    arrays = {}
+    for i, (values, states) in enumerate(encoded):
+        arrays['values_{}'.format(i)] = values
+        arrays['states_{}'.format(i)] = states
+
+    filename = store_filename(geojson_filename)
+    tmp_filename = filename + '.tmp.npz'
+    np.savez(
+        tmp_filename,
+        geometry=np.frombuffer(b''.join(geometries), dtype=np.uint8),
+        geometry_lengths=lengths,
+        columns=np.array(json.dumps(columns)),
+        source=np.array(json.dumps(source_stamp(geojson_filename))),
+        **arrays
+    )
+    os.replace(tmp_filename, filename)
+
+
+def decode_column(kind, values):
+    if kind == 'json':
+        return [json.loads(x) if x else None for x in values.tolist()]
+    return values.tolist()
+
+
+def decode_columns(columns, encoded, fill_missing=False):
+    """
+    Turn typed columns back into lists of values
+    Args:
+        columns, encoded - as returned by encode_columns
+        fill_missing - if True, properties missing from a record are
+            None, otherwise _MISSING
+    Returns:
+        list of the values for each column
+    """
+    values = []
+    for (_, kind), (column, states) in zip(columns, encoded):
+        column = decode_column(kind, column)
+        values.append([
+            x if state == PRESENT
+            else (None if state == NULL or fill_missing else _MISSING)
+            for x, state in zip(column, states.tolist())
+        ])
+    return values
+
+
+def rows(names, values, count):
+    """
+    Property dicts from decoded columns, leaving out missing properties
+    """
+    columns = zip(*values) if values else [()] * count
+    for row in columns:
+        yield {name: value for name, value in zip(names, row)
+               if value is not _MISSING}
+
+
+def write_combined(geojson_filename, part_filenames):
+    """
+    Write the companion store for a geojson file that has just been
+    written with the features of other geojson files that have their
+    own stores, in order
+    Args:
+        geojson_filename - the combined geojson file
+        part_filenames - the geojson files it was made from, in the
+            same directory
+    """
+    parts = [[os.path.basename(x), source_stamp(x)] for x in part_filenames]
+    filename = store_filename(geojson_filename)
+    tmp_filename = filename + '.tmp.npz'
+    np.savez(
+        tmp_filename,
+        parts=np.array(json.dumps(parts)),
+        source=np.array(json.dumps(source_stamp(geojson_filename))),
+    )
+    os.replace(tmp_filename, filename)
+
+
+def load_store(geojson_filename):
+    """
+    Open the companion store of a geojson file
+    Returns:
+        the loaded npz file, to be closed by the caller,
+        or None if there's no up to date companion store
+    """
+    filename = store_filename(geojson_filename)
+    if not os.path.exists(filename) or not os.path.exists(geojson_filename):
+        return None
+    saved = np.load(filename)
+    if json.loads(str(saved['source'])) != source_stamp(geojson_filename):
+        saved.close()
+        return None
+    return saved
+
+
+def current_parts(geojson_filename, saved):
+    """
+    The geojson files a combined store was made from
+    Returns:
+        list of filenames, or None if any of them has changed since
+    """
+    dirname = os.path.dirname(geojson_filename)
+    parts = []
+    for name, stamp in json.loads(str(saved['parts'])):
+        part = os.path.join(dirname, name)
+        if not os.path.exists(part) or source_stamp(part) != stamp:
+            return None
+        parts.append(part)
+    return parts
+
+
+def record_count(geojson_filename):
+    """
+    Number of records in a geojson file, from its companion store
+    Returns:
+        the count, or None if there's no up to date companion store
+    """
+    saved = load_store(geojson_filename)
+    if saved is None:
+        return None
+    with saved:
+        if 'parts' not in saved:
+            return len(saved['geometry_lengths'])
+        parts = current_parts(geojson_filename, saved)
+    if parts is None:
+        return None
+    counts = [record_count(x) for x in parts]
+    return None if None in counts else sum(counts)
+
+
+def read_parts(parts, fill_missing):
+    """
+    Read the stores of the files a combined store was made from
+    Returns:
+        list of records, or None if any store isn't up to date
+    """
+    records = []
+    for part in parts:
+        part_records = read_records(part)
+        if part_records is None:
+            return None
+        records.extend(part_records)
+    if fill_missing:
+        # Across all the parts, as fiona does for the combined file
+        names = property_order([x['properties'] for x in records])
+        for record in records:
+            for name in names:
+                record['properties'].setdefault(name, None)
+    return records
+
+
+def read_records(geojson_filename, fill_missing=False):
+    """
+    Read the companion store of a geojson file
+    Args:
+        geojson_filename
+        fill_missing - if True, properties missing from a record are
+            set to None, as fiona does
+    Returns:
+        list of dicts with shapely geometry in 3857 projection and
+        properties, or None if there's no up to date companion store
+    """
+    saved = load_store(geojson_filename)
+    if saved is None:
+        return None
+
+    with saved:
+        if 'parts' in saved:
+            parts = current_parts(geojson_filename, saved)
+            return None if parts is None else read_parts(parts, fill_missing)
+        buf = saved['geometry'].tobytes()
+        lengths = saved['geometry_lengths']
+        columns = json.loads(str(saved['columns']))
+        names = [name for name, _ in columns]
+        values = decode_columns(columns, [
+            (saved['values_{}'.format(i)], saved['states_{}'.format(i)])
+            for i in range(len(columns))
+        ], fill_missing)
+
+    ends = np.cumsum(lengths).tolist()
+    starts = [0] + ends[:-1]
+    records = []
+    for start, end, properties in zip(
+            starts, ends, rows(names, values, len(lengths))):
+        records.append({
+            'geometry': wkb.loads(buf[start:end]),
+            'properties': properties,
+        })
+    return records
@@ -0,0 +1,175 @@
+"""
+Shared cache of the OpenStreetMap road graphs downloaded for cities
+
+Each graph is stored under a hash of the region it covers (its boundary
+polygon) and what was downloaded (the network type and osm tags), along
+with the boundary itself. When another city's boundary lies inside a
+cached region, e.g. a city inside a county that's already been built,
+or the same city again, its graph is clipped out of the cached one
+instead of being downloaded again.
+
+The cache directory is given by the OSM_CACHE_DIR environment variable,
+see showcase/run_all_cities.py.
+"""
+import hashlib
+import json
+import os
+import shutil
+import uuid
+import networkx as nx
+from shapely.geometry import Point, mapping, shape
+from shapely.prepared import prep
+
+
+REGIONS_DIR = 'regions'
+GRAPH_FILE = 'graph.gpickle'
+REGION_FILE = 'region.json'
+
+
+def cache_dir():
+    """
+    The shared cache directory, or None if there isn't one
+    """
+    return os.environ.get('OSM_CACHE_DIR')
+
+
+def region_key(boundary, network_type, tags):
+    """
+    Content hash identifying a region's graph
+    Args:
+        boundary - shapely polygon or multipolygon, in 4326 projection
+        network_type - osmnx network type, e.g. drive
+        tags - list of the osm way tags kept
+    Returns:
+        hex digest
+    """
+    key = hashlib.sha1()
+    key.update(boundary.wkb)
+    key.update(json.dumps([network_type, sorted(tags)]).encode('utf-8'))
+    return key.hexdigest()
+
+
+def read_regions(cache_fp):
+    """
+    The regions in the cache
+    Returns:
+        list of dicts with key, boundary, network_type and tags
+    """
+    regions_fp = os.path.join(cache_fp, REGIONS_DIR)
+    if not os.path.exists(regions_fp):
+        return []
+    regions = []
+    for key in sorted(os.listdir(regions_fp)):
+        # Skip regions still being written
+        if key.startswith('.'):
+            continue
+        region_file = os.path.join(regions_fp, key, REGION_FILE)
+        if not os.path.exists(region_file):
+            continue
+        with open(region_file) as f:
+            region = json.load(f)
+        region['key'] = key
+        region['boundary'] = shape(region['boundary'])
+        regions.append(region)
+    return regions
+
+
+def find_region(cache_fp, boundary, network_type, tags):
+    """
+    Find the smallest cached region covering a boundary
+    Args:
+        cache_fp - cache directory
+        boundary - shapely polygon or multipolygon, in 4326 projection
+        network_type, tags - as for region_key
+    Returns:
+        the region dict, or None if no cached region covers the boundary
+    """
+    covering = [
+        x for x in read_regions(cache_fp)
+        if x['network_type'] == network_type
+        and set(x['tags']) >= set(tags)
+        and x['boundary'].contains(boundary)
+    ]
+    if not covering:
+        return None
+    return min(covering, key=lambda x: x['boundary'].area)
+
+
+def clip_graph(G, boundary):
+    """
+    Clip a graph to the nodes inside a boundary, keeping the largest
+    connected component, as osmnx does for a graph downloaded for the
+    boundary itself
+    Args:
+        G - networkx graph with x and y node attributes, in 4326
+        boundary - shapely polygon or multipolygon
+    Returns:
+        the clipped graph
+    """
+    inside = prep(boundary)
+    nodes = [node for node, data in G.nodes(data=True)
+             if inside.intersects(Point(data['x'], data['y']))]
+    clipped = G.subgraph(nodes)
+    if clipped.number_of_nodes():
+        largest = max(nx.weakly_connected_components(clipped), key=len)
+        clipped = clipped.subgraph(largest)
+    return clipped.copy()
+
+
+def get_graph(boundary, network_type, tags):
+    """
+    Get a graph for a boundary from the cache
+    Args:
+        boundary - shapely polygon or multipolygon, in 4326 projection
+        network_type, tags - as for region_key
+    Returns:
+        the graph, or None if there's no cache or no cached region
+        covers the boundary
+    """
+    cache_fp = cache_dir()
+    if not cache_fp:
+        return None
+    region = find_region(cache_fp, boundary, network_type, tags)
+    if not region:
+        return None
+
+    print("Using cached OpenStreetMap region {}".format(region['key']))
+    G = nx.read_gpickle(os.path.join(
+        cache_fp, REGIONS_DIR, region['key'], GRAPH_FILE))
+    if region['boundary'].equals(boundary):
+        return G
+    return clip_graph(G, boundary)
+
+
+def add_graph(G, boundary, network_type, tags):
+    """
+    Add a downloaded graph to the cache, if there is one
+    The region is written to a temporary directory and moved into
+    place, so that other processes never see part of one
+    Args:
+        G - networkx graph
+        boundary - shapely polygon or multipolygon, in 4326 projection
+        network_type, tags - as for region_key
+    """
+    cache_fp = cache_dir()
+    if not cache_fp:
+        return
+    key = region_key(boundary, network_type, tags)
+    region_fp = os.path.join(cache_fp, REGIONS_DIR, key)
+    if os.path.exists(region_fp):
+        return
+
+    temp_fp = os.path.join(cache_fp, REGIONS_DIR, '.' + uuid.uuid4().hex)
+    os.makedirs(temp_fp)
+    nx.write_gpickle(G, os.path.join(temp_fp, GRAPH_FILE))
+    with open(os.path.join(temp_fp, REGION_FILE), 'w') as f:
+        json.dump({
+            'boundary': mapping(boundary),
+            'network_type': network_type,
+            'tags': sorted(tags),
+        }, f)
+    try:
+        os.rename(temp_fp, region_fp)
+    except OSError:
+        # Another process cached the same region first
+        shutil.rmtree(temp_fp)
@@ -10,16 +10,14 @@ import json
 import requests
 import geopandas
 from . import util
-from shapely.geometry import Polygon, LineString, LinearRing
+from . import map_store
+from . import osm_cache
+from . import osm_extract
+from shapely.geometry import Polygon, LineString, LinearRing, box, shape
 import data.config
 from .record import transformer_3857_to_4326
 
 
-MAP_FP = None
-STANDARDIZED_FP = None
-RAW_FP = None
-
-
 def find_osm_polygon(city):
     """Interrogate the OSM nominatim API for a city polygon.
 
@@ -137,76 +135,160 @@ def buffer_polygon(polygon, points):
     return polygon
 
 
-def get_graph(config):
+def read_geometry(filename):
     """
-    Use osmnx to get a graph for a city according to shape type
-    specified in config object
+    Read a geojson geometry, or the geometry of the first feature of a
+    geojson feature or feature collection
+    """
+    with open(filename) as f:
+        data = json.load(f)
+    if data['type'] == 'FeatureCollection':
+        data = data['features'][0]
+    if data['type'] == 'Feature':
+        data = data['geometry']
+    return data
+
+
+def get_city_polygon(config, datadir):
+    """
+    Get the city's polygon, without using the network where possible
+    A polygon saved to the city's raw/maps/city_boundary.geojson is used
+    if there is one. Otherwise nominatim is searched for the city, and
+    what it finds is saved to processed/maps/city_polygon.json, to be
+    used for as long as the city stays the same
     Args:
         config object
+        datadir - the city's data directory
     Returns:
-        osmnx graph object
+        geojson polygon or multipolygon, in 4326 projection, or None if
+        nominatim has no polygon for the city
+    """
+    boundary_file = os.path.join(
+        datadir, 'raw', 'maps', 'city_boundary.geojson')
+    if os.path.exists(boundary_file):
+        print("Reading city polygon from " + boundary_file)
+        return read_geometry(boundary_file)
+
+    cache_file = os.path.join(
+        datadir, 'processed', 'maps', 'city_polygon.json')
+    if os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached['city'] == config.city:
+            return cached['polygon']
+
+    print("searching nominatim for " + str(config.city) + " polygon")
+    polygon_pos, polygon = find_osm_polygon(config.city)
+    if polygon_pos is not None:
+        print("city polygon found in OpenStreetMaps at position " +
+              str(polygon_pos))
+    if not os.path.exists(os.path.dirname(cache_file)):
+        os.makedirs(os.path.dirname(cache_file))
+    with open(cache_file, 'w') as f:
+        json.dump({'city': config.city, 'polygon': polygon}, f)
+    return polygon
+
+
+def get_boundary(config, datadir=None):
+    """
+    Get the polygon to build a city's graph within, according to shape
+    type specified in config object
+    Only polygon cities can need the network, the first time their
+    polygon is looked up, see get_city_polygon
+    Args:
+        config object
+        datadir - the city's data directory, used to find the boundary
+            shapefile or polygon and the standardized crashes
+    Returns:
+        shapely polygon or multipolygon, in 4326 projection
     """
 
     if config.map_geography == 'shapefile':
         print("Reading from shape file")
         # Read in boundary shapefile and convert it to 4326 projection
         polygons = geopandas.read_file(os.path.join(
-            RAW_FP, 'maps', config.boundary_shapefile))
+            datadir, 'raw', 'maps', config.boundary_shapefile))
         polygons = polygons.to_crs({'init': 'epsg:4326'})
         # Add an arbitrary column to group by
         polygons['groupby'] = 0
         combined_polys = polygons.dissolve(by='groupby')
-        poly = combined_polys.geometry[0]
+        return combined_polys.geometry[0]
+
+    # confirm if a polygon is available for this city, which determines which
+    # boundary is appropriate
+    polygon = None
+    if config.map_geography != 'radius':
+        polygon = get_city_polygon(config, datadir)
+
+    if polygon is not None:
+        # Check to see if polygon needs to be expanded to include other
+        # points; this is done every time, so that it follows the crashes
+        expanded = expand_polygon(polygon, os.path.join(
+            datadir, 'standardized', 'crashes.json'))
+
+        if not expanded:
+            print("building graph of roads within the city polygon")
+            return shape(polygon)
+        print("using buffered city polygon")
+        return expanded
+
+    print_string = ""
+    if config.map_geography != 'radius':
+        print_string = "No city polygon found in OpenStreetMaps, building "
+    else:
+        print_string = "Building "
+    print_string += "graph of roads within {} km of city ({}/{})".format(
+          str(config.city_radius),
+          str(config.city_latitude),
+          str(config.city_longitude))
+    print(print_string)
+
+    north, south, east, west = ox.bbox_from_point(
+        (config.city_latitude, config.city_longitude),
+        distance=config.city_radius * 1000)
+    return box(west, south, east, north)
+
+
+def get_graph(config, datadir=None):
+    """
+    Use osmnx to get a graph for a city according to shape type
+    specified in config object
+    If the config gives an osm_extract, the graph is read from that
+    file, see osm_extract.py. Otherwise it's clipped from a cached region
+    covering the city if there is one, see osm_cache.py, or downloaded
+    and cached
+    Args:
+        config object
+        datadir - the city's data directory, used to find the boundary
+            shapefile or polygon and the standardized crashes
+    Returns:
+        osmnx graph object
+    """
+    tags = ox.settings.useful_tags_path
+    boundary = get_boundary(config, datadir)
+    if config.osm_extract:
+        return osm_extract.read_graph(
+            os.path.join(datadir, 'raw', 'maps', config.osm_extract),
+            boundary, tags, name=config.city, crs=ox.settings.default_crs)
+
+    G1 = osm_cache.get_graph(boundary, 'drive', tags)
+    if G1 is None:
         print("graphing from polygon")
-        G1 = ox.graph_from_polygon(poly, network_type='drive',
+        G1 = ox.graph_from_polygon(boundary, network_type='drive',
                                    simplify=False)
         print("finished graphing from polygon")
-        return G1
-        
-    # confirm if a polygon is available for this city, which determines which
-    # graph function is appropriate
-    print("searching nominatim for " + str(config.city) + " polygon")
-    polygon_pos, polygon = find_osm_polygon(config.city)
-
-    if polygon_pos is not None and config.map_geography != 'radius':
-        # Check to see if polygon needs to be expanded to include other points
-        polygon = expand_polygon(polygon, os.path.join(
-            STANDARDIZED_FP, 'crashes.json'))
-
-        if not polygon:
-            print("city polygon found in OpenStreetMaps at position " +
-                  str(polygon_pos) + ", building graph of roads within " +
-                  "specified bounds")
-            G1 = ox.graph_from_place(config.city, network_type='drive',
-                                     simplify=False, which_result=polygon_pos)
-        else:
-            print("using buffered city polygon")
-            G1 = ox.graph_from_polygon(polygon, network_type='drive',
-                                       simplify=False)
-    else:
-        print_string = ""
-        if config.map_geography != 'radius':
-            print_string = "No city polygon found in OpenStreetMaps, building "
-        else:
-            print_string = "Building "
-        print_string += "graph of roads within {} km of city ({}/{})".format(
-              str(config.city_radius),
-              str(config.city_latitude),
-              str(config.city_longitude))
-
-        G1 = ox.graph_from_point((config.city_latitude,
-                                  config.city_longitude),
-                                 distance=config.city_radius * 1000,
-                                 network_type='drive', simplify=False)
+        osm_cache.add_graph(G1, boundary, 'drive', tags)
     return G1
-    
 
-def simple_get_roads(config, mapfp):
+
+def simple_get_roads(config, mapfp, datadir=None):
     """
     Use osmnx to get a simplified version of open street maps for the city
     Writes osm_nodes and osm_ways shapefiles to mapfp
     Args:
         config object
+        mapfp - the maps directory to write to
+        datadir - the city's data directory
     Returns:
         None
         This function creates the following files
@@ -216,7 +298,11 @@ def simple_get_roads(config, mapfp):
     """
 
     ox.settings.useful_tags_path.append('cycleway')
-    G1 = get_graph(config)
+    # Cities run together (see showcase/run_all_cities.py) share
+    # osmnx's cache of OpenStreetMap responses
+    if os.environ.get('OSM_CACHE_DIR'):
+        ox.config(use_cache=True, cache_folder=os.environ['OSM_CACHE_DIR'])
+    G1 = get_graph(config, datadir)
     G = ox.simplify_graph(G1)
 
     # Label endpoints
@@ -506,9 +592,10 @@ def write_geojson(way_results, node_results, outfp):
     feat_collection = geojson.FeatureCollection(feats)
     with open(outfp, 'w') as outfile:
         geojson.dump(feat_collection, outfile)
+    map_store.write_records(util.reproject_records(feats), outfp)
 
 
-if __name__ == '__main__':
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str, required=True,
                         help="Config file")
@@ -518,19 +605,17 @@ if __name__ == '__main__':
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether to force update the maps')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     config = data.config.Configuration(args.config)
     MAP_FP = os.path.join(args.datadir, 'processed/maps')
     DOC_FP = os.path.join(args.datadir, 'docs')
-    STANDARDIZED_FP = os.path.join(args.datadir, 'standardized')
-    RAW_FP = os.path.join(args.datadir, 'raw')
 
     # If maps do not exist, create
     if not os.path.exists(os.path.join(MAP_FP, 'osm_ways.shp')) \
        or args.forceupdate:
         print('Generating map from open street map...')
-        simple_get_roads(config, MAP_FP)
+        simple_get_roads(config, MAP_FP, args.datadir)
 
     if not os.path.exists(os.path.join(MAP_FP, 'osm_elements.geojson')) \
        or args.forceupdate:
@@ -543,3 +628,6 @@ if __name__ == '__main__':
             DOC_FP
         )
 
+
+if __name__ == '__main__':
+    main()
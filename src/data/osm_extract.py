@@ -0,0 +1,227 @@
+"""
+Build a city's road graph from a local OpenStreetMap extract
+
+Instead of querying Overpass through osmnx, the extract (.osm.pbf, or
+.osm XML, optionally gzipped or bzipped) is streamed once. Only the
+nodes inside the city's boundary are kept, and only the ways in osmnx's
+drive network, so a whole state extract can be read without holding it
+in memory. The graph has the same nodes, edges and attributes as
+osmnx's graph_from_polygon(network_type='drive', simplify=False), so
+osm_create_maps builds osm_ways, osm_nodes and features.geojson from it
+as usual.
+
+Like osmium and osmnx, this relies on the extract listing its nodes
+before its ways, as extracts from planet dumps and geofabrik do; an
+unsorted file can be sorted with osmium sort.
+
+Reading pbf files needs the osmium package, XML files need nothing extra.
+"""
+import bz2
+import gzip
+import math
+import re
+import xml.etree.ElementTree as ET
+import networkx as nx
+from shapely.geometry import Point
+from shapely.prepared import prep
+
+
+# osmnx's drive network filter: ways with one of these values are excluded
+DRIVE_EXCLUDE = {
+    'area': 'yes',
+    'highway': 'cycleway|footway|path|pedestrian|steps|track|corridor|'
+    'elevator|escalator|proposed|construction|bridleway|abandoned|'
+    'platform|raceway|service',
+    'motor_vehicle': 'no',
+    'motorcar': 'no',
+    'access': 'private',
+    'service': 'parking|parking_aisle|driveway|private|emergency_access',
+}
+DRIVE_EXCLUDE = {key: re.compile(value)
+                 for key, value in DRIVE_EXCLUDE.items()}
+ONEWAY_VALUES = ['yes', 'true', '1', '-1']
+NODE_TAGS = ['ref', 'highway']
+EARTH_RADIUS = 6371009
+
+
+def is_drive_way(tags):
+    """
+    Whether a way is part of osmnx's drive network
+    Args:
+        tags - dict of the way's osm tags
+    """
+    if 'highway' not in tags:
+        return False
+    for key, pattern in DRIVE_EXCLUDE.items():
+        if key in tags and pattern.search(tags[key]):
+            return False
+    return True
+
+
+def great_circle(lat1, lng1, lat2, lng2):
+    """
+    Great circle distance in meters, as osmnx computes edge lengths
+    """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_theta = math.radians(lng2) - math.radians(lng1)
+    h = math.sin(d_phi / 2) ** 2 \
+        + math.cos(phi1) * math.cos(phi2) * math.sin(d_theta / 2) ** 2
+    h = min(1.0, h)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(h))
+
+
+class GraphBuilder(object):
+    """
+    Collects the nodes and drive ways inside a boundary as an extract
+    is streamed through it
+    Args:
+        boundary - shapely polygon or multipolygon, in 4326 projection
+        way_tags - list of way tags to keep as edge attributes
+    """
+    def __init__(self, boundary, way_tags):
+        self.boundary = prep(boundary)
+        self.bounds = boundary.bounds
+        self.way_tags = way_tags
+        self.nodes = {}
+        self.ways = []
+
+    def in_bounds(self, lon, lat):
+        minx, miny, maxx, maxy = self.bounds
+        return minx <= lon <= maxx and miny <= lat <= maxy
+
+    def node(self, osmid, lon, lat, tags):
+        if self.in_bounds(lon, lat) \
+           and self.boundary.intersects(Point(lon, lat)):
+            data = {'osmid': osmid, 'x': lon, 'y': lat}
+            data.update({x: tags[x] for x in NODE_TAGS if x in tags})
+            self.nodes[osmid] = data
+
+    def way(self, osmid, refs, tags):
+        if not is_drive_way(tags):
+            return
+        if not any(x in self.nodes for x in refs):
+            return
+        data = {x: tags[x] for x in self.way_tags if x in tags}
+        data['osmid'] = osmid
+        data['oneway'] = tags.get('oneway') in ONEWAY_VALUES \
+            or tags.get('junction') == 'roundabout'
+        if tags.get('oneway') == '-1':
+            refs = list(reversed(refs))
+        self.ways.append((refs, data))
+
+    def graph(self, name='unnamed', crs=None):
+        """
+        Build the graph, keeping the largest connected component
+        Returns:
+            networkx MultiDiGraph in osmnx's format
+        """
+        G = nx.MultiDiGraph(name=name, crs=crs)
+        for osmid, data in self.nodes.items():
+            G.add_node(osmid, **data)
+
+        for refs, data in self.ways:
+            for u, v in zip(refs[:-1], refs[1:]):
+                # Edges leaving the boundary are dropped with their nodes
+                if u not in self.nodes or v not in self.nodes:
+                    continue
+                length = great_circle(
+                    self.nodes[u]['y'], self.nodes[u]['x'],
+                    self.nodes[v]['y'], self.nodes[v]['x'])
+                G.add_edge(u, v, length=length, **data)
+                if not data['oneway']:
+                    G.add_edge(v, u, length=length, **data)
+
+        # Nodes in the boundary that aren't on a drive way
+        G.remove_nodes_from([x for x in G.nodes() if not G.degree(x)])
+        if G.number_of_nodes():
+            largest = max(nx.weakly_connected_components(G), key=len)
+            G = G.subgraph(largest).copy()
+        return G
+
+
+def open_extract(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    if filename.endswith('.bz2'):
+        return bz2.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def read_xml(filename, builder):
+    """
+    Stream an osm XML extract through a GraphBuilder
+    """
+    with open_extract(filename) as f:
+        context = ET.iterparse(f, events=('start', 'end'))
+        _, root = next(context)
+        for event, element in context:
+            if event != 'end':
+                continue
+            if element.tag == 'node':
+                lon = float(element.get('lon'))
+                lat = float(element.get('lat'))
+                # Skip building tags for nodes that are clearly outside
+                if builder.in_bounds(lon, lat):
+                    builder.node(int(element.get('id')), lon, lat, {
+                        x.get('k'): x.get('v') for x in element.iter('tag')})
+            elif element.tag == 'way':
+                tags = {x.get('k'): x.get('v') for x in element.iter('tag')}
+                builder.way(int(element.get('id')),
+                            [int(x.get('ref')) for x in element.iter('nd')],
+                            tags)
+            elif element.tag != 'relation':
+                # tag, nd and member elements are read with their parent
+                continue
+            # Drop everything read so far, so the tree never grows
+            root.clear()
+
+
+def read_pbf(filename, builder):
+    """
+    Stream an osm pbf extract through a GraphBuilder
+    """
+    try:
+        import osmium
+    except ImportError:
+        raise ImportError(
+            "Reading {} needs the osmium package; ".format(filename) +
+            "osm XML extracts can be read without it")
+
+    class Handler(osmium.SimpleHandler):
+        def node(self, n):
+            lon, lat = n.location.lon, n.location.lat
+            # Skip building tags for nodes that are clearly outside
+            if builder.in_bounds(lon, lat):
+                builder.node(n.id, lon, lat, {x.k: x.v for x in n.tags})
+
+        def way(self, w):
+            if 'highway' in w.tags:
+                builder.way(w.id, [x.ref for x in w.nodes],
+                            {x.k: x.v for x in w.tags})
+
+    Handler().apply_file(filename)
+
+
+def read_graph(filename, boundary, way_tags, name='unnamed', crs=None):
+    """
+    Build the drive network graph inside a boundary from an extract
+    Args:
+        filename - .osm.pbf, .osm, .osm.gz or .osm.bz2 extract
+        boundary - shapely polygon or multipolygon, in 4326 projection
+        way_tags - list of way tags to keep as edge attributes
+        name, crs - graph attributes, as osmnx sets them
+    Returns:
+        networkx MultiDiGraph
+    """
+    builder = GraphBuilder(boundary, way_tags)
+    print("Reading roads from {}".format(filename))
+    if filename.endswith('.pbf'):
+        read_pbf(filename, builder)
+    else:
+        read_xml(filename, builder)
+    G = builder.graph(name, crs)
+    print("Read {} nodes and {} edges".format(
+        G.number_of_nodes(), G.number_of_edges()))
+    return G
@@ -0,0 +1,282 @@
+"""
+Opt-in profiling of pipeline stages and the steps inside them
+
+Code marks out the parts worth timing with the step context manager,
+which does nothing unless a profiler has been started. When one has,
+each step records its wall time, CPU time (its own process and any
+child processes it waited for), the process's peak resident memory so
+far, row counts and the sizes of the files it reads and writes. Steps
+can be nested, e.g. a pipeline stage and the functions inside it.
+
+The profiler writes a JSON report when finished. It can also dump a
+cProfile file and a tracemalloc snapshot for one chosen step, next to
+the report.
+
+pipeline.py starts a profiler with --profile. Any module with a main()
+can be profiled on its own with:
+    python -m data.profiling -o report.json data.create_segments -c ...
+"""
+import argparse
+import contextlib
+import cProfile
+import datetime
+import gzip
+import importlib
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from . import map_store
+
+
+class Step(object):
+    """
+    A timed section of code. Code inside the step can fill in the
+    row counts as it goes
+    """
+    def __init__(self, name, rows_in=None, rows_out=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = rows_out
+
+
+class Profiler(object):
+    """
+    Collects the records of each step run while it's active
+    Args:
+        report_file - where to write the JSON report
+        detail - optional name of a step to run under cProfile and
+            tracemalloc
+    """
+    active = None
+
+    def __init__(self, report_file, detail=None):
+        self.report_file = report_file
+        self.detail = detail
+        self.started = datetime.datetime.now()
+        self.start_time = time.perf_counter()
+        self.records = []
+        self.path = []
+        self.detail_files = {}
+
+    def record(self, record):
+        self.records.append(record)
+
+    def write(self):
+        directory = os.path.dirname(self.report_file)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        report = {
+            'started': self.started.isoformat(),
+            'wall_time': time.perf_counter() - self.start_time,
+            'command': sys.argv,
+            'steps': self.records,
+            'detail': self.detail_files,
+        }
+        with open(self.report_file, 'w') as f:
+            json.dump(report, f, indent=1)
+        print("Wrote profile to {}".format(self.report_file))
+
+
+def start(report_file, detail=None):
+    """
+    Start recording steps
+    Args:
+        report_file - where to write the JSON report
+        detail - optional step name to dump cProfile and tracemalloc
+            results for
+    """
+    Profiler.active = Profiler(report_file, detail)
+    return Profiler.active
+
+
+def finish():
+    """
+    Stop recording and write the report, if a profiler was started
+    """
+    if Profiler.active:
+        Profiler.active.write()
+        Profiler.active = None
+
+
+def default_report_file(datadir):
+    """
+    A new report file in a city's processed directory, named after
+    the time the run started
+    """
+    return os.path.join(
+        datadir, 'processed', 'profiles',
+        'profile_{}.json'.format(
+            datetime.datetime.now().strftime('%Y%m%d_%H%M%S')))
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """
+    Peak resident memory in megabytes
+    ru_maxrss is in kilobytes on linux, but bytes on mac
+    """
+    peak = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 1024.0 / 1024.0
+    return peak / 1024.0
+
+
+def cpu_times():
+    """
+    CPU time (user plus system) used by this process,
+    and by its finished child processes
+    """
+    times = os.times()
+    return times.user + times.system, \
+        times.children_user + times.children_system
+
+
+def count_rows(filename):
+    """
+    Count the records in a file, where that can be done cheaply
+    Args:
+        filename
+    Returns:
+        the number of rows in a csv file, of records in a json lines
+        file, or of features in a geojson file with an up to date map
+        store, otherwise None
+    """
+    if filename.endswith('.csv') or filename.endswith('.csv.gz'):
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'rb') as f:
+            return max(sum(1 for _ in f) - 1, 0)
+    if filename.endswith('.jsonl') or filename.endswith('.jsonl.gz'):
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'rb') as f:
+            return sum(1 for x in f if x.strip())
+    if filename.endswith('.geojson'):
+        return map_store.record_count(filename)
+    return None
+
+
+def file_info(filenames):
+    """
+    Size and row count of each existing file
+    Returns:
+        list of dicts with file, bytes and rows
+    """
+    info = []
+    for filename in filenames or []:
+        if os.path.isfile(filename):
+            info.append({
+                'file': filename,
+                'bytes': os.path.getsize(filename),
+                'rows': count_rows(filename),
+            })
+    return info
+
+
+@contextlib.contextmanager
+def step(name, rows_in=None, inputs=None, outputs=None):
+    """
+    Context manager for timing a step
+    Args:
+        name - name of the step, e.g. find_non_ints
+        rows_in - optional number of records going in, otherwise
+            counted from the inputs where possible
+        inputs - optional list of files the step reads
+        outputs - optional list of files the step writes
+    Yields:
+        a Step, whose rows_in and rows_out can be set inside the block
+    """
+    current = Step(name, rows_in)
+    profiler = Profiler.active
+    if not profiler:
+        yield current
+        return
+
+    profiler.path.append(name)
+    input_info = file_info(inputs)
+    detail = None
+    if name == profiler.detail:
+        tracemalloc.start()
+        detail = cProfile.Profile()
+        detail.enable()
+    start_cpu = cpu_times()
+    start_time = time.perf_counter()
+    failed = True
+    try:
+        yield current
+        failed = False
+    finally:
+        wall_time = time.perf_counter() - start_time
+        cpu_time, children_cpu_time = cpu_times()
+        if detail:
+            detail.disable()
+            dump_detail(profiler, name, detail)
+
+        path = '/'.join(profiler.path)
+        profiler.path.pop()
+        output_info = file_info(outputs)
+        profiler.record({
+            'name': name,
+            'path': path,
+            'wall_time': wall_time,
+            'cpu_time': cpu_time - start_cpu[0],
+            'children_cpu_time': children_cpu_time - start_cpu[1],
+            'peak_rss_mb': peak_rss_mb(),
+            'children_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+            'rows_in': current.rows_in if current.rows_in is not None
+            else sum_rows(input_info),
+            'rows_out': current.rows_out if current.rows_out is not None
+            else sum_rows(output_info),
+            'inputs': input_info,
+            'outputs': output_info,
+            'failed': failed,
+        })
+
+
+def dump_detail(profiler, name, detail):
+    """
+    Write the cProfile stats and a tracemalloc snapshot for a step
+    next to the report, and stop tracing memory
+    """
+    base = os.path.splitext(profiler.report_file)[0] + '_' + name
+    directory = os.path.dirname(base)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    detail.dump_stats(base + '.prof')
+    tracemalloc.take_snapshot().dump(base + '.tracemalloc')
+    tracemalloc.stop()
+    profiler.detail_files[name] = {
+        'cprofile': base + '.prof',
+        'tracemalloc': base + '.tracemalloc',
+    }
+
+
+def sum_rows(info):
+    rows = [x['rows'] for x in info or [] if x['rows'] is not None]
+    return sum(rows) if rows else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run a module's main() with profiling")
+    parser.add_argument("-o", "--output", type=str, required=True,
+                        help="JSON report file to write")
+    parser.add_argument("--detail", type=str,
+                        help="Step to dump cProfile and tracemalloc " +
+                        "results for; the module name for the whole run")
+    parser.add_argument("module", type=str,
+                        help="Module to run, e.g. data.create_segments")
+    parser.add_argument("args", nargs=argparse.REMAINDER,
+                        help="Arguments to pass to the module")
+
+    args = parser.parse_args(argv)
+    start(args.output, args.detail)
+    try:
+        with step(args.module):
+            importlib.import_module(args.module).main(args.args)
+    finally:
+        finish()
+
+
+if __name__ == '__main__':
+    main()
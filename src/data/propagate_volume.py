@@ -1,15 +1,14 @@
 import json
 import os
-import rtree
 import argparse
 from . import util
+from . import record_store
 from .record import Record
 import numpy as np
 import pandas as pd
 from pandas.io.json import json_normalize
 import geopandas as gpd
 from sklearn.neighbors import KNeighborsRegressor
-import sys
 
 
 BASE_DIR = os.path.dirname(
@@ -21,7 +20,8 @@ PROCESSED_DATA_FP = os.path.join(BASE_DIR, 'data/processed')
 STANDARDIZED_DATA_FP = os.path.join(BASE_DIR, 'data', 'standardized')
 
 
-def update_properties(segments, df, features):
+def update_properties(segments, df, features,
+                      processed_fp=PROCESSED_DATA_FP):
     """
     Takes a segment list and a dataframe, and writes out updated
     intersection and non-intersection segments
@@ -29,6 +29,7 @@ def update_properties(segments, df, features):
         segments - a list of intersection and non-intersection segments
         df - a dataframe of features
         features - a list of features to extract from the dataframe
+        processed_fp - the processed data directory
     Returns:
         nothing - writes to inter_segments.geojson and non_inter_segments.geojson
     """
@@ -52,83 +53,80 @@ def update_properties(segments, df, features):
     inters = [x for x in segments if util.is_inter(x.properties['id'])]
     non_inters = [x for x in segments if not util.is_inter(x.properties['id'])]
     util.write_segments(non_inters, inters, os.path.join(
-        PROCESSED_DATA_FP, 'maps'))
+        processed_fp, 'maps'))
 
 
-def read_volume():
+def read_volume(standardized_fp=STANDARDIZED_DATA_FP):
     """
     Read the standardized volume data, snap to nearest segments,
     and read relevant data
     Args:
-        None - reads from file
+        standardized_fp - the standardized data directory
     Returns:
         volume - a list of geojson points with volume properties
     """
     volume = []
-    with open(os.path.join(STANDARDIZED_DATA_FP, 'volume.json')) as data_file:
-        data = json.load(data_file)
-        for record in data:
-
-            if record['location']['longitude'] and record[
-                    'location']['latitude']:
-
-                properties = {
-                    'speed': record['speed']['averageSpeed'],
-                    'heavy': record['volume']['totalHeavyVehicles'],
-                    'light': record['volume']['totalLightVehicles'],
-                    'bikes': record['volume']['bikes'],
-                    'volume': record['volume']['totalVolume'],
-                    'orig': record['location']['address']
-                }
-
-                properties['location'] = {
-                    'latitude': float(record['location']['latitude']),
-                    'longitude': float(record['location']['longitude'])
-                }
-                record = Record(properties)
-
-                volume.append(record)
+    for record in record_store.iter_records(
+            os.path.join(standardized_fp, 'volume.json')):
+
+        if record['location']['longitude'] and record[
+                'location']['latitude']:
+
+            properties = {
+                'speed': record['speed']['averageSpeed'],
+                'heavy': record['volume']['totalHeavyVehicles'],
+                'light': record['volume']['totalLightVehicles'],
+                'bikes': record['volume']['bikes'],
+                'volume': record['volume']['totalVolume'],
+                'orig': record['location']['address']
+            }
+
+            properties['location'] = {
+                'latitude': float(record['location']['latitude']),
+                'longitude': float(record['location']['longitude'])
+            }
+            record = Record(properties)
+
+            volume.append(record)
 
     return [{'point': x.point, 'properties': x.properties} for x in volume]
 
     return volume
 
 
-def propagate_volume():
+def propagate_volume(processed_fp=PROCESSED_DATA_FP,
+                     standardized_fp=STANDARDIZED_DATA_FP):
     """
     Propagate volume from given volume data to other segments
     Args:
-        None - reads segment and volume data from file
+        processed_fp - the processed data directory
+        standardized_fp - the standardized data directory
     Returns:
         None - writes results to file
     """
     # Read in segments
     inter = util.read_geojson(os.path.join(
-        PROCESSED_DATA_FP, 'maps/inters_segments.geojson'))
+        processed_fp, 'maps/inters_segments.geojson'))
     non_inter = util.read_geojson(
-        os.path.join(PROCESSED_DATA_FP, 'maps/non_inters_segments.geojson'))
+        os.path.join(processed_fp, 'maps/non_inters_segments.geojson'))
     print("Read in {} intersection, {} non-intersection segments".format(
         len(inter), len(non_inter)))
 
     # Combine inter + non_inter
     combined_seg = inter + non_inter
 
-    # # Create spatial index for quick lookup
-    segments_index = rtree.index.Index()
-    for idx, element in enumerate(combined_seg):
-        segments_index.insert(idx, element.geometry.bounds)
-
-    print('Created spatial index')
-
-    volume = read_volume()
+    volume = read_volume(standardized_fp)
 
     # Find nearest atr - 20 tolerance
     print("Snapping atr to segments")
-    util.find_nearest(volume, combined_seg, segments_index, 20)
+    util.find_nearest(
+        volume,
+        util.read_segments_snapper(os.path.join(processed_fp, 'maps')),
+        20)
 
     # Should deprecate once imputed atrs are used, but for the moment
     # this is needed for make_canon_dataset
-    with open(os.path.join(PROCESSED_DATA_FP, 'snapped_atrs.json'), 'w') as f:
+    with open(os.path.join(processed_fp, 'snapped_atrs.json'), 'w') as f:
         json.dump([x['properties'] for x in volume], f)
 
     volume_df = json_normalize(volume)
@@ -233,7 +231,7 @@ def propagate_volume():
 
     # write to csv
     print('Writing to CSV')
-    output_fp = os.path.join(PROCESSED_DATA_FP, 'atrs_predicted.csv')
+    output_fp = os.path.join(processed_fp, 'atrs_predicted.csv')
     # force id into string
     merged_df['id'] = merged_df['id'].astype(str)
 
@@ -241,11 +239,12 @@ def propagate_volume():
     update_properties(
         combined_seg,
         merged_df,
-        ['volume', 'speed', 'volume_coalesced', 'speed_coalesced']
+        ['volume', 'speed', 'volume_coalesced', 'speed_coalesced'],
+        processed_fp=processed_fp
     )
 
 
-if __name__ == '__main__':
+def main(argv=None):
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--datadir", type=str,
@@ -254,15 +253,20 @@ if __name__ == '__main__':
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether force update the maps')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    processed_fp = PROCESSED_DATA_FP
+    standardized_fp = STANDARDIZED_DATA_FP
     if args.datadir:
-        PROCESSED_DATA_FP = os.path.join(args.datadir, 'processed')
-        STANDARDIZED_DATA_FP = os.path.join(args.datadir, 'standardized')
+        processed_fp = os.path.join(args.datadir, 'processed')
+        standardized_fp = os.path.join(args.datadir, 'standardized')
 
-    if not os.path.exists(os.path.join(STANDARDIZED_DATA_FP, 'volume.json')):
+    if not record_store.exists(
+            os.path.join(standardized_fp, 'volume.json')):
         print("No volumes found, skipping...")
-        sys.exit()
+        return
 
-    propagate_volume()
+    propagate_volume(processed_fp, standardized_fp)
 
 
+if __name__ == '__main__':
+    main()
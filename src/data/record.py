@@ -1,5 +1,8 @@
+import numpy as np
 from pyproj import Transformer
+from shapely.geometry import Point
 from . import util
+from . import map_store
 from dateutil.parser import parse
 
 # transformer object between 4326 projection and 3857 projection
@@ -46,10 +49,184 @@ class Record(object):
 
 
 class Crash(Record):
-    def __init__(self, properties):
-        Record.__init__(self, properties)
+    def __init__(self, properties, point=None):
+        Record.__init__(self, properties, point)
+        self._timestamp = None
 
     @property
     def timestamp(self):
-        return parse(self.properties['dateOccurred'])
+        # Parsed once, on first use
+        if self._timestamp is None:
+            self._timestamp = parse(self.properties['dateOccurred'])
+        return self._timestamp
+
+
+class RecordList(list):
+    """
+    A list of Records (or Crashes), along with their timestamps as a
+    datetime64 array, in local time, NaT where a record has none
+    """
+    def __init__(self, records, timestamps):
+        list.__init__(self, records)
+        self.timestamps = timestamps
+
+
+def object_array(values):
+    """
+    A one dimensional array of python objects
+    """
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+class RecordBatch(object):
+    """
+    Records stored as columns: arrays of their coordinates, ids,
+    timestamps and near ids, and a typed array for each other property
+    (see map_store.encode_columns), instead of an object, a properties
+    dict and a shapely point per record
+
+    Iterating over a batch gives a Record (or Crash) for each record,
+    made as it's needed, so code working on lists of records can take a
+    batch instead. Changes to those records aren't kept in the batch,
+    except that near_ids can be set directly.
+    Args:
+        lat, lon - float arrays, in 4326 projection
+        x, y - float arrays, in 3857 projection
+        ids - object array of the id properties, None where there's none
+        timestamps - datetime64 array, see util.parse_timestamps
+        near_ids - object array of the near_id properties
+        columns, encoded - the other properties, as returned by
+            map_store.encode_columns
+        record_type - 'crash' to iterate over Crashes, otherwise Records
+        order - optional list of all the property names, in the order
+            to give them in
+    """
+    def __init__(self, lat, lon, x, y, ids, timestamps, near_ids,
+                 columns, encoded, record_type='record', order=None):
+        self.lat = lat
+        self.lon = lon
+        self.x = x
+        self.y = y
+        self.ids = ids
+        self.timestamps = timestamps
+        self.near_ids = near_ids
+        self.columns = columns
+        self.encoded = encoded
+        self.record_type = record_type
+        self.order = order
+
+    # Properties kept as their own arrays
+    SPECIAL = ('id', 'near_id', 'location')
+
+    @classmethod
+    def from_items(cls, items, record_type='record', timestamps=None):
+        """
+        Make a batch from property dicts with a location
+        Args:
+            items - list of dicts, each with a location latitude and
+                longitude, as in the standardized files
+            record_type - 'crash' or 'record'
+            timestamps - optional datetime64 array, otherwise parsed
+                from dateOccurred (for crashes) or timestamp
+        """
+        lat = np.array([x['location']['latitude'] for x in items],
+                       dtype=float)
+        lon = np.array([x['location']['longitude'] for x in items],
+                       dtype=float)
+        coords = util.transform_coords(
+            np.column_stack([lon, lat]) if items else np.zeros((0, 2)),
+            transformer_4326_to_3857)
+        if timestamps is None:
+            timestamps = util.parse_timestamps([
+                x.get('dateOccurred' if record_type == 'crash'
+                      else 'timestamp') for x in items])
+
+        # Locations are rebuilt from lat and lon, unless they hold more
+        rest = []
+        for item in items:
+            location = item['location']
+            keep = len(location) != 2
+            rest.append({
+                key: value for key, value in item.items()
+                if key not in cls.SPECIAL or (key == 'location' and keep)})
+        columns, encoded = map_store.encode_columns(rest)
+
+        return cls(
+            lat, lon, coords[:, 0], coords[:, 1],
+            object_array([x.get('id') for x in items]),
+            timestamps,
+            object_array([x.get('near_id') for x in items]),
+            columns, encoded, record_type, map_store.property_order(items))
+
+    @classmethod
+    def from_records(cls, records, record_type=None):
+        """
+        Make a batch from a list of Records (or Crashes), keeping their
+        points and, for a RecordList, their timestamps
+        """
+        if record_type is None:
+            record_type = 'crash' if records \
+                and isinstance(records[0], Crash) else 'record'
+        batch = cls.from_items(
+            [x.properties for x in records], record_type,
+            getattr(records, 'timestamps', None))
+        if records:
+            batch.x = np.array([r.point.x for r in records])
+            batch.y = np.array([r.point.y for r in records])
+        return batch
+
+    def __len__(self):
+        return len(self.x)
+
+    def properties(self):
+        """
+        Generator of each record's properties dict
+        """
+        names = [name for name, _ in self.columns]
+        values = map_store.decode_columns(self.columns, self.encoded)
+        for i, row in enumerate(map_store.rows(names, values, len(self))):
+            if self.ids[i] is not None:
+                row['id'] = self.ids[i]
+            if 'location' not in row:
+                row['location'] = {
+                    'latitude': float(self.lat[i]),
+                    'longitude': float(self.lon[i]),
+                }
+            if self.near_ids[i] is not None:
+                row['near_id'] = self.near_ids[i]
+            if self.order:
+                # Any new properties, like near_id, go last
+                ordered = {x: row[x] for x in self.order if x in row}
+                ordered.update(row)
+                row = ordered
+            yield row
+
+    def points(self):
+        """
+        Shapely points in 3857 projection
+        """
+        return [Point(x, y) for x, y in zip(self.x.tolist(),
+                                            self.y.tolist())]
+
+    def __iter__(self):
+        record_class = Crash if self.record_type == 'crash' else Record
+        for properties, point in zip(self.properties(), self.points()):
+            yield record_class(properties, point)
 
+    def select(self, mask):
+        """
+        A batch of some of the records
+        Args:
+            mask - boolean array, or array of indices
+        """
+        mask = np.asarray(mask)
+        if mask.dtype == bool:
+            mask = np.flatnonzero(mask)
+        return RecordBatch(
+            self.lat[mask], self.lon[mask], self.x[mask], self.y[mask],
+            self.ids[mask], self.timestamps[mask], self.near_ids[mask],
+            self.columns,
+            [(values[mask], states[mask]) for values, states in self.encoded],
+            self.record_type, self.order)
@@ -0,0 +1,429 @@
+"""
+Reading and writing lists of records, e.g. the standardized crashes
+
+Records are written either as a single json list (the default, and what
+other tools read), or as json lines, one record per line, optionally
+gzipped. The format is chosen by the city's record_format config key,
+and shows in the file's extension: crashes.json, crashes.jsonl or
+crashes.jsonl.gz. Only one of these is kept for a file, so the stages
+refer to the file by its json name and find_file picks whichever exists.
+
+Records are read lazily, one at a time, in any of the formats (json lists
+are parsed incrementally too), optionally keeping only those in a date
+range, so that reading a file doesn't need memory for all of its records.
+A RecordReader can also pick up where an earlier read of a file stopped,
+when the file has since been rewritten with more records on the end.
+"""
+import codecs
+import gzip
+import hashlib
+import json
+import os
+from datetime import timedelta
+from dateutil.parser import parse
+
+
+# Format name and file extension, the first is the default
+FORMATS = [
+    ('json', '.json'),
+    ('jsonl', '.jsonl'),
+    ('jsonl.gz', '.jsonl.gz'),
+]
+EXTENSIONS = [x[1] for x in FORMATS]
+# Size of the pieces json lists are read in
+CHUNK_SIZE = 1 << 16
+# Number of records in a batch, see iter_batches
+BATCH_SIZE = 50000
+
+
+def split_extension(filename):
+    """
+    Split a records filename into its base and record format extension
+    """
+    # Longest first, so crashes.jsonl.gz isn't taken for crashes.jsonl
+    for extension in sorted(EXTENSIONS, key=len, reverse=True):
+        if filename.endswith(extension):
+            return filename[:-len(extension)], extension
+    return os.path.splitext(filename)
+
+
+def format_filename(filename, record_format='json'):
+    """
+    The filename records are written to in a format
+    Args:
+        filename - the file's json name, e.g. standardized/crashes.json
+        record_format - one of the names in FORMATS
+    """
+    extensions = dict(FORMATS)
+    if record_format not in extensions:
+        raise ValueError(
+            "Unknown record format {}, expected one of {}".format(
+                record_format, ', '.join(extensions)))
+    return split_extension(filename)[0] + extensions[record_format]
+
+
+def find_file(filename):
+    """
+    Find the file a list of records was written to, in whichever format
+    Args:
+        filename - the file's name in any format, e.g. crashes.json
+    Returns:
+        the existing file, or the filename given if there isn't one
+    """
+    if os.path.exists(filename):
+        return filename
+    base = split_extension(filename)[0]
+    for extension in EXTENSIONS:
+        if os.path.exists(base + extension):
+            return base + extension
+    return filename
+
+
+def exists(filename):
+    return os.path.exists(find_file(filename))
+
+
+def is_json_lines(filename):
+    return split_extension(filename)[1] != '.json'
+
+
+def open_records(filename, mode='r', compressed=None):
+    if compressed is None:
+        compressed = filename.endswith('.gz')
+    if compressed:
+        return gzip.open(filename, mode + 't')
+    return open(filename, mode)
+
+
+def decode_item(decoder, buffer, pos, eof):
+    """
+    Decode the json value starting at pos in a buffer read from a file
+    Returns:
+        the value and where it ends, or None and None if more of the
+        file is needed
+    """
+    try:
+        item, end = decoder.raw_decode(buffer, pos)
+    except ValueError:
+        if eof:
+            raise
+        return None, None
+    # Numbers and the like can't be told to be complete until something
+    # follows them
+    if end == len(buffer) and not eof:
+        return None, None
+    return item, end
+
+
+def iter_json_list(f, started=False):
+    """
+    Parse a json list from a file one item at a time
+    Args:
+        f - file to read
+        started - whether the list's opening [ (and maybe some of its
+            items) has already been read from the file
+    """
+    decoder = json.JSONDecoder()
+    buffer = f.read(CHUNK_SIZE).lstrip()
+    if started:
+        pos = 0
+    elif buffer.startswith('['):
+        pos = 1
+    else:
+        raise ValueError("Expected a json list")
+    eof = False
+
+    while True:
+        # Skip whitespace and separators
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buffer):
+            if buffer[pos] == ']':
+                return
+            item, end = decode_item(decoder, buffer, pos, eof)
+            if end is not None:
+                yield item
+                pos = end
+                continue
+        elif eof:
+            raise ValueError("Unexpected end of json list")
+
+        chunk = f.read(CHUNK_SIZE)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def date_filter(startdate=None, enddate=None, date_field='dateOccurred'):
+    """
+    Make a function telling whether a record is in a date range
+    Dates are compared on the records' local date and time, as written in
+    their iso formatted date field, without parsing them
+    Args:
+        startdate - optional first date to include
+        enddate - optional last date to include, the whole day
+        date_field - the records' iso formatted date property
+    Returns:
+        function taking a record, or None if there's no range
+    """
+    if not startdate and not enddate:
+        return None
+    start = parse(startdate).isoformat()[:19] if startdate else None
+    end = (parse(enddate) + timedelta(1)).isoformat()[:19] \
+        if enddate else None
+
+    def in_range(record):
+        date = record.get(date_field)
+        if not date:
+            return False
+        date = date[:19]
+        return (start is None or date >= start) \
+            and (end is None or date < end)
+    return in_range
+
+
+def iter_records(filename, startdate=None, enddate=None,
+                 date_field='dateOccurred'):
+    """
+    Read records one at a time, in whichever format they were written
+    Args:
+        filename - the file's name in any format, see find_file
+        startdate, enddate, date_field - optional date range to keep
+            records in, see date_filter
+    Returns:
+        generator of the records, as dicts
+    """
+    filename = find_file(filename)
+    in_range = date_filter(startdate, enddate, date_field)
+    with open_records(filename) as f:
+        if is_json_lines(filename):
+            records = (json.loads(line) for line in f if line.strip())
+        else:
+            records = iter_json_list(f)
+        for record in records:
+            if in_range is None or in_range(record):
+                yield record
+
+
+class HashingFile(object):
+    """
+    Wrap a binary file, keeping the size and hash of what's been read
+    from it, and decoding it for iter_json_list
+    Args:
+        f - file opened in binary mode
+        sha - hash of what's already been read
+        size - number of bytes already read
+        json_list - if True, the closing ] of a json list and the white
+            space around it aren't counted until something follows them,
+            so that at the end the size and hash are of the list up to
+            the end of its last item
+    """
+    def __init__(self, f, sha, size, json_list):
+        self.f = f
+        self.sha = sha
+        self.size = size
+        self.json_list = json_list
+        self.pending = b''
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def update(self, data):
+        data = self.pending + data
+        end = len(data)
+        if self.json_list:
+            stripped = data.rstrip()
+            if stripped.endswith(b']'):
+                stripped = stripped[:-1].rstrip()
+            end = len(stripped)
+        self.pending = data[end:]
+        self.sha.update(data[:end])
+        self.size += end
+
+    def read(self, size):
+        chunk = self.f.read(size)
+        self.update(chunk)
+        return self.decoder.decode(chunk, final=not chunk)
+
+    def __iter__(self):
+        for line in self.f:
+            self.update(line)
+            yield line
+
+
+class RecordReader(object):
+    """
+    Read the records of a file one at a time, like iter_records, only
+    reading those after the ones an earlier reader read, if the file
+    still starts with the same bytes
+    That's the case when a stage writes a file again with more records
+    on the end, as the standardization stages do when there's more raw
+    data. The file is still read through to check it, but only the new
+    records are parsed. Otherwise all of the records are read.
+    Once all the records have been read, watermark has the point reached,
+    for the next reader of the file
+    Args:
+        filename - the file's name in any format, see find_file
+        watermark - dict, from an earlier reader of the file, or None
+    """
+    def __init__(self, filename, watermark=None):
+        self.filename = find_file(filename)
+        self.previous = watermark
+        self.resumed = False
+        self.watermark = None
+
+    def open(self):
+        if self.filename.endswith('.gz'):
+            return gzip.open(self.filename, 'rb')
+        return open(self.filename, 'rb')
+
+    def read_prefix(self, f):
+        """
+        Read as far as the earlier reader did
+        Returns:
+            the hash so far, or None if the file doesn't start the same
+        """
+        watermark = self.previous
+        if not watermark or watermark['extension'] \
+           != split_extension(self.filename)[1]:
+            return None
+        sha = hashlib.sha256()
+        remaining = watermark['bytes']
+        last = b''
+        while remaining:
+            chunk = f.read(min(remaining, CHUNK_SIZE))
+            if not chunk:
+                return None
+            sha.update(chunk)
+            remaining -= len(chunk)
+            last = chunk[-1:]
+        # Json lines can only be picked up after a whole line
+        if sha.hexdigest() != watermark['hash'] \
+           or (is_json_lines(self.filename) and last not in (b'', b'\n')):
+            return None
+        return sha
+
+    def __iter__(self):
+        json_lines = is_json_lines(self.filename)
+        with self.open() as f:
+            sha = self.read_prefix(f)
+            self.resumed = sha is not None
+            if self.resumed:
+                size = self.previous['bytes']
+            else:
+                f.seek(0)
+                sha = hashlib.sha256()
+                size = 0
+            hashing = HashingFile(f, sha, size, not json_lines)
+            if json_lines:
+                records = (json.loads(x) for x in hashing if x.strip())
+            else:
+                records = iter_json_list(hashing, started=self.resumed)
+            for record in records:
+                yield record
+        self.watermark = {
+            'extension': split_extension(self.filename)[1],
+            'bytes': hashing.size,
+            'hash': hashing.sha.hexdigest(),
+        }
+
+
+def iter_batches(filename, size=None):
+    """
+    Read records in lists of up to size (by default BATCH_SIZE) records,
+    see iter_records
+    """
+    size = size or BATCH_SIZE
+    batch = []
+    for record in iter_records(filename):
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_records(filename, startdate=None, enddate=None,
+                 date_field='dateOccurred'):
+    """
+    Read a list of records, see iter_records
+    """
+    return list(iter_records(filename, startdate, enddate, date_field))
+
+
+class RecordWriter(object):
+    """
+    Write records one at a time, in the format given by the filename's
+    extension
+    They're written to a temporary file that replaces the file when the
+    writer is closed, removing the file in any other format, so that a
+    writer that's given up on (or left by an exception, when used as a
+    context manager) leaves the file alone
+    A json list is written exactly as json.dump would
+    Args:
+        filename - file to write, e.g. crashes.jsonl.gz
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.temp_file = filename + '.tmp'
+        self.json_lines = is_json_lines(filename)
+        self.count = 0
+        self.f = open_records(self.temp_file, 'w',
+                              compressed=filename.endswith('.gz'))
+        if not self.json_lines:
+            self.f.write('[')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, record):
+        if self.json_lines:
+            self.f.write(json.dumps(record) + '\n')
+        else:
+            if self.count:
+                self.f.write(', ')
+            self.f.write(json.dumps(record))
+        self.count += 1
+
+    def close(self):
+        if not self.json_lines:
+            self.f.write(']')
+        self.f.close()
+        os.replace(self.temp_file, self.filename)
+        remove_other_formats(self.filename)
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.temp_file)
+
+
+def write_records(filename, records):
+    """
+    Write records one at a time, see RecordWriter; if reading the
+    records raises an exception the file is left alone
+    Args:
+        filename - file to write, e.g. crashes.jsonl.gz
+        records - list (or any iterable) of dicts
+    Returns:
+        the number of records written
+    """
+    with RecordWriter(filename) as writer:
+        for record in records:
+            writer.write(record)
+    return writer.count
+
+
+def remove_other_formats(filename):
+    """
+    Remove the other formats of a records file, so they aren't read
+    instead of it
+    """
+    base, extension = split_extension(filename)
+    for other in EXTENSIONS:
+        if other != extension and os.path.exists(base + other):
+            os.remove(base + other)
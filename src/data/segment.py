@@ -1,3 +1,8 @@
+import numpy as np
+from shapely.geometry import Point, LineString, Polygon, MultiPoint, \
+    MultiLineString, MultiPolygon, GeometryCollection
+from . import map_store
+
 
 class Segment(object):
     "A segment contains a dict of properties and a shapely shape"
@@ -34,3 +39,246 @@ class IntersectionBuffer(object):
     def __init__(self, buffer, points):
         self.buffer = buffer
         self.points = points
+
+
+# Geometry types a SegmentBatch can hold, collections only when empty
+GEOMETRY_TYPES = ['Point', 'LineString', 'Polygon', 'MultiPoint',
+                  'MultiLineString', 'MultiPolygon', 'GeometryCollection']
+
+
+def geometry_parts(geometry):
+    """
+    Break a geometry into parts, each a list of rings of coordinates
+    (a point or a line is one part of one ring)
+    """
+    if geometry.is_empty:
+        return []
+    if geometry.geom_type in ('Point', 'LineString'):
+        return [[geometry.coords]]
+    if geometry.geom_type == 'Polygon':
+        return [[geometry.exterior.coords]
+                + [x.coords for x in geometry.interiors]]
+    if geometry.geom_type.startswith('Multi'):
+        parts = []
+        for geom in geometry.geoms:
+            parts += geometry_parts(geom)
+        return parts
+    raise ValueError("Can't store a {} in a SegmentBatch".format(
+        geometry.geom_type))
+
+
+class SegmentBatch(object):
+    """
+    Segments stored as columns: their coordinates in one shared array,
+    with offsets giving where each geometry's parts and rings start, an
+    id array, and a typed array for each other property (see
+    map_store.encode_columns), instead of a Segment object, a properties
+    dict and a shapely geometry per segment
+
+    Iterating over a batch gives a Segment for each segment, made as
+    it's needed, so code working on lists of segments can take a batch
+    instead. Changes to those segments aren't kept in the batch.
+    Args:
+        types - uint8 array, each geometry's position in GEOMETRY_TYPES
+        geom_offsets - geometry i's parts are
+            geom_offsets[i]:geom_offsets[i + 1]
+        part_offsets - and part j's rings part_offsets[j]:part_offsets[j + 1]
+        ring_offsets - and ring k's coordinates
+            ring_offsets[k]:ring_offsets[k + 1]
+        coords - (n, 2) float array, in 3857 projection
+        ids - object array of the id properties, None where there's none
+        columns, encoded - the other properties, as returned by
+            map_store.encode_columns
+        order - optional list of all the property names, in the order
+            to give them in
+    """
+    def __init__(self, types, geom_offsets, part_offsets, ring_offsets,
+                 coords, ids, columns, encoded, order=None):
+        self.types = types
+        self.geom_offsets = geom_offsets
+        self.part_offsets = part_offsets
+        self.ring_offsets = ring_offsets
+        self.coords = coords
+        self.ids = ids
+        self.columns = columns
+        self.encoded = encoded
+        self.order = order
+
+    @classmethod
+    def from_geometries(cls, geometries, properties):
+        """
+        Make a batch from shapely geometries and their properties
+        Args:
+            geometries - list of shapely geometries, in 3857 projection
+            properties - list of dicts, one per geometry
+        """
+        types = []
+        geom_offsets = [0]
+        part_offsets = [0]
+        ring_offsets = [0]
+        coords = []
+        for geometry in geometries:
+            parts = geometry_parts(geometry)
+            types.append(GEOMETRY_TYPES.index(geometry.geom_type))
+            for part in parts:
+                for ring in part:
+                    # Dropping any z values
+                    ring = np.asarray(ring, dtype=float)
+                    ring = ring.reshape(len(ring), -1)[:, :2] \
+                        if ring.size else np.zeros((0, 2))
+                    coords.append(ring)
+                    ring_offsets.append(ring_offsets[-1] + len(ring))
+                part_offsets.append(len(ring_offsets) - 1)
+            geom_offsets.append(len(part_offsets) - 1)
+
+        columns, encoded = map_store.encode_columns([
+            {key: value for key, value in x.items() if key != 'id'}
+            for x in properties])
+        ids = np.empty(len(properties), dtype=object)
+        ids[:] = [x.get('id') for x in properties]
+        return cls(
+            np.array(types, dtype=np.uint8),
+            np.array(geom_offsets, dtype=np.int64),
+            np.array(part_offsets, dtype=np.int64),
+            np.array(ring_offsets, dtype=np.int64),
+            np.vstack(coords) if coords else np.zeros((0, 2)),
+            ids, columns, encoded, map_store.property_order(properties))
+
+    @classmethod
+    def from_segments(cls, segments):
+        """
+        Make a batch from a list of Segments, or anything else with a
+        shapely geometry and a properties dict
+        """
+        return cls.from_geometries([x.geometry for x in segments],
+                                   [x.properties for x in segments])
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Make a batch from a list of dicts with a geometry and properties,
+        as map_store.read_records and util.reproject_records give
+        """
+        return cls.from_geometries([x['geometry'] for x in records],
+                                   [x['properties'] for x in records])
+
+    def __len__(self):
+        return len(self.types)
+
+    def geometry(self, i):
+        """
+        Geometry i, as a shapely geometry
+        """
+        parts = []
+        for j in range(self.geom_offsets[i], self.geom_offsets[i + 1]):
+            parts.append([
+                self.coords[self.ring_offsets[k]:self.ring_offsets[k + 1]]
+                for k in range(self.part_offsets[j],
+                               self.part_offsets[j + 1])])
+
+        geom_type = GEOMETRY_TYPES[self.types[i]]
+        if geom_type == 'Point':
+            return Point(parts[0][0][0]) if parts else Point()
+        if geom_type == 'LineString':
+            return LineString(parts[0][0]) if parts else LineString()
+        if geom_type == 'Polygon':
+            return Polygon(parts[0][0], parts[0][1:]) if parts \
+                else Polygon()
+        if geom_type == 'MultiPoint':
+            return MultiPoint([x[0][0] for x in parts])
+        if geom_type == 'MultiLineString':
+            return MultiLineString([x[0] for x in parts])
+        if geom_type == 'MultiPolygon':
+            return MultiPolygon([(x[0], x[1:]) for x in parts])
+        return GeometryCollection()
+
+    def geometries(self):
+        return [self.geometry(i) for i in range(len(self))]
+
+    def coord_ranges(self):
+        """
+        Where each geometry's coordinates start and end
+        Returns:
+            two int arrays
+        """
+        rings = self.part_offsets[self.geom_offsets]
+        coords = self.ring_offsets[rings]
+        return coords[:-1], coords[1:]
+
+    def bounds(self):
+        """
+        Each geometry's bounds, all at once
+        Returns:
+            (n, 4) float array of minx, miny, maxx, maxy, nan for empty
+            geometries
+        """
+        starts, ends = self.coord_ranges()
+        bounds = np.full((len(self), 4), np.nan)
+        filled = ends > starts
+        if filled.any():
+            starts = starts[filled]
+            bounds[filled, :2] = np.minimum.reduceat(
+                self.coords, starts, axis=0)
+            bounds[filled, 2:] = np.maximum.reduceat(
+                self.coords, starts, axis=0)
+        return bounds
+
+    def properties(self):
+        """
+        Generator of each segment's properties dict
+        """
+        names = [name for name, _ in self.columns]
+        values = map_store.decode_columns(self.columns, self.encoded)
+        for i, row in enumerate(map_store.rows(names, values, len(self))):
+            if self.ids[i] is not None:
+                row['id'] = self.ids[i]
+            if self.order:
+                # Any new properties, like near_id, go last
+                ordered = {x: row[x] for x in self.order if x in row}
+                ordered.update(row)
+                row = ordered
+            yield row
+
+    def __iter__(self):
+        for i, properties in enumerate(self.properties()):
+            yield Segment(self.geometry(i), properties)
+
+    def select(self, mask):
+        """
+        A batch of some of the segments
+        Args:
+            mask - boolean array, or array of indices
+        """
+        mask = np.asarray(mask)
+        if mask.dtype == bool:
+            mask = np.flatnonzero(mask)
+        mask = mask.astype(np.int64)
+
+        # Copy the selected geometries' parts, rings and coordinates
+        part_counts = self.geom_offsets[mask + 1] - self.geom_offsets[mask]
+        parts = ranges(self.geom_offsets[mask], part_counts)
+        ring_counts = self.part_offsets[parts + 1] - self.part_offsets[parts]
+        rings = ranges(self.part_offsets[parts], ring_counts)
+        coord_counts = self.ring_offsets[rings + 1] - self.ring_offsets[rings]
+        coords = ranges(self.ring_offsets[rings], coord_counts)
+
+        return SegmentBatch(
+            self.types[mask],
+            offsets(part_counts), offsets(ring_counts),
+            offsets(coord_counts), self.coords[coords],
+            self.ids[mask], self.columns,
+            [(values[mask], states[mask]) for values, states in self.encoded],
+            self.order)
+
+
+def offsets(counts):
+    return np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+
+def ranges(starts, counts):
+    """
+    The indices start:start + count for each start and count, together
+    """
+    total = int(counts.sum())
+    return np.arange(total, dtype=np.int64) - np.repeat(
+        np.cumsum(counts) - counts - starts, counts)
@@ -0,0 +1,328 @@
+"""
+Batch snapping of points to their nearest segment
+
+Segment geometries are flattened once into arrays of line pieces, so
+that the distances from a whole batch of points to all of their candidate
+segments can be computed with numpy instead of one shapely call per pair.
+"""
+import json
+import os
+import numpy as np
+from .segment import ranges
+
+
+# Number of points to snap at a time, to bound memory use
+BATCH_SIZE = 50000
+
+# Bump when the saved format changes, so old files get rebuilt
+INDEX_VERSION = 1
+
+
+def geometry_coords(geometry):
+    """
+    Get the coordinate sequences that make up a geometry
+    Args:
+        geometry - a shapely geometry
+    Returns:
+        list of numpy arrays of shape (n, 2)
+    """
+    if geometry.is_empty:
+        return []
+    if hasattr(geometry, 'geoms'):
+        coords = []
+        for geom in geometry.geoms:
+            coords += geometry_coords(geom)
+        return coords
+    if geometry.geom_type == 'Polygon':
+        return [np.asarray(ring.coords)[:, :2] for ring in
+                [geometry.exterior] + list(geometry.interiors)]
+    return [np.asarray(geometry.coords)[:, :2]]
+
+
+class SegmentSnapper(object):
+    """
+    Finds the nearest segment to each of a batch of points
+    Candidate segments are looked up with a grid hash of the segments'
+    bounds, which can be queried for all the points at once
+    Args:
+        segments - list of objects with a shapely geometry attribute
+            and an id property
+    """
+    def __init__(self, segments):
+        self.ids = [segment.properties['id'] for segment in segments]
+        starts = []
+        ends = []
+        counts = np.zeros(len(segments), dtype=np.int64)
+        bounds = np.full((len(segments), 4), np.nan)
+        for i, segment in enumerate(segments):
+            for coords in geometry_coords(segment.geometry):
+                if len(coords) == 1:
+                    # A single point, treated as a zero length piece
+                    coords = np.vstack([coords, coords])
+                starts.append(coords[:-1])
+                ends.append(coords[1:])
+                counts[i] += len(coords) - 1
+            if counts[i]:
+                bounds[i] = segment.geometry.bounds
+
+        if starts:
+            self.starts = np.vstack(starts)
+            self.ends = np.vstack(ends)
+        else:
+            self.starts = np.zeros((0, 2))
+            self.ends = np.zeros((0, 2))
+        # The pieces of segment i are offsets[i]:offsets[i] + counts[i]
+        self.counts = counts
+        self.offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        self.bounds = bounds
+
+        self.init_grid()
+
+    @classmethod
+    def from_batch(cls, batch):
+        """
+        Make a snapper from a SegmentBatch, flattening its coordinate
+        arrays directly instead of each segment's geometry
+        """
+        counts = np.diff(batch.ring_offsets)
+        # A single point is treated as a zero length piece
+        pieces = np.where(counts > 1, counts - 1, counts)
+        starts = ranges(batch.ring_offsets[:-1], pieces)
+        ends = starts + np.repeat(counts > 1, pieces)
+
+        rings = np.diff(batch.part_offsets[batch.geom_offsets])
+        ring_segments = np.repeat(np.arange(len(batch)), rings)
+
+        snapper = cls.__new__(cls)
+        snapper.ids = batch.ids.tolist()
+        snapper.starts = batch.coords[starts]
+        snapper.ends = batch.coords[ends]
+        snapper.counts = np.bincount(
+            ring_segments, weights=pieces, minlength=len(batch)
+        ).astype(np.int64)
+        snapper.offsets = np.concatenate(
+            [[0], np.cumsum(snapper.counts)[:-1]]).astype(np.int64)
+        snapper.bounds = batch.bounds()
+        snapper.init_grid()
+        return snapper
+
+    def init_grid(self):
+        # Grid cells are roughly the size of a typical segment
+        has_geometry = self.counts > 0
+        bounds = self.bounds[has_geometry]
+        sizes = np.maximum(bounds[:, 2] - bounds[:, 0],
+                           bounds[:, 3] - bounds[:, 1])
+        self.cell_size = float(np.median(sizes)) if len(sizes) else 1.0
+        self.cell_size = max(self.cell_size, 1.0)
+        self.grid_tolerance = None
+
+    def save(self, filename, source=None):
+        """
+        Save the flattened segments, so they don't need to be read and
+        flattened again
+        Args:
+            filename - .npz file to write
+            source - optional json serializable description of the files
+                the segments were read from, checked by load
+        """
+        # Write to a temporary file first, so a partly written
+        # file is never loaded
+        tmp_filename = filename + '.tmp.npz'
+        np.savez(
+            tmp_filename,
+            starts=self.starts,
+            ends=self.ends,
+            counts=self.counts,
+            bounds=self.bounds,
+            ids=np.array(json.dumps(self.ids)),
+            source=np.array(json.dumps([INDEX_VERSION, source])),
+        )
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename, source=None):
+        """
+        Load saved segments
+        Args:
+            filename - .npz file written by save
+            source - if given, must match what was given to save
+        Returns:
+            a SegmentSnapper, or None if the file doesn't exist or
+            is out of date
+        """
+        if not os.path.exists(filename):
+            return None
+        with np.load(filename) as saved:
+            if json.loads(str(saved['source'])) != \
+               json.loads(json.dumps([INDEX_VERSION, source])):
+                return None
+            snapper = cls.__new__(cls)
+            snapper.starts = saved['starts']
+            snapper.ends = saved['ends']
+            snapper.counts = saved['counts']
+            snapper.bounds = saved['bounds']
+            snapper.ids = json.loads(str(saved['ids']))
+        snapper.offsets = np.concatenate(
+            [[0], np.cumsum(snapper.counts)[:-1]])
+        snapper.init_grid()
+        return snapper
+
+    def build_grid(self, tolerance):
+        """
+        Hash each segment into every cell its bounds, expanded by
+        tolerance, overlap, as sorted arrays of cell keys and segments
+        """
+        segs = np.nonzero(self.counts > 0)[0]
+        cell_mins = np.floor(
+            (self.bounds[segs, :2] - tolerance) / self.cell_size
+        ).astype(np.int64)
+        cell_maxs = np.floor(
+            (self.bounds[segs, 2:] + tolerance) / self.cell_size
+        ).astype(np.int64)
+        widths = cell_maxs[:, 0] - cell_mins[:, 0] + 1
+        heights = cell_maxs[:, 1] - cell_mins[:, 1] + 1
+        num_cells = widths * heights
+
+        cell_segs = np.repeat(segs, num_cells)
+        # Position of each cell within its segment's block of cells
+        within = np.arange(num_cells.sum()) - np.repeat(
+            np.cumsum(num_cells) - num_cells, num_cells)
+        cell_xs = np.repeat(cell_mins[:, 0], num_cells) \
+            + within % np.repeat(widths, num_cells)
+        cell_ys = np.repeat(cell_mins[:, 1], num_cells) \
+            + within // np.repeat(widths, num_cells)
+
+        keys = cell_key(cell_xs, cell_ys)
+        order = np.argsort(keys, kind='mergesort')
+        self.grid_keys = keys[order]
+        self.grid_segs = cell_segs[order]
+        self.grid_tolerance = tolerance
+
+    def candidates(self, xs, ys, tolerance):
+        """
+        Find the segments whose bounds are within tolerance of each point
+        Returns:
+            two arrays, of point positions and segment positions
+        """
+        if self.grid_tolerance != tolerance:
+            self.build_grid(tolerance)
+
+        keys = cell_key(
+            np.floor(xs / self.cell_size).astype(np.int64),
+            np.floor(ys / self.cell_size).astype(np.int64))
+        lefts = np.searchsorted(self.grid_keys, keys, side='left')
+        rights = np.searchsorted(self.grid_keys, keys, side='right')
+        num = rights - lefts
+
+        point_idx = np.repeat(np.arange(len(xs)), num)
+        seg_idx = self.grid_segs[
+            np.arange(num.sum()) - np.repeat(np.cumsum(num) - num, num)
+            + np.repeat(lefts, num)]
+
+        # Cells are coarser than the bounds, so check the bounds themselves
+        bounds = self.bounds[seg_idx]
+        x = xs[point_idx]
+        y = ys[point_idx]
+        overlaps = (bounds[:, 0] <= x + tolerance) \
+            & (bounds[:, 2] >= x - tolerance) \
+            & (bounds[:, 1] <= y + tolerance) \
+            & (bounds[:, 3] >= y - tolerance)
+
+        return point_idx[overlaps], seg_idx[overlaps]
+
+    def snap(self, xs, ys, tolerance):
+        """
+        Find the nearest segment to each point, considering the segments
+        whose bounding box is within tolerance of the point
+        Args:
+            xs - array of x coordinates, in the segments' projection
+            ys - array of y coordinates
+            tolerance - max units distance from a point to the bounding
+                box of a segment
+        Returns:
+            an array of the position of the nearest segment for each
+            point (-1 if there was no segment nearby), and an array of
+            distances to that segment (inf if there was none)
+        """
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        nearest = np.full(len(xs), -1, dtype=np.int64)
+        distances = np.full(len(xs), np.inf)
+
+        for start in range(0, len(xs), BATCH_SIZE):
+            end = start + BATCH_SIZE
+            nearest[start:end], distances[start:end] = self._snap_batch(
+                xs[start:end], ys[start:end], tolerance)
+
+        return nearest, distances
+
+    def _snap_batch(self, xs, ys, tolerance):
+        nearest = np.full(len(xs), -1, dtype=np.int64)
+        distances = np.full(len(xs), np.inf)
+
+        point_idx, seg_idx = self.candidates(xs, ys, tolerance)
+        if not len(point_idx):
+            return nearest, distances
+
+        # Expand each (point, segment) pair into (point, piece) pairs
+        counts = self.counts[seg_idx]
+        pair_starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        piece_idx = np.arange(counts.sum()) \
+            - np.repeat(pair_starts, counts) \
+            + np.repeat(self.offsets[seg_idx], counts)
+        pair_distances = np.minimum.reduceat(
+            point_piece_distance(
+                np.repeat(xs[point_idx], counts),
+                np.repeat(ys[point_idx], counts),
+                self.starts[piece_idx],
+                self.ends[piece_idx]),
+            pair_starts)
+
+        # For each point, the closest segment, with ties going to
+        # the segment that comes first
+        order = np.lexsort((seg_idx, pair_distances, point_idx))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = point_idx[order][1:] != point_idx[order][:-1]
+        best = order[first]
+        nearest[point_idx[best]] = seg_idx[best]
+        distances[point_idx[best]] = pair_distances[best]
+
+        return nearest, distances
+
+
+def cell_key(cell_xs, cell_ys):
+    """
+    Combine grid cell coordinates into a single integer key
+    """
+    return (cell_xs << 32) + (cell_ys & 0xFFFFFFFF)
+
+
+def point_piece_distance(xs, ys, starts, ends):
+    """
+    Distance from each point to the corresponding straight line piece
+    Args:
+        xs, ys - arrays of point coordinates
+        starts, ends - arrays of shape (n, 2) of piece endpoints
+    Returns:
+        array of distances
+    """
+    dx = ends[:, 0] - starts[:, 0]
+    dy = ends[:, 1] - starts[:, 1]
+    length_sq = dx * dx + dy * dy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = ((xs - starts[:, 0]) * dx + (ys - starts[:, 1]) * dy) / length_sq
+    t = np.where(length_sq > 0, np.clip(t, 0, 1), 0)
+    return np.hypot(xs - (starts[:, 0] + t * dx), ys - (starts[:, 1] + t * dy))
+
+
+def snap_points(xs, ys, segments, tolerance=30):
+    """
+    Convenience function to snap one batch of points
+    Args:
+        xs, ys - coordinate arrays
+        segments - list of objects with a shapely geometry attribute
+        tolerance
+    Returns:
+        nearest segment positions and distances, as in SegmentSnapper.snap
+    """
+    return SegmentSnapper(segments).snap(xs, ys, tolerance)
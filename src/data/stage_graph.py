@@ -0,0 +1,586 @@
+"""
+Stage graph for running the pipeline in a single process
+
+Each stage wraps the main() of one of the pipeline's modules, and declares
+the files it reads, the files it writes, and the sections of the city's
+config file it depends on. A manifest of content hashes, stored in the
+city's processed directory, is used to decide which stages are stale.
+
+A stage's signature is a hash of its config sections and its inputs.
+Inputs that are written by an earlier stage are identified by the hash
+recorded when that stage finished (so files rewritten in place by a later
+stage, e.g. osm_elements.geojson after the waze stage, don't make earlier
+stages look stale), and all other inputs by their content hash.
+"""
+import glob
+import hashlib
+import importlib
+import json
+import os
+import yaml
+import data.config
+from . import profiling
+from . import record_store
+
+
+MANIFEST_FILE = 'manifest.json'
+STEPS = ['standardization', 'generation', 'model', 'visualization']
+
+# Config sections that determine the feature list
+FEATURE_KEYS = [
+    'openstreetmap_features',
+    'waze_features',
+    'additional_map_features',
+    'data_source',
+    'atr',
+    'atr_cols',
+    'tmc',
+    'tmc_cols',
+    'speed_limit',
+]
+
+# Segment files are rewritten in place by add_map and propagate_volume
+SEGMENT_FILES = [
+    'processed/maps/inters_segments.geojson',
+    'processed/maps/non_inters_segments.geojson',
+    'processed/maps/inter_and_non_int.geojson',
+]
+
+
+class StageContext(object):
+    """
+    The paths and config shared by all the stages of a city's run
+    """
+    def __init__(self, config_file, datadir):
+        self.config_file = config_file
+        self.datadir = datadir
+        self.config = data.config.Configuration(config_file)
+        with open(config_file) as f:
+            self.config_dict = yaml.safe_load(f)
+
+    def path(self, *parts):
+        return os.path.join(self.datadir, *parts)
+
+    def record_file(self, filename):
+        """
+        A records file's name in the city's record format, e.g.
+        standardized/crashes.jsonl.gz for standardized/crashes.json
+        """
+        return record_store.format_filename(
+            filename, self.config.record_format)
+
+    @property
+    def extra_maps(self):
+        # Maps generated from each extra map are written to a subdirectory
+        # of the maps directory, named after the map
+        return self.config.extra_maps
+
+    @property
+    def split_suffixes(self):
+        if self.config.split_columns:
+            return ['_' + x for x in self.config.split_columns]
+        return ['']
+
+
+class Stage(object):
+    """
+    A single step of the pipeline
+    Args:
+        name - unique name of the stage
+        step - which of STEPS the stage belongs to
+        run - function taking a StageContext and a forceupdate boolean
+        inputs - list of paths (relative to the data directory) or glob
+            patterns, or a function taking a StageContext returning the same
+        outputs - list or function, as with inputs, but no globs
+        config_keys - top level config file keys the stage depends on
+        enabled - optional function taking a StageContext, returning
+            whether the stage applies to this city
+    """
+    def __init__(self, name, step, run, inputs=None, outputs=None,
+                 config_keys=None, enabled=None):
+        self.name = name
+        self.step = step
+        self.run = run
+        self.inputs = inputs or []
+        self.outputs = outputs or []
+        self.config_keys = config_keys or []
+        self.enabled = enabled
+
+    def is_enabled(self, ctx):
+        return self.enabled is None or bool(self.enabled(ctx))
+
+    def input_files(self, ctx):
+        files = []
+        for pattern in resolve_paths(self.inputs, ctx):
+            matches = sorted(glob.glob(pattern))
+            if matches:
+                files.extend(x for x in matches if os.path.isfile(x))
+            elif not glob.has_magic(pattern):
+                # Keep missing inputs, so that their appearance
+                # makes the stage stale
+                files.append(pattern)
+        return files
+
+    def output_files(self, ctx):
+        return resolve_paths(self.outputs, ctx)
+
+
+def resolve_paths(paths, ctx):
+    """
+    Turn a list (or function returning a list) of paths relative to the
+    data directory into full paths
+    """
+    if callable(paths):
+        paths = paths(ctx)
+    return [x if os.path.isabs(x) else ctx.path(x) for x in paths]
+
+
+def file_digest(filename):
+    """
+    sha256 of a file's contents, read in chunks
+    """
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class Manifest(object):
+    """
+    The record of each stage's last successful run
+    Stored as json with the keys:
+        stages - for each stage, the signature it was run with and the
+            hashes of the outputs it wrote
+        files - size, mtime and hash for each file hashed, so unchanged
+            files don't need to be read again
+    """
+    def __init__(self, filename, datadir):
+        self.filename = filename
+        self.datadir = datadir
+        self.stages = {}
+        self.files = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                contents = json.load(f)
+            self.stages = contents['stages']
+            self.files = contents['files']
+
+    def key(self, filename):
+        return os.path.relpath(filename, self.datadir)
+
+    def file_hash(self, filename):
+        """
+        Content hash of a file, or None if it doesn't exist
+        """
+        if not os.path.exists(filename):
+            return None
+        stat = os.stat(filename)
+        key = self.key(filename)
+        cached = self.files.get(key)
+        if cached and cached[0] == stat.st_size \
+           and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = file_digest(filename)
+        self.files[key] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def record(self, stage_name, signature, outputs):
+        self.stages[stage_name] = {
+            'signature': signature,
+            'outputs': {
+                self.key(x): self.file_hash(x)
+                for x in outputs if os.path.exists(x)
+            }
+        }
+
+    def save(self):
+        directory = os.path.dirname(self.filename)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.filename, 'w') as f:
+            json.dump({'stages': self.stages, 'files': self.files}, f,
+                      indent=1, sort_keys=True)
+
+
+def stage_signature(stage, ctx, manifest, producers):
+    """
+    Hash a stage's config sections and inputs
+    Args:
+        stage - Stage object
+        ctx - StageContext
+        manifest - Manifest
+        producers - dict of file key to the name of the last stage
+            (before this one) that wrote it
+    Returns:
+        hex digest string
+    """
+    sha = hashlib.sha256()
+    sha.update(stage.name.encode('utf-8'))
+    for key in stage.config_keys:
+        sha.update(json.dumps(
+            [key, ctx.config_dict.get(key)],
+            sort_keys=True, default=str).encode('utf-8'))
+
+    for filename in stage.input_files(ctx):
+        key = manifest.key(filename)
+        digest = None
+        producer = producers.get(key)
+        if producer in manifest.stages:
+            digest = manifest.stages[producer]['outputs'].get(key)
+        if digest is None:
+            digest = manifest.file_hash(filename)
+        sha.update(json.dumps([key, digest]).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def run_stages(stages, ctx, steps=None, forceupdate=False):
+    """
+    Run the stale stages, in order
+    Args:
+        stages - list of Stage objects, in dependency order
+        ctx - StageContext
+        steps - optional list of steps to limit the run to
+        forceupdate - if True, run every stage regardless of the manifest
+    Returns:
+        the names of the stages that were run
+    """
+    manifest = Manifest(ctx.path('processed', MANIFEST_FILE), ctx.datadir)
+    producers = {}
+    ran = []
+
+    for stage in stages:
+        if not stage.is_enabled(ctx):
+            print("{} does not apply, skipping".format(stage.name))
+            continue
+
+        outputs = stage.output_files(ctx)
+        if not steps or stage.step in steps:
+            signature = stage_signature(stage, ctx, manifest, producers)
+            previous = manifest.stages.get(stage.name)
+
+            changed = forceupdate or previous is None \
+                or previous['signature'] != signature
+            # Outputs that were written last time but have since gone missing
+            missing = previous is not None and [
+                x for x in previous['outputs']
+                if not os.path.exists(ctx.path(x))]
+
+            if changed or missing:
+                print("Running stage {}".format(stage.name))
+                with profiling.step(stage.name,
+                                    inputs=stage.input_files(ctx),
+                                    outputs=outputs):
+                    stage.run(ctx, changed)
+                # Hash again, in case the stage changed one of its inputs
+                signature = stage_signature(
+                    stage, ctx, manifest, producers)
+                manifest.record(stage.name, signature, outputs)
+                manifest.save()
+                ran.append(stage.name)
+            else:
+                print("{} is up to date, skipping".format(stage.name))
+
+        for filename in outputs:
+            producers[manifest.key(filename)] = stage.name
+
+    return ran
+
+
+def module_stage(module, argv, forceupdate_flag=True):
+    """
+    Make a run function that calls a module's main() in this process
+    Args:
+        module - module name, e.g. data.create_segments
+        argv - function taking a StageContext and returning the
+            command line arguments to pass
+        forceupdate_flag - whether the module takes --forceupdate
+    """
+    def run(ctx, forceupdate):
+        args = argv(ctx)
+        if forceupdate and forceupdate_flag:
+            args = args + ['--forceupdate']
+        importlib.import_module(module).main(args)
+    return run
+
+
+def config_args(ctx):
+    return ['-c', ctx.config_file, '-d', ctx.datadir]
+
+
+def pool_args(ctx):
+    return config_args(ctx) + ['-p', str(os.cpu_count() or 1)]
+
+
+def datadir_args(ctx):
+    return ['-d', ctx.datadir]
+
+
+def shapefile_parts(filename):
+    return os.path.splitext(filename)[0] + '.*'
+
+
+def extra_map_path(extra_map, filename):
+    return os.path.join('processed', 'maps', extra_map['name'], filename)
+
+
+def extra_map_paths(ctx, *filenames):
+    return [extra_map_path(x, filename)
+            for x in ctx.extra_maps for filename in filenames]
+
+
+def each_extra_map(module, argv):
+    """
+    Make a run function that calls a module's main() once for each of
+    the city's extra maps
+    Args:
+        module - module name
+        argv - function taking a StageContext and an extra map dict, and
+            returning the command line arguments to pass
+    """
+    def run(ctx, forceupdate):
+        for extra_map in ctx.extra_maps:
+            module_stage(module, lambda ctx: argv(ctx, extra_map))(
+                ctx, forceupdate)
+    return run
+
+
+def add_map_args(ctx):
+    args = [ctx.datadir, '-p', str(os.cpu_count() or 1)]
+    for extra_map in ctx.extra_maps:
+        args += ['-m', extra_map['name']] + (extra_map['features'] or [])
+    return args
+
+
+STAGES = [
+    Stage(
+        'standardize_crashes', 'standardization',
+        module_stage('data_standardization.standardize_crashes',
+                     pool_args),
+        inputs=lambda ctx: [
+            os.path.join('raw', 'crashes', x)
+            for x in ctx.config.crashes_files
+        ] + ['processed/geocoded_addresses.csv'],
+        outputs=lambda ctx: [ctx.record_file('standardized/crashes.json')],
+        config_keys=['city', 'crashes_files', 'timezone',
+                     'startdate', 'enddate', 'record_format'],
+    ),
+    Stage(
+        'standardize_volume', 'standardization',
+        module_stage('data_standardization.standardize_volume',
+                     config_args, forceupdate_flag=False),
+        inputs=['raw/volume/*', 'raw/volume/*/*'],
+        outputs=lambda ctx: [ctx.record_file('standardized/volume.json')],
+        config_keys=['name', 'record_format'],
+    ),
+    Stage(
+        'standardize_point_data', 'standardization',
+        module_stage('data_standardization.standardize_point_data',
+                     config_args, forceupdate_flag=False),
+        inputs=lambda ctx: [
+            os.path.join('raw', 'supplemental', x['filename'])
+            for x in ctx.config.data_source
+        ],
+        outputs=lambda ctx: [ctx.record_file('standardized/points.json')],
+        config_keys=['data_source', 'timezone', 'record_format'],
+        enabled=lambda ctx: ctx.config.data_source,
+    ),
+    Stage(
+        'standardize_waze_data', 'standardization',
+        module_stage('data_standardization.standardize_waze_data',
+                     config_args, forceupdate_flag=False),
+        inputs=['raw/waze/*'],
+        outputs=lambda ctx: [ctx.record_file('standardized/waze.json')],
+        config_keys=['city', 'timezone', 'record_format'],
+        enabled=lambda ctx: os.path.exists(ctx.path('raw', 'waze')),
+    ),
+    Stage(
+        'osm_create_maps', 'generation',
+        module_stage('data.osm_create_maps', config_args),
+        inputs=lambda ctx: ([
+            shapefile_parts(os.path.join(
+                'raw', 'maps', ctx.config.boundary_shapefile))
+        ] if ctx.config.map_geography == 'shapefile' else []) + ([
+            # The city polygon is expanded to take in nearby crashes
+            'raw/maps/city_boundary.geojson',
+            ctx.record_file('standardized/crashes.json'),
+        ] if ctx.config.map_geography == 'polygon' else []) + ([
+            os.path.join('raw', 'maps', ctx.config.osm_extract)
+        ] if ctx.config.osm_extract else []),
+        outputs=[
+            'processed/maps/osm_ways.shp',
+            'processed/maps/osm_nodes.shp',
+            'processed/maps/features.geojson',
+            'processed/maps/osm_elements.geojson',
+        ],
+        config_keys=['city', 'city_latitude', 'city_longitude',
+                     'city_radius', 'map_geography', 'boundary_shapefile',
+                     'osm_extract'],
+    ),
+    Stage(
+        'add_waze_data', 'generation',
+        # Only new snapshots are added to the running totals,
+        # so the totals aren't started over when the waze data changes
+        module_stage(
+            'data.add_waze_data',
+            lambda ctx: datadir_args(ctx) + [
+                '-p', str(os.cpu_count() or 1)],
+            forceupdate_flag=False),
+        inputs=lambda ctx: [
+            ctx.record_file('standardized/waze.json'),
+            'processed/maps/osm_elements.geojson',
+        ],
+        outputs=[
+            'processed/maps/osm_elements.geojson',
+            'processed/maps/jams.geojson',
+            'processed/waze_aggregates.json',
+        ],
+        enabled=lambda ctx: record_store.exists(
+            ctx.path('standardized', 'waze.json')),
+    ),
+    Stage(
+        'create_segments', 'generation',
+        module_stage('data.create_segments', pool_args),
+        inputs=lambda ctx: [
+            'processed/maps/osm_elements.geojson',
+            'processed/maps/features.geojson',
+            ctx.record_file('standardized/points.json'),
+        ],
+        outputs=SEGMENT_FILES + ['processed/points_joined.json'],
+        config_keys=FEATURE_KEYS,
+    ),
+    Stage(
+        'extract_intersections', 'generation',
+        each_extra_map(
+            'data.extract_intersections',
+            lambda ctx, extra_map: [
+                extra_map['filename'], '-d', ctx.datadir,
+                '-n', extra_map['name'],
+                '-p', str(os.cpu_count() or 1)]),
+        inputs=lambda ctx: [
+            shapefile_parts(x['filename']) for x in ctx.extra_maps],
+        outputs=lambda ctx: extra_map_paths(
+            ctx, 'elements.geojson', 'inters.pkl'),
+        enabled=lambda ctx: ctx.extra_maps,
+    ),
+    Stage(
+        'create_extra_map_segments', 'generation',
+        each_extra_map(
+            'data.create_segments',
+            lambda ctx, extra_map: pool_args(ctx) + [
+                '-n', extra_map['name'],
+                '-r', ctx.path(extra_map_path(
+                    extra_map, 'elements.geojson'))]),
+        inputs=lambda ctx: extra_map_paths(ctx, 'elements.geojson') + [
+            ctx.record_file('standardized/points.json'),
+        ],
+        outputs=lambda ctx: extra_map_paths(
+            ctx, 'inters_segments.geojson', 'non_inters_segments.geojson'),
+        config_keys=FEATURE_KEYS,
+        enabled=lambda ctx: ctx.extra_maps,
+    ),
+    Stage(
+        'add_map', 'generation',
+        module_stage('data.add_map', add_map_args, forceupdate_flag=False),
+        inputs=lambda ctx: SEGMENT_FILES[:2] + extra_map_paths(
+            ctx, 'inters_segments.geojson', 'non_inters_segments.geojson'),
+        outputs=SEGMENT_FILES,
+        config_keys=['additional_map_features'],
+        enabled=lambda ctx: ctx.extra_maps,
+    ),
+    Stage(
+        'join_segments_crash', 'generation',
+        module_stage('data.join_segments_crash', config_args,
+                     forceupdate_flag=False),
+        inputs=lambda ctx: [
+            ctx.record_file('standardized/crashes.json')
+        ] + SEGMENT_FILES[:2],
+        outputs=lambda ctx: [
+            ctx.record_file('processed/crash_joined.json'),
+            'processed/crashes_rollup.geojson',
+        ] + [
+            'processed/crashes_rollup_' + x + '.geojson'
+            for x in ctx.config.split_columns
+        ],
+        config_keys=['crashes_files', 'record_format'],
+    ),
+    Stage(
+        'propagate_volume', 'generation',
+        module_stage('data.propagate_volume', datadir_args),
+        inputs=lambda ctx: [
+            ctx.record_file('standardized/volume.json')
+        ] + SEGMENT_FILES[:2],
+        outputs=[
+            'processed/atrs_predicted.csv',
+            'processed/snapped_atrs.json',
+        ] + SEGMENT_FILES,
+        enabled=lambda ctx: record_store.exists(
+            ctx.path('standardized', 'volume.json')),
+    ),
+    Stage(
+        'parse_tmc', 'generation',
+        module_stage('data.TMC_scraping.parse_tmc', datadir_args),
+        inputs=lambda ctx: [
+            'raw/volume/TMCs/*',
+            ctx.record_file('standardized/volume.json'),
+            ctx.record_file('processed/crash_joined.json'),
+        ] + SEGMENT_FILES[:2],
+        outputs=['processed/tmc_summary.json'],
+        enabled=lambda ctx: os.path.exists(
+            ctx.path('raw', 'volume', 'TMCs')) and record_store.exists(
+                ctx.path('standardized', 'volume.json')),
+    ),
+    Stage(
+        'make_canon_dataset', 'generation',
+        module_stage('features.make_canon_dataset', config_args,
+                     forceupdate_flag=False),
+        inputs=lambda ctx: [
+            ctx.record_file('processed/crash_joined.json'),
+            'processed/maps/inter_and_non_int.geojson',
+        ],
+        outputs=['processed/vz_predict_dataset.csv.gz'],
+        config_keys=FEATURE_KEYS + ['crashes_files'],
+    ),
+    Stage(
+        'train_model', 'model',
+        module_stage('models.train_model', config_args,
+                     forceupdate_flag=False),
+        inputs=[
+            'processed/vz_predict_dataset.csv.gz',
+            'processed/tmc_summary.json',
+        ],
+        outputs=lambda ctx: [
+            'processed/seg_with_predicted' + x + '.json'
+            for x in ctx.split_suffixes
+        ],
+        config_keys=FEATURE_KEYS + ['crashes_files', 'seg_data'],
+    ),
+    Stage(
+        'make_preds_viz', 'visualization',
+        module_stage('data.make_preds_viz', config_args,
+                     forceupdate_flag=False),
+        inputs=lambda ctx: [
+            'processed/seg_with_predicted' + x + '.json'
+            for x in ctx.split_suffixes
+        ] + ['processed/maps/inter_and_non_int.geojson'],
+        outputs=lambda ctx: [
+            'processed/preds_viz' + x + '.geojson'
+            for x in ctx.split_suffixes
+        ],
+    ),
+]
+
+
+def run_pipeline(config_file, datadir, steps=None, forceupdate=False):
+    """
+    Run the stale stages of the pipeline for a city
+    Args:
+        config_file - path to config file
+        datadir - path to the city's data directory, e.g. ../data/boston/
+        steps - optional list of steps to run
+        forceupdate - whether to run every stage
+    Returns:
+        the names of the stages that were run
+    """
+    ctx = StageContext(config_file, datadir)
+    return run_stages(STAGES, ctx, steps=steps, forceupdate=forceupdate)
@@ -1,6 +1,12 @@
 import os
 import subprocess
 import shutil
+import rtree
+from shapely.geometry import LineString, MultiLineString
+from shapely.ops import unary_union
+from .. import add_map
+from .. import util
+from ..segment import Segment
 
 
 def test_add_map(tmpdir):
@@ -79,3 +85,124 @@ def test_add_map(tmpdir):
         path,
         'boston',
     ])
+
+
+def test_get_mapping():
+    near = (LineString([(0, 3), (100, 3)]), {'AADT': 1})
+    further = (LineString([(0, 8), (100, 8)]), {'AADT': 2})
+    longer = (LineString([(200, 1), (400, 1)]), {'id': 'a', 'AADT': 3})
+    lines = [{
+        'line': LineString([(0, 0), (100, 0)]),
+        'properties': {'id': 1},
+        'candidates': [further, near],
+    }, {
+        'line': LineString([(0, 15), (100, 15)]),
+        'properties': {'id': 2},
+        'candidates': [further, near],
+    }, {
+        'line': LineString([(250, 0), (300, 0)]),
+        'properties': {'id': 3},
+        'candidates': [longer],
+    }, {
+        'line': LineString([(500, 0), (600, 0)]),
+        'properties': {'id': 4},
+        'candidates': [],
+    }]
+    add_map.get_mapping(lines, ['AADT'])
+
+    # Candidates without ids are given them
+    assert [further[1]['id'], near[1]['id']] == [0, 1]
+    # The closest candidate, at the smallest buffer
+    assert lines[0]['matches'] == [near]
+    # near is too far from line 2, which is matched at a larger buffer
+    assert lines[1]['matches'] == [further]
+    # line 3 is a subset of the longer line
+    assert lines[2]['matches'] == [longer]
+    assert 'matches' not in lines[3]
+    assert [x['properties']['AADT'] for x in lines] == [1, 2, 3, 0]
+
+
+def test_get_int_mapping():
+    def inter(x, y):
+        return MultiLineString([[(x, y), (x + 30, y)], [(x, y), (x, y + 30)]])
+
+    lines = [Segment(inter(0, 0), {'id': 1}),
+             Segment(inter(500, 0), {'id': 2})]
+    others = [inter(5, 5), inter(2, 1), inter(40, 40)]
+    buffered = []
+    index = rtree.index.Index()
+    for i, geometry in enumerate(others):
+        buffered.append((geometry.buffer(10), geometry, {'id': i}))
+        index.insert(i, buffered[-1][0].bounds)
+
+    results = add_map.get_int_mapping(lines, buffered, index)
+    assert [x[1] for x in results] == [{'id': 1}, {'id': 2}]
+    # The closest one overlaps most
+    assert [x[2] for x in results] == [{'id': 1}, {}]
+
+    line_buffer = lines[0].geometry.buffer(10)
+    scores = add_map.overlap_scores(
+        line_buffer, line_buffer.area, [x[0] for x in buffered],
+        [x[0].area for x in buffered])
+    for score, other in zip(scores, buffered):
+        union = unary_union([line_buffer, other[0]]).area
+        assert abs(score - max(line_buffer.area, other[0].area) / union) \
+            < 1e-9
+
+
+def test_empty_segments():
+    segments = [
+        Segment(LineString([(0, 0), (100, 0)]), {'id': 1}),
+        Segment(LineString(), {'id': 2}),
+        Segment(MultiLineString([[(0, 5), (30, 5)], [(0, 5), (0, 35)]]),
+                {'id': 3}),
+    ]
+    buffered, index = add_map.buffer_segments(segments, 20)
+    # Empty segments keep their place, but aren't indexed
+    assert [x[2]['id'] for x in buffered] == [1, 2, 3]
+    assert sorted(index.intersection((-50, -50, 150, 50))) == [0, 2]
+
+    results = add_map.get_candidates(buffered, index, segments)
+    assert [len(x['candidates']) for x in results] == [2, 0, 2]
+
+    results = add_map.get_int_mapping(segments, buffered, index)
+    assert [x[2] for x in results] == [{'id': 1}, {}, {'id': 3}]
+
+
+def test_add_map_features(tmpdir):
+    map_fp = os.path.join(tmpdir.strpath, 'processed', 'maps')
+    x, y = -7910000, 5215000
+
+    def write_map(directory, offset, properties):
+        os.makedirs(directory)
+        util.write_segments([
+            Segment(LineString([(x, y + offset), (x + 100, y + offset)]),
+                    dict(properties, id='00' + str(offset))),
+            Segment(LineString([(x + 1000, y + 1000 + offset),
+                                (x + 1100, y + 1000 + offset)]),
+                    dict(properties, id='01' + str(offset))),
+        ], [
+            Segment(MultiLineString([
+                [(x, y + offset), (x, y + 100 + offset)],
+                [(x, y + offset), (x - 100, y + offset)]]),
+                dict(properties, id=offset)),
+        ], directory)
+
+    write_map(map_fp, 0, {})
+    write_map(os.path.join(map_fp, 'inventory'), 3, {
+        'AADT': 1000, 'SPEEDLIMIT': 25})
+    write_map(os.path.join(map_fp, 'bike'), 2, {'bike_lane': 'yes'})
+
+    add_map.main([tmpdir.strpath, '-m', 'inventory', 'AADT',
+                  '-m', 'bike', 'bike_lane'])
+
+    non_inters = util.read_geojson(
+        os.path.join(map_fp, 'non_inters_segments.geojson'))
+    assert [x.properties for x in non_inters] == [
+        {'id': '000', 'AADT': 1000, 'bike_lane': 'yes'},
+        {'id': '010', 'AADT': 1000, 'bike_lane': 'yes'},
+    ]
+    inters = util.read_geojson(
+        os.path.join(map_fp, 'inters_segments.geojson'))
+    assert [x.properties for x in inters] == [
+        {'id': 0, 'AADT': 1000, 'bike_lane': 'yes'}]
@@ -1,7 +1,9 @@
+import json
 import os
 import shutil
 import geojson
 from .. import add_waze_data
+from .. import record_store
 
 TEST_FP = os.path.dirname(os.path.abspath(__file__))
 
@@ -71,3 +73,96 @@ def test_map_segments(tmpdir):
     test_segment = [x for x in osm_items['features']
                     if 'alert_JAM' in x['properties']][0]
     assert test_segment['properties']['alert_JAM'] == 1
+
+
+def test_map_segments_incremental(tmpdir):
+    orig_path = os.path.join(TEST_FP, 'data', 'test_waze')
+    with open(os.path.join(orig_path, 'test_waze.json')) as f:
+        records = json.load(f)
+
+    def run(name, filenames):
+        path = os.path.join(tmpdir.strpath, name, 'processed', 'maps')
+        os.makedirs(path)
+        shutil.copyfile(
+            os.path.join(orig_path, 'osm_elements.geojson'),
+            os.path.join(path, 'osm_elements.geojson'))
+        for filenames_added in filenames:
+            add_waze_data.map_segments(
+                os.path.join(tmpdir.strpath, name), filenames_added)
+        with open(os.path.join(path, 'osm_elements.geojson')) as f:
+            return [x['properties'] for x in geojson.load(f)['features']
+                    if x['geometry']['type'] == 'LineString']
+
+    first = os.path.join(tmpdir.strpath, 'first.json')
+    record_store.write_records(
+        first, [x for x in records if x['snapshotId'] <= 143])
+
+    # Adding the later snapshots to the totals for the earlier ones
+    # gives the same features as adding them all at once
+    expected = run('all', [os.path.join(orig_path, 'test_waze.json')])
+    assert run('incremental', [
+        first, os.path.join(orig_path, 'test_waze.json')]) == expected
+
+
+def test_map_segments_restandardized(tmpdir, capsys):
+    orig_path = os.path.join(TEST_FP, 'data', 'test_waze')
+    with open(os.path.join(orig_path, 'test_waze.json')) as f:
+        records = json.load(f)
+    # As written by standardize_waze_data, with the snapshots' times
+    # and a record for each snapshot
+    times = {x: '2018-10-15T{:02d}:00:00-04:00'.format(i)
+             for i, x in enumerate(sorted(set(
+                 x['snapshotId'] for x in records)))}
+    timed = []
+    for snapshot_id in sorted(times):
+        snapshot = {'snapshotId': snapshot_id,
+                    'snapshotTime': times[snapshot_id]}
+        timed.append(dict(snapshot, eventType='snapshot'))
+        timed += [dict(x, **snapshot) for x in records
+                  if x['snapshotId'] == snapshot_id]
+
+    def run(name, standardized):
+        datadir = os.path.join(tmpdir.strpath, name)
+        path = os.path.join(datadir, 'processed', 'maps')
+        if not os.path.exists(path):
+            os.makedirs(path)
+            shutil.copyfile(
+                os.path.join(orig_path, 'osm_elements.geojson'),
+                os.path.join(path, 'osm_elements.geojson'))
+        filename = os.path.join(datadir, 'standardized', 'waze.json')
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        record_store.write_records(filename, standardized)
+        add_waze_data.map_segments(datadir, filename)
+        osm_file = os.path.join(path, 'osm_elements.geojson')
+        with open(osm_file) as f:
+            return [x['properties'] for x in geojson.load(f)['features']
+                    if x['geometry']['type'] == 'LineString'], \
+                os.stat(osm_file).st_mtime_ns
+
+    expected, _ = run('all', timed)
+    assert len(times) == 4
+    assert any(x['jam_percent'] == 25 for x in expected)
+
+    # waze.json written again with the later snapshots on the end
+    first = [x for x in timed if x['snapshotId'] <= 143]
+    run('incremental', first)
+    capsys.readouterr()
+    result, written = run('incremental', timed)
+    assert 'from where it was read to before' in capsys.readouterr().out
+    assert result == expected
+
+    # Written again with nothing new, or standardized again with the
+    # first snapshot left out of the date range, so the rest are
+    # numbered differently: nothing is added, and the maps are left alone
+    assert run('incremental', timed) == (expected, written)
+    later = [dict(x, snapshotId=x['snapshotId'] - 4)
+             for x in timed if x['snapshotId'] > 5]
+    assert run('incremental', later) == (expected, written)
+
+    # New snapshots with no jams or alerts don't change any features
+    empty = [x for x in timed if x['eventType'] == 'snapshot']
+    _, written = run('empty', empty[:1])
+    capsys.readouterr()
+    assert run('empty', empty)[1] == written
+    assert "No segment's waze features changed" in capsys.readouterr().out
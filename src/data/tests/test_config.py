@@ -81,3 +81,19 @@ def test_get_feature_list(tmpdir):
     assert config.continuous_features == ['AADT']
     assert set(config.features) == set([
         'SPEEDLIMIT', 'Struct_Cnd', 'Surface_Tp', 'F_F_Class', 'AADT'])
+
+    assert config.extra_maps == [
+        {'name': 'Boston', 'filename': 'test', 'features': None}]
+
+    config_dict['additional_map_features']['extra_maps'] = [
+        {'name': 'bike', 'filename': 'bike.shp',
+         'features': ['bike_lane']},
+        {'name': 'zones', 'filename': 'zones.shp'},
+    ]
+    write_to_file(yml_file, config_dict)
+    config = data.config.Configuration(yml_file)
+    assert config.extra_maps == [
+        {'name': 'Boston', 'filename': 'test', 'features': None},
+        {'name': 'bike', 'filename': 'bike.shp', 'features': ['bike_lane']},
+        {'name': 'zones', 'filename': 'zones.shp', 'features': None},
+    ]
@@ -0,0 +1,71 @@
+import numpy as np
+from shapely.geometry import Point, LineString, MultiLineString, \
+    GeometryCollection
+from .. import conflate
+
+
+LINES = [
+    LineString([(0, 0), (10, 0), (20, 5)]),
+    LineString([(0, 3), (10, 2)]),
+    MultiLineString([[(0, 0), (0, 10)], [(5, 5), (15, 5), (15, 15)]]),
+    Point(3, 4),
+    GeometryCollection(),
+]
+
+
+def furthest(source, target):
+    if source.is_empty:
+        return 0
+    if target.is_empty:
+        return np.inf
+    coords = [x for geom in getattr(source, 'geoms', [source])
+              for x in geom.coords]
+    return max(target.distance(Point(x)) for x in coords)
+
+
+def test_max_distances(monkeypatch):
+    flat = conflate.FlatLines(LINES)
+    assert len(flat) == 5
+    source_idx, target_idx = np.meshgrid(range(5), range(5))
+    source_idx = source_idx.ravel()
+    target_idx = target_idx.ravel()
+    expected = [furthest(LINES[i], LINES[j])
+                for i, j in zip(source_idx, target_idx)]
+
+    assert np.allclose(conflate.max_distances(
+        flat, flat, source_idx, target_idx), expected)
+
+    # Pairs split into many chunks
+    monkeypatch.setattr(conflate, 'CHUNK_SIZE', 4)
+    assert len(conflate.chunk_bounds(
+        flat, flat, source_idx, target_idx)) > 5
+    assert np.allclose(conflate.max_distances(
+        flat, flat, source_idx, target_idx), expected)
+
+
+def test_pair_distances():
+    lines = conflate.FlatLines(LINES[:3])
+    candidates = conflate.FlatLines(LINES[1:])
+    line_idx = [0, 0, 1, 2, 2, 2]
+    candidate_idx = [0, 1, 2, 0, 1, 3]
+
+    within, contains = conflate.pair_distances(
+        lines, candidates, line_idx, candidate_idx)
+    assert np.allclose(within, [
+        furthest(LINES[j + 1], LINES[i])
+        for i, j in zip(line_idx, candidate_idx)])
+    assert np.allclose(contains, [
+        furthest(LINES[i], LINES[j + 1])
+        for i, j in zip(line_idx, candidate_idx)])
+
+    pooled = conflate.pair_distances(
+        lines, candidates, line_idx, candidate_idx, processes=2)
+    assert np.array_equal(pooled[0], within)
+    assert np.array_equal(pooled[1], contains)
+
+
+def test_buffers():
+    expected = [x.buffer(5) for x in LINES]
+    for processes in [1, 2]:
+        buffers = conflate.buffers(LINES, 5, processes)
+        assert [x.wkt for x in buffers] == [x.wkt for x in expected]
@@ -7,7 +7,7 @@ import os
 from .. import util
 import shutil
 import json
-from shapely.geometry import LineString, MultiLineString
+from shapely.geometry import LineString, MultiLineString, Point
 
 TEST_FP = os.path.dirname(os.path.abspath(__file__))
 
@@ -359,10 +359,11 @@ def test_connected_segments():
     assert len(inter_segments[1].lines) == 3
 
     # Test connected segments
-    assert set(inter_segments[0].connected_segments) == set([
+    # Intersections are in the order of their first node in the file
+    assert set(inter_segments[4].connected_segments) == set([
         '0011', '007', '005', '000'])
     assert set(non_int_lines[8].properties['connected_segments']) == set([
-        3, 4])
+        1, 2])
 
 
 def test_multilinestring():
@@ -382,3 +383,89 @@ def test_multilinestring():
         roads, int_buffers)
     assert all([x.geometry.type == 'LineString' for x in non_int_lines])
 
+
+def test_find_non_ints_parallel():
+    """
+    Splitting the map into tiles run in a process pool gives the same
+    segments as running it all in one process
+    """
+    results = []
+    for processes in (1, 2):
+        roads, inters = util.get_roads_and_inters(os.path.join(
+            TEST_FP,
+            'data/test_create_segments/test_adjacency.geojson'
+        ))
+        for i, road in enumerate(roads):
+            road.properties['orig_id'] = int(str(99) + str(i))
+
+        int_buffers = create_segments.get_intersection_buffers(inters, 20)
+        results.append(create_segments.find_non_ints(
+            roads, int_buffers, processes=processes))
+
+    (non_ints, inter_segments), (parallel_non_ints, parallel_inters) = results
+    assert [x.properties for x in non_ints] \
+        == [x.properties for x in parallel_non_ints]
+    assert all(x.geometry.equals(y.geometry)
+               for x, y in zip(non_ints, parallel_non_ints))
+    assert [x.connected_segments for x in inter_segments] \
+        == [x.connected_segments for x in parallel_inters]
+    assert [x.data for x in inter_segments] \
+        == [x.data for x in parallel_inters]
+
+
+def test_get_connections_order():
+    """
+    Segments joined to an intersection through another segment's end
+    point are found whatever order the segments come in
+    """
+    point = Record({}, point=Point(0, 0))
+    segments = [
+        Segment(LineString([(0, 0), (5, 0)]), {'id': 1}),
+        Segment(LineString([(5, 0), (10, 0)]), {'id': 2}),
+        Segment(LineString([(0, 0), (0, 5)]), {'id': 3}),
+        Segment(LineString([(1, 1), (5, 5)]), {'id': 4}),
+    ]
+    for ordered in (segments, segments[::-1]):
+        connections = create_segments.get_connections([point], ordered)
+        assert len(connections) == 1
+        assert sorted(x.properties['id'] for x in connections[0][0]) \
+            == [1, 2, 3]
+
+
+def test_get_connections_touching():
+    """
+    Segments that touch without sharing a vertex are connected, whether
+    one ends in the middle of the other or they cross
+    """
+    points = [Record({}, point=Point(0, 0)), Record({}, point=Point(5, 10))]
+    segments = [
+        Segment(LineString([(-10, 0), (10, 0)]), {'id': 1}),
+        # A T junction, between the two intersection points
+        Segment(LineString([(5, 0), (5, 10)]), {'id': 2}),
+        # Crossing the first segment, away from either point
+        Segment(LineString([(-3, -5), (-3, 5)]), {'id': 3}),
+        # Not touching anything
+        Segment(LineString([(-10, 5), (-5, 5)]), {'id': 4}),
+    ]
+    for ordered in (segments, segments[::-1]):
+        connections = create_segments.get_connections(points, ordered)
+        assert len(connections) == 1
+        assert sorted(x.properties['id'] for x in connections[0][0]) \
+            == [1, 2, 3]
+
+
+def test_get_intersection_buffers_clusters():
+    """
+    Chains of overlapping buffers form one cluster, and the points in
+    each buffer are the clustered intersections, in order
+    """
+    inters = [
+        {'geometry': Point(x, 0), 'properties': {'id': i}}
+        for i, x in enumerate([0, 110, 30, 60, 300])
+    ]
+    int_buffers = create_segments.get_intersection_buffers(inters, 20)
+    assert [[x.properties['id'] for x in buff.points]
+            for buff in int_buffers] == [[0, 2, 3], [1], [4]]
+    assert int_buffers[0].buffer.type == 'Polygon'
+    assert int_buffers[0].buffer.contains(Point(45, 0))
+    assert int_buffers[1].buffer.equals(inters[1]['geometry'].buffer(20))
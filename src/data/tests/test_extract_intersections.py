@@ -1,3 +1,4 @@
+import itertools
 from shapely.geometry import Point, LineString
 from .. import extract_intersections
 
@@ -28,3 +29,51 @@ def test_generate_intersections():
         (Point(2.0, 5.0), {'id_1': 2, 'id_2': 3})
     ]
 
+
+def get_grid_lines():
+    # A grid of overlapping horizontal and vertical lines
+    lines = []
+    for i in range(6):
+        lines.append((len(lines), LineString([(0, i * 2), (10, i * 2)])))
+        lines.append((len(lines), LineString([(i * 2, 0), (i * 2, 10)])))
+    # A line that touches nothing
+    lines.append((len(lines), LineString([(20, 20), (21, 21)])))
+    return lines
+
+
+def test_candidate_pairs():
+    lines = get_grid_lines()
+    pairs = extract_intersections.candidate_pairs(lines)
+    assert pairs == sorted(pairs)
+    assert all(i < j for i, j in pairs)
+    assert not [pair for pair in pairs if len(lines) - 1 in pair]
+    for i, j in itertools.combinations(range(len(lines)), 2):
+        if lines[i][1].intersects(lines[j][1]):
+            assert (i, j) in pairs
+
+
+def test_generate_intersections_parallel():
+    lines = get_grid_lines()
+
+    # Same as checking every combination of lines
+    expected = []
+    for segment1, segment2 in itertools.combinations(lines, 2):
+        if segment1[1].intersects(segment2[1]):
+            expected.extend(extract_intersections.extract_intersections(
+                segment1[1].intersection(segment2[1]),
+                {'id_1': segment1[0], 'id_2': segment2[0]}))
+
+    assert extract_intersections.generate_intersections(lines) == expected
+    assert extract_intersections.generate_intersections(
+        lines, processes=2) == expected
+
+
+def test_point_grid():
+    grid = extract_intersections.PointGrid(0.01)
+    assert grid.add(1, 1)
+    assert not grid.add(1, 1)
+    assert not grid.add(1.005, 0.995)
+    # Close, but in a neighbouring cell
+    assert not grid.add(0.999, 1)
+    assert grid.add(1.02, 1)
+    assert grid.add(10, 1)
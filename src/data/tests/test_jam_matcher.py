@@ -0,0 +1,46 @@
+from shapely.geometry import LineString
+from .. import jam_matcher
+from ..segment import Segment
+
+
+ROADS = [
+    Segment(LineString([(0, 0), (100, 10)]), {'name': 'Main Street'}),
+    Segment(LineString([(0, 8), (100, 18)]), {'name': 'Main Street'}),
+    Segment(LineString([(0, 50), (10, 51)]), {'name': None}),
+    Segment(LineString([(0, 100), (100, 110)]), {'name': 'Elm St'}),
+]
+
+
+def test_first_word():
+    assert jam_matcher.first_word('Main Street') == 'Main'
+    assert jam_matcher.first_word('') is None
+    assert jam_matcher.first_word(None) is None
+
+
+def test_match():
+    matcher = jam_matcher.JamMatcher(ROADS)
+
+    # Only close to the first road, unless the street name matches
+    jam = LineString([(0, 2), (100, 12)])
+    assert matcher.match(jam) == [0]
+    assert sorted(matcher.match(jam, 'Main')) == [0, 1]
+
+    # A short overlap only counts on a short road
+    assert matcher.match(LineString([(0, 51), (5, 51.5)])) == [2]
+    assert matcher.match(LineString([(0, 101), (5, 101.5)])) == []
+
+    assert matcher.match(LineString()) == []
+
+
+def test_match_all():
+    matcher = jam_matcher.JamMatcher(ROADS)
+    jams = [
+        (LineString([(0, 2), (100, 12)]), None),
+        (LineString([(0, 2), (100, 12)]), 'Main'),
+        (LineString([(0, 101), (50, 106)]), 'Elm'),
+        (LineString([(500, 500), (600, 500)]), None),
+    ]
+    expected = [[0], [0, 1], [3], []]
+    assert [sorted(x) for x in matcher.match_all(jams)] == expected
+    assert [sorted(x) for x in matcher.match_all(jams, processes=2)] \
+        == expected
@@ -0,0 +1,118 @@
+import os
+import json
+from shapely.geometry import LineString, MultiLineString, Point, mapping
+from data import map_store, util
+from data.segment import Segment
+
+
+def get_records():
+    return [
+        {
+            'geometry': LineString([(-7910000, 5215000), (-7910100, 5215100)]),
+            'properties': {
+                'id': '001', 'width': 12, 'oneway': True, 'jam_percent': 0.5,
+                'connected_segments': [1, 2], 'speed': None,
+            }
+        },
+        {
+            'geometry': MultiLineString([
+                [(-7910000, 5215000), (-7910050, 5215000)],
+                [(-7910050, 5215000), (-7910050, 5215050)]]),
+            'properties': {'id': '002', 'width': 0, 'oneway': False,
+                           'jam_percent': 1.0, 'display_name': 'main st'}
+        },
+        {
+            'geometry': Point(-7910000, 5215000),
+            'properties': {'id': 3, 'intersection': 1}
+        },
+    ]
+
+
+def test_write_and_read_records(tmpdir):
+    filename = os.path.join(str(tmpdir), 'elements.geojson')
+    with open(filename, 'w') as f:
+        f.write('{}')
+    records = get_records()
+    map_store.write_records(records, filename)
+    assert os.path.exists(os.path.join(str(tmpdir), 'elements.npz'))
+
+    result = map_store.read_records(filename)
+    assert len(result) == 3
+    for record, expected in zip(result, records):
+        assert record['geometry'].equals(expected['geometry'])
+        assert record['properties'] == expected['properties']
+    assert type(result[0]['properties']['width']) is int
+    assert type(result[0]['properties']['oneway']) is bool
+
+    # Missing properties are filled in if asked for
+    result = map_store.read_records(filename, fill_missing=True)
+    assert result[2]['properties']['width'] is None
+    assert result[2]['properties']['id'] == 3
+
+    # Once the geojson file changes, the store is out of date
+    with open(filename, 'w') as f:
+        f.write('{"type": "FeatureCollection", "features": []}')
+    assert map_store.read_records(filename) is None
+
+
+def test_write_and_read_segments(tmpdir):
+    mapfp = str(tmpdir)
+    inters = [Segment(x['geometry'], x['properties'])
+              for x in get_records()[:2]]
+    inters[1].properties['id'] = 4
+    non_inters = [Segment(
+        LineString([(-7910200, 5215000), (-7910300, 5215100)]),
+        {'id': '005', 'width': 3})]
+
+    util.write_segments(non_inters, inters, mapfp)
+    segments, _ = util.read_segments(mapfp)
+    assert [x.properties['id'] for x in segments] == ['001', 4, '005']
+
+    # The store gives the same records as the geojson
+    with open(os.path.join(mapfp, 'inters_segments.geojson')) as f:
+        features = json.load(f)['features']
+    assert [x['properties'] for x in features] \
+        == [x.properties for x in util.read_geojson(
+            os.path.join(mapfp, 'inters_segments.geojson'))]
+    # geojson coordinates are rounded, but only by a fraction of a metre
+    from_geojson = util.reproject_records(features)
+    for segment, record in zip(segments, from_geojson):
+        assert segment.geometry.hausdorff_distance(record['geometry']) < 1
+
+    # The combined file is the two files' features, and is read
+    # from their stores
+    combined = os.path.join(mapfp, 'inter_and_non_int.geojson')
+    with open(combined) as f:
+        features = json.load(f)['features']
+    assert [x['properties']['id'] for x in features] == ['005', '001', 4]
+    assert map_store.record_count(combined) == 3
+    result = map_store.read_records(combined, fill_missing=True)
+    assert [x['properties']['id'] for x in result] == ['005', '001', 4]
+    assert result[0]['properties']['jam_percent'] is None
+
+    # Until either of them changes
+    util.write_records_to_geojson(
+        inters[:1], os.path.join(mapfp, 'inters_segments.geojson'))
+    assert map_store.record_count(combined) is None
+    assert map_store.read_records(combined) is None
+
+
+def test_empty_geometries(tmpdir):
+    filename = os.path.join(str(tmpdir), 'elements.geojson')
+    with open(filename, 'w') as f:
+        f.write('{}')
+    records = [
+        {'geometry': LineString(), 'properties': {'id': 1}},
+        {'geometry': {'type': 'MultiLineString', 'coordinates': []},
+         'properties': {'id': 2}},
+    ]
+    map_store.write_records(records, filename)
+
+    # Empty geometries keep their type, so they can be written as geojson
+    result = map_store.read_records(filename)
+    assert [x['geometry'].geom_type for x in result] == [
+        'LineString', 'MultiLineString']
+    assert all(x['geometry'].is_empty for x in result)
+    assert len(util.prepare_geojson([
+        {'geometry': mapping(x['geometry']), 'properties': x['properties']}
+        for x in result])['features']) == 2
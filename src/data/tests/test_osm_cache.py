@@ -0,0 +1,48 @@
+import os
+import networkx as nx
+from shapely.geometry import MultiPoint, Point, box
+from .. import osm_cache
+
+TEST_FP = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_graph():
+    return nx.read_gpickle(os.path.join(TEST_FP, 'data', 'osm_output.gpickle'))
+
+
+def test_add_and_get_graph(tmpdir, monkeypatch):
+    G = get_graph()
+    minx, miny, maxx, maxy = MultiPoint([
+        (data['x'], data['y']) for _, data in G.nodes(data=True)]).bounds
+    region = box(minx - .001, miny - .001, maxx + .001, maxy + .001)
+    tags = ['cycleway', 'name']
+
+    # Without a cache directory, nothing is cached
+    monkeypatch.delenv('OSM_CACHE_DIR', raising=False)
+    osm_cache.add_graph(G, region, 'drive', tags)
+    assert osm_cache.get_graph(region, 'drive', tags) is None
+
+    monkeypatch.setenv('OSM_CACHE_DIR', str(tmpdir))
+    assert osm_cache.get_graph(region, 'drive', tags) is None
+    osm_cache.add_graph(G, region, 'drive', tags)
+    assert os.listdir(os.path.join(str(tmpdir), 'regions')) == [
+        osm_cache.region_key(region, 'drive', tags)]
+
+    # The same region gives back the whole graph
+    cached = osm_cache.get_graph(region, 'drive', tags)
+    assert set(cached.nodes()) == set(G.nodes())
+    assert cached.number_of_edges() == G.number_of_edges()
+
+    # A region inside it is clipped to the nodes inside
+    inner = box(minx, miny, (minx + maxx) / 2, maxy)
+    clipped = osm_cache.get_graph(inner, 'drive', tags)
+    assert 0 < clipped.number_of_nodes() < G.number_of_nodes()
+    for _, data in clipped.nodes(data=True):
+        assert inner.intersects(Point(data['x'], data['y']))
+    assert nx.is_weakly_connected(clipped)
+
+    # Regions that aren't covered, or need other tags, aren't found
+    outer = region.buffer(.01)
+    assert osm_cache.get_graph(outer, 'drive', tags) is None
+    assert osm_cache.get_graph(inner, 'drive', tags + ['lanes']) is None
+    assert osm_cache.get_graph(inner, 'walk', tags) is None
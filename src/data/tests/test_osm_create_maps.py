@@ -1,6 +1,7 @@
 import os
 import shutil
-from shapely.geometry import Polygon
+from types import SimpleNamespace
+from shapely.geometry import Point, Polygon, box, mapping
 import networkx as nx
 import json
 import fiona
@@ -85,7 +86,53 @@ def test_expand_polygon():
     assert result_shape.contains(records[2].point)
 
 
-def mockreturn(config):
+def test_get_boundary(tmpdir, monkeypatch):
+    datadir = tmpdir.strpath
+    os.makedirs(os.path.join(datadir, 'standardized'))
+    shutil.copy(os.path.join(TEST_FP, 'data', 'osm_crash_file.json'),
+                os.path.join(datadir, 'standardized', 'crashes.json'))
+    # Takes in all of the crashes, so it isn't expanded
+    polygon = box(-71.2, 42.2, -70.9, 42.5)
+    searches = []
+
+    def find_osm_polygon(city):
+        searches.append(city)
+        return 1, mapping(polygon)
+    monkeypatch.setattr(osm_create_maps, 'find_osm_polygon', find_osm_polygon)
+
+    # Polygon cities are looked up the first time
+    c = SimpleNamespace(
+        city='Boston, Massachusetts, USA', map_geography='polygon')
+    assert osm_create_maps.get_boundary(c, datadir).equals(polygon)
+    assert osm_create_maps.get_boundary(c, datadir).equals(polygon)
+    assert searches == [c.city]
+
+    # Or not at all, given a polygon
+    supplied = box(-71.3, 42.1, -70.8, 42.6)
+    os.makedirs(os.path.join(datadir, 'raw', 'maps'))
+    with open(os.path.join(
+            datadir, 'raw', 'maps', 'city_boundary.geojson'), 'w') as f:
+        json.dump({'type': 'Feature', 'properties': {},
+                   'geometry': mapping(supplied)}, f)
+    c.city = 'Cambridge, Massachusetts, USA'
+    assert osm_create_maps.get_boundary(c, datadir).equals(supplied)
+    assert searches == ['Boston, Massachusetts, USA']
+
+
+def test_get_boundary_radius(tmpdir, monkeypatch):
+    def find_osm_polygon(city):
+        raise AssertionError("Radius cities aren't looked up")
+    monkeypatch.setattr(osm_create_maps, 'find_osm_polygon', find_osm_polygon)
+
+    c = SimpleNamespace(
+        city='Boston, Massachusetts, USA', map_geography='radius',
+        city_latitude=42.33, city_longitude=-71.07, city_radius=1)
+    boundary = osm_create_maps.get_boundary(c, tmpdir.strpath)
+    assert boundary.contains(Point(-71.07, 42.33))
+    assert not boundary.contains(Point(-71.2, 42.33))
+
+
+def mockreturn(config, datadir=None):
     G1 = nx.read_gpickle(os.path.join(TEST_FP, 'data', 'osm_output.gpickle'))
     return G1
 
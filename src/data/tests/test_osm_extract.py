@@ -0,0 +1,79 @@
+import gzip
+import os
+from shapely.geometry import box
+from .. import osm_extract
+
+
+EXTRACT = """<?xml version='1.0' encoding='UTF-8'?>
+<osm version="0.6">
+  <node id="1" lat="42.0" lon="-71.0"/>
+  <node id="2" lat="42.0" lon="-71.001">
+    <tag k="highway" v="traffic_signals"/>
+  </node>
+  <node id="3" lat="42.001" lon="-71.001"/>
+  <node id="4" lat="42.001" lon="-71.0">
+    <tag k="highway" v="crossing"/>
+  </node>
+  <node id="5" lat="42.1" lon="-71.0"/>
+  <node id="6" lat="42.0005" lon="-71.0005"/>
+  <node id="7" lat="42.0002" lon="-71.0002"/>
+  <way id="10">
+    <nd ref="1"/><nd ref="2"/><nd ref="3"/>
+    <tag k="highway" v="residential"/>
+    <tag k="name" v="Main Street"/>
+    <tag k="surface" v="asphalt"/>
+  </way>
+  <way id="11">
+    <nd ref="3"/><nd ref="4"/><nd ref="5"/>
+    <tag k="highway" v="primary"/>
+    <tag k="oneway" v="-1"/>
+  </way>
+  <way id="12">
+    <nd ref="4"/><nd ref="6"/>
+    <tag k="highway" v="footway"/>
+  </way>
+  <way id="13">
+    <nd ref="1"/><nd ref="7"/>
+    <tag k="highway" v="service"/>
+    <tag k="service" v="driveway"/>
+  </way>
+  <relation id="20">
+    <member type="way" ref="10" role=""/>
+    <tag k="type" v="route"/>
+  </relation>
+</osm>
+"""
+
+
+def test_is_drive_way():
+    assert osm_extract.is_drive_way({'highway': 'residential'})
+    assert not osm_extract.is_drive_way({'name': 'Main Street'})
+    assert not osm_extract.is_drive_way({'highway': 'footway'})
+    assert not osm_extract.is_drive_way(
+        {'highway': 'primary', 'access': 'private'})
+
+
+def test_read_graph(tmpdir):
+    filename = os.path.join(str(tmpdir), 'extract.osm.gz')
+    with gzip.open(filename, 'wt') as f:
+        f.write(EXTRACT)
+
+    boundary = box(-71.01, 41.99, -70.99, 42.01)
+    G = osm_extract.read_graph(filename, boundary, ['name', 'highway'],
+                               name='test')
+    assert G.graph['name'] == 'test'
+    # Node 5 is outside the boundary, 6 and 7 are only on excluded ways
+    assert sorted(G.nodes()) == [1, 2, 3, 4]
+    assert G.nodes[2]['highway'] == 'traffic_signals'
+    assert G.nodes[1] == {'osmid': 1, 'x': -71.0, 'y': 42.0}
+
+    # Two way street in both directions, the oneway=-1 road reversed
+    assert sorted((u, v) for u, v, _ in G.edges(keys=True)) == [
+        (1, 2), (2, 1), (2, 3), (3, 2), (4, 3)]
+    edge = G.edges[1, 2, 0]
+    assert edge['osmid'] == 10
+    assert edge['name'] == 'Main Street'
+    assert edge['oneway'] is False
+    assert 'surface' not in edge
+    assert round(edge['length']) == 83
+    assert G.edges[4, 3, 0]['oneway'] is True
@@ -0,0 +1,45 @@
+import json
+import os
+from .. import profiling
+
+
+def test_step_without_profiler():
+    # Steps do nothing unless a profiler has been started
+    with profiling.step('nothing', rows_in=3) as step:
+        step.rows_out = 2
+    assert profiling.Profiler.active is None
+
+
+def test_profile_report(tmpdir):
+    report_file = os.path.join(str(tmpdir), 'profiles', 'profile.json')
+    csv_file = os.path.join(str(tmpdir), 'rows.csv')
+
+    profiling.start(report_file, detail='inner')
+    try:
+        with profiling.step('outer', outputs=[csv_file]):
+            with profiling.step('inner', rows_in=5) as step:
+                sum(x * x for x in range(10000))
+                step.rows_out = 4
+            with open(csv_file, 'w') as f:
+                f.write('a,b\n1,2\n3,4\n')
+    finally:
+        profiling.finish()
+    assert profiling.Profiler.active is None
+
+    with open(report_file) as f:
+        report = json.load(f)
+    inner, outer = report['steps']
+    assert inner['path'] == 'outer/inner'
+    assert inner['rows_in'] == 5
+    assert inner['rows_out'] == 4
+    assert inner['cpu_time'] >= 0
+    assert inner['peak_rss_mb'] > 0
+    assert not inner['failed']
+
+    assert outer['path'] == 'outer'
+    assert outer['wall_time'] >= inner['wall_time']
+    assert outer['rows_out'] == 2
+    assert outer['outputs'][0]['bytes'] == 12
+
+    assert os.path.exists(report['detail']['inner']['cprofile'])
+    assert os.path.exists(report['detail']['inner']['tracemalloc'])
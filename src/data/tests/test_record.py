@@ -0,0 +1,65 @@
+import numpy as np
+from .. import util
+from .. import record
+from ..segment import Segment
+from shapely.geometry import LineString
+
+
+ITEMS = [{
+    'id': 1,
+    'dateOccurred': '2016-01-01T00:10:00-05:00',
+    'location': {'latitude': 42.37, 'longitude': -71.11},
+    'vehicle': 1,
+}, {
+    'id': '2',
+    'dateOccurred': '2016-02-01T10:00:00-05:00',
+    'location': {'latitude': 42.36, 'longitude': -71.1,
+                 'address': 'MAIN ST'},
+    'summary': None,
+    'near_id': 7,
+}, {
+    'dateOccurred': '2017-01-01T00:00:00-05:00',
+    'location': {'latitude': 42.35, 'longitude': -71.09},
+    'vehicle': 2,
+    'extra': {'a': [1, 2]},
+}]
+
+
+def test_record_batch():
+    batch = record.RecordBatch.from_items(ITEMS, 'crash')
+    assert len(batch) == 3
+    assert list(batch.properties()) == ITEMS
+    assert [list(x) for x in batch.properties()] == [list(x) for x in ITEMS]
+    assert batch.timestamps[2] == np.datetime64('2017-01-01T00:00:00')
+
+    # Iterating gives the same Crashes as make_records
+    expected = util.make_records(ITEMS, 'crash')
+    crashes = list(batch)
+    assert all(isinstance(x, record.Crash) for x in crashes)
+    assert [x.properties for x in crashes] == [x.properties for x in expected]
+    for crash, other in zip(crashes, expected):
+        assert crash.point.equals(other.point)
+    assert crashes[1].timestamp == expected[1].timestamp
+
+    selected = batch.select(batch.timestamps < np.datetime64('2017-01-01'))
+    assert list(selected.properties()) == ITEMS[:2]
+    assert list(batch.select([2, 0]).properties()) == [ITEMS[2], ITEMS[0]]
+
+    from_records = record.RecordBatch.from_records(expected)
+    assert from_records.record_type == 'crash'
+    assert list(from_records.properties()) == ITEMS
+    assert np.array_equal(from_records.x, batch.x)
+
+
+def test_find_nearest_batch():
+    batch = record.RecordBatch.from_items(ITEMS, 'crash')
+    points = batch.points()
+    segments = [
+        Segment(LineString([(points[0].x - 5, points[0].y),
+                            (points[0].x + 5, points[0].y)]), {'id': 'a'}),
+        Segment(LineString([(points[1].x, points[1].y + 10),
+                            (points[1].x, points[1].y + 50)]), {'id': 'b'}),
+    ]
+    util.find_nearest(batch, segments, 30)
+    assert batch.near_ids.tolist() == ['a', 'b', '']
+    assert [x.near_id for x in batch] == ['a', 'b', '']
@@ -0,0 +1,132 @@
+import json
+import os
+import pytest
+from .. import record_store
+
+
+RECORDS = [
+    {'id': 1, 'dateOccurred': '2016-01-01T00:10:00-05:00', 'n': 1.5},
+    {'id': 2, 'dateOccurred': '2016-06-30T23:59:00-04:00',
+     'text': 'a ] , [ "quoted" }'},
+    {'id': 3, 'dateOccurred': '2017-01-01T08:00:00-05:00', 'n': [1, 2]},
+]
+
+
+@pytest.mark.parametrize('record_format',
+                         [x[0] for x in record_store.FORMATS])
+def test_write_and_read(tmpdir, record_format):
+    json_name = os.path.join(tmpdir.strpath, 'crashes.json')
+    filename = record_store.format_filename(json_name, record_format)
+    assert filename.endswith('crashes.' + record_format)
+
+    assert record_store.write_records(filename, iter(RECORDS)) == 3
+    assert not os.path.exists(filename + '.tmp')
+    assert record_store.find_file(json_name) == filename
+    assert record_store.read_records(json_name) == RECORDS
+    if record_format == 'json':
+        with open(filename) as f:
+            assert f.read() == json.dumps(RECORDS)
+
+
+def test_write_other_format(tmpdir):
+    json_name = os.path.join(tmpdir.strpath, 'crashes.json')
+    record_store.write_records(json_name, RECORDS)
+    record_store.write_records(json_name + 'l.gz', RECORDS[:1])
+
+    # Only the latest format is kept
+    assert os.listdir(tmpdir.strpath) == ['crashes.jsonl.gz']
+    assert record_store.read_records(json_name) == RECORDS[:1]
+
+
+def test_write_failed(tmpdir):
+    filename = os.path.join(tmpdir.strpath, 'crashes.json')
+    record_store.write_records(filename, RECORDS)
+
+    def records():
+        yield RECORDS[0]
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        record_store.write_records(filename, records())
+    assert os.listdir(tmpdir.strpath) == ['crashes.json']
+    assert record_store.read_records(filename) == RECORDS
+
+
+def test_iter_json_list(monkeypatch, tmpdir):
+    filename = os.path.join(tmpdir.strpath, 'items.json')
+    items = [12345, 'a,b', {'x': [1, {'y': None}]}, [], 1.5e10, True]
+    with open(filename, 'w') as f:
+        json.dump(items, f, indent=2)
+
+    # Items split across reads
+    monkeypatch.setattr(record_store, 'CHUNK_SIZE', 3)
+    with open(filename) as f:
+        assert list(record_store.iter_json_list(f)) == items
+
+    with open(filename, 'w') as f:
+        f.write(' [ ] ')
+    with open(filename) as f:
+        assert list(record_store.iter_json_list(f)) == []
+
+    with open(filename, 'w') as f:
+        f.write('[{"a": 1}, {"b"')
+    with open(filename) as f:
+        with pytest.raises(ValueError):
+            list(record_store.iter_json_list(f))
+
+
+def test_iter_records_dates(tmpdir):
+    filename = os.path.join(tmpdir.strpath, 'crashes.jsonl')
+    record_store.write_records(filename, RECORDS + [{'id': 4}])
+
+    def ids(**kwargs):
+        return [x['id'] for x in record_store.iter_records(
+            filename, **kwargs)]
+
+    assert ids() == [1, 2, 3, 4]
+    assert ids(startdate='2016-01-01') == [1, 2, 3]
+    assert ids(enddate='2016-06-30') == [1, 2]
+    assert ids(startdate='2016-01-02', enddate='2016-12-31') == [2]
+
+
+@pytest.mark.parametrize('record_format',
+                         [x[0] for x in record_store.FORMATS])
+def test_record_reader(monkeypatch, tmpdir, record_format):
+    filename = record_store.format_filename(
+        os.path.join(tmpdir.strpath, 'waze.json'), record_format)
+    monkeypatch.setattr(record_store, 'CHUNK_SIZE', 5)
+
+    def read(watermark):
+        reader = record_store.RecordReader(filename, watermark)
+        return list(reader), reader
+
+    record_store.write_records(filename, [])
+    records, reader = read(None)
+    assert records == [] and not reader.resumed
+
+    # Only the records written since are read
+    record_store.write_records(filename, RECORDS[:1])
+    records, reader = read(reader.watermark)
+    assert records == RECORDS[:1] and reader.resumed
+    record_store.write_records(filename, RECORDS)
+    records, reader = read(reader.watermark)
+    assert records == RECORDS[1:] and reader.resumed
+    records, reader = read(reader.watermark)
+    assert records == [] and reader.resumed
+    unchanged = reader.watermark
+
+    # Once the records already read change, they're all read again
+    record_store.write_records(filename, [dict(RECORDS[0], id=5)] + RECORDS)
+    records, reader = read(unchanged)
+    assert records == [dict(RECORDS[0], id=5)] + RECORDS
+    assert not reader.resumed
+    record_store.write_records(filename, RECORDS[:2])
+    records, reader = read(unchanged)
+    assert records == RECORDS[:2] and not reader.resumed
+
+    # As they are when the file's format changes
+    other = record_store.format_filename(filename, 'jsonl' if record_format
+                                         == 'json' else 'json')
+    record_store.write_records(other, RECORDS)
+    records, reader = read(unchanged)
+    assert records == RECORDS and not reader.resumed
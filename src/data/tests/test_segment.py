@@ -0,0 +1,55 @@
+import os
+import numpy as np
+import pytest
+from shapely.geometry import Point, LineString, Polygon, MultiLineString, \
+    GeometryCollection
+from .. import segment
+from .. import snap
+from .. import util
+
+
+TEST_FP = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_segment_batch():
+    geometries = [
+        Point(1, 2),
+        LineString([(0, 0), (1, 1), (2, 0)]),
+        Polygon([(0, 0), (4, 0), (4, 4), (0, 4)],
+                [[(1, 1), (2, 1), (2, 2), (1, 1)]]),
+        MultiLineString([[(0, 0), (1, 1)], [(5, 5), (6, 6), (7, 7)]]),
+        GeometryCollection(),
+    ]
+    properties = [{'id': i, 'name': str(i)} for i in range(5)]
+    batch = segment.SegmentBatch.from_geometries(geometries, properties)
+
+    assert len(batch) == 5
+    assert [x.wkt for x in batch.geometries()] == \
+        [x.wkt for x in geometries]
+    assert [x.properties for x in batch] == properties
+    assert np.allclose(batch.bounds()[:4], [x.bounds for x in geometries[:4]])
+    assert np.isnan(batch.bounds()[4]).all()
+
+    selected = batch.select([3, 1])
+    assert [x.wkt for x in selected.geometries()] == \
+        [geometries[3].wkt, geometries[1].wkt]
+    assert selected.ids.tolist() == [3, 1]
+    assert len(batch.select(np.zeros(5, dtype=bool))) == 0
+
+    with pytest.raises(ValueError):
+        segment.SegmentBatch.from_geometries(
+            [GeometryCollection([Point(1, 1)])], [{}])
+
+
+def test_snapper_from_batch():
+    segments = util.read_geojson(os.path.join(
+        TEST_FP, 'data', 'processed', 'maps',
+        'non_inters_segments.geojson'))
+    expected = snap.SegmentSnapper(segments)
+    snapper = snap.SegmentSnapper.from_batch(
+        segment.SegmentBatch.from_segments(segments))
+
+    assert snapper.ids == expected.ids
+    for name in ['starts', 'ends', 'counts', 'offsets', 'bounds']:
+        assert np.array_equal(getattr(snapper, name),
+                              getattr(expected, name))
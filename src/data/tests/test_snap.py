@@ -0,0 +1,124 @@
+import os
+import shutil
+import numpy as np
+from shapely.geometry import LineString, MultiLineString, Point
+from data import snap, util
+from data.segment import Segment
+from data.record import Record
+
+
+TEST_FP = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_segments():
+    return [
+        Segment(LineString([(0, 0), (10, 0), (10, 10)]), {'id': 'a'}),
+        Segment(MultiLineString([
+            [(20, 0), (30, 0)], [(30, 5), (30, 20)]]), {'id': 'b'}),
+        Segment(LineString([(0, 20), (5, 25)]), {'id': 'c'}),
+        Segment(Point(50, 50), {'id': 'd'}),
+    ]
+
+
+def test_snap_points():
+    segments = get_segments()
+
+    rng = np.random.RandomState(1)
+    xs = rng.uniform(-10, 60, 500)
+    ys = rng.uniform(-10, 60, 500)
+    tolerance = 5
+
+    nearest, distances = snap.snap_points(
+        xs, ys, segments, tolerance)
+
+    for x, y, segment_idx, distance in zip(xs, ys, nearest, distances):
+        point = Point(x, y)
+        candidates = [
+            (segment.geometry.distance(point), i)
+            for i, segment in enumerate(segments)
+            if point.buffer(tolerance).envelope.intersects(
+                segment.geometry.envelope)
+        ]
+        if candidates:
+            expected_distance, expected_idx = min(candidates)
+            assert segment_idx == expected_idx
+            assert np.isclose(distance, expected_distance)
+        else:
+            assert segment_idx == -1
+            assert distance == np.inf
+
+    # The same snapper can be reused with a different tolerance
+    snapper = snap.SegmentSnapper(segments)
+    assert (snapper.snap(xs, ys, tolerance)[0] == nearest).all()
+    nearest, _ = snapper.snap(xs, ys, 100)
+    assert (nearest >= 0).all()
+
+
+def test_snap_points_empty():
+    nearest, distances = snap.snap_points([], [], get_segments())
+    assert len(nearest) == 0
+    assert len(distances) == 0
+
+    nearest, distances = snap.snap_points([1], [1], [])
+    assert list(nearest) == [-1]
+
+
+def test_find_nearest():
+    segments = get_segments()
+
+    records = [
+        Record({}, point=Point(9, 1)),
+        Record({}, point=Point(31, 10)),
+        Record({}, point=Point(100, 100)),
+    ]
+    util.find_nearest(records, segments, 5, type_record=True)
+    assert [x.near_id for x in records] == ['a', 'b', '']
+
+    records = [
+        {'point': Point(1, 21), 'properties': {}},
+        {'point': Point(49, 49), 'properties': {}},
+    ]
+    util.find_nearest(records, segments, 5)
+    assert [x['properties']['near_id'] for x in records] == ['c', 'd']
+
+
+def test_save_and_load(tmpdir):
+    snapper = snap.SegmentSnapper(get_segments())
+    filename = os.path.join(tmpdir, 'index.npz')
+    snapper.save(filename, source=['a', 1])
+
+    assert snap.SegmentSnapper.load(filename, source=['a', 2]) is None
+    assert snap.SegmentSnapper.load(
+        os.path.join(tmpdir, 'missing.npz')) is None
+
+    loaded = snap.SegmentSnapper.load(filename, source=['a', 1])
+    assert loaded.ids == ['a', 'b', 'c', 'd']
+    xs = [9, 31, 100, 49]
+    ys = [1, 10, 100, 49]
+    assert list(loaded.snap(xs, ys, 5)[0]) == list(snapper.snap(xs, ys, 5)[0])
+
+
+def test_read_segments_snapper(tmpdir):
+    tmpdir = str(tmpdir)
+    shutil.copy(
+        os.path.join(TEST_FP, 'data', 'processed', 'maps',
+                     'non_inters_segments.geojson'),
+        tmpdir)
+    index_file = os.path.join(tmpdir, 'non_inters_index.npz')
+
+    snapper = util.read_segments_snapper(tmpdir, get_inter=False)
+    assert os.path.exists(index_file)
+    segments, _ = util.read_segments(tmpdir, get_inter=False)
+    assert snapper.ids == [x.properties['id'] for x in segments]
+
+    # Reading again uses the saved index
+    mtime = os.stat(index_file).st_mtime_ns
+    assert util.read_segments_snapper(tmpdir, get_inter=False).ids \
+        == snapper.ids
+    assert os.stat(index_file).st_mtime_ns == mtime
+
+    # Changing the segments file rebuilds it
+    with open(os.path.join(tmpdir, 'non_inters_segments.geojson'), 'a') as f:
+        f.write('\n')
+    util.read_segments_snapper(tmpdir, get_inter=False)
+    assert os.stat(index_file).st_mtime_ns != mtime
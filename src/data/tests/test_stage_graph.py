@@ -0,0 +1,183 @@
+import os
+import shutil
+from data import stage_graph
+
+
+TEST_FP = os.path.dirname(os.path.abspath(__file__))
+
+
+def write(filename, contents):
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'w') as f:
+        f.write(contents)
+
+
+def make_ctx(tmpdir):
+    datadir = os.path.join(tmpdir, 'data')
+    os.makedirs(datadir)
+    config_file = os.path.join(tmpdir, 'config.yml')
+    shutil.copy(
+        os.path.join(TEST_FP, 'data', 'config_features.yml'), config_file)
+    return stage_graph.StageContext(config_file, datadir)
+
+
+def toy_stages(calls, transform=lambda x: x):
+    """
+    Two stages, the second reading the output of the first
+    """
+    def first(ctx, forceupdate):
+        calls.append(('first', forceupdate))
+        with open(ctx.path('a.txt')) as f:
+            write(ctx.path('b.txt'), transform(f.read()))
+
+    def second(ctx, forceupdate):
+        calls.append(('second', forceupdate))
+        with open(ctx.path('b.txt')) as f:
+            write(ctx.path('c.txt'), f.read() + '!')
+
+    return [
+        stage_graph.Stage('first', 'generation', first,
+                          inputs=['a.txt'], outputs=['b.txt']),
+        stage_graph.Stage('second', 'model', second,
+                          inputs=['b.txt'], outputs=['c.txt']),
+    ]
+
+
+def test_run_stages(tmpdir):
+    ctx = make_ctx(tmpdir)
+    write(ctx.path('a.txt'), 'hello')
+    calls = []
+    stages = toy_stages(calls)
+
+    assert stage_graph.run_stages(stages, ctx) == ['first', 'second']
+    assert calls == [('first', True), ('second', True)]
+
+    # Nothing has changed
+    assert stage_graph.run_stages(stages, ctx) == []
+
+    # A changed input reruns everything downstream
+    write(ctx.path('a.txt'), 'goodbye')
+    assert stage_graph.run_stages(stages, ctx) == ['first', 'second']
+    with open(ctx.path('c.txt')) as f:
+        assert f.read() == 'goodbye!'
+
+    # Deleted outputs are regenerated, without forcing an update
+    os.remove(ctx.path('c.txt'))
+    calls[:] = []
+    assert stage_graph.run_stages(stages, ctx) == ['second']
+    assert calls == [('second', False)]
+
+    assert stage_graph.run_stages(
+        stages, ctx, forceupdate=True) == ['first', 'second']
+    assert stage_graph.run_stages(
+        stages, ctx, steps=['model'], forceupdate=True) == ['second']
+
+
+def test_run_stages_early_cutoff(tmpdir):
+    ctx = make_ctx(tmpdir)
+    write(ctx.path('a.txt'), 'hello')
+    calls = []
+    stages = toy_stages(calls, transform=lambda x: x.upper())
+    stage_graph.run_stages(stages, ctx)
+
+    # The first stage's output is the same, so the second doesn't rerun
+    write(ctx.path('a.txt'), 'HELLO')
+    assert stage_graph.run_stages(stages, ctx) == ['first']
+
+
+def test_pipeline_stages(tmpdir):
+    ctx = make_ctx(tmpdir)
+    write(ctx.path('raw', 'crashes', 'test'), 'crash data')
+    write(ctx.path('raw', 'volume', 'counts.csv'), 'volume data')
+    ran = []
+    runs = []
+
+    def fake_run(stage):
+        def run(run_ctx, forceupdate):
+            ran.append(stage.name)
+            runs.append(stage.name)
+            for filename in stage.output_files(run_ctx):
+                # Different contents on each run
+                write(filename, stage.name + str(len(runs)))
+        return run
+
+    stages = [
+        stage_graph.Stage(
+            x.name, x.step, None, inputs=x.inputs, outputs=x.outputs,
+            config_keys=x.config_keys, enabled=x.enabled)
+        for x in stage_graph.STAGES]
+    for stage in stages:
+        stage.run = fake_run(stage)
+
+    stage_graph.run_stages(stages, ctx)
+    assert ran == [
+        'standardize_crashes',
+        'standardize_volume',
+        'osm_create_maps',
+        'create_segments',
+        'join_segments_crash',
+        'propagate_volume',
+        'make_canon_dataset',
+        'train_model',
+        'make_preds_viz',
+    ]
+
+    ran[:] = []
+    assert stage_graph.run_stages(stages, ctx) == []
+
+    # Only the stages depending on crashes should rerun; the city polygon
+    # is expanded to take in the crashes, so that includes the map (and
+    # here, since the fake map changes, the stages after it)
+    write(ctx.path('raw', 'crashes', 'test'), 'more crash data')
+    assert stage_graph.run_stages(stages, ctx) == [
+        'standardize_crashes',
+        'osm_create_maps',
+        'create_segments',
+        'join_segments_crash',
+        'propagate_volume',
+        'make_canon_dataset',
+        'train_model',
+        'make_preds_viz',
+    ]
+
+
+def test_extra_map_stages(tmpdir, monkeypatch):
+    ctx = make_ctx(tmpdir)
+    ctx.config.extra_maps = [
+        {'name': 'Boston', 'filename': 'cob.shp', 'features': None},
+        {'name': 'bike', 'filename': 'bike.shp', 'features': ['bike_lane']},
+    ]
+    calls = []
+
+    class Module(object):
+        def __init__(self, name):
+            self.name = name
+
+        def main(self, argv):
+            calls.append((self.name, argv))
+
+    monkeypatch.setattr(stage_graph.importlib, 'import_module', Module)
+    monkeypatch.setattr(stage_graph.os, 'cpu_count', lambda: 2)
+    stages = {x.name: x for x in stage_graph.STAGES}
+
+    stages['extract_intersections'].run(ctx, False)
+    assert calls == [
+        ('data.extract_intersections',
+         ['cob.shp', '-d', ctx.datadir, '-n', 'Boston', '-p', '2']),
+        ('data.extract_intersections',
+         ['bike.shp', '-d', ctx.datadir, '-n', 'bike', '-p', '2']),
+    ]
+    assert [os.path.relpath(x, ctx.datadir) for x in
+            stages['add_map'].input_files(ctx)][2:] == [
+        'processed/maps/Boston/inters_segments.geojson',
+        'processed/maps/Boston/non_inters_segments.geojson',
+        'processed/maps/bike/inters_segments.geojson',
+        'processed/maps/bike/non_inters_segments.geojson',
+    ]
+
+    # All the maps are added at once
+    calls[:] = []
+    stages['add_map'].run(ctx, True)
+    assert calls == [('data.add_map', [
+        ctx.datadir, '-p', '2', '-m', 'Boston', '-m', 'bike', 'bike_lane'])]
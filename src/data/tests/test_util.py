@@ -1,5 +1,9 @@
 from .. import util
 from ..segment import Segment
+from .. import record
+from .. import record_store
+import datetime
+import json
 import os
 from shapely.geometry import Point, LineString, MultiLineString
 import fiona
@@ -230,3 +234,93 @@ def test_output_from_shapes(tmpdir):
             items['features'][1]['geometry']['coordinates'][0][0],
             [-71.11198305054148, 42.37143999999999])
 
+
+def test_reproject_records_batch():
+    records = [
+        {'geometry': {'type': 'Point', 'coordinates': [-71.1, 42.3]},
+         'properties': {'id': 1}},
+        {'geometry': {'type': 'Polygon', 'coordinates': []},
+         'properties': {'id': 2}},
+        {'geometry': {'type': 'MultiLineString', 'coordinates': [
+            [[-71.1, 42.3], [-71.2, 42.4]],
+            [[-71.2, 42.4], [-71.3, 42.5], [-71.3, 42.6]]]},
+         'properties': {'id': 3}},
+        {'geometry': {'type': 'LineString', 'coordinates': [
+            [-71.1, 42.3], [-71.0, 42.2]]},
+         'properties': {'id': 4}},
+    ]
+    result = util.reproject_records(records)
+
+    # Unsupported geometry types are skipped
+    assert [x['properties']['id'] for x in result] == [1, 3, 4]
+    assert [len(x.coords) for x in result[1]['geometry'].geoms] == [2, 3]
+
+    # Same as reprojecting one point at a time
+    expected = util.get_reproject_point(
+        42.5, -71.3, record.transformer_4326_to_3857)
+    assert result[1]['geometry'].geoms[1].coords[1] == (
+        expected.x, expected.y)
+    assert result[0]['geometry'].equals(util.get_reproject_point(
+        42.3, -71.1, record.transformer_4326_to_3857))
+
+    points = util.get_reproject_points(
+        [42.3, 42.5], [-71.1, -71.3], record.transformer_4326_to_3857)
+    assert points[1].equals(expected)
+
+    coords = util.reproject(
+        [(expected.x, expected.y)],
+        record.transformer_3857_to_4326)[0]['coordinates']
+    assert round(coords[0], 6) == -71.3
+    assert round(coords[1], 6) == 42.5
+
+
+def test_read_records_dates(tmpdir, monkeypatch):
+    crashes = [{
+        'id': i,
+        'dateOccurred': date,
+        'location': {'latitude': 42.3, 'longitude': -71.1},
+    } for i, date in enumerate([
+        '2016-01-01T00:10:00-05:00',
+        '2016-06-30T23:59:00-04:00',
+        '2017-01-01T08:00:00Z',
+        '2015-12-31T23:59:59.5-05:00',
+    ])]
+    filename = os.path.join(tmpdir.strpath, 'crashes.json')
+    with open(filename, 'w') as f:
+        json.dump(crashes, f)
+
+    # Read in more than one batch
+    monkeypatch.setattr(record_store, 'BATCH_SIZE', 3)
+    records = util.read_records(filename, 'crash')
+    assert [x.properties['id'] for x in records] == [0, 1, 2, 3]
+    assert records.timestamps.tolist() == [
+        datetime.datetime(2016, 1, 1, 0, 10),
+        datetime.datetime(2016, 6, 30, 23, 59),
+        datetime.datetime(2017, 1, 1, 8),
+        datetime.datetime(2015, 12, 31, 23, 59, 59),
+    ]
+    assert records[1].timestamp.utcoffset() == datetime.timedelta(hours=-4)
+
+    records = util.read_records(
+        filename, 'crash', startdate='2016-01-01', enddate='2016-06-30')
+    assert [x.properties['id'] for x in records] == [0, 1]
+    assert len(records.timestamps) == 2
+
+    assert util.read_records(filename, 'crash', startdate='2018') == []
+
+
+def test_parse_timestamps():
+    timestamps = util.parse_timestamps([
+        '2016-01-01T00:10:00-05:00', None, '01/02/2016 10:00 PM', 'x'])
+    assert np.isnat(timestamps).tolist() == [False, True, False, True]
+    assert timestamps[2] == np.datetime64('2016-01-02T22:00:00')
+    mask = util.date_mask(timestamps, startdate='2016-01-02')
+    assert mask.tolist() == [False, False, True, False]
+
+    # Only iso dates are cut short, other dates keep their time
+    timestamps = util.parse_timestamps([
+        'Tuesday, January 02, 2018 10:00 AM', '2018-01-02 10:00:00 PM',
+        '2018-01-02T10:00:00.750Z', '2018-01-02 10:00:00.5+0100'])
+    assert timestamps.tolist() == [
+        datetime.datetime(2018, 1, 2, 10), datetime.datetime(2018, 1, 2, 22),
+        datetime.datetime(2018, 1, 2, 10), datetime.datetime(2018, 1, 2, 10)]
@@ -0,0 +1,83 @@
+import os
+from shapely.geometry import LineString
+from .. import waze_store
+from ..segment import Segment
+
+
+ROADS = [
+    Segment(LineString([(0, 0), (100, 0)]), {'id': 1, 'segment_id': 'a'}),
+    Segment(LineString([(0, 50), (100, 50)]), {'id': 2, 'segment_id': 'b'}),
+]
+
+
+def jam(snapshot, level, speed):
+    return {'eventType': 'jam', 'snapshotId': snapshot,
+            'level': level, 'speed': speed}
+
+
+def test_aggregates(tmpdir):
+    filename = os.path.join(tmpdir.strpath, waze_store.FILENAME)
+    roads = waze_store.roads_key(ROADS)
+    aggregates = waze_store.WazeAggregates.load(filename, roads)
+    assert aggregates.num_snapshots == 0
+    assert aggregates.features({'id': 1, 'segment_id': 'a'}) == {
+        'id': 1, 'segment_id': 'a', 'jam_percent': 0, 'jam': 0,
+        'avg_jam_speed': 0, 'avg_jam_level': 0}
+
+    aggregates.add_snapshots({1, 2})
+    aggregates.add_jams({'a': [jam(1, 2, 5), jam(1, 4, 10)]})
+    aggregates.add_alerts([(1, 'JAM'), (1, 'JAM'), ('', 'HAZARD')])
+    aggregates.save(filename)
+
+    # Fold in another snapshot
+    aggregates = waze_store.WazeAggregates.load(filename, roads)
+    assert aggregates.is_new({'snapshotId': 4})
+    assert not aggregates.is_new({'snapshotId': 2})
+    aggregates.add_snapshots({4})
+    aggregates.add_jams({'a': [jam(4, 3, 0)]})
+    aggregates.add_alerts([(1, 'ROAD_CLOSED')])
+
+    properties = aggregates.features(
+        {'id': 1, 'segment_id': 'a', 'alert_OLD': 1})
+    assert properties == {
+        'id': 1, 'segment_id': 'a',
+        'jam_percent': 50, 'jam': 1, 'avg_jam_speed': 5, 'avg_jam_level': 3,
+        'alert_JAM': 2, 'alert_ROAD_CLOSED': 1}
+    assert aggregates.features({'id': 2, 'segment_id': 'b'})['jam'] == 0
+
+
+def test_roads_changed(tmpdir):
+    filename = os.path.join(tmpdir.strpath, waze_store.FILENAME)
+    aggregates = waze_store.WazeAggregates(waze_store.roads_key(ROADS))
+    aggregates.add_snapshots({1})
+    aggregates.save(filename)
+
+    # Reprojected coordinates still count as the same roads
+    moved = [Segment(LineString([(x + 1e-7, y) for x, y in
+                                 road.geometry.coords]), road.properties)
+             for road in ROADS]
+    assert waze_store.roads_key(moved) == waze_store.roads_key(ROADS)
+    assert waze_store.WazeAggregates.load(
+        filename, waze_store.roads_key(moved)).snapshots == {1}
+
+    assert waze_store.WazeAggregates.load(
+        filename, waze_store.roads_key(ROADS[:1])).snapshots == set()
+
+
+def test_snapshot_times():
+    aggregates = waze_store.WazeAggregates(waze_store.roads_key(ROADS))
+    first = dict(jam(1, 2, 5), snapshotTime='2018-10-15T16:12:00-04:00')
+    second = dict(jam(2, 4, 5), snapshotTime='2018-10-16T03:57:00-04:00')
+    aggregates.add_snapshots({waze_store.snapshot_key(first),
+                              waze_store.snapshot_key(second)})
+    aggregates.add_jams({'a': [first]})
+    assert aggregates.num_snapshots == 2
+
+    # Standardized again with the first snapshot out of the date range,
+    # the second one is numbered 1 but is still the same snapshot
+    renumbered = dict(second, snapshotId=1)
+    assert not aggregates.is_new(renumbered)
+    assert aggregates.is_new(
+        dict(jam(2, 1, 1), snapshotTime='2018-10-17T12:12:00-04:00'))
+    assert aggregates.features(
+        {'id': 1, 'segment_id': 'a'})['jam_percent'] == 50
@@ -1,15 +1,19 @@
 import fiona
+import numpy as np
 import pyproj
 import rtree
 from shapely.geometry import Point, shape, mapping, MultiLineString, LineString
 from matplotlib import pyplot
 import os
 import json
+import re
 from dateutil.parser import parse
-import datetime
-from .record import Crash, Record
+from .record import Crash, Record, RecordList, RecordBatch, object_array
 import geojson
 from .segment import Segment
+from . import snap
+from . import map_store
+from . import record_store
 from .record import transformer_4326_to_3857, transformer_3857_to_4326
 
 
@@ -21,6 +25,10 @@ BASE_DIR = os.path.dirname(
 
 MAP_FP = BASE_DIR + '/data/processed/maps'
 PROCESSED_DATA_FP = BASE_DIR + '/data/processed/'
+# An iso formatted date and time, with an optional fraction of a second
+# and utc offset after it, see parse_timestamps
+ISO_DATE = re.compile(
+    r'\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d(\.\d+)?(Z|[+-]\d\d:?\d\d)?$')
 
 
 
@@ -33,15 +41,12 @@ def get_hourly_rates(volume_file):
         counts - the average percentage of traffic that occurs each hour
     """
     all_counts = []
-    with open(volume_file) as data_file:
-        volumes = json.load(data_file)
-    
-        for v in volumes:
-            counts = v['volume']['hourlyVolume']
-            total = sum(counts)
-            counts = [x/total for x in counts]
-            if counts:
-                all_counts.append(counts)
+    for v in record_store.iter_records(volume_file):
+        counts = v['volume']['hourlyVolume']
+        total = sum(counts)
+        counts = [x/total for x in counts]
+        if counts:
+            all_counts.append(counts)
 
     counts = [sum(i)/len(all_counts) for i in zip(*all_counts)]
 
@@ -67,11 +72,15 @@ def plot_hourly_rates(all_counts, outfile):
 
 def read_geojson(fp):
     """ Read geojson file, reproject to 3857, and
-    output tuple geometry + property """
+    output tuple geometry + property
+    If the file has an up to date columnar store (see map_store.py),
+    that is read instead """
 
-    with open(fp) as f:
-        data = json.load(f)
-    data = reproject_records([x for x in data['features']])
+    data = map_store.read_records(fp)
+    if data is None:
+        with open(fp) as f:
+            data = json.load(f)
+        data = reproject_records([x for x in data['features']])
 
     return [Segment(x['geometry'], x['properties']) for x in data]
 
@@ -98,6 +107,25 @@ def get_reproject_point(lat, lon, transformer,
         return Point(float(lon), float(lat))
 
 
+def get_reproject_points(lats, lons, transformer, coords=False):
+    """
+    Turn a list of points in one projection into another, with a single
+    call to the transformer
+    Args:
+        lats - list of latitudes
+        lons - list of longitudes
+        transformer
+    Returns:
+        A list of points in the specified projection, or of x, y
+        tuples if coords is True
+    """
+    new_coords = transform_coords(
+        coords_array(list(zip(lons, lats))), transformer).tolist()
+    if coords:
+        return [(x, y) for x, y in new_coords]
+    return [Point(x, y) for x, y in new_coords]
+
+
 def read_records_from_geojson(filename):
     """
     Reads appropriately formatted geojson file,
@@ -109,111 +137,218 @@ def read_records_from_geojson(filename):
         A list of Records
     """
 
-    records = []
     with open(filename) as f:
         items = geojson.load(f)
-        for item in items['features']:
-            properties = item['properties']
-            properties['location'] = {
-                'latitude': item['geometry']['coordinates'][1],
-                'longitude': item['geometry']['coordinates'][0]
-            }
-            record = Record(properties)
-            records.append(record)
-    return records
+    for item in items['features']:
+        item['properties']['location'] = {
+            'latitude': item['geometry']['coordinates'][1],
+            'longitude': item['geometry']['coordinates'][0]
+        }
+    return make_records(
+        [item['properties'] for item in items['features']], 'record')
+
+
+def make_records(items, record_type):
+    """
+    Turn a list of properties with a location into Records (or Crashes),
+    reprojecting all the locations together
+    Args:
+        items - list of dicts with location latitude and longitude
+        record_type - 'crash' for Crash objects, otherwise Record
+    Returns:
+        A list of Records
+    """
+    points = get_reproject_points(
+        [item['location']['latitude'] for item in items],
+        [item['location']['longitude'] for item in items],
+        transformer_4326_to_3857)
+    if record_type == 'crash':
+        return [Crash(item, point) for item, point in zip(items, points)]
+    return [Record(item, point) for item, point in zip(items, points)]
+
+
+def parse_timestamps(dates):
+    """
+    Parse dates into a datetime64 array, all at once
+    Dates are kept in the local time they were written in, ignoring their
+    utc offset, so crashes are compared by their local date and time
+    Args:
+        dates - list of iso formatted date strings, or None
+    Returns:
+        datetime64[s] array, NaT where there's no date
+    """
+    # Iso dates are parsed by numpy without their fraction of a second
+    # and utc offset; anything else keeps its whole string for dateutil
+    trimmed = [iso_local(x) if isinstance(x, str) else '' for x in dates]
+    try:
+        return np.array(trimmed, dtype='datetime64[s]')
+    except ValueError:
+        pass
+
+    # Some dates aren't iso formatted, so parse those one at a time
+    timestamps = np.empty(len(dates), dtype='datetime64[s]')
+    for i, (date, trimmed_date) in enumerate(zip(dates, trimmed)):
+        try:
+            timestamps[i] = np.datetime64(trimmed_date, 's')
+        except ValueError:
+            try:
+                timestamps[i] = np.datetime64(
+                    parse(date).replace(tzinfo=None), 's')
+            except (ValueError, OverflowError):
+                timestamps[i] = np.datetime64('NaT')
+    return timestamps
+
+
+def iso_local(date):
+    """
+    The local date and time part of an iso formatted date string,
+    or the whole string if it isn't one
+    """
+    if ISO_DATE.match(date):
+        return date[:19]
+    return date
+
+
+def date_mask(timestamps, startdate=None, enddate=None):
+    """
+    Which timestamps are in a date range
+    Args:
+        timestamps - datetime64 array, see parse_timestamps
+        startdate - optional first date to include
+        enddate - optional last date to include, the whole day
+    Returns:
+        boolean array, False where there's no timestamp if there's a range
+    """
+    mask = np.ones(len(timestamps), dtype=bool)
+    if startdate:
+        mask &= timestamps >= np.datetime64(
+            parse(startdate).replace(tzinfo=None), 's')
+    if enddate:
+        mask &= timestamps < np.datetime64(
+            parse(enddate).replace(tzinfo=None), 's') + np.timedelta64(1, 'D')
+    return mask
+
+
+def read_items(filename, record_type, startdate=None, enddate=None):
+    """
+    Read the property dicts in a records file, and their timestamps
+    The file is read in batches, parsing each batch's dates together and
+    dropping the records outside the date range before the next is read
+    Args:
+        filename, record_type, startdate, enddate - as for read_records
+    Returns:
+        list of dicts, and a datetime64 array of their timestamps
+    """
+    date_field = 'dateOccurred' if record_type == 'crash' else 'timestamp'
+    items = []
+    timestamps = [np.array([], dtype='datetime64[s]')]
+    for batch in record_store.iter_batches(filename):
+        batch_timestamps = parse_timestamps(
+            [x.get(date_field) for x in batch])
+        if startdate or enddate:
+            mask = date_mask(batch_timestamps, startdate, enddate)
+            batch = [x for x, keep in zip(batch, mask) if keep]
+            batch_timestamps = batch_timestamps[mask]
+        items.extend(batch)
+        timestamps.append(batch_timestamps)
+    return items, np.concatenate(timestamps)
+
+
+def print_date_range(timestamps):
+    # Keep track of the earliest and latest crash date used
+    dated = timestamps[~np.isnat(timestamps)]
+    if len(dated):
+        print("Read in data from {} crashes from {} to {}".format(
+            len(timestamps), dated.min().astype('datetime64[D]'),
+            dated.max().astype('datetime64[D]')))
+    print("Read in data from {} records".format(len(timestamps)))
 
 
 def read_records(filename, record_type,
                  startdate=None, enddate=None):
     """
-    Reads appropriately formatted json file,
+    Reads appropriately formatted json file, in any of the formats in
+    record_store.py,
     pulls out currently relevant features,
     converts latitude and longitude to projection 4326, and turns into
     a Crash object
+    Records outside the date range are dropped as the file is read
     Args:
         filename - json file
         start - optionally give start for date range of crashes
         end - optionally give end date after which to exclude crashes
     Returns:
-        A list of Crashes
+        A RecordList of Crashes (or of Records), with their timestamps
     """
-
-    records = []
-    items = json.load(open(filename))
+    items, timestamps = read_items(filename, record_type, startdate, enddate)
     if not items:
-        return []
-
-    for item in items:
-        record = None
-        if record_type == 'crash':
-            record = Crash(item)
-        else:
-            record = Record(item)
-        records.append(record)
+        return RecordList([], timestamps)
 
-    if startdate:
-        records = [x for x in records if x.timestamp >= parse(startdate)]
-    if enddate:
-        records = [x for x in records
-                   if x.timestamp < parse(enddate) + datetime.timedelta(1)]
+    records = RecordList(make_records(items, record_type), timestamps)
+    print_date_range(timestamps)
+    return records
 
-    # Keep track of the earliest and latest crash date used
-    start = min([x.timestamp for x in records])
-    end = max([x.timestamp for x in records])
-    if start and end:
-        print("Read in data from {} crashes from {} to {}".format(
-            len(records), start.date(), end.date()))
-    print("Read in data from {} records".format(len(records)))
 
-    return records
+def read_record_batch(filename, record_type,
+                      startdate=None, enddate=None):
+    """
+    Read a records file into a RecordBatch, which takes much less memory
+    than the list of Records read_records gives
+    Args:
+        as for read_records
+    Returns:
+        RecordBatch
+    """
+    items, timestamps = read_items(filename, record_type, startdate, enddate)
+    batch = RecordBatch.from_items(items, record_type, timestamps)
+    del items
+    if len(batch):
+        print_date_range(timestamps)
+    return batch
 
 
-def find_nearest(records, segments, segments_index, tolerance,
-                 type_record=False):
+def find_nearest(records, segments, tolerance, type_record=False):
     """ Finds nearest segment to records
-    tolerance : max units distance from record point to consider
+    Snaps all the records in one batch, see data/snap.py
+    Args:
+        records - list of Records, or of dicts with a point and
+            properties, or a RecordBatch
+        segments - list of segments, or a SegmentSnapper made from them
+        tolerance : max units distance from record point to consider
+        type_record - whether the records are Records or dicts
+    Returns:
+        nothing, sets near_id on each record, or '' if no segment matched
     """
 
     print("Using tolerance {}".format(tolerance))
 
-    for record in records:
-
-        # We are in process of transition to using Record class
-        # but haven't converted it everywhere, so until we do, need
-        # to look at whether the records are of type record or not
-        record_point = None
-        if type_record:
-            record_point = record.point
-        else:
-            record_point = record['point']
+    snapper = segments
+    if not isinstance(snapper, snap.SegmentSnapper):
+        snapper = snap.SegmentSnapper(segments)
+
+    if isinstance(records, RecordBatch):
+        nearest, _ = snapper.snap(records.x, records.y, tolerance)
+        records.near_ids = object_array([
+            snapper.ids[x] if x >= 0 else '' for x in nearest.tolist()])
+        return
+
+    # We are in process of transition to using Record class
+    # but haven't converted it everywhere, so until we do, need
+    # to look at whether the records are of type record or not
+    if type_record:
+        points = [record.point for record in records]
+    else:
+        points = [record['point'] for record in records]
 
-        record_buffer_bounds = record_point.buffer(tolerance).bounds
-        nearby_segments = segments_index.intersection(record_buffer_bounds)
+    nearest, _ = snapper.snap(
+        [p.x for p in points], [p.y for p in points], tolerance)
 
-        segment_id_with_distance = [
-            # Get db index and distance to point
-            (
-                segments[segment_id].properties['id'],
-                segments[segment_id].geometry.distance(record_point)
-            )
-            for segment_id in nearby_segments
-        ]
-
-        # Find nearest segment
-        if len(segment_id_with_distance):
-            nearest = min(segment_id_with_distance, key=lambda tup: tup[1])
-            db_segment_id = nearest[0]
-            # Add db_segment_id to record
-            if type_record:
-                record.near_id = db_segment_id
-            else:
-                record['properties']['near_id'] = db_segment_id
-        # If no segment matched, populate key = ''
+    for record, segment_idx in zip(records, nearest):
+        near_id = snapper.ids[segment_idx] if segment_idx >= 0 else ''
+        if type_record:
+            record.near_id = near_id
         else:
-            if type_record:
-                record.near_id = ''
-            else:
-                record['properties']['near_id'] = ''
+            record['properties']['near_id'] = near_id
 
 
 def read_segments(dirname=MAP_FP, get_inter=True, get_non_inter=True):
@@ -233,24 +368,77 @@ def read_segments(dirname=MAP_FP, get_inter=True, get_non_inter=True):
     non_inter = []
 
     if get_inter:
-        inter = fiona.open(dirname + '/inters_segments.geojson')
-        inter = reproject_records([x for x in inter])
-        inter = [{
-            'geometry': mapping(x['geometry']),
-            'properties': x['properties']} for x in inter]
+        inter = read_map_records(dirname + '/inters_segments.geojson')
 
     if get_non_inter:
-        non_inter = fiona.open(
+        non_inter = read_map_records(
             dirname + '/non_inters_segments.geojson')
-        non_inter = reproject_records([x for x in non_inter])
-        non_inter = [{
-            'geometry': mapping(x['geometry']),
-            'properties': x['properties']} for x in non_inter]
 
     print("Read in {} intersection, {} non-intersection segments".format(
         len(inter), len(non_inter)))
 
-    return index_segments(list(inter) + list(non_inter))
+    return index_segments([
+        Segment(x['geometry'], x['properties']) for x in inter + non_inter
+    ], segment=True)
+
+
+def read_map_records(filename):
+    """
+    Read a map geojson file written by the data stages, using its
+    columnar store if it's up to date, see map_store.py
+    As with fiona, properties a record doesn't have are set to None
+    Args:
+        filename - geojson file
+    Returns:
+        list of dicts with shapely geometry in 3857 projection
+        and properties
+    """
+    records = map_store.read_records(filename, fill_missing=True)
+    if records is None:
+        with fiona.open(filename) as data:
+            records = reproject_records([x for x in data])
+    return records
+
+
+def read_segments_snapper(dirname=MAP_FP, get_inter=True,
+                          get_non_inter=True):
+    """
+    Gets a SegmentSnapper for the segments in a maps directory
+    The snapper is saved in the maps directory, and only rebuilt when
+    the segment files have changed since it was saved
+
+    Args:
+        Optional directory (defaults to MAP_FP)
+        get_inter - whether to include inter segments; defaults to True
+        get_non_inter - whether to include non inter segments;
+            defaults to True
+    Returns:
+        SegmentSnapper
+    """
+    names = []
+    if get_inter:
+        names.append('inters_segments.geojson')
+    if get_non_inter:
+        names.append('non_inters_segments.geojson')
+    index_file = os.path.join(dirname, '{}_index.npz'.format(
+        'segments' if get_inter and get_non_inter
+        else names[0].replace('_segments.geojson', '')))
+
+    # The size and modification time of each segment file
+    source = []
+    for name in names:
+        stat = os.stat(os.path.join(dirname, name))
+        source.append([name, stat.st_size, stat.st_mtime_ns])
+
+    snapper = snap.SegmentSnapper.load(index_file, source)
+    if snapper is None:
+        segments, _ = read_segments(dirname, get_inter, get_non_inter)
+        snapper = snap.SegmentSnapper(segments)
+        snapper.save(index_file, source)
+        print("Saved segment index to {}".format(index_file))
+    else:
+        print("Read segment index from {}".format(index_file))
+    return snapper
 
 
 def index_segments(segments, geojson=True, segment=False):
@@ -273,9 +461,16 @@ def index_segments(segments, geojson=True, segment=False):
         combined_seg = [Segment(shape(x['geometry']), x['properties']) for x in
                         segments]
     # Create spatial index for quick lookup
+    # Bulk loading is much faster than inserting one at a time,
+    # but can't be given an empty list
+    bounds = [
+        (idx, element.geometry.bounds, None)
+        for idx, element in enumerate(combined_seg)
+        if not element.geometry.is_empty
+    ]
     segments_index = rtree.index.Index()
-    for idx, element in enumerate(combined_seg):
-        segments_index.insert(idx, element.geometry.bounds)
+    if bounds:
+        segments_index = rtree.index.Index(bounds)
 
     return combined_seg, segments_index
 
@@ -325,6 +520,65 @@ def track(index, step, tot):
         print("finished {} of {}".format(index, tot))
 
 
+def tile_groups(bounds, num_tiles):
+    """
+    Split items into a grid of spatial tiles by the centers of their
+    bounding boxes, for handing out work to a process pool
+    Args:
+        bounds - list of (minx, miny, maxx, maxy) tuples, one per item
+        num_tiles - the approximate number of tiles
+    Returns:
+        list of lists of item positions, one list per non empty tile,
+        in tile order, each in ascending order
+        Items with empty bounds go in the first tile
+    """
+    filled = [b for b in bounds if b]
+    if not filled:
+        return [list(range(len(bounds)))] if bounds else []
+    minx = min(b[0] for b in filled)
+    miny = min(b[1] for b in filled)
+    maxx = max(b[2] for b in filled)
+    maxy = max(b[3] for b in filled)
+    per_side = max(int(np.ceil(np.sqrt(num_tiles))), 1)
+    tile_width = (maxx - minx) / per_side or 1
+    tile_height = (maxy - miny) / per_side or 1
+
+    tiles = {}
+    for i, b in enumerate(bounds):
+        tile = (0, 0)
+        if b:
+            tile = (
+                min(int(((b[0] + b[2]) / 2 - minx) / tile_width),
+                    per_side - 1),
+                min(int(((b[1] + b[3]) / 2 - miny) / tile_height),
+                    per_side - 1)
+            )
+        tiles.setdefault(tile, []).append(i)
+    return [tiles[tile] for tile in sorted(tiles.keys())]
+
+
+def coords_array(coords):
+    """
+    Turn a list of coordinates into an (n, 2) numpy array of floats,
+    dropping any z values
+    """
+    coords = np.asarray(coords, dtype=float)
+    if not coords.size:
+        return np.zeros((0, 2))
+    return coords.reshape(len(coords), -1)[:, :2]
+
+
+def transform_coords(coords, transformer):
+    """
+    Reproject an (n, 2) array of coordinates with a single call
+    to the transformer
+    """
+    if not len(coords):
+        return coords
+    xs, ys = transformer.transform(coords[:, 0], coords[:, 1])
+    return np.column_stack([xs, ys])
+
+
 def reproject(coords, transformer=None):
     """
     Reproject a set of coordinate points
@@ -336,58 +590,69 @@ def reproject(coords, transformer=None):
     Returns:
         new_coords = a list of reprojected json points
     """
-    new_coords = []
     if not transformer:
         transformer = transformer_4326_to_3857
 
-    for coord in coords:
-        re_point = transformer.transform(coord[0], coord[1])
-        point = Point(re_point)
-        new_coords.append(mapping(point))
-    return new_coords
+    new_coords = transform_coords(coords_array(list(coords)), transformer)
+    return [{'type': 'Point', 'coordinates': (x, y)}
+            for x, y in new_coords.tolist()]
 
 
 def reproject_records(records, transformer=None):
     """
     Reprojects a set of records from one projection to another
     Records can either be points, line strings, or multiline strings
+    The coordinates of all the records are reprojected together
     Args:
         records - list of records to reproject
         optional: transformer object (if not given, defaults to 4326->3857)
     Returns:
         list of reprojected records
     """
-    results = []
-
     if not transformer:
         transformer = transformer_4326_to_3857
 
+    # Flatten every record's lines of coordinates into one array
+    kept = []
+    lines = []
     for record in records:
+        geom_type = record['geometry']['type']
         coords = record['geometry']['coordinates']
-        if record['geometry']['type'] == 'Point':
-            re_point = transformer.transform(coords[0], coords[1])
-            point = Point(re_point)
-            results.append({'geometry': point,
-                            'properties': record['properties']})
-        elif record['geometry']['type'] == 'MultiLineString':
-            new_coords = []
-            for segment in coords:
-                new_segment = []
-                for coord in segment:
-                    new_segment.append(transformer.transform(
-                        coord[0], coord[1]))
-                new_coords.append(new_segment)
-
-            results.append({'geometry': MultiLineString(new_coords),
-                            'properties': record['properties']})
-        elif record['geometry']['type'] == 'LineString':
-            new_coords = []
-            for coord in coords:
-                new_coords.append(
-                    transformer.transform(coord[0], coord[1])
-                )
-            results.append({'geometry': LineString(new_coords),
-                            'properties': record['properties']})
+        if geom_type == 'Point':
+            record_lines = [[coords]]
+        elif geom_type == 'LineString':
+            record_lines = [coords]
+        elif geom_type == 'MultiLineString':
+            record_lines = coords
+        else:
+            continue
+        kept.append((record, geom_type, len(record_lines)))
+        lines.extend(coords_array(line) for line in record_lines)
+
+    if not kept:
+        return []
+    new_coords = transform_coords(np.concatenate(lines), transformer)
+    ends = np.cumsum([len(line) for line in lines]).tolist()
+    starts = [0] + ends[:-1]
+
+    # Then rebuild the geometries from the offsets of each line
+    results = []
+    line_idx = 0
+    for record, geom_type, num_lines in kept:
+        record_lines = [
+            new_coords[starts[i]:ends[i]]
+            for i in range(line_idx, line_idx + num_lines)]
+        line_idx += num_lines
+        if geom_type == 'Point':
+            geometry = Point(record_lines[0][0])
+        elif geom_type == 'LineString':
+            # Empty line strings can't be made from an empty array
+            geometry = LineString(record_lines[0]) \
+                if len(record_lines[0]) else LineString()
+        else:
+            geometry = MultiLineString(record_lines)
+        results.append({'geometry': geometry,
+                        'properties': record['properties']})
 
     return results
 
@@ -399,7 +664,7 @@ def write_records_to_geojson(records, outfilename):
         records - a list of objects that contain geometry and properties
         outfilename - geojson file to write to
     Returns:
-        records as a geojson list
+        the features as serialized geojson strings, see dump_features
     """
 
     records = [{
@@ -407,10 +672,36 @@ def write_records_to_geojson(records, outfilename):
         'properties': record.properties
         } for record in records]
 
-    records = prepare_geojson(records)
+    features = dump_features(prepare_geojson(records)['features'])
+    write_features(features, outfilename)
+    map_store.write_records(records, outfilename)
+    return features
+
+
+def dump_features(features):
+    """
+    Serialize each feature of a feature collection, so that features
+    written to more than one file are only serialized once
+    Args:
+        features - a list of geojson features
+    Returns:
+        a list of strings
+    """
+    return [geojson.dumps(x) for x in features]
+
+
+def write_features(features, outfilename):
+    """
+    Write serialized features as a feature collection, the same as
+    geojson.dump writes it
+    Args:
+        features - a list of strings, from dump_features
+        outfilename - geojson file to write to
+    """
     with open(outfilename, 'w') as outfile:
-        geojson.dump(records, outfile)
-    return records
+        outfile.write('{"type": "FeatureCollection", "features": [')
+        outfile.write(', '.join(features))
+        outfile.write(']}')
 
 
 def prepare_geojson(elements):
@@ -493,9 +784,7 @@ def get_roads_and_inters(filename):
     Returns:
         roads, intersections
     """
-    data = fiona.open(filename)
-
-    data = reproject_records([x for x in data])
+    data = read_map_records(filename)
     # All the line strings are roads
     roads = [Segment(x['geometry'], x['properties']) for x in data
              if x['geometry'].type == 'LineString']
@@ -522,38 +811,45 @@ def output_from_shapes(items, filename):
     Returns:
         nothing, writes to file
     """
-    output = []
-
+    # Only polygon exteriors are written
+    supported = []
+    lines = []
     for item, properties in items:
         if item.type == 'Polygon':
-            coords = [x for x in item.exterior.coords]
-            reprojected_coords = [[get_reproject_point(
-                x[1], x[0], transformer_3857_to_4326, coords=True)
-                                  for x in coords]]
+            item_lines = [item.exterior.coords]
         elif item.type == 'MultiLineString':
-            lines = [x for x in item]
-            reprojected_coords = []
-            for line in lines:
-                reprojected_coords.append([get_reproject_point(
-                    x[1], x[0], transformer_3857_to_4326, coords=True)
-                                  for x in line.coords])
-        elif item.type == 'LineString':
-            coords = [x for x in item.coords]
-            reprojected_coords = [get_reproject_point(
-                x[1], x[0], transformer_3857_to_4326, coords=True)
-                                  for x in coords]
-        elif item.type == 'Point':
-            reprojected_coords = get_reproject_point(
-                item.y, item.x, transformer_3857_to_4326,
-                coords=True
-            )
+            item_lines = [line.coords for line in item]
+        elif item.type in ('LineString', 'Point'):
+            item_lines = [item.coords]
         else:
             print("{} not supported, skipping".format(item.type))
             continue
+        supported.append((item.type, properties, len(item_lines)))
+        lines.extend(coords_array(line) for line in item_lines)
+
+    # Reproject all the coordinates together
+    new_coords = np.zeros((0, 2))
+    if lines:
+        new_coords = transform_coords(
+            np.concatenate(lines), transformer_3857_to_4326)
+    ends = np.cumsum([len(line) for line in lines]).tolist()
+    starts = [0] + ends[:-1]
+
+    output = []
+    line_idx = 0
+    for geom_type, properties, num_lines in supported:
+        reprojected_coords = [
+            [tuple(x) for x in new_coords[starts[i]:ends[i]].tolist()]
+            for i in range(line_idx, line_idx + num_lines)]
+        line_idx += num_lines
+        if geom_type == 'LineString':
+            reprojected_coords = reprojected_coords[0]
+        elif geom_type == 'Point':
+            reprojected_coords = reprojected_coords[0][0]
         output.append({
             'type': 'Feature',
             'geometry': {
-                'type': item.type,
+                'type': geom_type,
                 'coordinates': reprojected_coords
             },
             'properties': properties
@@ -572,20 +868,17 @@ def write_segments(non_inters, inters, mapfp):
         mapfp - maps directory to write to
     """
     # Store non-intersection segments
-
-    non_inters = write_records_to_geojson(
-        non_inters, os.path.join(
-            mapfp, 'non_inters_segments.geojson'))
+    non_inters_file = os.path.join(mapfp, 'non_inters_segments.geojson')
+    non_inters = write_records_to_geojson(non_inters, non_inters_file)
 
     # Store the individual intersections
-    int_w_ids = write_records_to_geojson(
-        inters, os.path.join(
-            mapfp, 'inters_segments.geojson'))
-
-    # Store the combined segments with all properties
-    segments = non_inters['features'] + int_w_ids['features']
-
-    with open(os.path.join(mapfp, 'inter_and_non_int.geojson'), 'w') as outfile:
-        geojson.dump(geojson.FeatureCollection(segments), outfile)
+    inters_file = os.path.join(mapfp, 'inters_segments.geojson')
+    int_w_ids = write_records_to_geojson(inters, inters_file)
+
+    # Store the combined segments with all properties, from the features
+    # already serialized, and a store that reads the two stores above
+    combined_file = os.path.join(mapfp, 'inter_and_non_int.geojson')
+    write_features(non_inters + int_w_ids, combined_file)
+    map_store.write_combined(combined_file, [non_inters_file, inters_file])
 
 
@@ -0,0 +1,197 @@
+"""
+Running per-segment totals of the waze data added to a city's segments
+
+Rather than working out each segment's waze features from all of the
+waze data every time, the counts and sums they're computed from are kept
+in processed/waze_aggregates.json, along with the snapshots that have
+already been added. Snapshots that come in later are folded into the
+totals, and the features refreshed from them, in time that depends only
+on how much new data there is.
+
+Snapshots are identified by their snapshotTime, when the snapshot
+started, which stays the same however many times the raw files are
+standardized, whatever the date range. Each snapshot also has a record
+of its own (with eventType snapshot) so snapshots with no jams or alerts
+still count. Waze files standardized before snapshotTime was written
+only have their snapshotId, their position among the raw snapshot files
+in that run, which is used in its place. The totals are started over
+whenever the road segments they're for change, and need to be rebuilt
+with --forceupdate if snapshots are taken out of the date range.
+
+How far each waze file has been read is kept too, so that when the
+standardized waze.json is written again with new snapshots on the end,
+only those are parsed, see record_store.RecordReader.
+"""
+import hashlib
+import json
+import os
+
+
+FILENAME = 'waze_aggregates.json'
+# Bump when the saved format changes, so old files get rebuilt
+VERSION = 3
+
+
+def snapshot_key(record):
+    """
+    What identifies a waze record's snapshot: the time it started, or its
+    snapshotId in files standardized before that was written
+    """
+    return record.get('snapshotTime', record['snapshotId'])
+
+
+def roads_key(road_segments):
+    """
+    Hash of the road segments' ids and coordinates, rounded to the
+    decimeter so that reprojecting them back and forth doesn't change it
+    """
+    sha = hashlib.sha1()
+    for road in road_segments:
+        sha.update(json.dumps([
+            road.properties.get('segment_id'),
+            road.properties.get('id'),
+            [[round(x, 1) for x in coords[:2]]
+             for coords in road.geometry.coords],
+        ], default=str).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class WazeAggregates(object):
+    """
+    Totals of the jams and alerts on each segment
+    Args:
+        roads - roads_key of the segments the totals are for
+    """
+    def __init__(self, roads):
+        self.roads = roads
+        # The snapshots that have been added, and the number of
+        # snapshots they cover, see add_snapshots
+        self.snapshots = set()
+        self.num_snapshots = 0
+        # By segment_id, the number of snapshots with a jam, the number
+        # of jams, and the sums of their levels and speeds
+        self.jams = {}
+        # By segment id, the number of alerts of each type
+        self.alerts = {}
+        # By waze filename, the watermark of the records already read
+        self.files = {}
+
+    @classmethod
+    def load(cls, filename, roads):
+        """
+        Read saved totals
+        Returns:
+            the totals, or empty ones if the file doesn't exist or was
+            saved for different segments
+        """
+        if not os.path.exists(filename):
+            return cls(roads)
+        with open(filename) as f:
+            saved = json.load(f)
+        if saved.get('version') != VERSION or saved['roads'] != roads:
+            print("Road segments have changed, adding all waze data again")
+            return cls(roads)
+
+        aggregates = cls(roads)
+        aggregates.snapshots = set(saved['snapshots'])
+        aggregates.num_snapshots = saved['num_snapshots']
+        aggregates.jams = saved['jams']
+        aggregates.alerts = saved['alerts']
+        aggregates.files = saved['files']
+        return aggregates
+
+    def save(self, filename):
+        # Write to a temporary file first, so a partly written
+        # file is never loaded
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump({
+                'version': VERSION,
+                'roads': self.roads,
+                'snapshots': sorted(self.snapshots, key=str),
+                'num_snapshots': self.num_snapshots,
+                'jams': self.jams,
+                'alerts': self.alerts,
+                'files': self.files,
+            }, f)
+        os.replace(tmp_filename, filename)
+
+    def is_new(self, record):
+        """
+        Whether a waze record is from a snapshot that hasn't been added
+        """
+        return snapshot_key(record) not in self.snapshots
+
+    def add_snapshots(self, snapshots):
+        """
+        Record that snapshots have been added
+        Snapshots known by their time count once each; those only known
+        by their snapshotId cover the snapshots numbered before them too,
+        whether or not there was anything in them
+        Args:
+            snapshots - set of snapshot keys, see snapshot_key
+        """
+        self.snapshots.update(snapshots)
+        ids = [x for x in self.snapshots if not isinstance(x, str)]
+        self.num_snapshots = len(self.snapshots) - len(ids) \
+            + (max(ids) if ids else 0)
+
+    def add_jams(self, waze_info):
+        """
+        Add jams to the totals
+        Args:
+            waze_info - dict of segment_id to a list of the jams on it,
+                from snapshots that haven't been added before
+        """
+        for segment_id, jams in waze_info.items():
+            totals = self.jams.setdefault(str(segment_id), {
+                'snapshots': 0, 'jams': 0, 'level': 0, 'speed': 0})
+            # only count one jam per snapshot on a road
+            totals['snapshots'] += len(set(snapshot_key(x) for x in jams))
+            totals['jams'] += len(jams)
+            totals['level'] += sum(x['level'] for x in jams)
+            totals['speed'] += sum(x['speed'] for x in jams)
+
+    def add_alerts(self, alerts):
+        """
+        Add alerts to the totals
+        Args:
+            alerts - list of tuples of the id of the segment an alert is
+                nearest and the alert's type
+        """
+        for near_id, alert_type in alerts:
+            counts = self.alerts.setdefault(str(near_id), {})
+            counts[alert_type] = counts.get(alert_type, 0) + 1
+
+    def features(self, properties):
+        """
+        Update a road segment's properties with its waze features
+        Args:
+            properties - dict, with the segment's segment_id and id
+        Returns:
+            properties
+        """
+        totals = self.jams.get(str(properties['segment_id']))
+        if totals:
+            num_jams = totals['snapshots']
+            # The averages across all jam instances
+            avg_level_when_jammed = round(totals['level'] / totals['jams'])
+            avg_speed = round(totals['speed'] / totals['jams'])
+        else:
+            num_jams = 0
+            avg_speed = 0
+            avg_level_when_jammed = 0
+
+        # Turn into number between 0 and 100
+        properties.update(jam_percent=100 * num_jams / self.num_snapshots
+                          if self.num_snapshots else 0)
+        properties.update(jam=1 if num_jams else 0)
+        properties.update(avg_jam_speed=avg_speed)
+        properties.update(avg_jam_level=avg_level_when_jammed)
+
+        for key in [x for x in properties if x.startswith('alert_')]:
+            del properties[key]
+        for key, count in self.alerts.get(str(properties['id']), {}).items():
+            properties['alert_' + key] = count
+
+        return properties
@@ -1,8 +1,23 @@
 import dateutil.parser as date_parser
 from datetime import datetime, timedelta
 import json
-from jsonschema import validate
+import os
+import re
+from jsonschema.validators import validator_for
 from dateutil import tz
+from data import record_store
+import numpy as np
+import pandas as pd
+
+# What validate_and_write_schema can do with invalid records
+INVALID_RECORDS = ['raise', 'drop', 'quarantine']
+# Kinds of time, for parse_dates
+NO_TIME, CLOCK, DELTA, OTHER_TIME = 0, 1, 2, 3
+# Kinds of time zone, for parse_dates
+NAIVE, UTC, OTHER_ZONE, UNPARSED = 0, 1, 2, 3
+# Times that dateutil reads as a time of day, e.g. 13:05 or 1:05 pm
+CLOCK_TIME = re.compile(
+    r'^\s*(\d{1,2}):(\d{2})(?::(\d{2}))?\s*(?:([AaPp])[Mm])?\s*$')
 
 
 def parse_date(date, timezone, time=None, time_format=None):
@@ -63,6 +78,237 @@ def parse_date(date, timezone, time=None, time_format=None):
     return date_time
 
 
+def parse_time(time, time_format=None):
+    """
+    Work out what parse_date does with a time, for times given
+    separately from the date
+    Args:
+        time - time value from the time column
+        time_format - as for parse_date
+    Returns:
+        (kind, seconds) tuple; CLOCK times replace a date's time of day
+        (and any time zone) with seconds after midnight, DELTA times add
+        seconds to the date, NO_TIME leaves the date alone, and
+        OTHER_TIME times have to be parsed along with their date
+    """
+    if not time:
+        return NO_TIME, 0
+    if time_format == "military":
+        time = str(time)
+        while len(time) < 4:
+            time = "0" + time
+        if int(time) > 2359:
+            return CLOCK, 0
+        clock = datetime.strptime(time, '%H%M')
+        return CLOCK, clock.hour * 3600 + clock.minute * 60
+    if time_format == "seconds":
+        return DELTA, int(time)
+
+    match = CLOCK_TIME.match(str(time))
+    if not match:
+        return OTHER_TIME, 0
+    hour, minute = int(match.group(1)), int(match.group(2))
+    second = int(match.group(3) or 0)
+    if match.group(4):
+        if hour < 1 or hour > 12:
+            return OTHER_TIME, 0
+        hour = hour % 12 + (12 if match.group(4) in 'Pp' else 0)
+    if hour > 23 or minute > 59 or second > 59:
+        return OTHER_TIME, 0
+    return CLOCK, hour * 3600 + minute * 60 + second
+
+
+def format_local(wall, utc):
+    """
+    Format datetimes the way datetime.isoformat() does
+    Args:
+        wall - numpy datetime64[ns] array of local wall clock times
+        utc - numpy datetime64[ns] array of the same times in utc
+    Returns:
+        numpy array of strings, e.g. 2016-01-01T02:30:23-05:00
+    """
+    if not len(wall):
+        return np.array([], dtype=object)
+    formatted = np.datetime_as_string(wall, unit='s').astype(object)
+    has_micro = (wall.astype('int64') % 1000000000) != 0
+    if has_micro.any():
+        formatted[has_micro] = np.datetime_as_string(
+            wall[has_micro], unit='us').astype(object)
+
+    offset_codes, offsets = pd.factorize(
+        (wall - utc).astype('timedelta64[s]').astype('int64'))
+    offset_strings = []
+    for offset in offsets:
+        sign = '-' if offset < 0 else '+'
+        hours, rest = divmod(abs(int(offset)), 3600)
+        minutes, seconds = divmod(rest, 60)
+        offset_strings.append('{}{:02d}:{:02d}'.format(
+            sign, hours, minutes) + (
+                ':{:02d}'.format(seconds) if seconds else ''))
+    return formatted + np.array(offset_strings, dtype=object)[offset_codes]
+
+
+def parse_dates(dates, timezone, times=None, time_format=None):
+    """
+    Column at a time version of parse_date, giving the same results
+    Each distinct date and each distinct time is only parsed once,
+    and dates without a time zone are localized all at once
+    Args:
+        dates - pandas Series of dates (or dates and times)
+        timezone - pytz timezone
+        times - optional Series of times, with the same index
+        time_format - as for parse_date
+    Returns:
+        pandas Series of datetime strings in standardized format, or
+        None where a date can't be parsed
+    """
+    date_codes, date_values = pd.factorize(dates)
+    distinct = parse_date_values(date_values)
+
+    rows = {
+        'wall': distinct['wall'][date_codes],
+        'zone': distinct['zone'][date_codes],
+        'kind': np.full(len(dates), NO_TIME),
+        'seconds': np.zeros(len(dates), dtype='timedelta64[s]'),
+    }
+    if times is not None:
+        add_times(rows, times, time_format, distinct['midnight'][date_codes])
+
+    result = np.full(len(dates), None, dtype=object)
+    done = rows['zone'] == UNPARSED
+    naive = (rows['zone'] == NAIVE) & (rows['kind'] != OTHER_TIME)
+    in_utc = (rows['zone'] == UTC) & (rows['kind'] != OTHER_TIME)
+    # pytz's localize() picks standard time for ambiguous times
+    local = pd.DatetimeIndex(rows['wall'][naive]).tz_localize(
+        timezone, ambiguous=np.zeros(naive.sum(), dtype=bool),
+        nonexistent='NaT')
+    utc = pd.DatetimeIndex(rows['wall'][in_utc]).tz_localize(
+        'UTC').tz_convert(timezone)
+    for in_rows, index in ((naive, local), (in_utc, utc)):
+        found = ~np.asarray(index.isna())
+        positions = np.flatnonzero(in_rows)[found]
+        done[positions] = True
+        result[positions] = format_local(
+            index[found].tz_localize(None).values,
+            index[found].tz_convert('UTC').tz_localize(None).values)
+
+    # Times that don't exist in the time zone, times that have to be
+    # parsed with their date, and other time zones are done one by one
+    for i in np.flatnonzero(~done):
+        result[i] = parse_row(
+            i, rows, date_values[date_codes[i]],
+            distinct['parsed'][date_codes[i]],
+            distinct['slow'][date_codes[i]], timezone,
+            times.iloc[i] if times is not None else None, time_format)
+    return pd.Series(result, index=dates.index)
+
+
+def parse_date_values(date_values):
+    """
+    Parse each distinct date, for parse_dates
+    Args:
+        date_values - array of distinct date strings
+    Returns:
+        dict of arrays with an entry for each date and one more at the
+        end, for missing dates (pandas' code -1):
+            parsed - the datetime, or None if it can't be parsed
+            wall - its local wall clock time
+            zone - its kind of time zone, UNPARSED if it can't be parsed
+            midnight - whether its time is midnight
+            slow - whether it's outside the range of numpy's datetimes
+    """
+    count = len(date_values) + 1
+    distinct = {
+        'parsed': [None] * count,
+        'wall': np.zeros(count, dtype='datetime64[ns]'),
+        'zone': np.full(count, UNPARSED),
+        'midnight': np.zeros(count, dtype=bool),
+        'slow': np.zeros(count, dtype=bool),
+    }
+    for i, value in enumerate(date_values):
+        try:
+            date = date_parser.parse(value)
+        except ValueError:
+            print("{} is badly formatted, skipping".format(value))
+            continue
+        distinct['parsed'][i] = date
+        if not 1678 <= date.year <= 2261:
+            distinct['slow'][i] = True
+            distinct['zone'][i] = OTHER_ZONE
+            continue
+        distinct['wall'][i] = np.datetime64(date.replace(tzinfo=None), 'ns')
+        distinct['midnight'][i] = date.hour == 0 and date.minute == 0 \
+            and date.second == 0
+        distinct['zone'][i] = zone_kind(date)
+    return distinct
+
+
+def zone_kind(date):
+    if not date.tzinfo:
+        return NAIVE
+    if date.tzinfo == tz.tzutc():
+        return UTC
+    return OTHER_ZONE
+
+
+def add_times(rows, times, time_format, midnight):
+    """
+    Combine a column of times with the dates they go with, as parse_date
+    does, for parse_dates
+    Times only apply to dates at midnight; clock times replace the time
+    of day and drop the time zone, and times in seconds are added on
+    Args:
+        rows - dict of the rows' wall times, zones, kinds of time, and
+            times in seconds, updated in place
+        times - Series of times
+        time_format - as for parse_date
+        midnight - boolean array of whether each row's date is midnight
+    """
+    time_codes, time_values = pd.factorize(times)
+    # Missing times get code -1, which picks out the last entry
+    kinds = [parse_time(x, time_format) for x in time_values] \
+        + [(NO_TIME, 0)]
+    kind = np.array([x[0] for x in kinds])
+    seconds = np.array([x[1] for x in kinds], dtype='int64') \
+        .astype('timedelta64[s]')
+    applies = midnight & (rows['zone'] != UNPARSED)
+    rows['kind'] = np.where(applies, kind[time_codes], NO_TIME)
+    rows['seconds'] = seconds[time_codes]
+
+    clock = rows['kind'] == CLOCK
+    rows['wall'][clock] = rows['wall'][clock].astype('datetime64[D]') \
+        + rows['seconds'][clock]
+    rows['zone'][clock] = NAIVE
+    delta = rows['kind'] == DELTA
+    rows['wall'][delta] = rows['wall'][delta] + rows['seconds'][delta]
+
+
+def parse_row(i, rows, value, date, slow, timezone, time, time_format):
+    """
+    Parse one row that parse_dates can't do along with the others
+    Args:
+        i - the row's position
+        rows - as for add_times
+        value - the row's date string
+        date - its parsed datetime
+        slow - whether it's outside the range of numpy's datetimes
+        timezone - pytz timezone
+        time, time_format - the row's time, as for parse_date
+    Returns:
+        datetime string in standardized format, or None
+    """
+    if rows['kind'][i] == OTHER_TIME or slow:
+        return parse_date(value, timezone, time, time_format)
+    if rows['zone'][i] == NAIVE:
+        return timezone.localize(
+            rows['wall'][i].astype('datetime64[us]').item()).isoformat()
+    if rows['kind'][i] == DELTA:
+        return (date + timedelta(
+            seconds=int(rows['seconds'][i] / np.timedelta64(1, 's')))
+        ).isoformat()
+    return date.isoformat()
+
+
 def parse_address(address):
     """
     Some cities have the lat/lon as part of the address.
@@ -77,19 +323,152 @@ def parse_address(address):
     return None, None, None
 
 
-def validate_and_write_schema(schema_path, schema_values, output_file):
+def item_validator(schema):
+    """
+    Compile a validator for the items of an array schema
+    Args:
+        schema - a schema for a list of records, as in standards/
+    Returns:
+        a jsonschema validator for a single record
+    """
+    item_schema = dict(schema['items'])
+    # Keep what the items' references and format checks rely on
+    for key in ('$schema', 'definitions'):
+        if key in schema:
+            item_schema[key] = schema[key]
+    validator = validator_for(item_schema)
+    validator.check_schema(item_schema)
+    return validator(item_schema)
+
+
+class RecordChecker(object):
     """
-    Validate a schema according to a schema file, and write to file
+    Validates records one at a time, passing on the valid ones and
+    routing the invalid ones according to validate_and_write_schema's
+    invalid argument
+    Args:
+        validator - a jsonschema validator for a single record
+        invalid - one of INVALID_RECORDS
+        quarantine - record_store.RecordWriter to write invalid records
+            to, with their errors, if they're quarantined
+        samples - how many invalid records to print
+    """
+    def __init__(self, validator, invalid, quarantine=None, samples=3):
+        self.validator = validator
+        self.invalid = invalid
+        self.quarantine = quarantine
+        self.samples = samples
+        self.valid_count = 0
+        self.invalid_count = 0
+        self.first_error = None
+
+    def check(self, value):
+        """
+        Validate a record, and print or quarantine it if it's invalid
+        Returns:
+            whether the record is valid
+        """
+        if self.validator.is_valid(value):
+            self.valid_count += 1
+            return True
+
+        self.invalid_count += 1
+        errors = list(self.validator.iter_errors(value))
+        if self.first_error is None:
+            self.first_error = errors[0]
+        if self.invalid_count <= self.samples:
+            print("Invalid record: {}\n    {}".format(
+                json.dumps(value)[:200],
+                '\n    '.join(x.message for x in errors)))
+        if self.quarantine:
+            self.quarantine.write({
+                'record': value,
+                'errors': [x.message for x in errors],
+            })
+        return False
+
+    def valid_records(self, values, schema_name):
+        """
+        The valid records of a list (or any iterable) of records
+        If invalid is raise and any weren't valid, the first record's
+        ValidationError is raised once they've all been checked
+        """
+        for value in values:
+            if self.check(value):
+                yield value
+
+        if self.invalid_count:
+            print("{} of {} records didn't match {}".format(
+                self.invalid_count, self.valid_count + self.invalid_count,
+                schema_name))
+            # Raising here leaves any earlier output alone
+            if self.invalid == 'raise':
+                raise self.first_error
+
+
+def finish_quarantine(quarantine):
+    """
+    Keep the quarantine file if any invalid records were written to it,
+    otherwise remove it, along with any left from an earlier run
+    Args:
+        quarantine - record_store.RecordWriter of the invalid records
+    """
+    if quarantine.count:
+        quarantine.close()
+        print("- invalid records written to {}".format(
+            quarantine.filename))
+        return
+    quarantine.abort()
+    if record_store.exists(quarantine.filename):
+        os.remove(record_store.find_file(quarantine.filename))
+
+
+def validate_and_write_schema(schema_path, schema_values, output_file,
+                              invalid='raise', samples=3):
+    """
+    Validate records according to a schema file, writing them to file
+    as they're validated
     Args:
         schema_path - the schema filename
-        schema_values - a list of dicts
-        output_file
+        schema_values - a list (or any iterable) of dicts
+        output_file - written in the format given by its extension,
+            see data/record_store.py
+        invalid - what to do with records that don't match the schema:
+            raise - raise the first record's ValidationError, once all
+                the records have been checked, and write nothing
+            drop - leave them out of the output
+            quarantine - leave them out of the output, and write them
+                with their errors to a file next to it, e.g.
+                crashes_invalid.json
+        samples - how many invalid records to print
+    Returns:
+        the number of records written
     """
+    if invalid not in INVALID_RECORDS:
+        raise ValueError("invalid must be one of {}".format(
+            ', '.join(INVALID_RECORDS)))
 
     with open(schema_path) as schema:
-        validate(schema_values, json.load(schema))
+        validator = item_validator(json.load(schema))
+
+    base, extension = record_store.split_extension(output_file)
+    quarantine_file = base + '_invalid' + extension
+    # Invalid records are written as they're found, so they never all
+    # have to be held in memory
+    quarantine = record_store.RecordWriter(quarantine_file) \
+        if invalid == 'quarantine' else None
+    checker = RecordChecker(validator, invalid, quarantine, samples)
+
+    try:
+        record_store.write_records(output_file, checker.valid_records(
+            schema_values, os.path.basename(schema_path)))
+    except BaseException:
+        if quarantine:
+            quarantine.abort()
+        raise
 
-    with open(output_file, "w") as f:
-        json.dump(schema_values, f)
+    if quarantine:
+        finish_quarantine(quarantine)
 
     print("- output written to {}".format(output_file))
+    return checker.valid_count
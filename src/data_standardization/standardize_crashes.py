@@ -2,24 +2,62 @@
 # Author terryf82 https://github.com/terryf82
 
 import argparse
+import hashlib
+import json
+import multiprocessing
 import os
+import numpy as np
 import pandas as pd
 from collections import OrderedDict
-import csv
 import calendar
 import random
 import dateutil.parser as date_parser
-from .standardization_util import parse_date, validate_and_write_schema
+from .standardization_util import parse_date, parse_dates, \
+    validate_and_write_schema, INVALID_RECORDS
 from data.geocoding_util import read_geocode_cache
+from data.stage_graph import file_digest
+from data import record_store
 import data.config
 
 CURR_FP = os.path.dirname(
     os.path.abspath(__file__))
 BASE_FP = os.path.dirname(os.path.dirname(CURR_FP))
+# Bump to standardize every crash file again, e.g. after changing how
+# crashes are standardized
+WATERMARK_VERSION = 1
+
+
+def truthy(column):
+    """
+    Whether each value in a column would count as true in python
+    """
+    return np.asarray(column, dtype=object).astype(bool)
+
 
 def read_standardized_fields(raw_crashes, fields, opt_fields,
                              timezone, datadir, city,
                              startdate=None, enddate=None):
+    """
+    Standardize crashes a column at a time
+    Crashes without coordinates (or a geocoded address), or without a
+    date, or outside of the date range, are dropped with masks, dates
+    are parsed with parse_dates, and the formatted crashes are only
+    built at the end
+    Args:
+        raw_crashes - DataFrame of crashes, or a list of dicts
+        fields - the required fields from the crash file's config
+        opt_fields - the optional fields from the crash file's config
+        timezone - the city's pytz timezone
+        datadir - the city's data directory
+        city - the city's name, for geocoded addresses
+        startdate, enddate - optional date range to keep
+    Returns:
+        dict of formatted crashes by id
+    """
+    if not isinstance(raw_crashes, pd.DataFrame):
+        raw_crashes = pd.DataFrame(list(raw_crashes))
+    raw_crashes = raw_crashes.reset_index(drop=True)
+    total = len(raw_crashes)
 
     crashes = {}
     # Drop times from startdate/enddate in the unlikely event
@@ -31,9 +69,6 @@ def read_standardized_fields(raw_crashes, fields, opt_fields,
         enddate = parse_date(enddate, timezone)
         enddate = date_parser.parse(enddate).date()
 
-    min_date = None
-    max_date = None
-    
     cached_addresses = {}
 
     if (not fields['latitude'] or not fields['longitude']):
@@ -54,118 +89,149 @@ def read_standardized_fields(raw_crashes, fields, opt_fields,
                 "Can't standardize crash data, no lat/lon or address found"
             )
 
-    no_geocoded_count = 0
-    for i, crash in enumerate(raw_crashes):
-        if i % 10000 == 0:
-            print(i)
-            
-        lat = crash[fields['latitude']] if fields['latitude'] else None
-        lon = crash[fields['longitude']] if fields['longitude'] else None
-
-        if not lat or not lon:
-
-            # skip any crashes that don't have coordinates
-            if 'address' not in opt_fields or opt_fields['address'] not in crash:
-                continue
+    if not total:
+        return crashes
 
-            address = crash[opt_fields['address']] + ' ' + city
+    lat = raw_crashes[fields['latitude']].values.astype(object) \
+        if fields['latitude'] else np.full(total, None, dtype=object)
+    lon = raw_crashes[fields['longitude']].values.astype(object) \
+        if fields['longitude'] else np.full(total, None, dtype=object)
+    keep = truthy(lat) & truthy(lon)
 
-            # If we have an address, look it up in the geocoded cache
-            if address in cached_addresses:
-                address, lat, lon, _ = cached_addresses[address]
-                if not address:
-                    no_geocoded_count += 1
-                    continue
-            else:
+    # Crashes without coordinates are looked up in the geocoded
+    # addresses, and skipped if they're not there
+    no_geocoded_count = 0
+    missing = np.flatnonzero(~keep)
+    if len(missing) and 'address' in opt_fields \
+       and opt_fields['address'] in raw_crashes:
+        addresses = raw_crashes[opt_fields['address']].values[missing]
+        for i, address in zip(missing, addresses):
+            cached = cached_addresses.get(str(address) + ' ' + city)
+            if not cached or not cached[0]:
                 no_geocoded_count += 1
                 continue
-
-        # construct crash date based on config settings, skipping any crashes without date
-        if fields["date_complete"]:
-            if not crash[fields["date_complete"]]:
-                continue
-
-            else:
-                crash_date = crash[fields["date_complete"]]
-
-        elif fields["date_year"] and fields["date_month"]:
-            if fields["date_day"]:
-                crash_date = str(crash[fields["date_year"]]) + "-" + str(
-                    crash[fields["date_month"]]) + "-" + crash[fields["date_day"]]
-            # some cities do not supply a day of month for crashes, randomize if so
-            else:
-                available_dates = calendar.Calendar().itermonthdates(
-                    crash[fields["date_year"]], crash[fields["date_month"]])
-                crash_date = str(random.choice(
-                    [date for date in available_dates if date.month == crash[fields["date_month"]]]))
-
-        # skip any crashes that don't have a date
-        else:
-            continue
-
-        crash_time = None
-        if fields["time"]:
-            crash_time = crash[fields["time"]]
-
-        if fields["time_format"]:
-            crash_date_time = parse_date(
-                crash_date,
-                timezone,
-                crash_time,
-                fields["time_format"]
-            )
-
+            lat[i], lon[i] = cached[1], cached[2]
+            keep[i] = True
+
+    # construct crash date based on config settings, skipping any crashes
+    # without date
+    if fields["date_complete"]:
+        dates = raw_crashes[fields["date_complete"]]
+        keep &= truthy(dates)
+    elif fields["date_year"] and fields["date_month"]:
+        years = raw_crashes[fields["date_year"]]
+        months = raw_crashes[fields["date_month"]]
+        if fields["date_day"]:
+            dates = years.astype(str) + "-" + months.astype(str) + "-" \
+                + raw_crashes[fields["date_day"]].astype(str)
+        # some cities do not supply a day of month for crashes, randomize
         else:
-            crash_date_time = parse_date(
-                crash_date,
-                timezone,
-                crash_time
-            )
-
-        # Skip crashes where date can't be parsed
-        if not crash_date_time:
-            continue
-
-        crash_day = date_parser.parse(crash_date_time).date()
-        # Drop crashes that occur outside of the range, if specified
-        if ((startdate is not None and crash_day < startdate) or
-                (enddate is not None and crash_day > enddate)):
-
-            continue
-        if min_date is None or crash_day < min_date:
-            min_date = crash_day
-        if max_date is None or crash_day > max_date:
-            max_date = crash_day
-        
+            dates = pd.Series(None, index=raw_crashes.index, dtype=object)
+            for i in np.flatnonzero(keep):
+                available_dates = calendar.Calendar().itermonthdates(
+                    int(years[i]), int(months[i]))
+                dates[i] = str(random.choice(
+                    [date for date in available_dates
+                     if date.month == int(months[i])]))
+    # skip any crashes that don't have a date
+    else:
+        keep[:] = False
+        dates = pd.Series(None, index=raw_crashes.index, dtype=object)
+
+    rows = np.flatnonzero(keep)
+    date_times = parse_dates(
+        dates.iloc[rows], timezone,
+        raw_crashes[fields["time"]].iloc[rows] if fields["time"] else None,
+        fields["time_format"] or None).values
+
+    # Skip crashes where date can't be parsed, and drop crashes that occur
+    # outside of the range, if specified
+    parsed = pd.notnull(date_times)
+    days = pd.Series(date_times, dtype=object).str[:10].fillna('').values
+    if startdate is not None:
+        parsed &= days >= startdate.isoformat()
+    if enddate is not None:
+        parsed &= days <= enddate.isoformat()
+    rows, date_times, days = rows[parsed], date_times[parsed], days[parsed]
+
+    if len(rows):
+        print("Including crashes between {} and {}".format(
+            days.min(), days.max()))
+
+    # Build the formatted crashes
+    ids = raw_crashes[fields["id"]].values[rows].tolist()
+    lats = lat[rows].astype(float).tolist()
+    lons = lon[rows].astype(float).tolist()
+    specific = city_specific_columns(raw_crashes.iloc[rows], opt_fields)
+    for i, crash_id in enumerate(ids):
         formatted_crash = OrderedDict([
-            ("id", crash[fields["id"]]),
-            ("dateOccurred", crash_date_time),
+            ("id", crash_id),
+            ("dateOccurred", date_times[i]),
             ("location", OrderedDict([
-                ("latitude", float(lat)),
-                ("longitude", float(lon))
+                ("latitude", lats[i]),
+                ("longitude", lons[i])
             ]))
         ])
-        formatted_crash = add_city_specific_fields(crash, formatted_crash,
-                                                   opt_fields)
+        for key, values, is_split in specific:
+            if not is_split:
+                formatted_crash[key] = values[i]
+            elif values[i]:
+                formatted_crash[key] = 1
         crashes[formatted_crash["id"]] = formatted_crash
 
-    if min_date and max_date:
-        print("Including crashes between {} and {}".format(
-            min_date.isoformat(), max_date.isoformat()))
-    elif min_date:
-        print("Including crashes after {}".format(
-            min_date.isoformat()))
-    elif max_date:
-        print("Including crashes before {}".format(
-            max_date.isoformat()))
-
     # Making sure we have enough entries with lat/lon to continue
-    if len(crashes) > 0 and no_geocoded_count/len(raw_crashes) > .9:
+    if len(crashes) > 0 and no_geocoded_count/total > .9:
         raise SystemExit("Not enough geocoded addresses found, exiting")
-    
+
     return crashes
 
 
+def city_specific_columns(crashes, fields):
+    """
+    Column at a time version of add_city_specific_fields
+    Args:
+        crashes - DataFrame of unformatted crashes
+        fields - a dict of config information about the crash fields
+    Returns:
+        list of (key, values, is_split) tuples in the order the fields
+        are added to a crash; summary and address values are added as
+        they are, split column values are masks of the crashes to set
+        the key to 1 for
+    """
+    columns = []
+    for key in ('summary', 'address'):
+        if key in fields and fields[key]:
+            columns.append(
+                (key, crashes[fields[key]].values.tolist(), False))
+
+    if 'split_columns' not in fields:
+        return columns
+    split_columns = fields['split_columns']
+    negative_splits = [x for x in split_columns
+                       if 'not_column' in split_columns[x].keys()]
+    splits = OrderedDict()
+    for key, value in split_columns.items():
+        if key in negative_splits or 'column_value' not in value \
+           or not value['column_name']:
+            continue
+        column = crashes[value['column_name']]
+        matches = (column == value['column_value']).values
+        if value['column_value'] == 'any':
+            matches = matches | truthy(column)
+        splits[key] = matches
+
+    for column in negative_splits:
+        # These are the columns that can't have a value for the current
+        # column to be true
+        value = np.ones(len(crashes), dtype=bool)
+        for compare_column in split_columns[column]['not_column'].split():
+            if compare_column in splits:
+                value &= ~splits[compare_column]
+        splits[column] = value
+
+    return columns + [(key, value, True) for key, value in splits.items()]
+
+
 def add_city_specific_fields(crash, formatted_crash, fields):
 
     # Add summary and address
@@ -225,38 +291,198 @@ def add_split_columns(crash, formatted_crash, fields):
     return formatted_crash
 
 
-def add_id(csv_file, id_field):
+def add_id(crashes, id_field, start=1):
+    """
+    If the crashes do not contain an id, create one from the row number
+    The crash file itself is left alone
+    Args:
+        crashes - DataFrame of crashes from a crash file
+        id_field - the id column from the crash file's config
+        start - the row number of the first crash in the file
+    """
+    if id_field not in crashes:
+        crashes[id_field] = np.arange(start, start + len(crashes))
+
+
+def crash_file_settings(csv_config, config, datadir):
+    """
+    Hash of everything besides the crash file that its standardized
+    crashes depend on
+    """
+    settings = [
+        WATERMARK_VERSION, csv_config, config.city, str(config.timezone),
+        config.startdate, config.enddate]
+    geocoded_file = os.path.join(
+        datadir, 'processed', 'geocoded_addresses.csv')
+    if os.path.exists(geocoded_file):
+        settings.append(file_digest(geocoded_file))
+    return hashlib.sha256(json.dumps(
+        settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def hash_bytes(f, sha, size=None):
     """
-    If the csv_file does not contain an id, create one
+    Add the next size bytes of a file (or the rest of it) to a hash,
+    reading them in chunks
+    Returns:
+        the last byte read
+    """
+    last = b''
+    while size is None or size > 0:
+        chunk = f.read(record_store.CHUNK_SIZE if size is None
+                       else min(size, record_store.CHUNK_SIZE))
+        if not chunk:
+            break
+        sha.update(chunk)
+        last = chunk[-1:]
+        if size is not None:
+            size -= len(chunk)
+    return last
+
+
+def read_appended_rows(filename, watermark):
+    """
+    Read the rows after the watermark, if the file still starts with the
+    rows it recorded
+    Returns:
+        DataFrame of the new rows and the hash of the whole file, or None
+        and None if the whole file needs to be read
+    """
+    with open(filename, 'rb') as f:
+        sha = hashlib.sha256()
+        last = hash_bytes(f, sha, watermark['bytes'])
+        if last != b'\n' or sha.hexdigest() != watermark['hash']:
+            return None, None
+        if not f.read(1):
+            # Nothing new
+            return pd.DataFrame(columns=watermark['columns']), \
+                watermark['hash']
+        f.seek(watermark['bytes'])
+        try:
+            crashes = pd.read_csv(
+                f, header=None, names=watermark['columns'],
+                na_filter=False, dtype=watermark['dtypes'])
+        except (ValueError, pd.errors.EmptyDataError):
+            # New rows that wouldn't be read the same way as the whole file
+            return None, None
+        # The rest of the file, for the new watermark
+        f.seek(watermark['bytes'])
+        hash_bytes(f, sha)
+    return crashes, sha.hexdigest()
+
+
+def read_new_rows(filename, id_field, watermark, settings):
+    """
+    Read the rows of a crash file that haven't been standardized yet
+    If the file still starts with the rows recorded in the watermark,
+    and nothing else has changed, only the rows appended since are
+    read, otherwise the whole file
+    The file is never held in memory, only its rows once parsed
+    Args:
+        filename - the crash file
+        id_field - the id column from the crash file's config
+        watermark - dict from the last run, or None
+        settings - hash from crash_file_settings
+    Returns:
+        DataFrame of rows to standardize, the new watermark, and
+        whether the rows are only the new ones
+    """
+    size = os.path.getsize(filename)
+    if watermark and watermark['settings'] == settings \
+       and size >= watermark['bytes']:
+        crashes, digest = read_appended_rows(filename, watermark)
+        if crashes is not None:
+            rows = watermark['rows']
+            add_id(crashes, id_field, rows + 1)
+            return crashes, dict(
+                watermark, rows=rows + len(crashes), bytes=size,
+                hash=digest), True
+
+    crashes = pd.read_csv(filename, na_filter=False)
+    new_watermark = {
+        'settings': settings,
+        'rows': len(crashes),
+        'bytes': size,
+        'hash': file_digest(filename),
+        'columns': list(crashes.columns),
+        'dtypes': {
+            column: str(dtype) if dtype != object else 'object'
+            for column, dtype in crashes.dtypes.items()},
+    }
+    add_id(crashes, id_field)
+    return crashes, new_watermark, False
+
+
+def standardize_file(args):
+    """
+    Standardize one crash file, only standardizing the rows added since
+    the last run where possible
+    Args:
+        args - tuple of config file, data directory, crash file name
+            and whether to standardize the whole file regardless
+    Returns:
+        the crash file name, and a list of its standardized crashes
     """
+    config_file, datadir, csv_file, forceupdate = args
+    config = data.config.Configuration(config_file)
+    csv_config = config.crashes_files[csv_file]
+    filename = os.path.join(datadir, 'raw', 'crashes', csv_file)
+    cache_file = os.path.join(
+        datadir, 'processed', 'standardized_crashes', csv_file + '.json')
+
+    cached = None
+    if os.path.exists(cache_file) and not forceupdate:
+        with open(cache_file) as f:
+            cached = json.load(f)
+
+    settings = crash_file_settings(csv_config, config, datadir)
+    df_crashes, watermark, incremental = read_new_rows(
+        filename, csv_config['required']['id'],
+        cached['watermark'] if cached else None, settings)
+    print("processing {} ({} {}rows)".format(
+        csv_file, len(df_crashes), 'new ' if incremental else ''))
+
+    std_crashes = {}
+    if incremental:
+        std_crashes = OrderedDict((x['id'], x) for x in cached['crashes'])
+    if len(df_crashes):
+        std_crashes.update(read_standardized_fields(
+            df_crashes,
+            csv_config['required'],
+            csv_config['optional'],
+            config.timezone,
+            datadir,
+            config.city,
+            config.startdate,
+            config.enddate
+        ))
+    std_crashes = list(std_crashes.values())
 
-    rows = []
-    with open(csv_file) as f:
-        csv_reader = csv.DictReader(f)
-        count = 1
-        for row in csv_reader:
-            if id_field in row:
-                break
-            row.update({id_field: count})
-            rows.append(row)
-            count += 1
-    if rows:
-        with open(csv_file, 'w') as f:
-            writer = csv.DictWriter(f, list(rows[0].keys()))
-            writer.writeheader()
-            for row in rows:
-                writer.writerow(row)
+    if not os.path.exists(os.path.dirname(cache_file)):
+        os.makedirs(os.path.dirname(cache_file))
+    with open(cache_file, 'w') as f:
+        json.dump({'watermark': watermark, 'crashes': std_crashes}, f)
+    return csv_file, std_crashes
 
 
-if __name__ == '__main__':
+def main(argv=None):
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str, required=True,
                         help="config file")
     parser.add_argument("-d", "--datadir", type=str, required=True,
                         help="data directory")
-
-    args = parser.parse_args()
+    parser.add_argument("-p", "--processes", type=int, default=1,
+                        help="number of crash files to standardize at once")
+    parser.add_argument('--forceupdate', action='store_true',
+                        help='Standardize every row of every crash file, ' +
+                        'not just the rows added since the last run')
+    parser.add_argument("--invalid", default='raise',
+                        choices=INVALID_RECORDS,
+                        help="What to do with crashes that don't match " +
+                        "the schema")
+
+    args = parser.parse_args(argv)
 
     # load config
     config_file = args.config
@@ -267,40 +493,36 @@ if __name__ == '__main__':
         raise SystemExit(crash_dir + " not found, exiting")
 
     print("searching "+crash_dir+" for raw files:")
-    dict_crashes = {}
-
-    for csv_file, csv_config in config.crashes_files.items():
+    for csv_file in config.crashes_files:
         if not os.path.exists(os.path.join(crash_dir, csv_file)):
             raise SystemExit(os.path.join(
                 crash_dir, csv_file) + " not found, exiting")
 
-        add_id(
-            os.path.join(crash_dir, csv_file), csv_config['required']['id'])
-
-        print("processing {}".format(csv_file))
+    tasks = [(config_file, args.datadir, csv_file, args.forceupdate)
+             for csv_file in config.crashes_files]
+    processes = min(args.processes, len(tasks))
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            results = dict(pool.imap_unordered(standardize_file, tasks))
+    else:
+        results = dict(standardize_file(x) for x in tasks)
 
-        df_crashes = pd.read_csv(os.path.join(
-            crash_dir, csv_file), na_filter=False)
-        raw_crashes = df_crashes.to_dict("records")
-
-        std_crashes = read_standardized_fields(
-            raw_crashes,
-            csv_config['required'],
-            csv_config['optional'],
-            config.timezone,
-            args.datadir,
-            config.city,
-            config.startdate,
-            config.enddate
-        )
-
-        print("{} crashes loaded with standardized fields, checking for specific fields".format(
-            len(std_crashes)))
-        dict_crashes.update(std_crashes)
+    # Later files take precedence for crashes with the same id
+    dict_crashes = {}
+    for csv_file in config.crashes_files:
+        print("{} crashes loaded from {}".format(
+            len(results[csv_file]), csv_file))
+        dict_crashes.update((x['id'], x) for x in results[csv_file])
 
     print("{} crashes loaded, validating against schema".format(len(dict_crashes)))
 
     schema_path = os.path.join(BASE_FP, "standards", "crashes-schema.json")
-    list_crashes = list(dict_crashes.values())
-    crashes_output = os.path.join(args.datadir, "standardized/crashes.json")
-    validate_and_write_schema(schema_path, list_crashes, crashes_output)
+    crashes_output = record_store.format_filename(
+        os.path.join(args.datadir, "standardized/crashes.json"),
+        config.record_format)
+    validate_and_write_schema(schema_path, dict_crashes.values(),
+                              crashes_output, invalid=args.invalid)
+
+
+if __name__ == '__main__':
+    main()
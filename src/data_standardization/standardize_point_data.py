@@ -4,13 +4,14 @@ import pandas as pd
 from collections import OrderedDict
 from . import standardization_util
 import data.config
+from data import record_store
 
 CURR_FP = os.path.dirname(
     os.path.abspath(__file__))
 BASE_FP = os.path.dirname(CURR_FP)
 
 
-def read_file_info(config, datadir):
+def read_file_info(config, datadir, invalid='raise'):
 
     points = []
     for source_config in list(config.data_source):
@@ -74,12 +75,14 @@ def read_file_info(config, datadir):
 
         schema_path = os.path.join(os.path.dirname(BASE_FP),
                                    "standards", "points-schema.json")
-        output = os.path.join(datadir, "standardized", "points.json")
+        output = record_store.format_filename(
+            os.path.join(datadir, "standardized", "points.json"),
+            config.record_format)
         standardization_util.validate_and_write_schema(
-            schema_path, points, output)
+            schema_path, points, output, invalid=invalid)
 
 
-if __name__ == '__main__':
+def main(argv=None):
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str,
@@ -87,13 +90,21 @@ if __name__ == '__main__':
     parser.add_argument("-d", "--datadir", type=str,
                         help="path to destination's data folder," +
                         "e.g. ../data/boston")
+    parser.add_argument("--invalid", default='raise',
+                        choices=standardization_util.INVALID_RECORDS,
+                        help="What to do with points that don't match " +
+                        "the schema")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # load config for this city
     config_file = os.path.join(BASE_FP, args.config)
     config = data.config.Configuration(config_file)
     if config.data_source:
-        read_file_info(config, args.datadir)
+        read_file_info(config, args.datadir, args.invalid)
     else:
-        print("No point data found, skipping")    
+        print("No point data found, skipping")
+
+
+if __name__ == '__main__':
+    main()
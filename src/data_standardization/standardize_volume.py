@@ -1,28 +1,24 @@
 import argparse
 import os
-from jsonschema import validate
-import json
 from .boston_volume import BostonVolumeParser
+from .standardization_util import validate_and_write_schema
 import data.config
+from data import record_store
 
-BASE_FP = None
-PROCESSED_DATA_FP = None
 CURR_FP = os.path.dirname(
     os.path.abspath(__file__))
 
 
-def write_volume(volume_counts):
+def write_volume(volume_counts, datadir, record_format='json'):
 
     schema_path = os.path.join(os.path.dirname(os.path.dirname(
         CURR_FP)), "standards", "volumes-schema.json")
-    with open(schema_path) as volume_schema:
-        validate(volume_counts, json.load(volume_schema))
-        volume_output = os.path.join(BASE_FP, "standardized", "volume.json")
-        with open(volume_output, "w") as f:
-            json.dump(volume_counts, f)
+    volume_output = record_store.format_filename(
+        os.path.join(datadir, "standardized", "volume.json"), record_format)
+    validate_and_write_schema(schema_path, volume_counts, volume_output)
 
 
-if __name__ == '__main__':
+def main(argv=None):
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str, required=True,
@@ -30,12 +26,15 @@ if __name__ == '__main__':
     parser.add_argument("-d", "--datadir", type=str,
                         help="data directory")
 
-    args = parser.parse_args()
-    BASE_FP = os.path.join(args.datadir)
+    args = parser.parse_args(argv)
 
     config = data.config.Configuration(args.config)
     if config.name == 'boston':
         volume_counts = BostonVolumeParser(args.datadir).get_volume()
-        write_volume(volume_counts)
+        write_volume(volume_counts, args.datadir, config.record_format)
     else:
         print("No volume data given for {}".format(config.name))
+
+
+if __name__ == '__main__':
+    main()
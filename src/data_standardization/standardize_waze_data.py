@@ -5,6 +5,7 @@ import gzip
 import json
 import datetime
 import data.config
+from data import record_store
 
 CURR_FP = os.path.dirname(
     os.path.abspath(__file__))
@@ -55,7 +56,9 @@ def read_snapshots(dirname, config, startdate=None, enddate=None):
         startdate - drop days before this date
         enddate - drop days after this date
     returns
-        a list of all jams, alerts and irregularities for this city
+        a list of all jams, alerts and irregularities for this city,
+        each with the snapshotId and snapshotTime of its snapshot,
+        and a record with eventType snapshot for each snapshot
     """
     files = os.listdir(dirname)
     city = config.city.split(',')[0]
@@ -98,6 +101,12 @@ def read_snapshots(dirname, config, startdate=None, enddate=None):
            or (enddate and end > enddate + datetime.timedelta(1)):
             continue
         count += 1
+        # snapshotId numbers the snapshots in this run, snapshotTime
+        # stays the same when the files are standardized again
+        snapshot = {'snapshotId': count, 'snapshotTime': start.isoformat()}
+        # Every snapshot gets a record of its own, so that snapshots
+        # with nothing in the city still count towards the total
+        all_data.append(dict(snapshot, eventType='snapshot'))
 
         # We care about jams, alerts, and irregularities
         if 'jams' in data:
@@ -107,7 +116,7 @@ def read_snapshots(dirname, config, startdate=None, enddate=None):
                          x['pubMillis'],
                          timezone
                      ),
-                     snapshotId=count
+                     **snapshot
                 )
                 for x in data['jams']
                 if 'city' in x and city in x['city']
@@ -123,7 +132,7 @@ def read_snapshots(dirname, config, startdate=None, enddate=None):
                          'latitude': x['location']['y'],
                          'longitude': x['location']['x']
                      },
-                     snapshotId=count
+                     **snapshot
                 )
                 for x in data['alerts']
                 if 'city' in x and city in x['city']]
@@ -131,7 +140,7 @@ def read_snapshots(dirname, config, startdate=None, enddate=None):
         if 'irregularities' in data:
             all_data += [
                 dict(x, eventType='irregularity',
-                     snapshotId=count) for x in data['irregularities']
+                     **snapshot) for x in data['irregularities']
                 if 'city' in x and city in x['city']]
 
     print("Reading waze data from {} snapshots between {} and {}".format(
@@ -140,7 +149,7 @@ def read_snapshots(dirname, config, startdate=None, enddate=None):
     return all_data
 
 
-if __name__ == '__main__':
+def main(argv=None):
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str, required=True,
@@ -152,7 +161,7 @@ if __name__ == '__main__':
                         help="If given, start date in format YYYY-MM-DD")
     parser.add_argument("-e", "--enddate",
                         help="If given, last day included in format YYYY-MM-DD")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # load config for this city
     config_file = args.config
@@ -165,8 +174,11 @@ if __name__ == '__main__':
         enddate=args.enddate
     )
 
-    jsonfile = os.path.join(
-        args.datadir, 'standardized', 'waze.json')
+    jsonfile = record_store.format_filename(os.path.join(
+        args.datadir, 'standardized', 'waze.json'), config.record_format)
     print("output {} records to {}".format(len(snapshots), jsonfile))
-    with open(jsonfile, 'w') as f:
-        json.dump(snapshots, f)
+    record_store.write_records(jsonfile, snapshots)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,10 @@
 from .. import standardization_util
 import json
 import os
+import pandas as pd
+import pytest
 import pytz
+from jsonschema import ValidationError
 
 TEST_FP = os.path.dirname(os.path.abspath(__file__))
 
@@ -52,6 +55,35 @@ def test_parse_date():
         '2009-01-08T08:53:00.000Z', timezone) == '2009-01-08T03:53:00-05:00'
 
 
+def test_parse_dates():
+    timezone = pytz.timezone('America/New_York')
+    dates = [
+        '01/08/2009', '01/08/2009 08:53:00 PM', '2009-01-08T08:53:00.000Z',
+        '2009-01-08T08:53:00+02:00', '01/08/2009 unk', '',
+        # Ambiguous and nonexistent times around daylight savings
+        '2016-11-06 01:30', '2016-03-13 02:30', '1500-01-01',
+    ]
+    for time_format, times in (
+            (None, ['', '08:53:00 PM', '13:05', '12:30 am', '9:5', 'x']),
+            ('military', ['', '0201', 155, '9999']),
+            ('seconds', ['', '75180', 0])):
+        pairs = [(date, time) for date in dates for time in times]
+        expected = [standardization_util.parse_date(
+            date, timezone, time, time_format) for date, time in pairs]
+        result = standardization_util.parse_dates(
+            pd.Series([x[0] for x in pairs], index=range(5, 5 + len(pairs))),
+            timezone,
+            pd.Series([x[1] for x in pairs], index=range(5, 5 + len(pairs)),
+                      dtype=object),
+            time_format)
+        assert list(result.index) == list(range(5, 5 + len(pairs)))
+        assert result.tolist() == expected
+
+    assert standardization_util.parse_dates(
+        pd.Series(dates), timezone).tolist() == [
+            standardization_util.parse_date(x, timezone) for x in dates]
+
+
 def test_parse_address():
 
     address = "29 OXFORD ST\n" + \
@@ -86,5 +118,51 @@ def test_validate_and_write_schema(tmpdir):
     items = json.load(open(os.path.join(tmppath, 'test.json')))
     assert items == values
 
-        
-    
+
+def test_validate_and_write_schema_invalid(tmpdir):
+    schema_path = os.path.join(TEST_FP, 'test-schema.json')
+    output = os.path.join(tmpdir.strpath, 'test.json')
+    quarantine = os.path.join(tmpdir.strpath, 'test_invalid.json')
+    valid = [{
+        "id": i,
+        "dateOccurred": "2009-01-08T20:53:00Z",
+        "location": {"latitude": 42.3, "longitude": -71.1}
+    } for i in range(3)]
+    values = valid[:2] + [{"id": 5}] + valid[2:]
+
+    # Raising writes nothing
+    with pytest.raises(ValidationError):
+        standardization_util.validate_and_write_schema(
+            schema_path, values, output)
+    assert not os.path.exists(output)
+    assert not os.path.exists(output + '.tmp')
+
+    assert standardization_util.validate_and_write_schema(
+        schema_path, iter(values), output, invalid='drop') == 3
+    with open(output) as f:
+        assert f.read() == json.dumps(valid)
+    assert not os.path.exists(quarantine)
+
+    standardization_util.validate_and_write_schema(
+        schema_path, values, output, invalid='quarantine')
+    assert json.load(open(output)) == valid
+    quarantined = json.load(open(quarantine))
+    assert [x['record'] for x in quarantined] == [{"id": 5}]
+    assert "'dateOccurred' is a required property" \
+        in quarantined[0]['errors']
+
+    # A run that fails part way leaves both files alone
+    def failing():
+        yield from values
+        raise KeyError
+    with pytest.raises(KeyError):
+        standardization_util.validate_and_write_schema(
+            schema_path, failing(), output, invalid='quarantine')
+    assert [x['record'] for x in json.load(open(quarantine))] == [{"id": 5}]
+    assert sorted(os.listdir(tmpdir.strpath)) == ['test.json',
+                                                  'test_invalid.json']
+
+    # A later clean run removes the stale quarantine file
+    standardization_util.validate_and_write_schema(
+        schema_path, valid, output, invalid='quarantine')
+    assert not os.path.exists(quarantine)
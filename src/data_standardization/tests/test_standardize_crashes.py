@@ -4,7 +4,9 @@ from jsonschema import validate
 import json
 import os
 import csv
+import pandas as pd
 import pytz
+import yaml
 
 
 TEST_FP = os.path.dirname(os.path.abspath(__file__))
@@ -34,29 +36,29 @@ def test_add_id(tmpdir):
     """
     tmppath = create_test_csv(tmpdir, 'test.csv')
     filename = os.path.join(tmppath, 'test.csv')
-    standardize_crashes.add_id(filename, 'ID')
+    with open(filename) as f:
+        contents = f.read()
+    crashes = pd.read_csv(filename, na_filter=False)
+    standardize_crashes.add_id(crashes, 'ID')
 
     expected = [{
-        'ID': '1',
+        'ID': 1,
         'key1': 'value1',
         'key2': 'value2'
     }, {
-        'ID': '2',
+        'ID': 2,
         'key1': 'another value',
         'key2': '5'
     }]
-
-    with open(filename) as f:
-        csv_reader = csv.DictReader(f)
-        for i, row in enumerate(csv_reader):
-            assert row == expected[i]
+    assert crashes.to_dict('records') == expected
 
     # Test calling it again and make sure it doesn't change
-    standardize_crashes.add_id(filename, 'ID')
+    standardize_crashes.add_id(crashes, 'ID', 5)
+    assert crashes.to_dict('records') == expected
+
+    # The file itself is left alone
     with open(filename) as f:
-        csv_reader = csv.DictReader(f)
-        for i, row in enumerate(csv_reader):
-            assert row == expected[i]
+        assert f.read() == contents
 
 
 def test_numeric_and_string_ids():
@@ -391,3 +393,151 @@ def test_add_city_specific_fields():
     assert result['pedestrian'] == 1
     assert 'vehicle' not in result
     assert 'bike' not in result
+
+
+def test_standardize_dataframe(tmpdir):
+    fields = {
+        "id": "id",
+        "date_complete": "date",
+        "time": "time",
+        "time_format": "",
+        "latitude": "lat",
+        "longitude": "lng"
+    }
+    opt_fields = {
+        'summary': 'summary',
+        'split_columns': {
+            'pedestrian': {'column_name': 'peds', 'column_value': 'any'},
+            'vehicle': {'not_column': 'pedestrian'}
+        }
+    }
+    df = pd.DataFrame([
+        ['1', '2016-01-01', '13:05', 42.3, -71.1, 'a', 0],
+        ['2', '2016-01-02', '', 42.3, '', 'b', 0],
+        ['3', '', '13:05', 42.3, -71.1, 'c', 0],
+        ['4', '2017-06-01', '1:05 AM', '42.3', '-71.1', 'd', 2],
+        ['5', 'unk', '', 42.3, -71.1, 'e', 0],
+        ['6', '2015-06-01', '', 42.3, -71.1, 'f', 0],
+        # Later crashes replace earlier ones with the same id
+        ['1', '2016-01-03', '', 42.4, -71.2, 'g', 0],
+    ], columns=['id', 'date', 'time', 'lat', 'lng', 'summary', 'peds'])
+    result = standardize_crashes.read_standardized_fields(
+        df, fields, opt_fields, pytz.timezone("America/New_York"),
+        tmpdir, 'test_city', startdate='2016-01-01')
+
+    assert list(result.keys()) == ['1', '4']
+    assert result['1'] == {
+        'id': '1',
+        'dateOccurred': '2016-01-03T00:00:00-05:00',
+        'location': {'latitude': 42.4, 'longitude': -71.2},
+        'summary': 'g',
+        'vehicle': 1,
+    }
+    assert result['4']['dateOccurred'] == '2017-06-01T01:05:00-04:00'
+    assert result['4']['location'] == {'latitude': 42.3, 'longitude': -71.1}
+    assert result['4']['pedestrian'] == 1
+    assert 'vehicle' not in result['4']
+
+
+def test_main_incremental(tmpdir):
+    datadir = str(tmpdir)
+    os.makedirs(os.path.join(datadir, 'raw', 'crashes'))
+    os.makedirs(os.path.join(datadir, 'standardized'))
+    crash_files = {}
+    for name in ('first.csv', 'second.csv'):
+        crash_files[name] = {
+            'required': {
+                'id': 'ID', 'latitude': 'lat', 'longitude': 'lng',
+                'date_complete': 'date', 'time': '', 'time_format': ''},
+            'optional': {'summary': 'summary'},
+        }
+    config_file = os.path.join(datadir, 'config.yml')
+    with open(config_file, 'w') as f:
+        yaml.safe_dump({
+            'name': 'test', 'city': 'Boston, MA, USA',
+            'city_latitude': 42.36, 'city_longitude': -71.06,
+            'city_radius': 15, 'timezone': 'America/New_York',
+            'crashes_files': crash_files,
+        }, f)
+
+    def write_rows(name, rows, mode='w'):
+        with open(os.path.join(datadir, 'raw', 'crashes', name), mode) as f:
+            if mode == 'w':
+                f.write('date,lat,lng,summary\n')
+            for row in rows:
+                f.write(','.join(row) + '\n')
+
+    def read_crashes():
+        with open(os.path.join(
+                datadir, 'standardized', 'crashes.json')) as f:
+            return json.load(f)
+
+    write_rows('first.csv', [
+        ('2016-01-01', '42.36', '-71.06', 'a'),
+        ('2016-01-02', '42.36', '-71.06', 'b'),
+    ])
+    write_rows('second.csv', [('2016-01-03', '42.36', '-71.06', 'c')])
+    standardize_crashes.main(['-c', config_file, '-d', datadir])
+    # The second file's crash 1 replaces the first file's
+    assert [(x['id'], x['summary']) for x in read_crashes()] == [
+        (1, 'c'), (2, 'b')]
+    with open(os.path.join(datadir, 'raw', 'crashes', 'first.csv')) as f:
+        assert 'ID' not in f.read()
+
+    # Appended rows are standardized on their own, and numbered on from
+    # the rows already there
+    write_rows('first.csv', [('2016-01-04', '42.36', '-71.06', 'd')], 'a')
+    standardize_crashes.main(
+        ['-c', config_file, '-d', datadir, '-p', '2'])
+    assert [(x['id'], x['summary']) for x in read_crashes()] == [
+        (1, 'c'), (2, 'b'), (3, 'd')]
+    with open(os.path.join(datadir, 'processed', 'standardized_crashes',
+                           'first.csv.json')) as f:
+        assert json.load(f)['watermark']['rows'] == 3
+
+    # Rows that would change how the file is read, or a changed file,
+    # mean the whole file is standardized again
+    write_rows('second.csv', [('2016-01-05', '', '-71.06', 'e')], 'a')
+    write_rows('first.csv', [('2016-01-06', '42.36', '-71.06', 'f')])
+    standardize_crashes.main(['-c', config_file, '-d', datadir])
+    assert [(x['id'], x['summary']) for x in read_crashes()] == [
+        (1, 'c')]
+
+
+def test_read_new_rows(tmpdir, monkeypatch):
+    # Small chunks, so the file is hashed in several pieces
+    monkeypatch.setattr(standardize_crashes.record_store, 'CHUNK_SIZE', 7)
+    filename = os.path.join(str(tmpdir), 'crashes.csv')
+    with open(filename, 'w') as f:
+        f.write('date,lat,lng\n2016-01-01,42.36,-71.06\n')
+    crashes, watermark, incremental = standardize_crashes.read_new_rows(
+        filename, 'ID', None, 'settings')
+    assert list(crashes['ID']) == [1] and not incremental
+
+    # Nothing new
+    crashes, same, incremental = standardize_crashes.read_new_rows(
+        filename, 'ID', watermark, 'settings')
+    assert len(crashes) == 0 and incremental and same == watermark
+
+    # Only the appended rows are read, and the watermark covers them
+    with open(filename, 'a') as f:
+        f.write('2016-01-02,42.37,-71.07\n2016-01-03,42.38,-71.08\n')
+    crashes, watermark, incremental = standardize_crashes.read_new_rows(
+        filename, 'ID', watermark, 'settings')
+    assert incremental
+    assert list(crashes['ID']) == [2, 3]
+    assert list(crashes['lat']) == [42.37, 42.38]
+    _, full, _ = standardize_crashes.read_new_rows(
+        filename, 'ID', None, 'settings')
+    assert watermark == full
+
+    # A changed file, or changed settings, are read in full
+    with open(filename, 'w') as f:
+        f.write('date,lat,lng\n2016-01-09,42.36,-71.06\n'
+                '2016-01-02,42.37,-71.07\n2016-01-03,42.38,-71.08\n')
+    crashes, _, incremental = standardize_crashes.read_new_rows(
+        filename, 'ID', watermark, 'settings')
+    assert len(crashes) == 3 and not incremental
+    crashes, _, incremental = standardize_crashes.read_new_rows(
+        filename, 'ID', full, 'other settings')
+    assert len(crashes) == 3 and not incremental
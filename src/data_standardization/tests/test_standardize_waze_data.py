@@ -43,12 +43,15 @@ def test_read_snapshots(tmpdir):
         TEST_FP, 'data', 'waze'), config)
 
     expected_results = [
+        {'eventType': 'snapshot', 'snapshotId': 1,
+         'snapshotTime': '2018-10-15T16:12:00-04:00'},
         {
             'pubMillis': 1539632995870,
             'city': 'Cambridge, MA',
             'eventType': 'jam',
             'pubTimeStamp': '2018-10-15 15:49:55',
-            'snapshotId': 1
+            'snapshotId': 1,
+            'snapshotTime': '2018-10-15T16:12:00-04:00'
         },
         {
             'country': 'US',
@@ -63,15 +66,19 @@ def test_read_snapshots(tmpdir):
             },
             'eventType': 'alert',
             'pubTimeStamp': '2018-10-15 15:40:47',
-            'snapshotId': 1
+            'snapshotId': 1,
+            'snapshotTime': '2018-10-15T16:12:00-04:00'
         },
+        {'eventType': 'snapshot', 'snapshotId': 2,
+         'snapshotTime': '2018-10-16T03:57:00-04:00'},
         {
             'roadType': 1,
             'city': 'Cambridge, MA',
             'pubMillis': 1539670005835,
             'eventType': 'jam',
             'pubTimeStamp': '2018-10-16 02:06:45',
-            'snapshotId': 2
+            'snapshotId': 2,
+            'snapshotTime': '2018-10-16T03:57:00-04:00'
         },
         {
             'type': 'WEATHERHAZARD',
@@ -84,8 +91,11 @@ def test_read_snapshots(tmpdir):
             },
             'eventType': 'alert',
             'pubTimeStamp': '2018-10-15 08:48:41',
-            'snapshotId': 2
+            'snapshotId': 2,
+            'snapshotTime': '2018-10-16T03:57:00-04:00'
         },
+        {'eventType': 'snapshot', 'snapshotId': 3,
+         'snapshotTime': '2018-10-17T12:12:00-04:00'},
         {
             'updateDate': 'Wed Oct 17 16:14:17 +0000 2018',
             'speed': 3.79,
@@ -94,7 +104,8 @@ def test_read_snapshots(tmpdir):
             'detectionDate': 'Wed Oct 17 15:08:10 +0000 2018',
             'type': 'Small',
             'eventType': 'irregularity',
-            'snapshotId': 3
+            'snapshotId': 3,
+            'snapshotTime': '2018-10-17T12:12:00-04:00'
         }
     ]
     assert results == expected_results
@@ -106,13 +117,16 @@ def test_read_snapshots(tmpdir):
         enddate='2018-10-16'
     )
     assert results == [
+        {'eventType': 'snapshot', 'snapshotId': 1,
+         'snapshotTime': '2018-10-16T03:57:00-04:00'},
         {
             'roadType': 1,
             'city': 'Cambridge, MA',
             'pubMillis': 1539670005835,
             'eventType': 'jam',
             'pubTimeStamp': '2018-10-16 02:06:45',
-            'snapshotId': 1
+            'snapshotId': 1,
+            'snapshotTime': '2018-10-16T03:57:00-04:00'
         },
         {
             'type': 'WEATHERHAZARD',
@@ -125,6 +139,7 @@ def test_read_snapshots(tmpdir):
             },
             'eventType': 'alert',
             'pubTimeStamp': '2018-10-15 08:48:41',
-            'snapshotId': 1
+            'snapshotId': 1,
+            'snapshotTime': '2018-10-16T03:57:00-04:00'
         },
     ]
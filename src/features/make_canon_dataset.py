@@ -2,13 +2,14 @@
 # coding: utf-8
 # Generate canonical dataset for hackathon
 # Developed by: bpben
-import json
 import pandas as pd
 from data.util import read_geojson
+from data import record_store
 import os
 import argparse
 import warnings
 import data.config
+from data import profiling
 
 
 BASE_DIR = os.path.dirname(
@@ -24,18 +25,21 @@ def read_records(fp, id_col, split_columns=[]):
     """
     Read point data, output segments with crash counts, and counts
     for each additional column that's been specified in split_columns
+    Only the columns needed are kept as the records are read
     Args:
-        fp - file, probably a crash_joined.json file
+        fp - file, probably a crash_joined.json file, in any of the
+            formats in data/record_store.py
         id_col - column that corresponds to segment id, probably near_id
         split_columns - a list of columns to add
     Returns:
         Pandas dataframe with the segment/crash info
     """
 
-    with open(fp, 'r') as f:
-        data = json.load(f)
-
-    df = pd.DataFrame(data)
+    columns = [id_col] + split_columns
+    df = pd.DataFrame.from_records(
+        ([x.get(column) for column in columns]
+         for x in record_store.iter_records(fp)),
+        columns=columns)
     df = df.fillna(0)
 
     print("total number of records in {}:{}".format(fp, len(df)))
@@ -124,38 +128,43 @@ def combine_crash_with_segments(crash, aggregated):
     return crash_roads
 
 
-if __name__ == '__main__':
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--datadir", type=str,
                         help="Can give alternate data directory")
     parser.add_argument("-c", "--config", type=str,
                         help="Config file", required=True)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     config = data.config.Configuration(args.config)
 
     # Can override the hardcoded data directory
+    data_fp = DATA_FP
     if args.datadir:
-        DATA_FP = os.path.join(args.datadir, 'processed')
-        MAP_FP = os.path.join(DATA_FP, 'maps')
+        data_fp = os.path.join(args.datadir, 'processed')
 
     feats = config.features
-    print("Data directory: " + DATA_FP)
+    print("Data directory: " + data_fp)
 
-    aggregated, crash = aggregate_roads(
-        feats,
-        DATA_FP,
-        config.split_columns
-    )
+    with profiling.step('aggregate_roads') as step:
+        aggregated, crash = aggregate_roads(
+            feats,
+            data_fp,
+            config.split_columns
+        )
+        step.rows_out = len(aggregated)
 
     crash_roads = combine_crash_with_segments(
         crash, aggregated)
 
     # output canon dataset
-    print("exporting canonical dataset to ", DATA_FP)
+    print("exporting canonical dataset to ", data_fp)
 
     crash_roads.set_index('segment_id').to_csv(
-        os.path.join(DATA_FP, 'vz_predict_dataset.csv.gz'),
+        os.path.join(data_fp, 'vz_predict_dataset.csv.gz'),
         compression='gzip')
 
+
+if __name__ == '__main__':
+    main()
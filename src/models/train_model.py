@@ -10,6 +10,7 @@ import argparse
 from copy import deepcopy
 from .model_classes import Indata, Tuner, Tester
 import data.config
+from data import profiling
 
 # all model outputs must be stored in the "data/processed/" directory
 BASE_DIR = os.path.dirname(
@@ -276,7 +277,7 @@ def initialize_and_run(data_model, features, lm_features, target,
     output_importance(trained_model, features, datadir, target)
 
 
-if __name__ == '__main__':
+def main(argv=None):
 
     parser = argparse.ArgumentParser()
     # parse arguments
@@ -286,12 +287,14 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--datadir', type=str,
                         help="data directory")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     config = data.config.Configuration(args.config)
     set_defaults(config)
 
-    DATA_FP = os.path.join(BASE_DIR, 'data', config.name)
-    PROCESSED_DATA_FP = os.path.join(BASE_DIR, 'data', config.name, 'processed/')
+    data_fp = os.path.join(BASE_DIR, 'data', config.name)
+    if args.datadir:
+        data_fp = args.datadir
+    PROCESSED_DATA_FP = os.path.join(data_fp, 'processed/')
     seg_data = os.path.join(PROCESSED_DATA_FP, config.seg_data)
 
     # get the targets
@@ -303,13 +306,13 @@ if __name__ == '__main__':
     print(('Outputting to: %s' % PROCESSED_DATA_FP))
 
     # Read in data
-    data = pd.read_csv(seg_data, dtype={'segment_id': 'str'})
+    seg_df = pd.read_csv(seg_data, dtype={'segment_id': 'str'})
 
-    f_cat, f_cont, features = get_features(config, data)
+    f_cat, f_cont, features = get_features(config, seg_df)
 
-    data = add_extra_features(data, config, PROCESSED_DATA_FP)
+    seg_df = add_extra_features(seg_df, config, PROCESSED_DATA_FP)
     # grab the highest values from each column
-    data_segs = data.groupby('segment_id')[features].max()
+    data_segs = seg_df.groupby('segment_id')[features].max()
     data_segs.reset_index(inplace=True)
 
     data_segs, features, lm_features = process_features(
@@ -318,12 +321,16 @@ if __name__ == '__main__':
 
     for target in targets:
         # want any instance of target
-        any_target = data.groupby('segment_id')[target].max()
+        any_target = seg_df.groupby('segment_id')[target].max()
         any_target = (any_target>0).astype(int)
         any_target.name = target
         data_model = data_segs.set_index('segment_id').join(any_target).reset_index()    
         print("running model for target: %s" % target )
-        initialize_and_run(data_model, features, lm_features, target,
-                           PROCESSED_DATA_FP)
+        with profiling.step('initialize_and_run_' + target,
+                            rows_in=len(data_model)):
+            initialize_and_run(data_model, features, lm_features, target,
+                               PROCESSED_DATA_FP)
 
 
+if __name__ == '__main__':
+    main()
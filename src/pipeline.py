@@ -1,155 +1,15 @@
 import argparse
 import os
-import subprocess
 import shutil
 import data.config
+import data.profiling
+import data.stage_graph
 
 BASE_DIR = os.path.dirname(
     os.path.dirname(
         os.path.abspath(__file__)))
 
 
-def data_standardization(config_file, DATA_FP, forceupdate=False):
-    """
-    Standardize data from a csv file into compatible crashes
-    according to a config file
-    Args:
-        config_file
-        DATA_FP - data directory for this city
-    """
-
-    # standardize data, if the files don't already exist
-    # or forceupdate
-    if not os.path.exists(os.path.join(
-            DATA_FP, 'standardized', 'crashes.json')) or forceupdate:
-        print("Standardizing crash data..")
-        subprocess.check_call([
-            'python',
-            '-m',
-            'data_standardization.standardize_crashes',
-            '-c',
-            config_file,
-            '-d',
-            DATA_FP
-        ])
-    else:
-        print("Already standardized crash data, skipping")
-
-    # Handling volume data
-    if (not os.path.exists(os.path.join(
-            DATA_FP, 'standardized', 'volume.json'))) or forceupdate:
-        subprocess.check_call([
-            'python',
-            '-m',
-            'data_standardization.standardize_volume',
-            '-c',
-            config_file,
-            '-d',
-            DATA_FP
-        ])
-    else:
-        print("Already standardized volume data, skipping")
-
-    if not os.path.exists(os.path.join(
-           DATA_FP, 'standardized', 'points.json')) or forceupdate:
-        subprocess.check_call([
-            'python',
-            '-m',
-            'data_standardization.standardize_point_data',
-            '-c',
-            config_file,
-            '-d',
-            DATA_FP
-        ])
-    else:
-        print("Already standardized point data, skipping")
-    forceupdate = True
-
-    if os.path.exists(os.path.join(DATA_FP, 'raw', 'waze')) and \
-       (not os.path.exists(os.path.join(BASE_DIR, 'standardized', 'waze.json')
-                           or forceupdate)):
-        subprocess.check_call([
-            'python',
-            '-m',
-            'data_standardization.standardize_waze_data',
-            '-c',
-            config_file,
-            '-d',
-            DATA_FP,
-            # The script can filter by dates, but if this is something
-            # we'd like to add, dates should probably be specified
-            # Might be better to just only store the waze snapshots force
-            # the desired weeks in the raw waze directory
-        ])
-    elif not os.path.exists(os.path.join(DATA_FP, 'raw', 'waze')):
-        print("No waze data, skipping")
-    else:
-        print("Already standardized waze data, skipping")
-
-
-def data_generation(config_file, DATA_FP, startdate=None, enddate=None,
-                    forceupdate=False):
-    """
-    Generate the map and feature data for this city
-    Args:
-        config_file - path to config file
-        DATA_FP - path to data directory, e.g. ../data/boston/
-        startdate (optional)
-        enddate (optional)
-    """
-    print("Generating data and features...")
-    subprocess.check_call([
-        'python',
-        '-m',
-        'data.make_dataset',
-        '-c',
-        config_file,
-        '-d',
-        DATA_FP
-    ]
-        + (['-s', str(startdate)] if startdate else [])
-        + (['-e', str(enddate)] if enddate else [])
-        + (['--forceupdate'] if forceupdate else [])
-    )
-
-
-def train_model(config_file, DATA_FP):
-    """
-    Trains the model
-    Args:
-        config_file - path to config file
-        DATA_FP - path to data directory, e.g. ../data/boston/
-    """
-    print("Training model...")
-    subprocess.check_call([
-        'python',
-        '-m',
-        'models.train_model',
-        '-c',
-        config_file,
-        '-d',
-        DATA_FP
-    ])
-
-
-def visualize(DATA_FP, config_file):
-    """
-    Creates the visualization data set for a city
-    Args:
-        DATA_FP - path to data directory, e.g. ../data/boston/
-    """
-    print("Generating visualization data")
-    subprocess.check_call([
-        'python',
-        '-m',
-        'data.make_preds_viz',
-        '-d',
-        DATA_FP,
-        '-c',
-        config_file
-    ])
-
-
 def copy_files(base_dir, data_fp, config):
     """
     Copy necessary files into showcase directory
@@ -247,8 +107,15 @@ if __name__ == '__main__':
                         help="Give list of steps to run, as comma-separated " +
                         "string.  Has to be among 'standardization'," +
                         "'generation', 'model', 'visualization'")
+    parser.add_argument('--profile', action='store_true',
+                        help="Record the time and memory each stage " +
+                        "takes, in the city's processed/profiles directory")
+    parser.add_argument('--profile_stage',
+                        help="Also dump cProfile and tracemalloc " +
+                        "results for this stage or step, implies --profile")
 
     args = parser.parse_args()
+    steps = None
     if args.onlysteps:
         steps = args.onlysteps.split(',')
 
@@ -257,21 +124,20 @@ if __name__ == '__main__':
 
     DATA_FP = os.path.join(BASE_DIR, 'data', config.name)
 
-    if not args.onlysteps or 'standardization' in args.onlysteps:
-        data_standardization(args.config_file, DATA_FP, forceupdate=args.forceupdate)
-
-    startdate = config.startdate
-    enddate = config.enddate
-    if not args.onlysteps or 'generation' in args.onlysteps:
-        data_generation(args.config_file, DATA_FP,
-                        startdate=startdate,
-                        enddate=enddate,
-                        forceupdate=args.forceupdate)
-
-    if not args.onlysteps or 'model' in args.onlysteps:
-        train_model(args.config_file, DATA_FP)
-
-    if not args.onlysteps or 'visualization' in args.onlysteps:
-        visualize(DATA_FP, args.config_file)
-        copy_files(BASE_DIR, DATA_FP, config)
-        make_js_config(BASE_DIR, config)
+    if args.profile or args.profile_stage:
+        data.profiling.start(
+            data.profiling.default_report_file(DATA_FP),
+            detail=args.profile_stage)
+
+    try:
+        # Stages whose inputs and config are unchanged since their last
+        # run are skipped, see data/stage_graph.py
+        data.stage_graph.run_pipeline(
+            args.config_file, DATA_FP, steps=steps,
+            forceupdate=args.forceupdate)
+
+        if not steps or 'visualization' in steps:
+            copy_files(BASE_DIR, DATA_FP, config)
+            make_js_config(BASE_DIR, config)
+    finally:
+        data.profiling.finish()
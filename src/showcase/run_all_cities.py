@@ -1,17 +1,192 @@
 # -*- coding: utf-8 -*-
+"""
+Run the pipeline for every city with a data directory and a config file
+
+Cities run at the same time, each in its own pipeline.py process, up to
+--workers at once. Each city has a memory budget: the peak memory of its
+last profiled run (pipeline.py is run with --profile, so each run records
+one for the next), or --budget if it hasn't been profiled. A city only
+starts once its budget fits in what's left of --memory, so that large
+cities don't run out of memory together; a city whose budget is more
+than --memory runs on its own.
+
+All the cities share an osmnx cache of OpenStreetMap responses, so maps
+that overlap don't need to be downloaded again. Each city's output goes
+to its own log, in the city's logs directory, and one city failing
+doesn't stop the rest. The failures are listed at the end.
+"""
+import argparse
+import datetime
+import glob
+import json
 import os
 import subprocess
-import argparse
+import sys
+import time
 
 
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_FP = os.path.join(SRC_DIR, 'config')
 DATA_FP = os.path.dirname(
     os.path.dirname(
         os.path.dirname(
             os.path.abspath(__file__)))) + '/data/'
+OSM_CACHE_FP = os.path.join(DATA_FP, '.osm_cache')
 
+# Default memory budget, in megabytes, for cities without a profile
+DEFAULT_BUDGET = 4096
+# Allowance on top of a city's last recorded peak memory
+BUDGET_MARGIN = 1.25
 
-if __name__ == '__main__':
 
+def find_cities(data_fp, config_fp, names=None):
+    """
+    Find the cities with both a data directory and a config file
+    Args:
+        data_fp - directory of the cities' data directories
+        config_fp - directory of the config files
+        names - optional list of cities to run, otherwise all of them
+    Returns:
+        list of (city, config file) tuples, and a list of the cities
+        without a config file
+    """
+    if names is None:
+        names = sorted(
+            x for x in os.listdir(data_fp)
+            if not x.startswith('.')
+            and os.path.isdir(os.path.join(data_fp, x)))
+    cities = []
+    missing = []
+    for city in names:
+        config_file = os.path.join(config_fp, 'config_{}.yml'.format(city))
+        if os.path.exists(config_file):
+            cities.append((city, config_file))
+        else:
+            missing.append(city)
+    return cities, missing
+
+
+def get_budget(city_dir, default=DEFAULT_BUDGET):
+    """
+    The memory budget for a city, from its most recent profile report
+    Args:
+        city_dir - the city's data directory
+        default - budget in megabytes if there's no usable report
+    Returns:
+        budget in megabytes
+    """
+    reports = sorted(glob.glob(os.path.join(
+        city_dir, 'processed', 'profiles', 'profile_*.json')))
+    for report_file in reversed(reports):
+        try:
+            with open(report_file) as f:
+                steps = json.load(f)['steps']
+        except (ValueError, KeyError, OSError):
+            continue
+        peaks = [max(x['peak_rss_mb'], x['children_peak_rss_mb'])
+                 for x in steps]
+        if peaks:
+            return int(max(peaks) * BUDGET_MARGIN)
+    return default
+
+
+def total_memory():
+    """
+    Physical memory in megabytes
+    """
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') \
+        / 1024.0 / 1024.0
+
+
+def run_jobs(jobs, workers, memory, env=None, poll_interval=1):
+    """
+    Run commands in parallel, within a total memory budget
+    Jobs are started largest budget first, as long as there's a free
+    worker and their budget fits in the memory not yet budgeted for
+    Args:
+        jobs - list of dicts with name, command, budget (in megabytes)
+            and log_file
+        workers - maximum number of jobs to run at once
+        memory - total memory budget in megabytes
+        env - optional environment for the commands
+        poll_interval - seconds between checks for finished jobs
+    Returns:
+        list of dicts with name, returncode, wall_time and log_file,
+        in the order the jobs finished
+    """
+    pending = sorted(jobs, key=lambda x: -x['budget'])
+    running = []
+    results = []
+    while pending or running:
+        budgeted = sum(x[0]['budget'] for x in running)
+        for job in list(pending):
+            if len(running) >= workers:
+                break
+            if running and budgeted + job['budget'] > memory:
+                continue
+            pending.remove(job)
+            budgeted += job['budget']
+            log_dir = os.path.dirname(job['log_file'])
+            if log_dir and not os.path.exists(log_dir):
+                os.makedirs(log_dir)
+            log = open(job['log_file'], 'w')
+            print("Starting {} (budget {}MB), logging to {}".format(
+                job['name'], job['budget'], job['log_file']))
+            process = subprocess.Popen(
+                job['command'], cwd=SRC_DIR, env=env,
+                stdout=log, stderr=subprocess.STDOUT)
+            running.append((job, process, log, time.time()))
+
+        time.sleep(poll_interval)
+        for item in list(running):
+            job, process, log, started = item
+            if process.poll() is None:
+                continue
+            running.remove(item)
+            log.close()
+            results.append({
+                'name': job['name'],
+                'returncode': process.returncode,
+                'wall_time': time.time() - started,
+                'log_file': job['log_file'],
+            })
+            print("{} {} after {:.0f}s".format(
+                job['name'],
+                'failed' if process.returncode else 'finished',
+                time.time() - started))
+    return results
+
+
+def log_tail(log_file, lines=5):
+    """
+    The last few lines of a log file
+    """
+    if not os.path.exists(log_file):
+        return []
+    with open(log_file, errors='replace') as f:
+        return [x.rstrip() for x in f.readlines()[-lines:]]
+
+
+def print_summary(results, missing):
+    """
+    Print which cities ran, and why the rest didn't
+    Returns:
+        the names of the cities that failed
+    """
+    succeeded = [x['name'] for x in results if not x['returncode']]
+    failed = [x for x in results if x['returncode']]
+    print("Ran pipeline on {}".format(", ".join(sorted(succeeded))))
+    for city in missing:
+        print("Skipped {}, no config file found".format(city))
+    for result in failed:
+        print("{} failed with return code {}, see {}".format(
+            result['name'], result['returncode'], result['log_file']))
+        for line in log_tail(result['log_file']):
+            print("    " + line)
+    return [x['name'] for x in failed]
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--forceupdate', action='store_true',
                         help='Whether to force update the maps')
@@ -20,21 +195,51 @@ if __name__ == '__main__':
                         help="Give list of steps to run, as comma-separated " +
                         "string.  Has to be among 'standardization'," +
                         "'generation', 'model', 'visualization'")
-    args = parser.parse_args()
-
-    cities = os.listdir(DATA_FP)
-    for city in cities:
-        config_file = os.path.join('config', 'config_{}.yml'.format(city))
-
-        print("Running pipeline for {}".format(city))
-        print(args.onlysteps)
-        subprocess.check_call([
-            'python',
-            'pipeline.py',
-            '-c',
-            config_file,
-        ] + (['--forceupdate'] if args.forceupdate else []) +
-            (['--onlysteps', args.onlysteps] if args.onlysteps else [])
-        )
-    city_list = ", ".join(cities)
-    print("Ran pipeline on {}".format(city_list))
+    parser.add_argument('--cities',
+                        help="Comma separated cities to run, defaults to " +
+                        "every city in the data directory")
+    parser.add_argument('-w', '--workers', type=int,
+                        default=max((os.cpu_count() or 1) // 2, 1),
+                        help="Maximum number of cities to run at once")
+    parser.add_argument('-m', '--memory', type=int,
+                        help="Total memory budget in MB, defaults to " +
+                        "80%% of physical memory")
+    parser.add_argument('-b', '--budget', type=int, default=DEFAULT_BUDGET,
+                        help="Memory budget in MB for cities that " +
+                        "haven't been profiled yet")
+    parser.add_argument('--osm_cache', default=OSM_CACHE_FP,
+                        help="Shared cache directory for OpenStreetMap " +
+                        "downloads")
+    args = parser.parse_args(argv)
+
+    cities, missing = find_cities(
+        DATA_FP, CONFIG_FP,
+        args.cities.split(',') if args.cities else None)
+
+    run_started = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    jobs = []
+    for city, config_file in cities:
+        city_dir = os.path.join(DATA_FP, city)
+        jobs.append({
+            'name': city,
+            'command': [
+                sys.executable, 'pipeline.py', '-c', config_file,
+                '--profile'
+            ] + (['--forceupdate'] if args.forceupdate else []) +
+            (['--onlysteps', args.onlysteps] if args.onlysteps else []),
+            'budget': get_budget(city_dir, args.budget),
+            'log_file': os.path.join(
+                city_dir, 'logs', 'pipeline_{}.log'.format(run_started)),
+        })
+
+    env = dict(os.environ)
+    env['OSM_CACHE_DIR'] = args.osm_cache
+    results = run_jobs(jobs, args.workers,
+                       args.memory or int(total_memory() * .8), env=env)
+
+    if print_summary(results, missing):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
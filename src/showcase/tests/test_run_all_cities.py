@@ -0,0 +1,52 @@
+import json
+import os
+import sys
+from .. import run_all_cities
+
+
+def test_find_cities(tmpdir):
+    data_fp = tmpdir.mkdir('data')
+    config_fp = tmpdir.mkdir('config')
+    for city in ('boston', 'cambridge', '.osm_cache'):
+        data_fp.mkdir(city)
+    config_fp.join('config_boston.yml').write('')
+    cities, missing = run_all_cities.find_cities(str(data_fp), str(config_fp))
+    assert cities == [('boston', str(config_fp.join('config_boston.yml')))]
+    assert missing == ['cambridge']
+
+
+def test_get_budget(tmpdir):
+    assert run_all_cities.get_budget(str(tmpdir), 100) == 100
+    profiles = tmpdir.mkdir('processed').mkdir('profiles')
+    profiles.join('profile_20180101_000000.json').write(json.dumps({
+        'steps': [
+            {'peak_rss_mb': 100, 'children_peak_rss_mb': 0},
+            {'peak_rss_mb': 200, 'children_peak_rss_mb': 400},
+        ]
+    }))
+    assert run_all_cities.get_budget(str(tmpdir), 100) == 500
+
+
+def test_run_jobs(tmpdir):
+    def job(name, code, budget):
+        return {
+            'name': name,
+            'command': [sys.executable, '-c', code],
+            'budget': budget,
+            'log_file': os.path.join(str(tmpdir), name, 'pipeline.log'),
+        }
+
+    results = run_all_cities.run_jobs([
+        job('fails', 'import sys; print("oops"); sys.exit(2)', 10),
+        job('small', 'print("small")', 10),
+        # More than the memory budget, so it runs on its own
+        job('large', 'print("large")', 1000),
+    ], workers=2, memory=100, poll_interval=.1)
+
+    results = {x['name']: x for x in results}
+    assert results['fails']['returncode'] == 2
+    assert results['small']['returncode'] == 0
+    assert results['large']['returncode'] == 0
+    assert run_all_cities.log_tail(results['fails']['log_file']) == ['oops']
+    assert run_all_cities.print_summary(
+        list(results.values()), ['missing']) == ['fails']
@@ -0,0 +1,247 @@
+# End to end scaling benchmark of the pipeline on synthetic cities
+# Generates a city at each size (see tools/synthetic_city.py), runs each
+# stage in its own process under data/profiling.py, and appends the
+# timings and peak memory to a results file, tagged with the git commit,
+# so that runs on different commits can be compared:
+#   python -m tools.benchmark run -w ../benchmark -s 1000,50000
+#   python -m tools.benchmark compare old_results.json new_results.json
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+from . import synthetic_city
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Stages to run, in order, as module names
+STAGES = [
+    'data.create_segments',
+    'data.join_segments_crash',
+    'features.make_canon_dataset',
+    'models.train_model',
+    'data.make_preds_viz',
+]
+# Stages that can also be run, for cities with waze and volume data
+OPTIONAL_STAGES = [
+    'data.add_waze_data',
+    'data.propagate_volume',
+]
+SIZES = [1000, 50000, 500000]
+
+
+def git_commit():
+    """
+    The current git commit, or None if it can't be found
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=SRC_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def stage_args(stage, config_file, datadir):
+    """
+    The command line arguments the pipeline runs a stage with
+    """
+    if stage in ('data.add_waze_data', 'data.propagate_volume'):
+        return ['-d', datadir]
+    if stage == 'data.create_segments':
+        return ['-c', config_file, '-d', datadir,
+                '-p', str(os.cpu_count() or 1)]
+    return ['-c', config_file, '-d', datadir]
+
+
+def prepare_city(workdir, size, seed):
+    """
+    Generate the city for a size, unless it's already been generated,
+    and copy it to a fresh directory to run the stages in
+    Returns:
+        the config file and data directory to run with
+    """
+    source = os.path.join(workdir, 'cities', '{}_{}'.format(size, seed))
+    if not os.path.exists(os.path.join(source, 'config.yml')):
+        synthetic_city.make_city(source, size, seed=seed)
+
+    datadir = os.path.join(workdir, 'runs', str(size))
+    if os.path.exists(datadir):
+        shutil.rmtree(datadir)
+    shutil.copytree(source, datadir)
+    return os.path.join(datadir, 'config.yml'), datadir
+
+
+def run_stage(stage, config_file, datadir, report_file, log_file):
+    """
+    Run a stage's main() in its own process under the profiler
+    Returns:
+        the profile record for the stage, or None if the stage
+        didn't write a report
+    """
+    with open(log_file, 'w') as log:
+        returncode = subprocess.call(
+            [sys.executable, '-m', 'data.profiling', '-o', report_file,
+             stage] + stage_args(stage, config_file, datadir),
+            cwd=SRC_DIR, stdout=log, stderr=subprocess.STDOUT)
+    if not os.path.exists(report_file):
+        return None
+    with open(report_file) as f:
+        report = json.load(f)
+    record = [x for x in report['steps'] if x['path'] == stage][0]
+    record['returncode'] = returncode
+    record['steps'] = [x for x in report['steps'] if x['path'] != stage]
+    return record
+
+
+def run_benchmark(workdir, sizes, stages, results_file, seed=0):
+    """
+    Run the stages on synthetic cities of each size
+    Args:
+        workdir - directory for the generated cities, runs and logs
+        sizes - list of approximate numbers of road segments
+        stages - list of stage module names, in the order to run them
+        results_file - json file to append the results to
+        seed - random seed for generating the cities
+    Returns:
+        the list of results from this run
+    """
+    commit = git_commit()
+    started = datetime.datetime.now().isoformat()
+    results = []
+    for size in sizes:
+        config_file, datadir = prepare_city(workdir, size, seed)
+        logdir = os.path.join(workdir, 'logs', str(size))
+        if not os.path.exists(logdir):
+            os.makedirs(logdir)
+
+        for stage in stages:
+            print("Running {} on {} segments".format(stage, size))
+            record = run_stage(
+                stage, config_file, datadir,
+                os.path.join(logdir, stage + '.json'),
+                os.path.join(logdir, stage + '.log'))
+            result = {
+                'commit': commit,
+                'started': started,
+                'size': size,
+                'seed': seed,
+                'stage': stage,
+                'failed': record is None or bool(record['returncode']),
+            }
+            if record:
+                result.update({
+                    'wall_time': record['wall_time'],
+                    'cpu_time': record['cpu_time']
+                    + record['children_cpu_time'],
+                    'peak_rss_mb': max(record['peak_rss_mb'],
+                                       record['children_peak_rss_mb']),
+                    'steps': {
+                        x['path']: x['wall_time'] for x in record['steps']},
+                })
+            results.append(result)
+            if result['failed']:
+                print("{} failed, see {}, skipping the rest".format(
+                    stage, os.path.join(logdir, stage + '.log')))
+                break
+
+    previous = []
+    if os.path.exists(results_file):
+        with open(results_file) as f:
+            previous = json.load(f)
+    with open(results_file, 'w') as f:
+        json.dump(previous + results, f, indent=1)
+    print("Wrote results to {}".format(results_file))
+    return results
+
+
+def latest_results(results):
+    """
+    The most recent result for each size and stage
+    """
+    latest = {}
+    for result in results:
+        latest[(result['size'], result['stage'])] = result
+    return latest
+
+
+def compare(old_results, new_results):
+    """
+    Compare the latest timings and memory of two sets of results
+    Args:
+        old_results, new_results - lists of results, as written by
+            run_benchmark
+    Returns:
+        list of (size, stage, old result, new result) tuples, for the
+        sizes and stages in both that didn't fail
+    """
+    old = latest_results(old_results)
+    new = latest_results(new_results)
+    rows = []
+    for key in sorted(set(old) & set(new)):
+        if not old[key]['failed'] and not new[key]['failed']:
+            rows.append(key + (old[key], new[key]))
+    return rows
+
+
+def print_comparison(rows):
+    print("{:>8} {:<28} {:>10} {:>10} {:>8} {:>10} {:>10}".format(
+        'size', 'stage', 'old (s)', 'new (s)', 'change',
+        'old (MB)', 'new (MB)'))
+    for size, stage, old, new in rows:
+        change = (new['wall_time'] - old['wall_time']) \
+            / old['wall_time'] * 100 if old['wall_time'] else 0
+        print("{:>8} {:<28} {:>10.2f} {:>10.2f} {:>7.1f}% {:>10.1f} "
+              "{:>10.1f}".format(
+                  size, stage, old['wall_time'], new['wall_time'], change,
+                  old['peak_rss_mb'], new['peak_rss_mb']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser(
+        'run', help='Run the benchmark')
+    run_parser.add_argument("-w", "--workdir", type=str, required=True,
+                            help="Directory for generated cities and runs")
+    run_parser.add_argument("-s", "--sizes", type=str,
+                            default=','.join(str(x) for x in SIZES),
+                            help="Comma separated numbers of road segments")
+    run_parser.add_argument("--stages", type=str,
+                            default=','.join(STAGES),
+                            help="Comma separated stage modules to run, " +
+                            "from: " + ', '.join(STAGES + OPTIONAL_STAGES))
+    run_parser.add_argument("-r", "--results", type=str,
+                            help="Results file to append to, defaults " +
+                            "to results.json in the work directory")
+    run_parser.add_argument("--seed", type=int, default=0,
+                            help="Random seed for the cities")
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='Compare two results files')
+    compare_parser.add_argument("old", type=str, help="Old results file")
+    compare_parser.add_argument("new", type=str, help="New results file")
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        run_benchmark(
+            args.workdir,
+            [int(x) for x in args.sizes.split(',')],
+            args.stages.split(','),
+            args.results or os.path.join(args.workdir, 'results.json'),
+            seed=args.seed)
+    elif args.command == 'compare':
+        with open(args.old) as f:
+            old_results = json.load(f)
+        with open(args.new) as f:
+            new_results = json.load(f)
+        print_comparison(compare(old_results, new_results))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
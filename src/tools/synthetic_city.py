@@ -0,0 +1,457 @@
+# Generate a synthetic city, for benchmarking the pipeline at a chosen
+# scale without downloading anything
+# The city is a jittered grid of streets, written in the same formats the
+# pipeline's standardization and map generation steps produce:
+#   processed/maps/osm_elements.geojson - roads and intersections
+#   processed/maps/features.geojson - signals and crosswalks
+#   standardized/crashes.json
+#   standardized/points.json - point-based features
+#   standardized/waze.json - jams and alerts
+#   standardized/volume.json - ATR volume counts
+# along with a config file, config.yml
+import argparse
+import datetime
+import json
+import math
+import os
+import numpy as np
+import yaml
+from data.util import coords_array, transform_coords
+from data.record import transformer_4326_to_3857, transformer_3857_to_4326
+from data import map_store
+
+CENTER_LATITUDE = 42.3600825
+CENTER_LONGITUDE = -71.0588801
+# Distance between neighbouring intersections, in meters
+BLOCK_SIZE = 100
+# Every few streets is a larger avenue
+AVENUE_EVERY = 5
+START_DATE = datetime.datetime(2016, 1, 1)
+END_DATE = datetime.datetime(2017, 12, 31)
+ALERT_TYPES = ['JAM', 'ACCIDENT', 'WEATHERHAZARD', 'ROAD_CLOSED']
+
+
+def grid_size(segments):
+    """
+    The number of intersections along each side of a square grid
+    with at least the given number of road segments
+    An n by n grid has 2n(n - 1) segments
+    """
+    return max(int(math.ceil((1 + math.sqrt(1 + 2 * segments)) / 2)), 2)
+
+
+def to_lon_lat(coords):
+    """
+    Reproject an (n, 2) array of 3857 coordinates to 4326,
+    rounded as they would be in a geojson file
+    """
+    return np.round(
+        transform_coords(coords, transformer_3857_to_4326), 7)
+
+
+def make_roads(size, rng):
+    """
+    Make the roads and intersections of a grid
+    Args:
+        size - number of intersections along each side
+        rng - numpy RandomState
+    Returns:
+        roads - list of dicts with coordinates (a (3, 2) array in 3857)
+            and properties
+        nodes - list of dicts with coordinates (an x, y tuple in 3857)
+            and properties
+    """
+    center = coords_array([(CENTER_LONGITUDE, CENTER_LATITUDE)])
+    center_x, center_y = transform_coords(
+        center, transformer_4326_to_3857)[0]
+
+    offsets = (np.arange(size) - (size - 1) / 2.0) * BLOCK_SIZE
+    xs = center_x + offsets[np.newaxis, :] + rng.uniform(
+        -BLOCK_SIZE / 10, BLOCK_SIZE / 10, (size, size))
+    ys = center_y + offsets[:, np.newaxis] + rng.uniform(
+        -BLOCK_SIZE / 10, BLOCK_SIZE / 10, (size, size))
+    signals = rng.uniform(size=(size, size)) < .2
+
+    def node_id(row, col):
+        return str(1000000 + row * size + col)
+
+    def street_name(horizontal, index):
+        if index % AVENUE_EVERY == 0:
+            return '{} Avenue'.format(index + 1)
+        return '{} {}'.format(index + 1, 'Street' if horizontal else 'Road')
+
+    roads = []
+    for horizontal in (True, False):
+        for i in range(size):
+            name = street_name(horizontal, i)
+            avenue = i % AVENUE_EVERY == 0
+            osmid = str((2000000 if horizontal else 3000000) + i)
+            oneway = 0 if avenue else int(rng.uniform() < .3)
+            cycleway_type = int(rng.randint(0, 3))
+            for j in range(size - 1):
+                if horizontal:
+                    start, end = (i, j), (i, j + 1)
+                else:
+                    start, end = (j, i), (j + 1, i)
+                coords = np.array([
+                    (xs[start], ys[start]),
+                    ((xs[start] + xs[end]) / 2 + rng.uniform(-3, 3),
+                     (ys[start] + ys[end]) / 2 + rng.uniform(-3, 3)),
+                    (xs[end], ys[end]),
+                ])
+                lanes = 4 if avenue else 2
+                width = 20 if avenue else int(rng.choice([8, 10, 12]))
+                from_id, to_id = node_id(*start), node_id(*end)
+                roads.append({'coordinates': coords, 'properties': {
+                    'id': str(len(roads)),
+                    'osmid': osmid,
+                    'from': from_id,
+                    'to': to_id,
+                    'key': '0',
+                    'name': name,
+                    'highway': 'secondary' if avenue else 'residential',
+                    'length': round(float(np.hypot(
+                        *(coords[-1] - coords[0]))), 3),
+                    'oneway': oneway,
+                    'lanes': lanes,
+                    'width': width,
+                    'width_per_lane': round(width / lanes),
+                    'hwy_type': 2 if avenue else 1,
+                    'cycleway_type': cycleway_type,
+                    'osm_speed': 30 if avenue else 25,
+                    'maxspeed': '30 mph' if avenue else '25 mph',
+                    'signal': 0,
+                    'segment_id': '-'.join([osmid, from_id, to_id]),
+                    'bridge': None,
+                    'tunnel': None,
+                    'access': None,
+                    'ref': None,
+                }})
+
+    nodes = []
+    for row in range(size):
+        for col in range(size):
+            nodes.append({
+                'coordinates': (xs[row, col], ys[row, col]),
+                'properties': {
+                    'osmid': node_id(row, col),
+                    'streets': ', '.join([street_name(True, row),
+                                          street_name(False, col)]),
+                    'dead_end': None,
+                    'intersection': 1,
+                    'highway': 'traffic_signals'
+                    if signals[row, col] else None,
+                    'signal': int(signals[row, col]),
+                }
+            })
+    return roads, nodes
+
+
+def write_features(features, filename):
+    """
+    Write a list of geojson features one at a time, rather than building
+    the whole collection in memory
+    """
+    with open(filename, 'w') as f:
+        f.write('{"type": "FeatureCollection", "features": [\n')
+        for i, feature in enumerate(features):
+            if i:
+                f.write(',\n')
+            f.write(json.dumps(feature))
+        f.write('\n]}\n')
+
+
+def write_map(roads, nodes, mapdir):
+    """
+    Write osm_elements.geojson (and its map store) and features.geojson
+    """
+    road_coords = to_lon_lat(np.concatenate(
+        [x['coordinates'] for x in roads])).tolist()
+    node_coords = to_lon_lat(
+        np.array([x['coordinates'] for x in nodes])).tolist()
+
+    elements = []
+    records = []
+    for i, road in enumerate(roads):
+        elements.append({
+            'type': 'Feature',
+            'geometry': {'type': 'LineString',
+                         'coordinates': road_coords[i * 3:i * 3 + 3]},
+            'properties': road['properties'],
+        })
+        records.append({
+            'geometry': {'type': 'LineString',
+                         'coordinates': road['coordinates'].tolist()},
+            'properties': road['properties'],
+        })
+    for node, coords in zip(nodes, node_coords):
+        elements.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': coords},
+            'properties': node['properties'],
+        })
+        records.append({
+            'geometry': {'type': 'Point',
+                         'coordinates': list(node['coordinates'])},
+            'properties': node['properties'],
+        })
+
+    elements_file = os.path.join(mapdir, 'osm_elements.geojson')
+    write_features(elements, elements_file)
+    map_store.write_records(records, elements_file)
+
+    features = []
+    for node, coords in zip(nodes, node_coords):
+        if node['properties']['signal']:
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': coords},
+                'properties': {'feature': 'signal'},
+            })
+        else:
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': coords},
+                'properties': {'feature': 'crosswalk'},
+            })
+    write_features(features, os.path.join(mapdir, 'features.geojson'))
+
+
+def points_on_roads(roads, count, rng, jitter=5):
+    """
+    Pick random points along random roads
+    Args:
+        roads
+        count - number of points
+        rng - numpy RandomState
+        jitter - maximum distance the points are moved off the road
+    Returns:
+        an array of road positions, and a (count, 2) array of
+        latitude, longitude
+    """
+    picked = rng.randint(0, len(roads), count)
+    along = rng.uniform(size=count)
+    starts = np.array([roads[i]['coordinates'][0] for i in picked])
+    ends = np.array([roads[i]['coordinates'][-1] for i in picked])
+    if not count:
+        return picked, np.zeros((0, 2))
+    coords = starts + (ends - starts) * along[:, np.newaxis] \
+        + rng.uniform(-jitter, jitter, (count, 2))
+    lon_lat = to_lon_lat(coords)
+    return picked, lon_lat[:, ::-1]
+
+
+def random_dates(count, rng):
+    seconds = int((END_DATE - START_DATE).total_seconds())
+    return [
+        (START_DATE + datetime.timedelta(seconds=int(x))).strftime(
+            '%Y-%m-%dT%H:%M:%S-05:00')
+        for x in rng.randint(0, seconds, count)
+    ]
+
+
+def make_crashes(roads, count, rng):
+    """
+    Crashes in the standardized crash format
+    """
+    _, locations = points_on_roads(roads, count, rng)
+    dates = random_dates(count, rng)
+    categories = rng.choice(['car', 'bike', 'pedestrian'], count,
+                            p=[.8, .1, .1])
+    return [{
+        'id': i,
+        'dateOccurred': date,
+        'location': {'latitude': lat, 'longitude': lon},
+        'vehicles': [{'category': str(category)}],
+        'summary': 'synthetic crash',
+    } for i, ((lat, lon), date, category) in enumerate(
+        zip(locations.tolist(), dates, categories))]
+
+
+def make_points(roads, count, rng):
+    """
+    Point-based features in the standardized point format
+    """
+    _, locations = points_on_roads(roads, count, rng)
+    dates = random_dates(count, rng)
+    return [{
+        'feature': 'concern',
+        'date': date,
+        'category': 'synthetic concern',
+        'location': {'latitude': lat, 'longitude': lon},
+    } for (lat, lon), date in zip(locations.tolist(), dates)]
+
+
+def make_waze(roads, count, rng, snapshots=100):
+    """
+    Waze jams and alerts in the standardized waze format
+    Half the items are jams along a road, half are alerts near one
+    """
+    jams = count // 2
+    jam_roads = rng.randint(0, len(roads), jams)
+    items = []
+    for i in jam_roads:
+        coords = to_lon_lat(roads[i]['coordinates']).tolist()
+        items.append({
+            'type': 'NONE',
+            'line': [{'x': x, 'y': y} for x, y in coords],
+            'street': roads[i]['properties']['name'],
+            'level': int(rng.randint(1, 6)),
+            'speed': int(rng.randint(0, 30)),
+            'delay': int(rng.randint(0, 300)),
+            'eventType': 'jam',
+            'pubTimeStamp': '2018-10-01 00:00:00',
+            'snapshotId': int(rng.randint(1, snapshots + 1)),
+        })
+
+    alert_roads, locations = points_on_roads(roads, count - jams, rng)
+    for i, (lat, lon) in zip(alert_roads, locations.tolist()):
+        items.append({
+            'type': str(rng.choice(ALERT_TYPES)),
+            'street': roads[i]['properties']['name'],
+            'location': {'latitude': lat, 'longitude': lon},
+            'eventType': 'alert',
+            'pubTimeStamp': '2018-10-01 00:00:00',
+            'snapshotId': int(rng.randint(1, snapshots + 1)),
+        })
+    return items
+
+
+def make_volumes(roads, count, rng):
+    """
+    ATR volume counts in the standardized volume format
+    """
+    _, locations = points_on_roads(roads, count, rng, jitter=0)
+    volumes = []
+    for i, (lat, lon) in enumerate(locations.tolist()):
+        hourly = rng.randint(0, 100, 24).tolist()
+        heavy = int(sum(hourly) * .05)
+        volumes.append({
+            'startDateTime': '2016-06-01',
+            'location': {
+                'latitude': lat,
+                'longitude': lon,
+                'address': 'ATR {}'.format(i),
+            },
+            'speed': {'averageSpeed': int(rng.randint(15, 40))},
+            'volume': {
+                'totalVolume': sum(hourly),
+                'totalLightVehicles': sum(hourly) - heavy,
+                'totalHeavyVehicles': heavy,
+                'bikes': 0,
+                'hourlyVolume': hourly,
+            },
+        })
+    return volumes
+
+
+def make_config(name):
+    return {
+        'city': 'Synthetic City, Massachusetts, USA',
+        'name': name,
+        'city_latitude': CENTER_LATITUDE,
+        'city_longitude': CENTER_LONGITUDE,
+        'city_radius': 15,
+        'timezone': 'America/New_York',
+        'startdate': START_DATE.strftime('%Y-%m-%d'),
+        'enddate': END_DATE.strftime('%Y-%m-%d'),
+        'crashes_files': {
+            'synthetic_crashes.csv': {
+                'required': {
+                    'id': 'id',
+                    'latitude': 'latitude',
+                    'longitude': 'longitude',
+                    'date_complete': 'date',
+                },
+                'optional': {'summary': 'summary'},
+            }
+        },
+        'openstreetmap_features': {
+            'categorical': {
+                'width': 'Width',
+                'cycleway_type': 'Bike lane',
+                'oneway': 'One Way',
+                'lanes': 'Number of lanes',
+                'signal': 'Traffic signal',
+                'crosswalk': 'Crosswalk',
+            },
+            'continuous': {
+                'width_per_lane': 'Average width per lane',
+            },
+        },
+        'data_source': [{
+            'name': 'concern',
+            'filename': 'concern.csv',
+            'latitude': 'Y',
+            'longitude': 'X',
+            'date': 'date',
+        }],
+    }
+
+
+def make_city(datadir, segments, seed=0, name='synthetic',
+              crashes_per_segment=2, points_per_segment=.5,
+              waze_per_segment=2, volumes_per_segment=.01):
+    """
+    Generate a synthetic city
+    Args:
+        datadir - the city's data directory to write to
+        segments - the approximate number of road segments
+        seed - random seed, the same seed and size give the same city
+        name - the city's name in its config file
+        crashes_per_segment, points_per_segment, waze_per_segment,
+            volumes_per_segment - how many of each record to make,
+            relative to the number of road segments
+    Returns:
+        dict with the config file's path and the number of each
+        thing generated
+    """
+    rng = np.random.RandomState(seed)
+    mapdir = os.path.join(datadir, 'processed', 'maps')
+    standardized = os.path.join(datadir, 'standardized')
+    for directory in (mapdir, standardized):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    roads, nodes = make_roads(grid_size(segments), rng)
+    print("Generated {} roads and {} intersections".format(
+        len(roads), len(nodes)))
+    write_map(roads, nodes, mapdir)
+
+    counts = {'roads': len(roads), 'intersections': len(nodes)}
+    for kind, func, per_segment in (
+            ('crashes', make_crashes, crashes_per_segment),
+            ('points', make_points, points_per_segment),
+            ('waze', make_waze, waze_per_segment),
+            ('volume', make_volumes, volumes_per_segment)):
+        records = func(roads, int(round(len(roads) * per_segment)), rng)
+        with open(os.path.join(standardized, kind + '.json'), 'w') as f:
+            json.dump(records, f)
+        counts[kind] = len(records)
+
+    config_file = os.path.join(datadir, 'config.yml')
+    with open(config_file, 'w') as f:
+        yaml.safe_dump(make_config(name), f, default_flow_style=False)
+
+    print("Wrote synthetic city to {}".format(datadir))
+    counts['config'] = config_file
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--datadir", type=str, required=True,
+                        help="Directory to write the city to")
+    parser.add_argument("-s", "--segments", type=int, default=1000,
+                        help="Approximate number of road segments")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed")
+    parser.add_argument("-n", "--name", type=str, default='synthetic',
+                        help="City name for the config file")
+
+    args = parser.parse_args(argv)
+    make_city(args.datadir, args.segments, seed=args.seed, name=args.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import json
+import os
+import yaml
+from .. import synthetic_city, benchmark
+from data import util
+
+
+def test_make_city(tmpdir):
+    datadir = str(tmpdir)
+    counts = synthetic_city.make_city(datadir, 40, seed=1)
+    # A 5x5 grid
+    assert counts['roads'] == 40
+    assert counts['intersections'] == 25
+    assert counts['crashes'] == 80
+
+    roads, inters = util.get_roads_and_inters(os.path.join(
+        datadir, 'processed', 'maps', 'osm_elements.geojson'))
+    assert len(roads) == 40
+    assert len(inters) == 25
+
+    with open(os.path.join(datadir, 'standardized', 'crashes.json')) as f:
+        crashes = json.load(f)
+    assert len(crashes) == 80
+    assert set(crashes[0].keys()) >= {'id', 'dateOccurred', 'location'}
+
+    with open(counts['config']) as f:
+        config = yaml.safe_load(f)
+    assert config['name'] == 'synthetic'
+
+    # The same seed gives the same city
+    other = os.path.join(datadir, 'other')
+    synthetic_city.make_city(other, 40, seed=1)
+    with open(os.path.join(other, 'standardized', 'crashes.json')) as f:
+        assert json.load(f) == crashes
+
+
+def test_compare():
+    old = [
+        {'size': 10, 'stage': 'a', 'failed': False, 'wall_time': 2},
+        {'size': 10, 'stage': 'b', 'failed': True},
+        {'size': 10, 'stage': 'a', 'failed': False, 'wall_time': 4},
+    ]
+    new = [
+        {'size': 10, 'stage': 'a', 'failed': False, 'wall_time': 3},
+        {'size': 10, 'stage': 'b', 'failed': False, 'wall_time': 1},
+        {'size': 20, 'stage': 'a', 'failed': False, 'wall_time': 1},
+    ]
+    rows = benchmark.compare(old, new)
+    assert [(x[0], x[1], x[2]['wall_time'], x[3]['wall_time'])
+            for x in rows] == [(10, 'a', 4, 3)]